@@ -0,0 +1,641 @@
+"""
+This module holds the storage backends behind the Database.
+A backend hands the Database its tables, key indexes, secondary
+indexes and key sequences so the models never depend on where data lives
+"""
+import json
+import sqlite3
+import struct
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from app.columnar import ColumnarTable
+from app.indexes import OrderedIndex, ChildIndex, HASH
+from app.sequences import KeySequences
+from app.utilities import check_type
+
+
+_SORT_INT = struct.Struct('>Q')
+
+
+def encode_value(value):
+    """
+    Returns the text form of an indexed value, which is either a
+    string, an int or a tuple such as (owner key, name)
+    """
+    return json.dumps(value, separators=(',', ':'))
+
+
+def decode_value(text):
+    """Returns the indexed value encoded by encode_value"""
+    value = json.loads(text)
+    return tuple(value) if isinstance(value, list) else value
+
+
+def sort_key(value):
+    """
+    Returns bytes that compare like value does, so SQLite can order
+    and range over indexed values. Ints sort before strings and a
+    tuple sorts right before the longer tuples it starts
+    """
+    parts = []
+    for part in (value if isinstance(value, tuple) else (value,)):
+        if isinstance(part, int):
+            parts.append(b'\x01' + _SORT_INT.pack(part + (1 << 63)))
+        elif isinstance(part, str):
+            # escape zero bytes so the terminator sorts below any character
+            parts.append(b'\x02' + part.encode('utf-8').replace(b'\x00', b'\x00\xff')
+                         + b'\x00\x00')
+        else:
+            raise TypeError('Only ints and strings can be indexed')
+    return b''.join(parts)
+
+
+class StorageBackend:
+    """
+    The interface every backend implements.
+    table(name, model) returns a dict-like of key to model object,
+    key_index(name) an OrderedIndex-like set of keys,
+    secondary_index(name, declaration) a HashIndex-like or
+    SortedIndex-like index of the Indexed declaration and
+    key_sequences(*models) a KeySequences-like allocator
+    """
+    # whether every process sees the same data
+    shared = False
+
+    def table(self, name, model):
+        raise NotImplementedError
+
+    def key_index(self, name):
+        raise NotImplementedError
+
+    def secondary_index(self, name, declaration):
+        raise NotImplementedError
+
+    def key_sequences(self, *models):
+        raise NotImplementedError
+
+    @contextmanager
+    def atomic(self):
+        """
+        Groups the writes made in a with block so they are stored
+        together or not at all where the backend can do so
+        """
+        yield
+
+    def close(self):
+        """Releases any resources held by the backend"""
+        pass
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Keeps everything in plain dicts in the memory of this process.
+    With columnar set, models declaring a text_field such as recipe
+    steps are kept in a ColumnarTable instead, which takes a fraction
+    of the memory but builds a new object on every access
+    """
+    def __init__(self, columnar=False):
+        if check_type(columnar, bool):
+            self.columnar = columnar
+
+    def table(self, name, model):
+        if self.columnar and getattr(model, 'text_field', None):
+            return ColumnarTable(model)
+        return {}
+
+    def key_index(self, name):
+        return OrderedIndex()
+
+    def secondary_index(self, name, declaration):
+        return declaration.new_index()
+
+    def key_sequences(self, *models):
+        return KeySequences(*models)
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Keeps everything in an embedded SQLite file so several worker
+    processes can share it. Objects are stored as JSON records and
+    child keys live in their own table so that they are updated in
+    place instead of rewriting the parent
+    """
+    shared = True
+
+    def __init__(self, path):
+        if check_type(path, str):
+            self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA busy_timeout=5000')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS children (
+                parent_table TEXT NOT NULL,
+                parent_key INTEGER NOT NULL,
+                child_key INTEGER NOT NULL,
+                rank REAL NOT NULL,
+                PRIMARY KEY (parent_table, parent_key, child_key));
+            CREATE INDEX IF NOT EXISTS children_by_rank
+                ON children (parent_table, parent_key, rank);
+            CREATE TABLE IF NOT EXISTS key_indexes (
+                name TEXT NOT NULL,
+                key INTEGER NOT NULL,
+                PRIMARY KEY (name, key));
+            CREATE TABLE IF NOT EXISTS secondary_indexes (
+                name TEXT NOT NULL,
+                sort_key BLOB NOT NULL,
+                key INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (name, sort_key, key));
+            CREATE INDEX IF NOT EXISTS secondary_indexes_by_key
+                ON secondary_indexes (name, key);
+            CREATE TABLE IF NOT EXISTS sequences (
+                name TEXT PRIMARY KEY,
+                last_key INTEGER NOT NULL);
+        ''')
+
+    def execute(self, sql, parameters=()):
+        """Runs one statement and returns all the rows it produced"""
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def table(self, name, model):
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS "objects_%s" ('
+            'key INTEGER PRIMARY KEY, record TEXT NOT NULL)' % name)
+        return SQLiteTable(self, name, model)
+
+    def key_index(self, name):
+        return SQLiteKeyIndex(self, name)
+
+    def secondary_index(self, name, declaration):
+        return SQLiteSecondaryIndex(self, name, declaration.unique,
+                                    declaration.kind)
+
+    def key_sequences(self, *models):
+        return SQLiteKeySequences(self, *models)
+
+    @contextmanager
+    def atomic(self):
+        """Runs the writes of a with block in one SQLite transaction"""
+        with self.lock:
+            if self.connection.in_transaction:
+                yield
+                return
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class SQLiteTable(MutableMapping):
+    """A table of model objects stored as JSON records"""
+    def __init__(self, backend, name, model):
+        self.backend = backend
+        self.name = name
+        self.model = model
+        self.children_attribute = getattr(model, 'children_attribute', None)
+        self._sql_name = '"objects_%s"' % name
+
+    def _attach_children(self, obj):
+        """Points obj's child index at the children table"""
+        children = getattr(obj, self.children_attribute)
+        if not isinstance(children, SQLiteChildIndex):
+            live_children = SQLiteChildIndex(self.backend, self.name, obj.key)
+            for child_key in children:
+                live_children.add(child_key)
+            setattr(obj, self.children_attribute, live_children)
+
+    def __getitem__(self, key):
+        rows = self.backend.execute(
+            'SELECT record FROM %s WHERE key = ?' % self._sql_name, (key,))
+        if not rows:
+            raise KeyError(key)
+        obj = self.model(**json.loads(rows[0][0]))
+        if self.children_attribute:
+            self._attach_children(obj)
+        return obj
+
+    def __setitem__(self, key, obj):
+        self.backend.execute(
+            'INSERT OR REPLACE INTO %s (key, record) VALUES (?, ?)'
+            % self._sql_name, (key, json.dumps(obj.to_record())))
+        if self.children_attribute:
+            self._attach_children(obj)
+
+    def __delitem__(self, key):
+        with self.backend.lock:
+            cursor = self.backend.connection.execute(
+                'DELETE FROM %s WHERE key = ?' % self._sql_name, (key,))
+            if cursor.rowcount == 0:
+                raise KeyError(key)
+            self.backend.connection.execute(
+                'DELETE FROM children WHERE parent_table = ? AND parent_key = ?',
+                (self.name, key))
+
+    def __contains__(self, key):
+        return bool(self.backend.execute(
+            'SELECT 1 FROM %s WHERE key = ?' % self._sql_name, (key,)))
+
+    def __iter__(self):
+        for row in self.backend.execute(
+                'SELECT key FROM %s ORDER BY key' % self._sql_name):
+            yield row[0]
+
+    def __len__(self):
+        return self.backend.execute(
+            'SELECT COUNT(*) FROM %s' % self._sql_name)[0][0]
+
+
+class SQLiteChildIndex:
+    """
+    The ordered child keys of one parent, kept in the children table.
+    Positions are kept with fractional ranks so an insert or a move
+    only rewrites one row
+    """
+    def __init__(self, backend, parent_table, parent_key):
+        self.backend = backend
+        self._parent = (parent_table, parent_key)
+
+    def _keys(self):
+        return [row[0] for row in self.backend.execute(
+            'SELECT child_key FROM children WHERE parent_table = ? '
+            'AND parent_key = ? ORDER BY rank', self._parent)]
+
+    def _rank_at(self, position):
+        """Returns a rank that sorts right before the child at position"""
+        rows = self.backend.execute(
+            'SELECT rank FROM children WHERE parent_table = ? AND parent_key = ? '
+            'ORDER BY rank LIMIT 2 OFFSET ?',
+            self._parent + (max(position - 1, 0),))
+        if position <= 0:
+            return rows[0][0] - 1.0 if rows else 0.0
+        if len(rows) == 0:
+            return self._last_rank() + 1.0
+        if len(rows) == 1:
+            return rows[0][0] + 1.0
+        rank = (rows[0][0] + rows[1][0]) / 2
+        if not rows[0][0] < rank < rows[1][0]:
+            # the gap is used up; spread the ranks out and try again
+            self._renumber()
+            return self._rank_at(position)
+        return rank
+
+    def _renumber(self):
+        """Rewrites the ranks as 1, 2, 3... keeping the order"""
+        for rank, key in enumerate(self._keys(), 1):
+            self.backend.execute(
+                'UPDATE children SET rank = ? WHERE parent_table = ? '
+                'AND parent_key = ? AND child_key = ?',
+                (float(rank),) + self._parent + (key,))
+
+    def _last_rank(self):
+        rows = self.backend.execute(
+            'SELECT MAX(rank) FROM children WHERE parent_table = ? '
+            'AND parent_key = ?', self._parent)
+        return rows[0][0] if rows[0][0] is not None else 0.0
+
+    def add(self, key):
+        """Appends key at the end. Adding an existing key does nothing"""
+        with self.backend.lock:
+            if key not in self:
+                self.backend.execute(
+                    'INSERT INTO children VALUES (?, ?, ?, ?)',
+                    self._parent + (key, self._last_rank() + 1.0))
+
+    def extend(self, keys):
+        """Appends keys at the end with one statement"""
+        with self.backend.lock:
+            existing = set(self._keys())
+            rank = self._last_rank()
+            rows = []
+            for key in keys:
+                if key not in existing:
+                    existing.add(key)
+                    rank += 1.0
+                    rows.append(self._parent + (key, rank))
+            self.backend.connection.executemany(
+                'INSERT INTO children VALUES (?, ?, ?, ?)', rows)
+
+    def insert(self, position, key):
+        """Inserts key so that it ends up at position"""
+        with self.backend.lock:
+            if key in self:
+                raise ValueError('%s is already in the index' % str(key))
+            if position < 0:
+                position = max(len(self) + position, 0)
+            self.backend.execute('INSERT INTO children VALUES (?, ?, ?, ?)',
+                                 self._parent + (key, self._rank_at(position)))
+
+    def index(self, key):
+        """Returns the position of key or raises KeyError"""
+        if key not in self:
+            raise KeyError('%s is not in the index' % str(key))
+        return self.backend.execute(
+            'SELECT COUNT(*) FROM children WHERE parent_table = ? '
+            'AND parent_key = ? AND rank < (SELECT rank FROM children WHERE '
+            'parent_table = ? AND parent_key = ? AND child_key = ?)',
+            self._parent + self._parent + (key,))[0][0]
+
+    def remove(self, key):
+        """Removes key from the index or raises KeyError"""
+        with self.backend.lock:
+            cursor = self.backend.connection.execute(
+                'DELETE FROM children WHERE parent_table = ? AND parent_key = ? '
+                'AND child_key = ?', self._parent + (key,))
+            if cursor.rowcount == 0:
+                raise KeyError('%s is not in the index' % str(key))
+
+    def discard(self, key):
+        """Removes key from the index if it is there"""
+        self.backend.execute(
+            'DELETE FROM children WHERE parent_table = ? AND parent_key = ? '
+            'AND child_key = ?', self._parent + (key,))
+
+    def move(self, key, position):
+        """Moves an existing key to position"""
+        with self.backend.lock:
+            self.remove(key)
+            self.insert(position, key)
+
+    def clear(self):
+        """Removes all keys"""
+        self.backend.execute(
+            'DELETE FROM children WHERE parent_table = ? AND parent_key = ?',
+            self._parent)
+
+    def __getitem__(self, position):
+        length = len(self)
+        if position < 0:
+            position += length
+        if not 0 <= position < length:
+            raise IndexError('index out of range')
+        return self.backend.execute(
+            'SELECT child_key FROM children WHERE parent_table = ? '
+            'AND parent_key = ? ORDER BY rank LIMIT 1 OFFSET ?',
+            self._parent + (position,))[0][0]
+
+    def __contains__(self, key):
+        return bool(self.backend.execute(
+            'SELECT 1 FROM children WHERE parent_table = ? AND parent_key = ? '
+            'AND child_key = ?', self._parent + (key,)))
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return self.backend.execute(
+            'SELECT COUNT(*) FROM children WHERE parent_table = ? '
+            'AND parent_key = ?', self._parent)[0][0]
+
+    def __eq__(self, other):
+        if isinstance(other, (SQLiteChildIndex, ChildIndex)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self._keys())
+
+
+class SQLiteKeyIndex:
+    """An insertion-ordered set of keys stored in the key_indexes table"""
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def add(self, key):
+        """Adds key to the index. Adding an existing key does nothing"""
+        self.backend.execute('INSERT OR IGNORE INTO key_indexes VALUES (?, ?)',
+                             (self.name, key))
+
+    def remove(self, key):
+        """Removes key from the index or raises KeyError"""
+        with self.backend.lock:
+            cursor = self.backend.connection.execute(
+                'DELETE FROM key_indexes WHERE name = ? AND key = ?',
+                (self.name, key))
+            if cursor.rowcount == 0:
+                raise KeyError('%s is not in the index' % str(key))
+
+    def discard(self, key):
+        """Removes key from the index if it is there"""
+        self.backend.execute('DELETE FROM key_indexes WHERE name = ? AND key = ?',
+                             (self.name, key))
+
+    def clear(self):
+        """Removes all keys"""
+        self.backend.execute('DELETE FROM key_indexes WHERE name = ?',
+                             (self.name,))
+
+    def __contains__(self, key):
+        return bool(self.backend.execute(
+            'SELECT 1 FROM key_indexes WHERE name = ? AND key = ?',
+            (self.name, key)))
+
+    def __iter__(self):
+        return iter([row[0] for row in self.backend.execute(
+            'SELECT key FROM key_indexes WHERE name = ? ORDER BY rowid',
+            (self.name,))])
+
+    def __len__(self):
+        return self.backend.execute(
+            'SELECT COUNT(*) FROM key_indexes WHERE name = ?', (self.name,))[0][0]
+
+
+class SQLiteSecondaryIndex:
+    """
+    A secondary index stored in the secondary_indexes table.
+    Rows are ordered by the sort_key of their value so exact lookups
+    and range queries both use the primary key. A unique index gets a
+    partial UNIQUE index of its own, so SQLite refuses a duplicate
+    written by any process
+    """
+    def __init__(self, backend, name, unique=False, kind=HASH):
+        self.backend = backend
+        self.name = name
+        self.unique = unique
+        self.kind = kind
+        if unique:
+            backend.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS "unique_%s" ON secondary_indexes '
+                "(sort_key) WHERE name = '%s'" % (name, name.replace("'", "''")))
+
+    def allows(self, value, key):
+        """
+        Returns True. Another process may take value between a check
+        and the write, so add() relies on the UNIQUE index instead
+        """
+        return True
+
+    def add(self, value, key):
+        """
+        Indexes key under value, removing it from its old value.
+        Raises ValueError, leaving the old value, if the index is
+        unique and holds value for another key
+        """
+        with self.backend.atomic():
+            rows = self.backend.execute(
+                'SELECT value FROM secondary_indexes WHERE name = ? AND key = ?',
+                (self.name, key))
+            if rows and decode_value(rows[0][0]) == value:
+                return
+            self.discard(key)
+            try:
+                self.backend.execute(
+                    'INSERT INTO secondary_indexes VALUES (?, ?, ?, ?)',
+                    (self.name, sort_key(value), key, encode_value(value)))
+            except sqlite3.IntegrityError:
+                raise ValueError('%s already holds %r' % (self.name, value))
+
+    def discard(self, key):
+        """Removes key from the index if it is there"""
+        self.backend.execute(
+            'DELETE FROM secondary_indexes WHERE name = ? AND key = ?',
+            (self.name, key))
+
+    def discard_many(self, keys):
+        """Removes each of keys from the index if it is there"""
+        with self.backend.lock:
+            self.backend.connection.executemany(
+                'DELETE FROM secondary_indexes WHERE name = ? AND key = ?',
+                ((self.name, key) for key in keys))
+
+    def value_of(self, key, default=None):
+        """Returns the value key is indexed under or default"""
+        rows = self.backend.execute(
+            'SELECT value FROM secondary_indexes WHERE name = ? AND key = ?',
+            (self.name, key))
+        return decode_value(rows[0][0]) if rows else default
+
+    def keys(self, value):
+        """Returns the keys indexed under value in key order"""
+        return [row[0] for row in self.backend.execute(
+            'SELECT key FROM secondary_indexes WHERE name = ? AND sort_key = ? '
+            'ORDER BY key', (self.name, sort_key(value)))]
+
+    def first(self, value):
+        """Returns the smallest key indexed under value or None"""
+        rows = self.backend.execute(
+            'SELECT key FROM secondary_indexes WHERE name = ? AND sort_key = ? '
+            'ORDER BY key LIMIT 1', (self.name, sort_key(value)))
+        return rows[0][0] if rows else None
+
+    def range(self, low=None, high=None, limit=None):
+        """
+        Returns the keys whose values are at least low and below high,
+        in value order. A missing bound leaves that end open and limit
+        caps the number of keys
+        """
+        return [key for _, key in self.range_items(low, high, limit)]
+
+    def range_items(self, low=None, high=None, limit=None):
+        """Returns the (value, key) pairs of range(low, high, limit)"""
+        sql = 'SELECT value, key FROM secondary_indexes WHERE name = ?'
+        parameters = [self.name]
+        if low is not None:
+            sql += ' AND sort_key >= ?'
+            parameters.append(sort_key(low))
+        if high is not None:
+            sql += ' AND sort_key < ?'
+            parameters.append(sort_key(high))
+        sql += ' ORDER BY sort_key, key'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        return [(decode_value(value), key)
+                for value, key in self.backend.execute(sql, parameters)]
+
+    def items(self):
+        """Yields (value, key) pairs in value order"""
+        for value, key in self.backend.execute(
+                'SELECT value, key FROM secondary_indexes WHERE name = ? '
+                'ORDER BY sort_key, key', (self.name,)):
+            yield decode_value(value), key
+
+    def clear(self):
+        """Removes all entries"""
+        self.backend.execute('DELETE FROM secondary_indexes WHERE name = ?',
+                             (self.name,))
+
+    def __len__(self):
+        return self.backend.execute(
+            'SELECT COUNT(*) FROM secondary_indexes WHERE name = ?',
+            (self.name,))[0][0]
+
+
+class SQLiteKeySequences:
+    """
+    Key sequences kept in the sequences table. Allocation runs in an
+    immediate transaction so two processes never get the same key
+    """
+    def __init__(self, backend, *models):
+        self.backend = backend
+        self._names = {}
+        for model in models:
+            self.register(model)
+
+    def register(self, model, last_key=0):
+        """Adds a new sequence for model"""
+        if check_type(model, type):
+            self._names[model] = model.__name__
+            self.backend.execute(
+                'INSERT OR IGNORE INTO sequences VALUES (?, ?)',
+                (model.__name__, last_key))
+
+    def _name(self, model):
+        if check_type(model, type):
+            try:
+                return self._names[model]
+            except KeyError:
+                raise KeyError('No key sequence for %s' % str(model))
+
+    def next_key(self, model):
+        """Allocates the next key for model"""
+        name = self._name(model)
+        with self.backend.atomic():
+            connection = self.backend.connection
+            connection.execute('UPDATE sequences SET last_key = last_key + 1 '
+                               'WHERE name = ?', (name,))
+            return connection.execute('SELECT last_key FROM sequences '
+                                      'WHERE name = ?', (name,)).fetchone()[0]
+
+    def next_keys(self, model, count):
+        """Allocates a block of count keys for model"""
+        if check_type(count, int) and count < 0:
+            raise ValueError('count should not be negative')
+        name = self._name(model)
+        with self.backend.atomic():
+            connection = self.backend.connection
+            connection.execute('UPDATE sequences SET last_key = last_key + ? '
+                               'WHERE name = ?', (count, name))
+            last_key = connection.execute('SELECT last_key FROM sequences '
+                                          'WHERE name = ?', (name,)).fetchone()[0]
+        return range(last_key - count + 1, last_key + 1)
+
+    def observe(self, model, key):
+        """Records that key is in use by an object of model"""
+        if check_type(key, int):
+            self.backend.execute('UPDATE sequences SET last_key = MAX(last_key, ?) '
+                                 'WHERE name = ?', (key, self._name(model)))
+
+    def state(self):
+        """Returns a dict of type name to last key"""
+        return dict(self.backend.execute('SELECT name, last_key FROM sequences'))
+
+    def restore(self, state):
+        """Restores the counters from a dict returned by state()"""
+        if check_type(state, dict):
+            for name in self._names.values():
+                self.backend.execute('UPDATE sequences SET last_key = ? '
+                                     'WHERE name = ?', (state.get(name, 0), name))
@@ -0,0 +1,164 @@
+"""
+This module takes snapshots of the Database in a forked child process
+so that the process serving requests is never blocked by serialization
+"""
+import os
+import threading
+import time
+from app.utilities import check_type
+from app.indexes import LazyIndex
+from app.wal import WriteAheadLog
+
+IDLE = 'idle'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class BackgroundSaver:
+    """
+    Forks the process and writes a snapshot of database from the child.
+    The child sees a copy-on-write image of the memory at the time of
+    the fork, while the parent keeps serving. A lock another thread
+    held at the fork would stay locked in the child for good, so the
+    fork happens with the exclusive lock and every lock in
+    _child_locks() held. The child takes no other lock.
+    When log is given, the records that made it into the snapshot
+    are dropped from it once the child succeeds. The evicted trees the
+    child reads from the tiered store's file are held there until then
+    """
+    def __init__(self, database, path, log=None):
+        if check_type(path, str):
+            self.database = database
+            self.path = path
+            self.log = log
+        self.state = IDLE
+        self.pid = None
+        self.started_at = None
+        self.finished_at = None
+        self.last_duration = None
+        self.last_success_at = None
+        self.saves = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._waiter = None
+
+    def start(self):
+        """Starts a background save or raises ValueError if one is running"""
+        with self._lock:
+            if self.state == RUNNING:
+                raise ValueError('A background save is already running')
+            # no writes between reading the log offset and the fork
+            with self.database.lock.write():
+                log_offset = self.log.position() if self.log else None
+                started_at = time.time()
+                tiers = self.database.tiers
+                if tiers is not None:
+                    # the child reads evicted trees from the live file
+                    tiers.hold()
+                locks = self._child_locks()
+                for lock in locks:
+                    lock.acquire()
+                try:
+                    pid = os.fork()
+                except OSError:
+                    if tiers is not None:
+                        tiers.release()
+                    raise
+                finally:
+                    # in the parent and in the child's copy of them
+                    for lock in reversed(locks):
+                        lock.release()
+                if pid == 0:
+                    self._run_child()
+            self.pid = pid
+            self.state = RUNNING
+            self.started_at = started_at
+            self.finished_at = None
+            self._waiter = threading.Thread(target=self._wait_for_child,
+                                            args=(pid, log_offset, tiers),
+                                            name='bgsave-waiter', daemon=True)
+            self._waiter.start()
+
+    def _child_locks(self):
+        """
+        Returns the locks the child may take as it compacts and writes
+        the snapshot, in the order they are acquired. They are the locks
+        of the write-ahead logs and the tiered store, and those of the
+        indexes built on first use. Last is the lock inside the database
+        lock, which snapshot() takes as a reader. With the exclusive lock
+        held no reader is building an index, so those locks are free
+        """
+        database = self.database
+        logs = [listener for listener in database.listeners
+                if isinstance(listener, WriteAheadLog)]
+        if self.log is not None and self.log not in logs:
+            logs.append(self.log)
+        locks = [log._lock for log in logs]
+        if database.tiers is not None:
+            locks.append(database.tiers._lock)
+        for index in (database.search_index, database.fuzzy_index,
+                      database.user_counts):
+            if index is not None:
+                locks.append(index._build_lock)
+        locks.extend(index._lock for model_indexes in database.indexes.values()
+                     for index in model_indexes.values() if isinstance(index, LazyIndex))
+        locks.append(database.lock._condition)
+        return locks
+
+    def _run_child(self):
+        """Writes the snapshot in the child process then exits"""
+        status = 1
+        try:
+            # the child has its own copy, so it can finish any deferred
+            # deletes without holding up the parent
+            self.database.compact()
+            self.database.snapshot(self.path)
+            status = 0
+        finally:
+            # skip atexit handlers and buffers inherited from the parent
+            os._exit(status)
+
+    def _wait_for_child(self, pid, log_offset, tiers):
+        """Reaps the child and records how it went"""
+        _, exit_status = os.waitpid(pid, 0)
+        if tiers is not None:
+            tiers.release()
+        succeeded = os.WIFEXITED(exit_status) and os.WEXITSTATUS(exit_status) == 0
+        if succeeded and self.log is not None:
+            self.log.discard_before(log_offset)
+        with self._lock:
+            self.finished_at = time.time()
+            self.last_duration = self.finished_at - self.started_at
+            if succeeded:
+                self.state = SUCCEEDED
+                self.saves += 1
+                self.last_success_at = self.finished_at
+            else:
+                self.state = FAILED
+                self.failures += 1
+            self.pid = None
+
+    def wait(self, timeout=None):
+        """Blocks until the running save, if any, has finished"""
+        waiter = self._waiter
+        if waiter is not None:
+            waiter.join(timeout)
+
+    def status(self):
+        """Returns a dict describing the current and last save"""
+        with self._lock:
+            status = {
+                'state': self.state,
+                'pid': self.pid,
+                'path': self.path,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'last_duration': self.last_duration,
+                'last_success_at': self.last_success_at,
+                'saves': self.saves,
+                'failures': self.failures,
+            }
+        if self.state == RUNNING:
+            status['running_for'] = time.time() - self.started_at
+        return status
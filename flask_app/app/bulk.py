@@ -0,0 +1,226 @@
+"""
+This module imports recipes in bulk from CSV, NDJSON or JSON.
+Every row names a user by email, a category and optionally a recipe
+and one of its steps, e.g. as CSV:
+    email,first_name,last_name,password,category,recipe,step
+    jo@example.com,Jo,Doe,secret,cakes,Banana cake,Mash the bananas
+Rows are streamed through generators, validated a batch at a time,
+given keys allocated in blocks and saved with Database.insert_many.
+Users, categories and recipes that already exist are reused
+"""
+import csv
+import json
+import time
+from itertools import islice
+from app.models import User, RecipeCategory, Recipe, RecipeStep
+
+FORMATS = ('csv', 'ndjson', 'json')
+COLUMNS = ('email', 'first_name', 'last_name', 'password', 'category',
+           'category_description', 'recipe', 'recipe_description', 'step')
+BATCH_SIZE = 10000
+
+
+def guess_format(path):
+    """Returns the format of a file from its extension"""
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension in ('ndjson', 'jsonl'):
+        return 'ndjson'
+    if extension in ('csv', 'json'):
+        return extension
+    raise ValueError('Cannot tell the format of %s; use one of %s'
+                     % (path, ', '.join(FORMATS)))
+
+
+def read_rows(lines, file_format):
+    """
+    Yields the rows held in lines, an iterable of text lines
+    such as an open file. JSON is a single array and has to be
+    read whole; CSV and NDJSON are read one line at a time
+    """
+    if file_format == 'csv':
+        for row in csv.DictReader(lines):
+            yield row
+    elif file_format == 'ndjson':
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    elif file_format == 'json':
+        rows = json.loads(''.join(lines))
+        if not isinstance(rows, list):
+            raise ValueError('A JSON import should be an array of rows')
+        for row in rows:
+            yield row
+    else:
+        raise ValueError('file_format should be one of %s' % ', '.join(FORMATS))
+
+
+def batches(rows, size):
+    """Yields lists of up to size rows"""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def clean_row(row, line):
+    """
+    Returns row with every column present and stripped of spaces,
+    or raises ValueError naming the line the row came from
+    """
+    if not isinstance(row, dict):
+        raise ValueError('Row %d should be an object' % line)
+    cleaned = {}
+    for column in COLUMNS:
+        value = row.get(column)
+        if value is None:
+            value = ''
+        if not isinstance(value, str):
+            raise ValueError('Row %d: %s should be a string' % (line, column))
+        cleaned[column] = value if column == 'password' else value.strip()
+    # the email format is checked once, when a new user is built
+    if not cleaned['email']:
+        raise ValueError('Row %d: email is required' % line)
+    if not cleaned['category']:
+        raise ValueError('Row %d: category is required' % line)
+    if cleaned['step'] and not cleaned['recipe']:
+        raise ValueError('Row %d: a step needs a recipe' % line)
+    return cleaned
+
+
+class BulkImporter:
+    """
+    Imports rows into a database one batch at a time. Each batch is
+    saved atomically; if a row is invalid the batches before it stay
+    imported and the error names the row
+    """
+    def __init__(self, database, batch_size=BATCH_SIZE):
+        if batch_size < 1:
+            raise ValueError('batch_size should be at least 1')
+        self.database = database
+        self.batch_size = batch_size
+        self.rows = 0
+        self.created = {model: 0 for model in (User, RecipeCategory,
+                                               Recipe, RecipeStep)}
+        self.seconds = 0.0
+        # the key of every user, category and recipe seen so far by
+        # (email,), (email, category) and (email, category, recipe)
+        self._keys = {}
+
+    def run(self, rows):
+        """Imports rows and returns the report"""
+        started = time.perf_counter()
+        try:
+            first_line = 1
+            for batch in batches(rows, self.batch_size):
+                self._import_batch(batch, first_line)
+                first_line += len(batch)
+        finally:
+            self.seconds += time.perf_counter() - started
+        return self.report()
+
+    def report(self):
+        """Returns what has been imported so far and how fast"""
+        return {
+            'rows': self.rows,
+            'users': self.created[User],
+            'recipe_categories': self.created[RecipeCategory],
+            'recipes': self.created[Recipe],
+            'recipe_steps': self.created[RecipeStep],
+            'seconds': round(self.seconds, 3),
+            'rows_per_second': round(self.rows / self.seconds) if self.seconds else 0,
+        }
+
+    def _find_user(self, email):
+        """
+        Returns the key of the existing user with email or None.
+        The keys of the user's categories and recipes are remembered
+        so they are looked up once instead of once per row
+        """
+        database = self.database
+        user = database.get_user_by_email(email)
+        if user is None:
+            return None
+        for category in user.get_all_recipe_categories(database):
+            self._keys.setdefault((email, category.name), category.key)
+            for recipe in category.get_all_recipes(database):
+                self._keys.setdefault((email, category.name, recipe.name),
+                                      recipe.key)
+        return user.key
+
+    def _import_batch(self, batch, first_line):
+        """Validates batch, allocates its keys and saves it"""
+        rows = [clean_row(row, line) for line, row in enumerate(batch, first_line)]
+        # the rows that introduce each new object in order, by model
+        new_rows = {model: [] for model in self.created}
+        planned = set()
+        for line, row in enumerate(rows, first_line):
+            user = (row['email'],)
+            category = user + (row['category'],)
+            recipe = category + (row['recipe'],) if row['recipe'] else None
+            for model, identity in ((User, user), (RecipeCategory, category),
+                                    (Recipe, recipe)):
+                if identity is None or identity in planned \
+                or identity in self._keys:
+                    continue
+                key = self._find_user(identity[0]) if model is User else None
+                if key is None:
+                    new_rows[model].append((line, identity, row))
+                    planned.add(identity)
+                else:
+                    self._keys[identity] = key
+            if row['step']:
+                new_rows[RecipeStep].append((line, recipe, row))
+
+        # allocate every key the batch needs at once
+        keys = {model: iter(self.database.get_next_keys(model, len(new_rows[model])))
+                for model in new_rows}
+        batch_keys = {}
+
+        def key_of(identity):
+            return batch_keys.get(identity) or self._keys[identity]
+
+        objects = []
+        for model, pending in new_rows.items():
+            for line, identity, row in pending:
+                key = next(keys[model])
+                try:
+                    objects.append(self._build(model, key, identity, row, key_of))
+                except (TypeError, ValueError) as error:
+                    raise ValueError('Row %d: %s' % (line, error))
+                if model is not RecipeStep:
+                    batch_keys[identity] = key
+        self.database.insert_many(objects)
+        self._keys.update(batch_keys)
+        for model, pending in new_rows.items():
+            self.created[model] += len(pending)
+        self.rows += len(rows)
+
+    @staticmethod
+    def _build(model, key, identity, row, key_of):
+        """Builds the new object introduced by row"""
+        if model is User:
+            if not (row['first_name'] and row['last_name'] and row['password']):
+                raise ValueError('first_name, last_name and password are '
+                                 'required for a new user')
+            return User(key=key, first_name=row['first_name'],
+                        last_name=row['last_name'], email=row['email'],
+                        password=row['password'])
+        if model is RecipeCategory:
+            return RecipeCategory(key=key, name=row['category'],
+                                  user=key_of(identity[:1]),
+                                  description=row['category_description'])
+        if model is Recipe:
+            return Recipe(key=key, name=row['recipe'],
+                          description=row['recipe_description'],
+                          category=key_of(identity[:2]))
+        return RecipeStep(key=key, text_content=row['step'],
+                          recipe=key_of(identity))
+
+
+def import_file(database, path, file_format=None, batch_size=BATCH_SIZE):
+    """Imports the rows of the file at path and returns the report"""
+    file_format = file_format or guess_format(path)
+    with open(path, newline='', encoding='utf-8') as source:
+        return BulkImporter(database, batch_size).run(read_rows(source, file_format))
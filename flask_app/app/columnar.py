@@ -0,0 +1,185 @@
+"""
+This module holds the columnar table, a compact way to keep a large
+table of small objects such as recipe steps in memory. Instead of
+one Python object per row, the integer fields are kept in parallel
+arrays and the text field in one UTF-8 buffer with offsets
+"""
+from array import array
+from bisect import bisect_left
+from collections.abc import MutableMapping, ItemsView, ValuesView
+
+
+class ColumnarTable(MutableMapping):
+    """
+    A dict-like table of key to model object for a model declaring
+    int_fields, whose first is key, and one text_field. Rows are kept
+    in key order, so lookups are a binary search and scans read the
+    arrays front to back. Objects are built afresh on every access,
+    as with SQLiteTable, so a changed object has to be saved again.
+    Deleted rows and replaced text are left in place until they make
+    up half of the table, then squeezed out in one pass
+    """
+    def __init__(self, model):
+        if getattr(model, 'children_attribute', None):
+            raise ValueError('%s has children and cannot be stored in columns'
+                             % model.__name__)
+        self.model = model
+        self.int_fields = model.int_fields
+        self.text_field = model.text_field
+        self._clear_columns()
+
+    def _clear_columns(self):
+        # one array per int field, the keys first, all in key order
+        self._columns = [array('q') for _ in self.int_fields]
+        self._keys = self._columns[0]
+        # where the UTF-8 text of each row starts in _text and its length
+        self._starts = array('q')
+        self._lengths = array('q')
+        self._text = bytearray()
+        # 1 for rows holding an object, 0 for deleted rows
+        self._alive = bytearray()
+        self._count = 0
+        # bytes of _text no row points at any more
+        self._garbage = 0
+
+    def _row(self, key):
+        """Returns the row key is stored in, alive or not, or -1"""
+        keys = self._keys
+        row = bisect_left(keys, key)
+        if row < len(keys) and keys[row] == key:
+            return row
+        return -1
+
+    def _build(self, row):
+        """Returns a new model object holding the fields of row"""
+        obj = self.model.__new__(self.model)
+        for field, column in zip(self.int_fields, self._columns):
+            setattr(obj, field, column[row])
+        start = self._starts[row]
+        setattr(obj, self.text_field,
+                self._text[start:start + self._lengths[row]].decode('utf-8'))
+        return obj
+
+    def __getitem__(self, key):
+        row = self._row(key)
+        if row < 0 or not self._alive[row]:
+            raise KeyError(key)
+        return self._build(row)
+
+    def __setitem__(self, key, obj):
+        encoded = getattr(obj, self.text_field).encode('utf-8')
+        values = [getattr(obj, field) for field in self.int_fields]
+        values[0] = key
+        row = self._row(key)
+        if row < 0:
+            keys = self._keys
+            row = len(keys)
+            if keys and key < keys[-1]:
+                # keys are handed out in order, so this is the rare case
+                row = bisect_left(keys, key)
+            for column, value in zip(self._columns, values):
+                column.insert(row, value)
+            self._starts.insert(row, len(self._text))
+            self._lengths.insert(row, len(encoded))
+            self._alive.insert(row, 1)
+            self._text.extend(encoded)
+            self._count += 1
+            return
+        for column, value in zip(self._columns[1:], values[1:]):
+            column[row] = value
+        if self._alive[row]:
+            start = self._starts[row]
+            if self._text[start:start + self._lengths[row]] == encoded:
+                return
+            self._garbage += self._lengths[row]
+        else:
+            self._alive[row] = 1
+            self._count += 1
+        self._starts[row] = len(self._text)
+        self._lengths[row] = len(encoded)
+        self._text.extend(encoded)
+        self._compact_if_sparse()
+
+    def __delitem__(self, key):
+        row = self._row(key)
+        if row < 0 or not self._alive[row]:
+            raise KeyError(key)
+        self._alive[row] = 0
+        self._count -= 1
+        self._garbage += self._lengths[row]
+        self._compact_if_sparse()
+
+    def _compact_if_sparse(self):
+        """Squeezes out dead rows and text once they are half the table"""
+        if len(self._keys) - self._count > self._count \
+        or self._garbage > len(self._text) // 2 > 0:
+            self.compact()
+
+    def compact(self):
+        """Rewrites the columns and the text without dead rows or text"""
+        columns, starts, lengths = self._columns, self._starts, self._lengths
+        text, alive = self._text, self._alive
+        self._clear_columns()
+        for row in range(len(alive)):
+            if not alive[row]:
+                continue
+            for new_column, column in zip(self._columns, columns):
+                new_column.append(column[row])
+            self._starts.append(len(self._text))
+            self._lengths.append(lengths[row])
+            self._alive.append(1)
+            self._text.extend(text[starts[row]:starts[row] + lengths[row]])
+        self._count = len(self._keys)
+
+    def __contains__(self, key):
+        row = self._row(key)
+        return row >= 0 and self._alive[row] == 1
+
+    def __iter__(self):
+        keys, alive = self._keys, self._alive
+        for row in range(len(keys)):
+            if alive[row]:
+                yield keys[row]
+
+    def __len__(self):
+        return self._count
+
+    def _scan(self):
+        """Yields (key, object) pairs in key order in one pass over the columns"""
+        keys, alive = self._keys, self._alive
+        for row in range(len(keys)):
+            if alive[row]:
+                yield keys[row], self._build(row)
+
+    def items(self):
+        return _ScannedItems(self)
+
+    def values(self):
+        return _ScannedValues(self)
+
+    def clear(self):
+        self._clear_columns()
+
+    def memory_size(self):
+        """Returns the bytes taken by the columns and the text buffer"""
+        return sum(column.itemsize * len(column) for column in self._columns) \
+            + self._starts.itemsize * len(self._starts) \
+            + self._lengths.itemsize * len(self._lengths) \
+            + len(self._text) + len(self._alive)
+
+    def __repr__(self):
+        return '%s(%s, %d rows)' % (type(self).__name__, self.model.__name__,
+                                    self._count)
+
+
+class _ScannedItems(ItemsView):
+    """The items of a ColumnarTable, iterated by scanning its rows"""
+    def __iter__(self):
+        return self._mapping._scan()
+
+
+class _ScannedValues(ValuesView):
+    """The values of a ColumnarTable, iterated by scanning its rows"""
+    def __iter__(self):
+        for _, obj in self._mapping._scan():
+            yield obj
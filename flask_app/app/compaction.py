@@ -0,0 +1,79 @@
+"""
+This module reclaims the objects hidden by Database.delete_later
+from a background thread, a small slice of time at a time, so a
+large delete never holds the writers up for long
+"""
+import threading
+import time
+
+# the longest the compactor holds the exclusive lock at a time
+SLICE_SECONDS = 0.005
+# the pause between slices so waiting writers get the lock
+PAUSE_SECONDS = 0.005
+# how often an idle compactor looks for tombstones
+IDLE_SECONDS = 0.5
+
+
+class Compactor:
+    """
+    Calls database.compact(slice_seconds) from a daemon thread while
+    there are tombstones, pausing between slices, and keeps count of
+    what it has reclaimed
+    """
+    def __init__(self, database, slice_seconds=SLICE_SECONDS,
+                 pause_seconds=PAUSE_SECONDS, idle_seconds=IDLE_SECONDS):
+        if slice_seconds <= 0:
+            raise ValueError('slice_seconds should be positive')
+        self.database = database
+        self.slice_seconds = slice_seconds
+        self.pause_seconds = pause_seconds
+        self.idle_seconds = idle_seconds
+        self.objects_reclaimed = 0
+        self.slices = 0
+        self.busy_seconds = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the background thread"""
+        if self._thread is not None:
+            raise ValueError('The compactor is already running')
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='compactor',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the background thread after its current slice"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        """Body of the background thread"""
+        while not self._stopped.is_set():
+            if not self.database.tombstones:
+                self._stopped.wait(self.idle_seconds)
+                continue
+            self.run_slice()
+            self._stopped.wait(self.pause_seconds)
+
+    def run_slice(self):
+        """Compacts for one slice and returns the number of objects reclaimed"""
+        started = time.perf_counter()
+        reclaimed = self.database.compact(self.slice_seconds)
+        self.busy_seconds += time.perf_counter() - started
+        self.objects_reclaimed += reclaimed
+        self.slices += 1
+        return reclaimed
+
+    def status(self):
+        """Returns a dict describing the work done and left"""
+        return {
+            'running': self._thread is not None,
+            'tombstones': len(self.database.tombstones),
+            'objects_reclaimed': self.objects_reclaimed,
+            'slices': self.slices,
+            'busy_seconds': round(self.busy_seconds, 3),
+        }
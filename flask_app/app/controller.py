@@ -1,7 +1,7 @@
 """
 This module holds functionality that connects the models to the views
 """
-from flask import session
+from flask import session, request, current_app
 from app.models import db
 from app import utilities
 
@@ -77,4 +77,16 @@ def add_user_to_session(user_key):
 
     session['user_key'] = user_key
     session.modified = True
-    
\ No newline at end of file
+    
+
+def is_admin_request():
+    """
+    Checks that the request carries the admin token from the
+    ADMIN_TOKEN config, in the X-Admin-Token header or the token arg.
+    Admin routes are disabled when ADMIN_TOKEN is not set
+    """
+    admin_token = current_app.config.get('ADMIN_TOKEN')
+    if not admin_token:
+        return False
+    token = request.headers.get('X-Admin-Token') or request.args.get('token')
+    return token == admin_token
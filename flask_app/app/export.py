@@ -0,0 +1,54 @@
+"""
+This module streams a user's recipe tree out of the Database as
+NDJSON, one object per line, parents before their children:
+    {"type": "User", "key": 1, "email": ...}
+    {"type": "RecipeCategory", "key": 1, "user": 1, "name": ...}
+    {"type": "Recipe", "key": 1, "category": 1, "name": ...}
+    {"type": "RecipeStep", "key": 1, "recipe": 1, "text_content": ...}
+Steps come in their authored order. Passwords are never exported
+"""
+import json
+from app.versions import MODEL_NAMES
+
+CHUNK_SIZE = 64 * 1024
+# fields that must not leave the database
+PRIVATE_FIELDS = ('password',)
+
+
+def _line(obj):
+    """Returns the NDJSON line of obj"""
+    record = {'type': MODEL_NAMES.get(type(obj), type(obj).__name__)}
+    record.update(obj.to_record())
+    for name in PRIVATE_FIELDS:
+        record.pop(name, None)
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def export_user(view, user):
+    """
+    Yields the NDJSON lines of user and everything under it. view is
+    what Database.read_view() returns and user comes from it; the tree
+    is walked lazily so only one parent's child keys are held at a time
+    """
+    yield _line(user)
+    for category in user.get_all_recipe_categories(view):
+        yield _line(category)
+        for recipe in category.get_all_recipes(view):
+            yield _line(recipe)
+            for step in recipe.get_all_steps(view):
+                yield _line(step)
+
+
+def chunks(lines, size=CHUNK_SIZE):
+    """Joins lines into chunks of about size characters for streaming"""
+    pending = []
+    length = 0
+    for line in lines:
+        pending.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(pending)
+            pending = []
+            length = 0
+    if pending:
+        yield ''.join(pending)
@@ -0,0 +1,248 @@
+"""
+This module holds the typo-tolerant search over the names of
+categories and recipes. Names are broken into trigrams, the three
+letter pieces of their words. A query gathers the names sharing
+enough of its trigrams and ranks them by edit distance, so
+'choclate cake' still finds 'Chocolate cake'
+"""
+import re
+import threading
+from collections import Counter
+from heapq import nlargest
+from app.indexes import fold
+
+CATEGORY = 'category'
+RECIPE = 'recipe'
+# a query may be this many characters per edit away from a name
+CHARACTERS_PER_EDIT = 4
+# the most names checked by edit distance per query, taken from those
+# sharing the most trigrams so a crowd of similar names stays cheap
+CANDIDATES = 50
+_WORD = re.compile(r'\w+')
+
+
+def normalize(text):
+    """Returns the casefolded words of text joined by single spaces"""
+    return ' '.join(_WORD.findall(fold(text)))
+
+
+def trigrams(text):
+    """Returns the set of trigrams of the casefolded words of text"""
+    grams = set()
+    for word in _WORD.findall(fold(text)):
+        # the padding marks where words start and end
+        padded = '  %s ' % word
+        for position in range(len(padded) - 2):
+            grams.add(padded[position:position + 3])
+    return grams
+
+
+def edit_distance(query, name, limit=None):
+    """
+    Returns the Levenshtein distance between query and name, and the
+    smallest distance between query and a prefix of name so a name
+    can be matched while it is still being typed. Given a limit, only
+    the cells within limit of the diagonal are worked out, it stops
+    once both distances are above limit and gives limit + 1 for them
+    """
+    if limit is None:
+        limit = max(len(query), len(name))
+    # a prefix longer than this is more than limit edits away
+    name = name[:len(query) + limit + 1]
+    above = limit + 1
+    previous = [column if column <= limit else above for column in range(len(name) + 1)]
+    for row, query_character in enumerate(query, 1):
+        low, high = max(1, row - limit), min(len(name), row + limit)
+        current = [above] * (len(name) + 1)
+        if row <= limit:
+            current[0] = row
+        for column in range(low, high + 1):
+            current[column] = min(previous[column] + 1, current[column - 1] + 1,
+                                  previous[column - 1] + (query_character != name[column - 1]),
+                                  above)
+        previous = current
+        if min(previous) > limit:
+            # no row below has a smaller prefix distance
+            return above, above
+    return previous[-1], min(previous)
+
+
+class FuzzyIndex:
+    """
+    A trigram index of the names of the categories and recipes of a
+    Database, kept per user and registered as a listener so it is
+    updated inside the writer's exclusive lock. Like SearchIndex it is
+    built the first time it is used
+    """
+    def __init__(self, database):
+        self.database = database
+        # readers may build the index while holding the shared lock
+        self._build_lock = threading.Lock()
+        self.rebuild()
+
+    def rebuild(self):
+        """Drops the index so it is built from scratch on first use e.g. after a load"""
+        with self.database.lock.read():
+            self.built = False
+            # (kind, key) to (user key, normalized name)
+            self._names = {}
+            # user key to the set of (kind, key) of the user's names
+            self._names_of = {}
+            # (user key, trigram) to a set of (kind, key)
+            self._postings = {}
+
+    def build(self):
+        """Indexes every name unless that has been done since rebuild()"""
+        if self.built:
+            return
+        with self.database.lock.read(), self._build_lock:
+            if self.built:
+                return
+            for key in list(self.database.recipe_categories):
+                self._refresh((CATEGORY, key))
+            for key in list(self.database.recipes):
+                self._refresh((RECIPE, key))
+            # writes wait for the shared lock, so none were missed
+            self.built = True
+
+    def __len__(self):
+        self.build()
+        return len(self._names)
+
+    def _read(self, entry):
+        """Returns the (user key, normalized name) of entry or None if it is gone"""
+        kind, key = entry
+        categories = self.database.recipe_categories
+        if kind == CATEGORY:
+            category = categories.get(key)
+            return category and (category.user, normalize(category.name))
+        recipe = self.database.recipes.get(key)
+        category = recipe and categories.get(recipe.category)
+        return category and (category.user, normalize(recipe.name))
+
+    def _refresh(self, entry):
+        """Brings the trigrams of entry in line with the live object"""
+        old = self._names.get(entry)
+        new = self._read(entry)
+        if old == new:
+            return
+        if old is not None:
+            del self._names[entry]
+            entries = self._names_of[old[0]]
+            entries.discard(entry)
+            if not entries:
+                del self._names_of[old[0]]
+            for gram in trigrams(old[1]):
+                entries = self._postings[(old[0], gram)]
+                entries.discard(entry)
+                if not entries:
+                    del self._postings[(old[0], gram)]
+        if new is not None:
+            self._names[entry] = new
+            self._names_of.setdefault(new[0], set()).add(entry)
+            for gram in trigrams(new[1]):
+                self._postings.setdefault((new[0], gram), set()).add(entry)
+
+    def _entries(self, event):
+        """Returns the entries whose names event touches"""
+        if event[0] == 'child_moved':
+            return ()
+        obj = event[1]
+        type_name = type(obj).__name__
+        # the names under a tombstone are dropped as they are compacted
+        tombstone = event[0] == 'object_deleted' and self.database.is_tombstone(obj)
+        if type_name == 'Recipe':
+            return ((RECIPE, obj.key),)
+        if type_name == 'RecipeCategory':
+            entries = [(CATEGORY, obj.key)]
+            if event[0] == 'object_deleted' and not tombstone:
+                # a deleted category still holds the keys of its recipes
+                entries.extend((RECIPE, key) for key in obj.recipes)
+            return entries
+        if type_name == 'User' and event[0] == 'object_deleted' and not tombstone:
+            return list(self._names_of.get(obj.key, ()))
+        return ()
+
+    # Database listener interface
+    def object_saved(self, obj):
+        """Re-reads the name of obj"""
+        self.batch_applied([('object_saved', obj)])
+
+    def object_deleted(self, obj):
+        """Drops the names of obj and its children"""
+        self.batch_applied([('object_deleted', obj)])
+
+    def child_moved(self, parent, child_key, position):
+        """Does nothing since order does not affect names"""
+        pass
+
+    def objects_compacted(self, compacted):
+        """Drops the names of the categories and recipes compacted"""
+        if not self.built:
+            return
+        kinds = {'RecipeCategory': CATEGORY, 'Recipe': RECIPE}
+        for type_name, keys in compacted:
+            if type_name in kinds:
+                for key in keys:
+                    self._refresh((kinds[type_name], key))
+
+    def batch_applied(self, events):
+        """Re-reads every name touched by a batch once"""
+        if not self.built:
+            # the build will read the names as they are then
+            return
+        changed = set()
+        for event in events:
+            changed.update(self._entries(event))
+        for entry in changed:
+            self._refresh(entry)
+
+    def find(self, user_key, query, limit=10):
+        """
+        Returns up to limit (kind, key, distance) triples for the user's
+        names within an edit for every CHARACTERS_PER_EDIT characters of
+        query, closest first
+        """
+        query = normalize(query)
+        grams = trigrams(query)
+        if not grams or limit < 1:
+            return []
+        allowed = len(query) // CHARACTERS_PER_EDIT
+        # an edit breaks at most three trigrams, and the last word may
+        # still be unfinished so its closing trigram is not counted
+        needed = max(1, len(grams) - 3 * allowed - 1)
+        self.build()
+        with self.database.lock.read():
+            postings = sorted((self._postings.get((user_key, gram), ()) for gram in grams),
+                              key=len)
+            # a name in needed of the lists is in one of the shortest
+            # len(postings) - needed + 1, so only those add candidates
+            seeding = len(postings) - needed + 1
+            counts = Counter()
+            for entries in postings[:seeding]:
+                counts.update(entries)
+            for entries in postings[seeding:]:
+                # the other lists only count towards the candidates
+                counts.update(counts.keys() & entries)
+            # names sharing more trigrams are closer, so try them first
+            candidates = nlargest(CANDIDATES, ((count, entry) for entry, count in counts.items()
+                                               if count >= needed))
+            names = self._names
+            shortest = len(query) - allowed
+            ranked = []
+            for count, entry in candidates:
+                # the fewest edits that can leave only count trigrams shared
+                fewest = -(-(len(grams) - 1 - count) // 3)
+                if len(ranked) >= limit and fewest > ranked[limit - 1][0]:
+                    break
+                name = names[entry][1]
+                if len(name) < shortest:
+                    continue
+                distance, prefix_distance = edit_distance(query, name, allowed)
+                if prefix_distance <= allowed:
+                    ranked.append((prefix_distance, distance, len(name), name, entry))
+                    if len(ranked) >= limit:
+                        ranked.sort()
+        ranked.sort()
+        return [(kind, key, prefix_distance)
+                for prefix_distance, _, _, _, (kind, key) in ranked[:limit]]
@@ -0,0 +1,749 @@
+"""
+This module holds the index structures used by the Database
+and the models to keep track of keys
+"""
+import sys
+import threading
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate, chain
+from random import random
+from app.persistent import PersistentSequence, _at, _build, _delete_item, \
+    _insert_item, _join, _rank, _walk
+
+
+class OrderedIndex:
+    """
+    An insertion-ordered set of keys.
+    add, remove and membership checks are O(1) and iteration
+    follows the order in which keys were first added
+    """
+    def __init__(self, keys=()):
+        # dicts keep insertion order so the values are not needed
+        self._keys = dict.fromkeys(keys)
+
+    def add(self, key):
+        """Adds key to the index. Adding an existing key does nothing"""
+        self._keys[key] = None
+
+    def remove(self, key):
+        """Removes key from the index or raises KeyError"""
+        try:
+            del self._keys[key]
+        except KeyError:
+            raise KeyError('%s is not in the index' % str(key))
+
+    def discard(self, key):
+        """Removes key from the index if it is there"""
+        self._keys.pop(key, None)
+
+    def clear(self):
+        """Removes all keys"""
+        self._keys.clear()
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __reversed__(self):
+        return reversed(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __eq__(self, other):
+        if isinstance(other, OrderedIndex):
+            return list(self._keys) == list(other._keys)
+        return NotImplemented
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, list(self._keys))
+
+
+class LazyOrderedIndex(OrderedIndex):
+    """
+    An OrderedIndex whose keys are only read from load_keys()
+    the first time the index is used
+    """
+    def __init__(self, load_keys):
+        self._load_keys = load_keys
+        self._loaded_keys = None
+
+    @property
+    def _keys(self):
+        if self._loaded_keys is None:
+            self._loaded_keys = dict.fromkeys(self._load_keys())
+        return self._loaded_keys
+
+    @property
+    def loaded(self):
+        """Whether the keys have been read yet"""
+        return self._loaded_keys is not None
+
+
+# the distance between the labels of keys appended to a ChildIndex, so
+# that many keys fit between two before they have to be labelled again
+LABEL_GAP = 1 << 32
+
+
+class ChildIndex:
+    """
+    The ordered keys of the children of one parent object
+    e.g. the steps of a recipe in the order they were authored.
+    Each key has a label that orders it in a persistent treap, so
+    inserting at a position, moving, removing and finding the position
+    of a key are O(log n), membership checks are O(1) and snapshot()
+    returns the current keys in O(1)
+    """
+    # every recipe and category has one, so no per-instance __dict__
+    __slots__ = ('_root', '_labels')
+
+    def __init__(self, keys=()):
+        self._root = None
+        # key to its label
+        self._labels = {}
+        self.extend(keys)
+
+    def _last_label(self):
+        """Returns the label of the last key or 0"""
+        item = self._root
+        if item is None:
+            return 0
+        while item.right:
+            item = item.right
+        return item.label
+
+    def add(self, key):
+        """Appends key at the end. Adding an existing key does nothing"""
+        if key not in self._labels:
+            self.insert(len(self._labels), key)
+
+    def extend(self, keys):
+        """
+        Appends keys at the end, skipping those already in the index.
+        The new keys are built into a treap in linear time and joined
+        to the existing one in O(log n)
+        """
+        label = self._last_label()
+        entries = []
+        for key in keys:
+            if key in self._labels:
+                continue
+            label += LABEL_GAP
+            self._labels[key] = label
+            entries.append((label, key))
+        if entries:
+            self._root = _join(self._root, _build(entries))
+
+    def insert(self, position, key):
+        """Inserts key so that it ends up at position"""
+        if key in self._labels:
+            raise ValueError('%s is already in the index' % str(key))
+        position = self._clamp(position)
+        if position == len(self._labels):
+            label = self._last_label() + LABEL_GAP
+        else:
+            after = _at(self._root, position).label
+            before = _at(self._root, position - 1).label if position else after - 2 * LABEL_GAP
+            if after - before < 2:
+                # no label is left between the two, which takes
+                # about log2(LABEL_GAP) inserts at the same spot
+                self._relabel()
+                self.insert(position, key)
+                return
+            label = (before + after) // 2
+        self._labels[key] = label
+        self._root = _insert_item(self._root, label, key, random())
+
+    def _relabel(self):
+        """Spreads the labels LABEL_GAP apart again"""
+        keys = list(self)
+        self._root = None
+        self._labels = {}
+        self.extend(keys)
+
+    def index(self, key):
+        """Returns the position of key or raises KeyError"""
+        try:
+            label = self._labels[key]
+        except KeyError:
+            raise KeyError('%s is not in the index' % str(key))
+        return _rank(self._root, label)
+
+    def remove(self, key):
+        """Removes key from the index or raises KeyError"""
+        try:
+            label = self._labels.pop(key)
+        except KeyError:
+            raise KeyError('%s is not in the index' % str(key))
+        self._root = _delete_item(self._root, label)
+
+    def discard(self, key):
+        """Removes key from the index if it is there"""
+        if key in self._labels:
+            self.remove(key)
+
+    def move(self, key, position):
+        """Moves an existing key to position"""
+        self.remove(key)
+        self.insert(position, key)
+
+    def clear(self):
+        """Removes all keys"""
+        self._root = None
+        self._labels.clear()
+
+    def snapshot(self):
+        """Returns the current keys as a PersistentSequence in O(1)"""
+        return PersistentSequence._make(self._root)
+
+    def _clamp(self, position):
+        """Turns position into a valid insertion point like list.insert"""
+        length = len(self._labels)
+        if position < 0:
+            position = max(length + position, 0)
+        return min(position, length)
+
+    def __getitem__(self, position):
+        length = len(self._labels)
+        if position < 0:
+            position += length
+        if not 0 <= position < length:
+            raise IndexError('index out of range')
+        return _at(self._root, position).key
+
+    def __contains__(self, key):
+        return key in self._labels
+
+    def __iter__(self):
+        # the nodes are never changed, so writers do not disturb this
+        for item in _walk(self._root):
+            yield item.key
+
+    def __len__(self):
+        return len(self._labels)
+
+    def memory_size(self):
+        """Returns the bytes of the index, its labels and treap nodes, not of the keys"""
+        size = sys.getsizeof(self) + sys.getsizeof(self._labels)
+        if self._root is not None:
+            # every node has the same slots and labels are about as big
+            size += (sys.getsizeof(self._root)
+                     + sys.getsizeof(self._root.label)) * len(self._labels)
+        return size
+
+    def __eq__(self, other):
+        if isinstance(other, ChildIndex):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, list(self))
+
+
+class IndexView:
+    """
+    A read-only view of the objects whose keys are in index.
+    Nothing is copied up front; objects are looked up in table as the
+    view is iterated so it always reflects the current state.
+    When a ReadWriteLock is given the keys are read under its shared lock
+    """
+    def __init__(self, index, table, lock=None):
+        self._index = index
+        self._table = table
+        self._lock = lock
+
+    def __iter__(self):
+        if self._lock is None:
+            keys = self._index
+        else:
+            # writers may change the index once the lock is released
+            with self._lock.read():
+                keys = list(self._index)
+        for key in keys:
+            try:
+                yield self._table[key]
+            except KeyError:
+                # the object was removed from the table behind our back
+                continue
+
+    def __getitem__(self, position):
+        if self._lock is None:
+            return self._table[self._index[position]]
+        with self._lock.read():
+            return self._table[self._index[position]]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __bool__(self):
+        return len(self._index) > 0
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, list(self._index))
+
+
+def binary_search(item, sorted_items):
+    """
+    Searches sorted_items for item by bisection in O(log n) without
+    copying. Returns None if item is not found, otherwise the position
+    of its first occurrence
+    """
+    position = bisect_left(sorted_items, item)
+    if position < len(sorted_items) and sorted_items[position] == item:
+        return position
+    return None
+
+
+# keys per block of a SortedKeyIndex. Blocks grow to twice this
+# before they are split, and shrink to half of it before they are merged
+BLOCK_SIZE = 1000
+
+
+class SortedKeyIndex:
+    """
+    Keys, e.g. names, kept sorted as keys are added and removed.
+    They are held in blocks of sorted keys, and the largest key of each
+    block is kept so that finding a key's block is a binary search.
+    Adding or removing a key then shifts one block rather than every
+    key, so each costs O(log n) however large the index grows. range()
+    walks the keys between two bounds, and iteration follows key order.
+    Neither copies the keys, so the index should not change while they
+    are consumed
+    """
+    def __init__(self, keys=()):
+        # sorting once is much cheaper than inserting one key at a time
+        self._fill(sorted(keys))
+
+    def _fill(self, keys):
+        """Splits the sorted keys into blocks"""
+        self._blocks = [keys[start:start + BLOCK_SIZE]
+                        for start in range(0, len(keys), BLOCK_SIZE)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._length = len(keys)
+        # the position of the first key of each block, made when needed
+        self._offsets = None
+
+    def _locate(self, key):
+        """
+        Returns (block number, position in the block) of the first
+        occurrence of key or of where it would be. The block number is
+        the number of blocks if key is larger than every key
+        """
+        number = bisect_left(self._maxes, key)
+        if number == len(self._maxes):
+            return number, 0
+        return number, bisect_left(self._blocks[number], key)
+
+    def add(self, key):
+        """Inserts key at its place in O(log n)"""
+        maxes = self._maxes
+        if not maxes:
+            self._blocks.append([key])
+            maxes.append(key)
+        else:
+            number = bisect_right(maxes, key)
+            if number == len(maxes):
+                # larger than every key, so it goes last
+                number -= 1
+                self._blocks[number].append(key)
+                maxes[number] = key
+            else:
+                insort(self._blocks[number], key)
+            if len(self._blocks[number]) > 2 * BLOCK_SIZE:
+                self._split(number)
+        self._length += 1
+        self._offsets = None
+
+    def _split(self, number):
+        """Splits a block that has grown too large in two"""
+        block = self._blocks[number]
+        half = len(block) // 2
+        self._blocks[number:number + 1] = [block[:half], block[half:]]
+        self._maxes[number:number + 1] = [block[half - 1], block[-1]]
+
+    def _delete(self, number, position):
+        """Deletes the key at position in block number"""
+        blocks, maxes = self._blocks, self._maxes
+        block = blocks[number]
+        del block[position]
+        self._length -= 1
+        self._offsets = None
+        if not block:
+            del blocks[number]
+            del maxes[number]
+        elif len(block) < BLOCK_SIZE // 2 and len(blocks) > 1:
+            # many small blocks would make the block search longer
+            if number == len(blocks) - 1:
+                number -= 1
+            merged = blocks[number] + blocks[number + 1]
+            blocks[number:number + 2] = [merged]
+            maxes[number:number + 2] = [merged[-1]]
+            if len(merged) > 2 * BLOCK_SIZE:
+                self._split(number)
+        else:
+            maxes[number] = block[-1]
+
+    def _find(self, key):
+        """Returns (block number, position in the block) of key or None"""
+        number, position = self._locate(key)
+        if number < len(self._blocks) and self._blocks[number][position] == key:
+            return number, position
+        return None
+
+    def remove(self, key):
+        """Removes one occurrence of key, raising KeyError if it is missing"""
+        found = self._find(key)
+        if found is None:
+            raise KeyError(key)
+        self._delete(*found)
+
+    def discard(self, key):
+        """Removes one occurrence of key if it is there"""
+        found = self._find(key)
+        if found is not None:
+            self._delete(*found)
+
+    def remove_all(self, keys):
+        """
+        Removes every occurrence of keys in one pass over the index,
+        which beats finding the keys one at a time when there are many
+        """
+        doomed = set(keys)
+        if doomed:
+            self._fill([key for key in self if key not in doomed])
+
+    def _block_offsets(self):
+        """Returns the position of the first key of each block"""
+        if self._offsets is None:
+            self._offsets = list(accumulate(chain((0,), map(len, self._blocks))))
+        return self._offsets
+
+    def position(self, key):
+        """Returns the position of key in key order or None if it is missing"""
+        found = self._find(key)
+        if found is None:
+            return None
+        number, position = found
+        return self._block_offsets()[number] + position
+
+    def bisect(self, key):
+        """Returns the position key is or would be at"""
+        number, position = self._locate(key)
+        if number == len(self._blocks):
+            return self._length
+        return self._block_offsets()[number] + position
+
+    def range(self, low=None, high=None, limit=None):
+        """
+        Yields the keys that are at least low and below high in order.
+        A missing bound leaves that end open and limit caps the number
+        of keys
+        """
+        number, start = (0, 0) if low is None else self._locate(low)
+        blocks, maxes = self._blocks, self._maxes
+        while number < len(blocks) and (limit is None or limit > 0):
+            block = blocks[number]
+            stop = len(block)
+            if high is not None and not maxes[number] < high:
+                stop = bisect_left(block, high)
+            if limit is not None:
+                stop = min(stop, start + limit)
+                limit -= max(stop - start, 0)
+            for position in range(start, stop):
+                yield block[position]
+            if stop < len(block):
+                return
+            number, start = number + 1, 0
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self._length
+        if not 0 <= position < self._length:
+            raise IndexError('SortedKeyIndex index out of range')
+        offsets = self._block_offsets()
+        number = bisect_right(offsets, position) - 1
+        return self._blocks[number][position - offsets[number]]
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __iter__(self):
+        return chain.from_iterable(self._blocks)
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, list(self))
+
+
+HASH = 'hash'
+SORTED = 'sorted'
+# above this many keys a sorted index is rebuilt in one pass
+# instead of shifting its entries once per key
+DISCARDS_PER_PASS = 64
+# stands in for a missing value since None can be indexed
+_MISSING = object()
+# sorts after every character, so the strings starting with a prefix
+# are at least prefix and below prefix + PREFIX_END
+PREFIX_END = '\U0010ffff'
+
+
+def fold(value):
+    """Returns value casefolded if it is a string so case is ignored"""
+    if isinstance(value, str):
+        folded = value.casefold()
+        # keep one copy of names that are already folded
+        return value if folded == value else folded
+    return value
+
+
+class Indexed:
+    """
+    Declares a secondary index over attributes of a model, e.g.
+        indexes = (Indexed('email', unique=True),
+                   Indexed('name', fields=('user', 'name'), kind=SORTED))
+    An object is indexed under the value of its one field or the tuple
+    of its fields. With fold=True strings are casefolded first so the
+    index ignores case. The Database keeps every declared index up to
+    date as objects are saved, renamed and deleted
+    """
+    def __init__(self, name, fields=None, unique=False, kind=HASH, fold=False):
+        if kind not in (HASH, SORTED):
+            raise ValueError('kind should be %s or %s' % (HASH, SORTED))
+        self.name = name
+        self.fields = tuple(fields or (name,))
+        self.unique = unique
+        self.kind = kind
+        self.fold = fold
+
+    def value_of(self, obj):
+        """Returns the value obj is indexed under"""
+        values = tuple(getattr(obj, field) for field in self.fields)
+        if self.fold:
+            values = tuple(fold(value) for value in values)
+        if len(values) == 1:
+            return values[0]
+        return values
+
+    def new_index(self, entries=()):
+        """Returns an in-memory index of the declared kind holding entries"""
+        index_type = SortedIndex if self.kind == SORTED else HashIndex
+        return index_type(self.unique, entries)
+
+
+class HashIndex:
+    """
+    A secondary index of value to the keys of the objects holding it.
+    Finding the keys of a value is O(1). The value each key is indexed
+    under is remembered so adding a key again moves it from its old value
+    """
+    kind = HASH
+
+    def __init__(self, unique=False, entries=()):
+        self.unique = unique
+        # key to the value it is indexed under
+        self._values = {key: value for value, key in entries}
+        # value to its key, or to a set of keys if several objects share it
+        self._keys = dict(zip(self._values.values(), self._values))
+        if len(self._keys) < len(self._values):
+            # some objects share a value
+            self._keys = {}
+            for key, value in self._values.items():
+                self._add_entry(value, key)
+
+    def allows(self, value, key):
+        """Returns False if a unique index holds value for another key"""
+        if not self.unique:
+            return True
+        return all(other == key for other in self.keys(value))
+
+    def add(self, value, key):
+        """Indexes key under value, removing it from its old value"""
+        old_value = self._values.get(key, _MISSING)
+        if old_value is not _MISSING:
+            if old_value == value:
+                return
+            self._remove_entry(old_value, key)
+        self._values[key] = value
+        self._add_entry(value, key)
+
+    def discard(self, key):
+        """Removes key from the index if it is there"""
+        value = self._values.pop(key, _MISSING)
+        if value is not _MISSING:
+            self._remove_entry(value, key)
+
+    def discard_many(self, keys):
+        """Removes each of keys from the index if it is there"""
+        for key in keys:
+            self.discard(key)
+
+    def value_of(self, key, default=None):
+        """Returns the value key is indexed under or default"""
+        return self._values.get(key, default)
+
+    def _add_entry(self, value, key):
+        entry = self._keys.get(value, _MISSING)
+        if entry is _MISSING:
+            self._keys[value] = key
+        elif isinstance(entry, set):
+            entry.add(key)
+        else:
+            self._keys[value] = {entry, key}
+
+    def _remove_entry(self, value, key):
+        entry = self._keys[value]
+        if not isinstance(entry, set):
+            del self._keys[value]
+            return
+        entry.discard(key)
+        if len(entry) == 1:
+            self._keys[value] = entry.pop()
+
+    def keys(self, value):
+        """Returns the keys indexed under value in key order"""
+        entry = self._keys.get(value, _MISSING)
+        if entry is _MISSING:
+            return []
+        if isinstance(entry, set):
+            return sorted(entry)
+        return [entry]
+
+    def first(self, value):
+        """Returns the smallest key indexed under value or None"""
+        keys = self.keys(value)
+        return keys[0] if keys else None
+
+    def items(self):
+        """Yields (value, key) pairs"""
+        for key, value in self._values.items():
+            yield value, key
+
+    def clear(self):
+        """Removes all entries"""
+        self._values.clear()
+        self._keys.clear()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, list(self.items()))
+
+
+class SortedIndex(HashIndex):
+    """
+    A secondary index kept as a SortedKeyIndex of (value, key) pairs.
+    Finding the keys of a value is O(log n) and range queries return
+    keys in value order
+    """
+    kind = SORTED
+
+    def __init__(self, unique=False, entries=()):
+        self.unique = unique
+        self._values = {key: value for value, key in entries}
+        self._entries = SortedKeyIndex((value, key) for key, value in self._values.items())
+
+    def _add_entry(self, value, key):
+        self._entries.add((value, key))
+
+    def _remove_entry(self, value, key):
+        self._entries.remove((value, key))
+
+    def discard_many(self, keys):
+        """Removes each of keys from the index if it is there"""
+        entries = []
+        for key in keys:
+            value = self._values.pop(key, _MISSING)
+            if value is not _MISSING:
+                entries.append((value, key))
+        if len(entries) > DISCARDS_PER_PASS:
+            self._entries.remove_all(entries)
+        else:
+            for entry in entries:
+                self._entries.remove(entry)
+
+    def keys(self, value):
+        """Returns the keys indexed under value in key order"""
+        keys = []
+        for entry_value, key in self._entries.range((value,)):
+            if entry_value != value:
+                break
+            keys.append(key)
+        return keys
+
+    def range(self, low=None, high=None, limit=None):
+        """
+        Returns the keys whose values are at least low and below high,
+        in value order. A missing bound leaves that end open and limit
+        caps the number of keys
+        """
+        return [key for _, key in self.range_items(low, high, limit)]
+
+    def range_items(self, low=None, high=None, limit=None):
+        """Returns the (value, key) pairs of range(low, high, limit)"""
+        return list(self._entries.range(None if low is None else (low,),
+                                         None if high is None else (high,), limit))
+
+    def items(self):
+        """Yields (value, key) pairs in value order"""
+        # a copy, since a snapshot may be written while writers carry on
+        return iter(list(self._entries))
+
+    def clear(self):
+        """Removes all entries"""
+        self._values.clear()
+        self._entries = SortedKeyIndex()
+
+
+class LazyIndex:
+    """
+    Stands in for a secondary index of the kind declared that is only
+    built from load_entries() the first time it is used, e.g. one held
+    in a snapshot. Its size is known without building it, and
+    raw_entries() hands out the stored form as long as it is unbuilt
+    """
+    def __init__(self, declaration, count, load_entries, raw_entries=None):
+        self.kind = declaration.kind
+        self.unique = declaration.unique
+        self._declaration = declaration
+        self._count = count
+        self._load_entries = load_entries
+        self._raw_entries = raw_entries
+        self._index = None
+        # readers may build it while holding the shared lock
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        """The index, built on first use"""
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = self._declaration.new_index(self._load_entries())
+        return self._index
+
+    @property
+    def loaded(self):
+        """Whether the index has been built yet"""
+        return self._index is not None
+
+    def raw_entries(self):
+        """Returns the stored entries if the index is unbuilt, else None"""
+        if self._index is not None or self._raw_entries is None:
+            return None
+        return self._raw_entries()
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def __len__(self):
+        return self._count if self._index is None else len(self._index)
+
+    def __repr__(self):
+        if self._index is None:
+            return '%s(%d entries)' % (type(self).__name__, self._count)
+        return repr(self._index)
@@ -0,0 +1,160 @@
+"""
+This module holds the reader/writer lock that makes the Database
+safe to use from the threads of a threaded worker
+"""
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+
+class ReadWriteLock:
+    """
+    Many threads may hold the shared (read) lock at once while the
+    exclusive (write) lock is held by one thread with no readers.
+    Both are reentrant and a writer may also take the read lock,
+    but a reader cannot upgrade to a writer. Waiting writers are
+    served before new readers so writes are not starved
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        # thread ident to number of read acquisitions
+        self._readers = {}
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        """Takes the shared lock"""
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+            while self._writer is not None or self._waiting_writers:
+                self._condition.wait()
+            self._readers[me] = 1
+
+    def release_read(self):
+        """Releases the shared lock"""
+        me = threading.get_ident()
+        with self._condition:
+            depth = self._readers.get(me, 0)
+            if depth == 0:
+                raise RuntimeError('release_read without acquire_read')
+            if depth == 1:
+                del self._readers[me]
+                if not self._readers:
+                    self._condition.notify_all()
+            else:
+                self._readers[me] = depth - 1
+
+    def acquire_write(self):
+        """Takes the exclusive lock"""
+        me = threading.get_ident()
+        if self._writer == me:
+            # only this thread can change these while it is the writer
+            self._writer_depth += 1
+            return
+        with self._condition:
+            if me in self._readers:
+                raise RuntimeError('A read lock cannot be upgraded to a write lock')
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        """Releases the exclusive lock"""
+        if self._writer != threading.get_ident():
+            raise RuntimeError('release_write without acquire_write')
+        if self._writer_depth > 1:
+            self._writer_depth -= 1
+            return
+        with self._condition:
+            self._writer_depth = 0
+            self._writer = None
+            self._condition.notify_all()
+
+    @contextmanager
+    def upgraded(self):
+        """
+        Holds the exclusive lock for the duration of a with block even
+        if this thread holds the shared lock. The shared lock is given up
+        while waiting and taken back afterwards, so other writers may run
+        in between and whatever was read before must be checked again
+        """
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        with self._condition:
+            depth = self._readers.pop(me, 0)
+            if depth and not self._readers:
+                self._condition.notify_all()
+        try:
+            with self.write():
+                yield
+        finally:
+            if depth:
+                with self._condition:
+                    while self._writer is not None or self._waiting_writers:
+                        self._condition.wait()
+                    self._readers[me] = depth
+
+    @contextmanager
+    def read(self):
+        """Holds the shared lock for the duration of a with block"""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        """Holds the exclusive lock for the duration of a with block"""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def _find_lock(args, kwargs):
+    """Returns the ReadWriteLock of the first argument that has one"""
+    for arg in args + tuple(kwargs.values()):
+        lock = getattr(arg, 'lock', None)
+        if isinstance(lock, ReadWriteLock):
+            return lock
+    return None
+
+
+def shared(method):
+    """
+    Runs method holding the shared lock of the first argument with a
+    ReadWriteLock called lock e.g. the Database passed to a model method
+    """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        lock = _find_lock(args, kwargs)
+        if lock is None:
+            return method(*args, **kwargs)
+        with lock.read():
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def exclusive(method):
+    """Like shared but holds the exclusive lock"""
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        lock = _find_lock(args, kwargs)
+        if lock is None:
+            return method(*args, **kwargs)
+        with lock.write():
+            return method(*args, **kwargs)
+    return wrapper
@@ -1,225 +1,1029 @@
 """
 This module holds the pretend-models for the application
 """
-from random import randint
+import heapq
+import time
+from contextlib import contextmanager
 from app.utilities import check_type, check_email_format
+from app.indexes import LazyOrderedIndex, ChildIndex, IndexView, Indexed, SORTED, \
+    PREFIX_END, fold
+from app import wal, snapshot
+from app.backends import MemoryBackend
+from app.locks import ReadWriteLock, shared, exclusive
+from app.versions import VersionStore
+from app.search import SearchIndex
+from app.fuzzy import FuzzyIndex, CATEGORY
+from app.stats import DatabaseStats, UserCounts
+from app.tiering import TieredStore
 
-def binary_search(character, list_of_characters, position=0):
-    """
-    Searches for character using binary search
-    returns None if character is not found
-    otherwise returns character's position in sorted list
-    """
-    length_of_list = len(list_of_characters)
-    if length_of_list <= 1:
-        if length_of_list == 0:
-            return None
-        if character != list_of_characters[0]:
-            return None
-        return position
+class Database:
+    """This is the daabase for the application"""
+    def __init__(self, backend=None):
+        # shared by readers, exclusive for writers. Model methods take it
+        # through the Database passed to them
+        self.lock = ReadWriteLock()
+        # objects told about every mutation e.g. a WriteAheadLog
+        self.listeners = []
+        # publishes immutable versions for lock-free reads once enabled
+        self.versions = None
+        # the full-text index of the recipes once enabled
+        self.search_index = None
+        # the trigram index of category and recipe names once enabled
+        self.fuzzy_index = None
+        # events held back while a batch is applied, otherwise None
+        self._pending_events = None
+        # (model, key) to the root hidden by delete_later whose subtree
+        # is waiting to be compacted, oldest first
+        self.tombstones = {}
+        # the tombstone being compacted and a stack of (model, iterator
+        # over keys) for the levels of its subtree still to be reclaimed
+        self._compacting = None
+        self._compaction = []
+        # what stats() keeps between calls, made on the first call
+        self._stats = None
+        # the on-disk tier of cold users' trees once enabled
+        self.tiers = None
+        self._bind(backend or MemoryBackend())
+        # the objects under each user for stats(), counted on first use
+        self.user_counts = UserCounts(self)
+        self.add_listener(self.user_counts)
 
-    random_int = randint(0, length_of_list - 1)
-    if character < list_of_characters[random_int]:
-        new_list = list_of_characters[:(random_int)]
-        position += 0
-    else:
-        new_list = list_of_characters[random_int:]
-        position += random_int
-    # return this so that it recursively comes back to the surface
-    return binary_search(character, new_list, position)
+    def _bind(self, backend):
+        """Gets the tables, indexes and maps from backend"""
+        self.backend = backend
+        self.users = backend.table('users', User)
+        self.recipes = backend.table('recipes', Recipe)
+        self.recipe_categories = backend.table('recipe_categories',
+                                               RecipeCategory)
+        self.recipe_steps = backend.table('recipe_steps', RecipeStep)
+        self.user_keys = backend.key_index('user_keys')
+        self.recipe_keys = backend.key_index('recipe_keys')
+        self.recipe_category_keys = backend.key_index('recipe_category_keys')
+        self.recipe_step_keys = backend.key_index('recipe_step_keys')
+        self._bind_indexes(backend.secondary_index)
+        self.key_sequences = backend.key_sequences(User, Recipe,
+                                                   RecipeCategory, RecipeStep)
 
+    @staticmethod
+    def _index_name(model, index_name):
+        """Returns the name an index of model is stored under"""
+        return '%s.%s' % (model.__name__, index_name)
 
-class Database:
-    """This is the daabase for the application"""
-    def __init__(self):
-        self.users = {}
-        self.recipes = {}
-        self.recipe_categories = {}
-        self.recipe_steps = {}
-        self._user_keys = []
-        self.user_email_key_map = {}
-        self._recipe_keys = []
-        self.recipe_name_key_map = {}
-        self._recipe_category_keys = []
-        self.recipe_category_name_key_map = {}
-        self._recipe_step_keys = []
-
-    @property
-    def recipe_category_keys(self):
-        self._recipe_category_keys =  list(set(self._recipe_category_keys))
-        return self._recipe_category_keys
-
-    @property
-    def recipe_keys(self):
-        self._recipe_keys =  list(set(self._recipe_keys))
-        return self._recipe_keys
-
-    @property
-    def recipe_step_keys(self):
-        self._recipe_step_keys =  list(set(self._recipe_step_keys))
-        return self._recipe_step_keys
-
-    @property
-    def user_keys(self):
-        self._user_keys =  list(set(self._user_keys))
-        return self._user_keys
+    def _bind_indexes(self, make_index):
+        """
+        Gets the secondary indexes declared by the models from
+        make_index(name, declaration). An index that comes back empty
+        while its table is not, e.g. one declared after the data was
+        stored, is filled from the table
+        """
+        # model to {index name: index}
+        self.indexes = {}
+        for model in MODEL_TYPES.values():
+            table = self.get_table(model)
+            self.indexes[model] = {}
+            for declaration in model.indexes:
+                index = make_index(self._index_name(model, declaration.name),
+                                   declaration)
+                if not len(index) and len(table):
+                    for key, obj in table.items():
+                        index.add(declaration.value_of(obj), key)
+                self.indexes[model][declaration.name] = index
+
+    def is_empty(self):
+        """Returns True if there are no objects in the database"""
+        return not (len(self.users) or len(self.recipe_categories)
+                    or len(self.recipes) or len(self.recipe_steps)
+                    or (self.tiers is not None and self.tiers.evicted_users))
+
+    @exclusive
+    def set_backend(self, backend):
+        """
+        Switches this empty database to another storage backend
+        e.g. SQLiteBackend so several workers can share the data
+        """
+        if not self.is_empty():
+            raise ValueError('The backend of a database with data cannot be changed')
+        self._bind(backend)
+        self.user_counts.rebuild()
+        if self.versions is not None:
+            self.versions.rebuild()
+        if self.search_index is not None:
+            self.search_index.rebuild()
+        if self.fuzzy_index is not None:
+            self.fuzzy_index.rebuild()
+        if self.tiers is not None:
+            self.tiers.rebuild()
+
+    @exclusive
+    def enable_versions(self):
+        """
+        Starts publishing an immutable version of the database after
+        every mutation so read_view() can be used without locking.
+        Only writes made through this process are seen, so it cannot
+        be used with a backend shared by several processes
+        """
+        if self.backend.shared:
+            raise ValueError('Versions cannot track a shared backend')
+        if self.tiers is not None:
+            raise ValueError('Versions would keep evicted objects in memory')
+        if self.versions is None:
+            self.versions = VersionStore(self)
+            self.add_listener(self.versions)
+
+    @exclusive
+    def enable_search(self):
+        """
+        Starts keeping a full-text index of the recipes so search()
+        can be used. Like versions it only sees the writes made
+        through this process
+        """
+        if self.backend.shared:
+            raise ValueError('Search cannot track a shared backend')
+        if self.search_index is None:
+            self.search_index = SearchIndex(self)
+            self.add_listener(self.search_index)
+
+    @shared
+    def search(self, query, limit=10):
+        """
+        Returns up to limit (Recipe, score) pairs for the recipes whose
+        name, description or steps match query, best first
+        """
+        if check_type(query, str) and check_type(limit, int):
+            if self.search_index is None:
+                raise ValueError('Search is not enabled')
+            results = [(self.fetch(Recipe, key), score)
+                       for key, score in self.search_index.search(query, limit)]
+            return [(recipe, score) for recipe, score in results
+                    if recipe is not None and self.is_visible(recipe)]
+
+    @exclusive
+    def enable_fuzzy_search(self):
+        """
+        Starts keeping a trigram index of the names of categories and
+        recipes so fuzzy_find() can be used. Like search it only sees
+        the writes made through this process
+        """
+        if self.backend.shared:
+            raise ValueError('Fuzzy search cannot track a shared backend')
+        if self.fuzzy_index is None:
+            self.fuzzy_index = FuzzyIndex(self)
+            self.add_listener(self.fuzzy_index)
+
+    @exclusive
+    def enable_tiering(self, path, memory_budget):
+        """
+        Starts keeping the trees of the least recently used users in a
+        file at path whenever the tables take more than memory_budget
+        bytes, see TieredStore. Versions would keep every object in
+        memory and other processes cannot see the file, so it works
+        with neither
+        """
+        if self.backend.shared:
+            raise ValueError('Tiering cannot be used with a shared backend')
+        if self.versions is not None:
+            raise ValueError('Versions would keep evicted objects in memory')
+        if self.tiers is None:
+            self.tiers = TieredStore(self, path, memory_budget)
+            self.add_listener(self.tiers)
+
+    @shared
+    def fuzzy_find(self, user_key, query, limit=10):
+        """
+        Returns up to limit of the user's RecipeCategory and Recipe
+        objects whose names are close to query despite typos, closest first
+        """
+        if check_type(user_key, int) and check_type(query, str) \
+        and check_type(limit, int):
+            if self.fuzzy_index is None:
+                raise ValueError('Fuzzy search is not enabled')
+            found = [self.fetch(RecipeCategory if kind == CATEGORY else Recipe, key)
+                     for kind, key, _ in self.fuzzy_index.find(user_key, query, limit)]
+            return [obj for obj in found if obj is not None and self.is_visible(obj)]
+
+    def read_view(self):
+        """
+        Returns the latest DatabaseVersion if versions are enabled,
+        otherwise the database itself. Both have the get_* methods and
+        the objects they return have get_all_* methods taking the view
+        """
+        versions = self.versions
+        if versions is None:
+            return self
+        return versions.current
+
+    @shared
+    def stats(self):
+        """
+        Returns a JSON-ready dict of the objects, approximate bytes and
+        index sizes of every table, the largest users by number of
+        objects and how fast the database has grown lately. Bytes are
+        estimated from a sample of each table so a call stays cheap
+        """
+        if self._stats is None:
+            self._stats = DatabaseStats(self, TABLE_NAMES)
+        return self._stats.collect()
+
+    def add_listener(self, listener):
+        """
+        Registers listener to be told about mutations. It should have
+        object_saved(obj), object_deleted(obj) and
+        child_moved(parent, child_key, position) methods
+        """
+        self.listeners.append(listener)
 
+    def remove_listener(self, listener):
+        """Stops telling listener about mutations"""
+        self.listeners.remove(listener)
+
+    def notify_saved(self, obj):
+        """Tells the listeners that obj has been saved"""
+        self._notify(('object_saved', obj))
+
+    def notify_deleted(self, obj):
+        """Tells the listeners that obj and its children have been deleted"""
+        self._notify(('object_deleted', obj))
+
+    def notify_child_moved(self, parent, child_key, position):
+        """Tells the listeners that a child of parent has been moved"""
+        self._notify(('child_moved', parent, child_key, position))
+
+    def _notify(self, event):
+        """
+        Hands event, the listener method name and its arguments,
+        to the listeners or holds it back until the batch ends
+        """
+        if self._pending_events is not None:
+            self._pending_events.append(event)
+            return
+        for listener in self.listeners:
+            getattr(listener, event[0])(*event[1:])
+
+    @contextmanager
+    def batched_notifications(self):
+        """
+        Holds back the events of the mutations made in a with block and
+        hands them over together at its end. Listeners with a
+        batch_applied(events) method get them in one call, the others
+        get them one by one. The exclusive lock must be held
+        """
+        if self._pending_events is not None:
+            # already batching
+            yield
+            return
+        self._pending_events = []
+        try:
+            yield
+        finally:
+            events, self._pending_events = self._pending_events, None
+            if events:
+                for listener in self.listeners:
+                    batch_applied = getattr(listener, 'batch_applied', None)
+                    if batch_applied is not None:
+                        batch_applied(events)
+                    else:
+                        for event in events:
+                            getattr(listener, event[0])(*event[1:])
+
+    def transaction(self):
+        """
+        Returns a Transaction that stages creates, updates and deletes
+        and applies them together when its with block ends
+        """
+        return Transaction(self)
+
+    def get_table(self, type_of_object):
+        """Returns the dict that holds objects of type_of_object"""
+        if check_type(type_of_object, type):
+            tables = {
+                User: self.users,
+                RecipeCategory: self.recipe_categories,
+                Recipe: self.recipes,
+                RecipeStep: self.recipe_steps,
+            }
+            try:
+                return tables[type_of_object]
+            except KeyError:
+                raise TypeError('%s type does not exist in database'
+                                % str(type_of_object))
+
+    @exclusive
+    def open_log(self, log):
+        """
+        Replays the records in log to rebuild the database
+        then appends every subsequent mutation to it
+        """
+        for record in log.replay():
+            self.apply_record(record)
+        self.add_listener(log)
+
+    @shared
+    def snapshot(self, path, log=None):
+        """
+        Writes a compact binary image of the database to path.
+        If log is given it is truncated once the snapshot is on disk
+        since everything in it is now part of the snapshot
+        """
+        if check_type(path, str):
+            if self.tombstones:
+                # the image would bring the hidden objects back to life
+                raise ValueError('Deleted objects are still being compacted')
+            tables = [(model.__name__, self.get_table(model),
+                       getattr(model, 'children_attribute', None))
+                      for model in MODEL_TYPES.values()]
+            if self.tiers is not None and self.tiers.evicted_users:
+                # evicted objects are copied from disk without faulting them in
+                tables = [(type_name, self.tiers.table_view(
+                    MODEL_TYPES[type_name], table,
+                    self._build_from_snapshot(MODEL_TYPES[type_name])), attribute)
+                          for type_name, table, attribute in tables]
+            indexes = {self._index_name(model, name): index
+                       for model, model_indexes in self.indexes.items()
+                       for name, index in model_indexes.items()}
+            snapshot.write_snapshot(path, tables, indexes,
+                                    self.key_sequences.state())
+            if log is not None:
+                log.truncate()
+
+    @exclusive
+    def load(self, path):
+        """
+        Loads a snapshot written by snapshot() into this empty database.
+        The file is memory-mapped and objects are only built the first
+        time they are accessed. Call open_log afterwards to replay
+        the changes made since the snapshot
+        """
+        if check_type(path, str):
+            if not isinstance(self.backend, MemoryBackend):
+                raise ValueError('Snapshots can only be loaded into memory')
+            if not self.is_empty():
+                raise ValueError('Snapshots can only be loaded into an empty database')
+            image = snapshot.Snapshot(path)
+            self.users = image.table('User', self._build_from_snapshot(User))
+            self.recipe_categories = image.table(
+                'RecipeCategory', self._build_from_snapshot(RecipeCategory))
+            self.recipes = image.table('Recipe', self._build_from_snapshot(Recipe))
+            self.recipe_steps = image.table(
+                'RecipeStep', self._build_from_snapshot(RecipeStep))
+            if self.backend.columnar:
+                # columns are only compact once every step is in them
+                steps = self.backend.table('recipe_steps', RecipeStep)
+                steps.update(self.recipe_steps.scan())
+                self.recipe_steps = steps
+            self.user_keys = LazyOrderedIndex(lambda: image.keys('User'))
+            self.recipe_category_keys = LazyOrderedIndex(
+                lambda: image.keys('RecipeCategory'))
+            self.recipe_keys = LazyOrderedIndex(lambda: image.keys('Recipe'))
+            self.recipe_step_keys = LazyOrderedIndex(
+                lambda: image.keys('RecipeStep'))
+            # each index is decoded the first time it is used
+            self._bind_indexes(image.index)
+            self.key_sequences.restore(image.sequences)
+            self.user_counts.rebuild()
+            if self.versions is not None:
+                self.versions.rebuild()
+            if self.search_index is not None:
+                self.search_index.rebuild()
+            if self.fuzzy_index is not None:
+                self.fuzzy_index.rebuild()
+            if self.tiers is not None:
+                self.tiers.rebuild()
+
+    @staticmethod
+    def _build_from_snapshot(model):
+        """Returns a function that builds a model object from a snapshot record"""
+        children_attribute = getattr(model, 'children_attribute', None)
+
+        def build(fields, children):
+            obj = model(**fields)
+            if children_attribute:
+                setattr(obj, children_attribute, ChildIndex(children))
+            return obj
+        return build
+
+    @exclusive
+    def apply_record(self, record):
+        """Applies one write-ahead log record to the database"""
+        if record and record[0] == wal.BATCH:
+            with self.batched_notifications():
+                for batched_record in record[1]:
+                    self.apply_record(batched_record)
+            return
+        try:
+            type_of_object = MODEL_TYPES[record[1]]
+        except (KeyError, IndexError, TypeError):
+            raise ValueError('Invalid log record %r' % (record,))
+        table = self.get_table(type_of_object)
+        operation = record[0]
+        if operation == wal.PUT:
+            fields = record[2]
+            obj = table.get(fields['key'])
+            if obj is None:
+                obj = type_of_object(**fields)
+            else:
+                self._detach_if_moved(obj, fields)
+                for name, value in fields.items():
+                    setattr(obj, name, value)
+            obj.save(self)
+        elif operation == wal.DELETE:
+            obj = table.get(record[2])
+            if obj is not None:
+                self.delete_object(obj)
+        elif operation == wal.MOVE:
+            obj = table[record[2]]
+            getattr(obj, obj.children_attribute).move(record[3], record[4])
+        else:
+            raise ValueError('Invalid log record %r' % (record,))
+
+    def _detach_if_moved(self, obj, fields):
+        """
+        Takes obj's key out of its parent's children if fields give it
+        another parent, e.g. a recipe moved by change_category. The new
+        parent takes the key when obj is saved
+        """
+        if type(obj) not in PARENT_FIELDS:
+            return
+        field, parent_model = PARENT_FIELDS[type(obj)]
+        if field in fields and fields[field] != getattr(obj, field):
+            parent = self.get_table(parent_model).get(getattr(obj, field))
+            if parent is not None:
+                getattr(parent, parent_model.children_attribute).discard(obj.key)
+
+    @exclusive
+    def move_recipes(self, recipes, new_category):
+        """
+        Moves recipes, steps and all, to new_category, a RecipeCategory
+        of the same user or its key. Only the two categories' child
+        indexes and the recipes' name indexes change; the steps keep
+        pointing at their recipes. Every recipe is checked before any
+        is moved and listeners get the moves as one batch. Returns the
+        number of recipes moved
+        """
+        if isinstance(new_category, RecipeCategory):
+            new_category = new_category.key
+        category = self.get_recipe_category(new_category)
+        if category is None:
+            raise KeyError('Category should be saved in db first')
+        moves = []
+        for recipe in recipes:
+            if not isinstance(recipe, Recipe):
+                raise TypeError('%s is not a Recipe' % str(type(recipe)))
+            stored = self.get_recipe(recipe.key)
+            if stored is None:
+                raise KeyError('The recipe is non-existent in database')
+            old_category = self.get_recipe_category(stored.category)
+            if old_category.user != category.user:
+                raise ValueError('Recipes can only be moved between '
+                                 'categories of the same user')
+            if old_category.key != category.key:
+                moves.append((recipe, stored, old_category))
+        with self.backend.atomic(), self.batched_notifications():
+            for recipe, stored, old_category in moves:
+                old_category.recipes.discard(stored.key)
+                stored.category = recipe.category = category.key
+                # adds the key to the new category and re-indexes the name
+                stored.save(self)
+        return len(moves)
+
+    @exclusive
     def get_next_key(self, type_of_object):
-        """Gets the next key basing on the type of object"""
+        """
+        Allocates the next key basing on the type of object.
+        Keys are never reused even after objects are deleted
+        """
         # type_of_object should be of type type
         if check_type(type_of_object, type):
-            if type_of_object == User:
-                return self.__get_max_value(self.user_keys) + 1
+            return self.key_sequences.next_key(type_of_object)
 
-            if type_of_object == Recipe:
-                return self.__get_max_value(self.recipe_keys) + 1
+    @exclusive
+    def get_next_keys(self, type_of_object, count):
+        """Allocates a block of count keys and returns them as a range"""
+        if check_type(type_of_object, type):
+            return self.key_sequences.next_keys(type_of_object, count)
 
-            if type_of_object == RecipeCategory:
-                return self.__get_max_value(self.recipe_category_keys) + 1
+    @exclusive
+    def insert_many(self, objects):
+        """
+        Saves many new objects in one pass. Parents must already be in
+        the database or come before their children in objects. The child
+        index of each parent is extended once instead of once per child
+        and listeners get the whole lot as one batch
+        """
+        objects = list(objects)
+        new_objects = {(type(obj), obj.key): obj for obj in objects}
+        children = {}
+        for obj in objects:
+            model = type(obj)
+            if model in PARENT_FIELDS:
+                field, parent_model = PARENT_FIELDS[model]
+                parent_key = getattr(obj, field)
+                if (parent_model, parent_key) not in children:
+                    parent = new_objects.get((parent_model, parent_key)) \
+                        or self.fetch(parent_model, parent_key)
+                    if parent is None:
+                        raise KeyError('%s should be saved in db first'
+                                       % parent_model.__name__)
+                    children[(parent_model, parent_key)] = (parent, [])
+                children[(parent_model, parent_key)][1].append(obj.key)
+        with self.backend.atomic(), self.batched_notifications():
+            for parent, keys in children.values():
+                getattr(parent, parent.children_attribute).extend(keys)
+            for obj in objects:
+                # the parent already holds the key so save only stores obj
+                obj.save(self)
+
+    @exclusive
+    def delete_object(self, object_to_delete):
+        """
+        Deletes object_to_delete and everything under it. The subtree
+        is collected level by level first, then removed from every
+        table and index in one batch. Returns a report of how many
+        objects of each kind were removed and how long it took
+        """
+        started = time.perf_counter()
+        if self.tiers is not None:
+            # the tree may have been evicted since object_to_delete was read
+            self.fetch(type(object_to_delete), getattr(object_to_delete, 'key', None))
+        subtree = self._collect_subtree(object_to_delete)
+        with self.backend.atomic():
+            removed = self._remove_subtree(object_to_delete, subtree)
+        self.notify_deleted(object_to_delete)
+        report = {
+            'users': removed.get(User, 0),
+            'recipe_categories': removed.get(RecipeCategory, 0),
+            'recipes': removed.get(Recipe, 0),
+            'recipe_steps': removed.get(RecipeStep, 0),
+        }
+        report['objects'] = sum(report.values())
+        report['seconds'] = round(time.perf_counter() - started, 6)
+        return report
+
+    def _collect_subtree(self, root):
+        """
+        Returns (model, keys) pairs for root and the objects under it,
+        one level at a time from the top. Only the objects that have
+        children are read, so the steps cost no more than their keys
+        """
+        model = type(root)
+        table = self.get_table(model)
+        if root.key not in table:
+            raise KeyError('%s does not exist' % str(model))
+        subtree = [(model, [root.key])]
+        parents = [root]
+        while model in CHILD_TYPES:
+            attribute = model.children_attribute
+            model = CHILD_TYPES[model]
+            keys = [key for parent in parents for key in getattr(parent, attribute)]
+            if model in CHILD_TYPES:
+                table = self.get_table(model)
+                parents = [obj for obj in map(table.get, keys) if obj is not None]
+                keys = [obj.key for obj in parents]
+            subtree.append((model, keys))
+        return subtree
+
+    def _remove_subtree(self, root, subtree):
+        """
+        Removes the keys of subtree from the tables, key indexes and
+        secondary indexes, and root from its parent's children.
+        Returns the number of objects removed by model
+        """
+        if type(root) in PARENT_FIELDS:
+            field, parent_model = PARENT_FIELDS[type(root)]
+            parent = self.get_table(parent_model).get(getattr(root, field))
+            if parent is not None:
+                # keep the parent's child index free of dangling keys
+                getattr(parent, parent_model.children_attribute).discard(root.key)
+        removed = {}
+        for model, keys in subtree:
+            table = self.get_table(model)
+            key_index = self._key_index(model)
+            count = 0
+            for key in keys:
+                try:
+                    del table[key]
+                except KeyError:
+                    # a child key left behind by an earlier failure
+                    continue
+                key_index.discard(key)
+                count += 1
+            for index in self.indexes.get(model, {}).values():
+                index.discard_many(keys)
+            removed[model] = count
+        return removed
 
-            if type_of_object == RecipeStep:
-                return self.__get_max_value(self.recipe_step_keys) + 1
+    def _key_index(self, type_of_object):
+        """Returns the index of the keys of type_of_object"""
+        return {
+            User: self.user_keys,
+            RecipeCategory: self.recipe_category_keys,
+            Recipe: self.recipe_keys,
+            RecipeStep: self.recipe_step_keys,
+        }[type_of_object]
 
-    def __get_max_value(self, unsorted_list):
-        """Returns the maximum value of a list or 0 if list is empty"""
-        if check_type(unsorted_list, list):
-            length = len(unsorted_list)
-            if length == 0:
-                return 0
+    @exclusive
+    def delete_later(self, object_to_delete):
+        """
+        Deletes object_to_delete in constant time by hiding it: it is
+        taken out of its table, its indexes and its parent, and left as
+        a tombstone. The objects under it are invisible from then on
+        and are reclaimed by compact(), e.g. from a Compactor thread.
+        Only the processes sharing this memory would see the tombstones,
+        so it cannot be used with a shared backend
+        """
+        if self.backend.shared:
+            raise ValueError('Deletes cannot be deferred on a shared backend')
+        model = type(object_to_delete)
+        if model not in CHILD_TYPES:
+            # an object without children is as cheap to delete outright
+            self.delete_object(object_to_delete)
+            return
+        object_to_delete = self.fetch(model, object_to_delete.key)
+        if object_to_delete is None:
+            raise KeyError('%s does not exist' % str(model))
+        self.tombstones[(model, object_to_delete.key)] = object_to_delete
+        self._remove_subtree(object_to_delete, [(model, [object_to_delete.key])])
+        self.notify_deleted(object_to_delete)
 
-            unsorted_list.sort()
-            return unsorted_list[length - 1]
+    def is_tombstone(self, obj):
+        """Returns True if obj was hidden by delete_later and is being compacted"""
+        return (type(obj), obj.key) in self.tombstones
 
+    def is_visible(self, obj):
+        """
+        Returns False if obj hangs under an object hidden by delete_later,
+        i.e. one of its ancestors is no longer in its table
+        """
+        if not self.tombstones:
+            return True
+        model = type(obj)
+        while model in PARENT_FIELDS:
+            field, model = PARENT_FIELDS[model]
+            obj = self.get_table(model).get(getattr(obj, field))
+            if obj is None:
+                return False
+        return True
 
-    def delete_object(self, object_to_delete):
+    @exclusive
+    def compact(self, seconds=None):
+        """
+        Reclaims the objects under the tombstones left by delete_later,
+        oldest first, for about seconds or until none are left. Listeners
+        with an objects_compacted(compacted) method are given the
+        (type name, keys) reclaimed; the others were already told about
+        the deletion of the root. Returns the number of objects reclaimed
         """
-        Depending on the object type, delete object from
-        the dict where its type is
-        """
-        # store the type of object in a variable
-        # check that variable against all the possible
-        # Object types and locate the dict
-        # then call del(approriate_dict[object_to_delete.key])
-        object_type = type(object_to_delete)
-        object_dict = {}
-        object_keys_list = []
-        object_key_map = {}
-        object_mapper = ''
-        cascaded_objects = []
-        if object_type == RecipeCategory:
-            object_dict = self.recipe_categories
-            object_keys_list = self.recipe_category_keys
-            object_key_map = self.recipe_category_name_key_map
-            object_mapper = object_to_delete.name
-            cascaded_objects = object_to_delete.get_all_recipes(self)
-
-        elif object_type == Recipe:
-            object_dict = self.recipes
-            object_keys_list = self.recipe_keys
-            object_key_map = self.recipe_name_key_map
-            object_mapper = object_to_delete.name
-            cascaded_objects = object_to_delete.get_all_steps(self)
-
-        elif object_type == RecipeStep:
-            object_dict = self.recipe_steps
-            object_keys_list = self.recipe_step_keys   
+        deadline = None if seconds is None else time.perf_counter() + seconds
+        removed = {}
+        while self.tombstones:
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            if self._compacting is None:
+                self._compacting = next(iter(self.tombstones))
+                root = self.tombstones[self._compacting]
+                self._compaction = [self._children_of(root)]
+            if not self._compaction:
+                del self.tombstones[self._compacting]
+                self._compacting = None
+                continue
+            model, keys = self._compaction.pop()
+            table = self.get_table(model)
+            key_index = self._key_index(model)
+            # one key at a time, since rebuilding a sorted index in one
+            # pass would take longer than a slice
+            indexes = list(self.indexes.get(model, {}).values())
+            reclaimed = removed.setdefault(model, [])
+            for key in keys:
+                obj = table.pop(key, None)
+                if obj is None:
+                    continue
+                key_index.discard(key)
+                for index in indexes:
+                    index.discard(key)
+                reclaimed.append(key)
+                if model in CHILD_TYPES:
+                    self._compaction.append(self._children_of(obj))
+                if deadline is not None and time.perf_counter() >= deadline:
+                    # the rest of this level is left for the next slice
+                    self._compaction.append((model, keys))
+                    break
+        compacted = [(model.__name__, keys) for model, keys in removed.items() if keys]
+        if compacted:
+            for listener in self.listeners:
+                objects_compacted = getattr(listener, 'objects_compacted', None)
+                if objects_compacted is not None:
+                    objects_compacted(compacted)
+        return sum(len(keys) for keys in removed.values())
 
-        else:
-            raise TypeError('%s type does not exist in database' % str(object_type)) 
+    @staticmethod
+    def _children_of(obj):
+        """Returns (child model, iterator over child keys) of obj"""
+        model = type(obj)
+        return CHILD_TYPES[model], iter(getattr(obj, model.children_attribute))
 
-        try:
-            del(object_dict[object_to_delete.key])
-            object_keys_list.remove(object_to_delete.key)
-            if object_mapper:
-                del(object_key_map[object_mapper])
-            # delete child componet objects
-            for cascaded_object in cascaded_objects:
-                self.delete_object(cascaded_object)
-        except KeyError:
-            raise KeyError('%s does not exist' % str(object_type))        
-
-    
+    @shared
+    def fetch(self, type_of_object, key):
+        """
+        Returns the object of type_of_object under key or None. With
+        tiering enabled, an object whose user was evicted is faulted
+        back in with the rest of the user's tree
+        """
+        obj = self.get_table(type_of_object).get(key)
+        if self.tiers is None:
+            return obj
+        if obj is None:
+            return self._fault_in(type_of_object, key)
+        self.tiers.touch(self.owner_of(obj))
+        return obj
+
+    def owner_of(self, obj):
+        """Returns the key of the user obj belongs to or None if it is hidden"""
+        model = type(obj)
+        while model in PARENT_FIELDS:
+            field, model = PARENT_FIELDS[model]
+            obj = self.get_table(model).get(getattr(obj, field))
+            if obj is None:
+                return None
+        return obj.key
+
+    def _fault_in(self, type_of_object, key):
+        """
+        Reads the tree holding the object under key back from the tiered
+        store and returns the object, or None if it is not there either.
+        The tables are only changed under the exclusive lock, which a
+        reader takes through lock.upgraded(), so other readers never see
+        half a tree. An object saved again since its tree was evicted is
+        newer than its copy on disk and is kept
+        """
+        tiers = self.tiers
+        if tiers.owner(type_of_object.__name__, key) is None:
+            return None
+        with self.lock.upgraded():
+            # a writer may have faulted it in or deleted it while this
+            # thread waited
+            obj = self.get_table(type_of_object).get(key)
+            if obj is not None:
+                return obj
+            user_key = tiers.owner(type_of_object.__name__, key)
+            if user_key is None:
+                return None
+            builders = {}
+            for type_name, fields, children in tiers.take(user_key):
+                model = MODEL_TYPES[type_name]
+                table = self.get_table(model)
+                if fields['key'] in table:
+                    continue
+                if model not in builders:
+                    builders[model] = self._build_from_snapshot(model)
+                table[fields['key']] = builders[model](fields, children)
+            return self.get_table(type_of_object).get(key)
+
+    @exclusive
+    def evict_user(self, user_key):
+        """
+        Moves the user and everything under it to the tiered store and
+        out of the tables. The key and secondary indexes keep them, so
+        they are still found and are faulted back in when looked up.
+        Returns the number of objects evicted. Raises ValueError while
+        a background save holds the tiered store
+        """
+        if self.tiers is None:
+            raise ValueError('Tiering is not enabled')
+        if self.tiers.holds:
+            raise ValueError('Users cannot be evicted during a background save')
+        user = self.users.get(user_key)
+        if user is None:
+            raise KeyError('%s does not exist' % str(User))
+        # a build only reads the tables, so it must not come after this
+        for index in (self.search_index, self.fuzzy_index, self.user_counts):
+            if index is not None:
+                index.build()
+        subtree = self._collect_subtree(user)
+        rows = []
+        for model, keys in subtree:
+            table = self.get_table(model)
+            attribute = getattr(model, 'children_attribute', None)
+            for key in keys:
+                obj = table.get(key)
+                if obj is not None:
+                    rows.append((model.__name__, key, obj.to_record(),
+                                 list(getattr(obj, attribute)) if attribute else None))
+        self.tiers.put(user_key, rows)
+        for model, keys in subtree:
+            table = self.get_table(model)
+            for key in keys:
+                table.pop(key, None)
+        return len(rows)
+
+    @exclusive
     def create_user(self, user_data):
         """Creates a new user and adds the user to self.users"""
-        try:
-            if self.user_email_key_map[user_data['email']]:
+        email = user_data.get('email')
+        # a shared backend's transaction keeps other processes from
+        # taking the email between the check and the save
+        with self.backend.atomic():
+            if isinstance(email, str) and self.find_one(User, 'email', email):
                 raise ValueError('User already exists')
-        except KeyError:
-            # if the key does not exist, pass
-            pass
-        user_key = self.get_next_key(User)
-        try:
-            user = User(**user_data, key=user_key)
-            user.save(self)
-        except:
-            raise ValueError('invalid user data')
+            user_key = self.get_next_key(User)
+            try:
+                user = User(**user_data, key=user_key)
+            except:
+                raise ValueError('invalid user data')
+            try:
+                user.save(self)
+            except ValueError:
+                raise ValueError('User already exists')
+            except:
+                raise ValueError('invalid user data')
         return user
 
+    @shared
     def get_user(self, user_key):
         """
         returns the User object corresponding to user_key or
         None if user does not exist
         """
         if check_type(user_key, int):
-            try:
-                user = self.users[user_key]
-            except KeyError:
-                return None
-            return user
+            return self.fetch(User, user_key)
 
+    @shared
     def get_user_by_email(self, email):
         """
         Returns a user object corresponding to the email
         passed in or None is user does not exist
         """
         if check_type(email, str):
-            try:
-                user_key = self.user_email_key_map[email]
-            except KeyError:
-                return None
-            return self.get_user(user_key)
-        
+            return self.find_one(User, 'email', email)
+
+    @shared
+    def get_recipe_category_by_name(self, user_key, name):
+        """
+        Returns the user's RecipeCategory called name in O(1)
+        or None if the user has no such category
+        """
+        if check_type(user_key, int) and check_type(name, str):
+            return self.find_one(RecipeCategory, 'name', (user_key, name))
+
+    @shared
+    def get_recipe_by_name(self, recipe_category_key, name):
+        """
+        Returns the Recipe called name in the category in O(1)
+        or None if the category has no such recipe
+        """
+        if check_type(recipe_category_key, int) and check_type(name, str):
+            return self.find_one(Recipe, 'name', (recipe_category_key, name))
+
+    @shared
+    def suggest_recipe_categories(self, user_key, prefix, limit=10):
+        """
+        Returns up to limit of the user's categories whose names start
+        with prefix, ignoring case, in name order. It costs O(log n + limit)
+        """
+        if check_type(user_key, int) and check_type(prefix, str) \
+        and check_type(limit, int):
+            prefix = fold(prefix)
+            return self.find_range(RecipeCategory, 'prefix', (user_key, prefix),
+                                   (user_key, prefix + PREFIX_END), limit)
+
+    @shared
+    def suggest_recipes(self, user_key, prefix, limit=10):
+        """
+        Returns up to limit of the user's recipes whose names start with
+        prefix, ignoring case, in name order. Each category of the user
+        is one range of the index so no other recipe is looked at
+        """
+        if check_type(user_key, int) and check_type(prefix, str) \
+        and check_type(limit, int):
+            user = self.fetch(User, user_key)
+            if user is None:
+                return []
+            prefix = fold(prefix)
+            index = self.get_index(Recipe, 'prefix')
+            matches = []
+            for category_key in user.recipe_categories:
+                matches.extend((value[1], key) for value, key in index.range_items(
+                    (category_key, prefix), (category_key, prefix + PREFIX_END), limit))
+            # only the recipes that make the cut are read from the table
+            return [self.fetch(Recipe, key) for _, key in heapq.nsmallest(limit, matches)]
+
+    def get_index(self, model, index_name):
+        """Returns the secondary index called index_name that model declares"""
+        try:
+            return self.indexes[model][index_name]
+        except (KeyError, TypeError):
+            raise KeyError('%s has no index called %s' % (str(model), index_name))
+
+    @shared
+    def find(self, model, index_name, value):
+        """Returns the objects of model indexed under value in key order"""
+        return [obj for obj in (self.fetch(model, key)
+                                for key in self.get_index(model, index_name).keys(value))
+                if obj is not None and self.is_visible(obj)]
+
+    @shared
+    def find_one(self, model, index_name, value):
+        """Returns the object of model indexed under value or None"""
+        key = self.get_index(model, index_name).first(value)
+        if key is None:
+            return None
+        obj = self.fetch(model, key)
+        # indexed values hold the parent key, so the objects under one
+        # value are either all under a tombstone or none of them are
+        return obj if obj is not None and self.is_visible(obj) else None
+
+    @shared
+    def find_range(self, model, index_name, low=None, high=None, limit=None):
+        """
+        Returns up to limit objects of model indexed at or above low and
+        below high, in value order. Only sorted indexes have an order
+        """
+        index = self.get_index(model, index_name)
+        if index.kind != SORTED:
+            raise ValueError('%s is not a sorted index' % index_name)
+        return [obj for obj in (self.fetch(model, key) for key in index.range(low, high, limit))
+                if obj is not None and self.is_visible(obj)]
+
+    def index_object(self, obj):
+        """
+        Brings the secondary indexes of obj's model up to date with obj.
+        Nothing is changed if a unique index holds obj's value for
+        another object; ValueError is raised instead
+        """
+        indexes = self.indexes.get(type(obj))
+        if not indexes:
+            return
+        values = []
+        for declaration in type(obj).indexes:
+            index = indexes[declaration.name]
+            value = declaration.value_of(obj)
+            if not index.allows(value, obj.key):
+                raise ValueError('%s with %s %r already exists'
+                                 % (type(obj).__name__, declaration.name, value))
+            values.append((declaration, index, value))
+        # a shared backend checks uniqueness as it writes, and its
+        # transaction takes back the entries added before a refusal
+        with self.backend.atomic():
+            for declaration, index, value in values:
+                try:
+                    index.add(value, obj.key)
+                except ValueError:
+                    raise ValueError('%s with %s %r already exists'
+                                     % (type(obj).__name__, declaration.name, value))
+
+    def unindex_object(self, obj):
+        """Removes obj from the secondary indexes of its model"""
+        for index in self.indexes.get(type(obj), {}).values():
+            index.discard(obj.key)
+
+    @shared
     def get_recipe_category(self, recipe_category_key):
         """
         Returns the RecipeCategory object if it exists
         or None if it doesn't
         """
         if check_type(recipe_category_key, int):
-            try:
-                recipe_category = self.recipe_categories[recipe_category_key]
-            except KeyError:
+            recipe_category = self.fetch(RecipeCategory, recipe_category_key)
+            if recipe_category is None:
                 return None
-            return recipe_category
+            # objects under a tombstone are gone as far as readers know
+            return recipe_category if self.is_visible(recipe_category) else None
 
+    @shared
     def get_recipe(self, recipe_key):
         """
         Returns the Recipe object if it exists
         or None if it doesn't
         """
         if check_type(recipe_key, int):
-            try:
-                recipe = self.recipes[recipe_key]
-            except KeyError:
+            recipe = self.fetch(Recipe, recipe_key)
+            if recipe is None:
                 return None
-            return recipe
+            return recipe if self.is_visible(recipe) else None
 
+    @shared
     def get_recipe_step(self, recipe_step_key):
         """
         Returns the RecipeStep object if it exists
         or None if it doesn't
         """
         if check_type(recipe_step_key, int):
-            try:
-                recipe_step = self.recipe_steps[recipe_step_key]
-            except KeyError:
+            recipe_step = self.fetch(RecipeStep, recipe_step_key)
+            if recipe_step is None:
                 return None
-            return recipe_step
+            return recipe_step if self.is_visible(recipe_step) else None
 
 
 class User:
     """
     Any user who interfaces with the app falls in this category
     """
+    # the attribute holding the index of child keys
+    # no per-instance __dict__, since every user stays in memory
+    __slots__ = ('key', 'first_name', 'last_name', 'email', 'password',
+                 'recipe_categories')
+    children_attribute = 'recipe_categories'
+    # the secondary indexes the Database keeps for users
+    indexes = (Indexed('email', unique=True),)
+
     def __init__(self, key, first_name, last_name, email, password):
         if check_type(key, int):
             self.key = key
@@ -232,27 +1036,34 @@ class User:
                 self.email = email
         if check_type(password, str):
             self.password = password
-        # a list of recipe_category keys
-        self._recipe_categories = []
+        # the ordered index of recipe_category keys
+        self.recipe_categories = ChildIndex()
 
-    @property
-    def recipe_categories(self):
-        self._recipe_categories = list(set(self._recipe_categories))
-        return self._recipe_categories
+    def to_record(self):
+        """Returns the fields needed to rebuild this user"""
+        return dict(key=self.key, first_name=self.first_name,
+                    last_name=self.last_name, email=self.email,
+                    password=self.password)
 
     def add_recipe_category(self, key):
-        """Adds a new recipe category key to self._recipe_categories"""
-        self._recipe_categories.append(key)
+        """Adds a new recipe category key to self.recipe_categories"""
+        self.recipe_categories.add(key)
 
+    @exclusive
     def save(self, database):
         """Saves user to the database appropriately"""
         # add self's key to db's set of user keys
         # Add self to db.users dict with key as self.key
         if check_type(database, Database):
-            database.user_keys.append(self.key)
-            database.users[self.key] = self
-            database.user_email_key_map[self.email] = self.key
+            with database.backend.atomic():
+                # raises before anything is stored if the email is taken
+                database.index_object(self)
+                database.user_keys.add(self.key)
+                database.key_sequences.observe(User, self.key)
+                database.users[self.key] = self
+                database.notify_saved(self)
 
+    @exclusive
     def create_recipe_category(self, database, recipe_category_data):
         """
         Creates a new recipe category and
@@ -262,27 +1073,21 @@ class User:
             # get the last recipe category key and add 1 
             key = database.get_next_key(RecipeCategory)
             try:
-                # save user in database
-                self.save(database)
-                category = RecipeCategory(**recipe_category_data, key=key, user=self.key)
-                category.save(database)
+                # save user in database, in one transaction with the new category
+                with database.backend.atomic():
+                    self.save(database)
+                    category = RecipeCategory(**recipe_category_data, key=key, user=self.key)
+                    category.save(database)
             except TypeError:
                 return None
             return category
 
+    @shared
     def get_all_recipe_categories(self, database):
-        """Returns all the user's recipe categories"""
+        """Returns a view of all the user's recipe categories"""
         if check_type(database, Database):
-            local_recipe_categories = []
-            for category in self.recipe_categories:
-                try:
-                    recipe_category_object = database.recipe_categories[category]
-                except KeyError:
-                    self.recipe_categories.remove(category)
-                else:
-                    local_recipe_categories.append(recipe_category_object)
-
-            return local_recipe_categories
+            return IndexView(self.recipe_categories, database.recipe_categories,
+                             database.lock)
 
 
 class RecipeCategory:
@@ -291,6 +1096,14 @@ class RecipeCategory:
     Each RecipeCategory is created and can be deleted by
     one user
     """
+    __slots__ = ('key', 'name', 'description', 'user', 'recipes')
+    children_attribute = 'recipes'
+    # hashed so a user's category is found by name in O(1), and sorted
+    # ignoring case so a user's categories can be listed by name and
+    # suggested as they are typed
+    indexes = (Indexed('name', fields=('user', 'name')),
+               Indexed('prefix', fields=('user', 'name'), kind=SORTED, fold=True))
+
     def __init__(self, key, name, user, description=''):
         if check_type(key, int):
             self.key = key
@@ -303,25 +1116,27 @@ class RecipeCategory:
         # the creator's key. It does not change
         if check_type(user, int):
             self.user = user
-        # the list of child recipe keys
-        self._recipes = []
+        # the ordered index of child recipe keys
+        self.recipes = ChildIndex()
 
-    @property
-    def recipes(self):
-        self._recipes = list(set(self._recipes))
-        return self._recipes
+    def to_record(self):
+        """Returns the fields needed to rebuild this recipe category"""
+        return dict(key=self.key, name=self.name, user=self.user,
+                    description=self.description)
 
+    @exclusive
     def delete(self, database):
-        """Deletes this category of recipes and all recipes in it"""
+        """
+        Deletes this category of recipes and all recipes in it and
+        returns the report of Database.delete_object
+        """
         if check_type(database, Database):
             try:
-                database.delete_object(self)
-                user = database.get_user(self.user)
-                if user:
-                    user.recipe_categories.remove(self.key)
+                return database.delete_object(self)
             except KeyError:
                 raise KeyError('The recipe category is non-existent in database')
 
+    @exclusive
     def create_recipe(self, database, recipe_data):
         """
         Creates a new recipe and
@@ -331,34 +1146,29 @@ class RecipeCategory:
             # get the last recipe key and add 1 
             key = database.get_next_key(Recipe)
             try:
-                # save category in database
-                self.save(database)
-                recipe = Recipe(**recipe_data, key=key, category=self.key)
-                recipe.save(database)
+                # save category in database, in one transaction with the new recipe
+                with database.backend.atomic():
+                    self.save(database)
+                    recipe = Recipe(**recipe_data, key=key, category=self.key)
+                    recipe.save(database)
             except TypeError:
                 return None
             return recipe
 
+    @shared
     def get_all_recipes(self, database):
-        """Returns all recipes under this category"""
+        """Returns a view of all recipes under this category"""
         if check_type(database, Database):
-            local_recipes = []
-            for recipe in self.recipes:
-                try:
-                    recipe_object = database.recipes[recipe]
-                except KeyError:
-                    self.recipes.remove(recipe)
-                else:
-                    local_recipes.append(recipe_object)
-
-            return local_recipes
+            return IndexView(self.recipes, database.recipes, database.lock)
 
+    @exclusive
     def set_description(self, description, database):
         """Edit the description of this recipe category"""
         if check_type(description, str) and check_type(database, Database):
             self.description = description
             self.save(database)
 
+    @exclusive
     def set_name(self, name, database):
         """Edit the name of this recipe category"""
         if check_type(name, str) and check_type(database, Database):
@@ -367,27 +1177,36 @@ class RecipeCategory:
             self.name = name
             self.save(database)
 
+    @exclusive
     def save(self, database):
         """Saves recipe category in db and in user"""
         # add self's key to set of recipe categories of user
         if check_type(database, Database):
-            try:
-                user = database.users[self.user]
-                user.recipe_categories.append(self.key)
-            except KeyError:
+            user = database.fetch(User, self.user)
+            if user is None:
                 raise KeyError('User should be saved in db first')
-            # add self's key to set of db's recipe_category_keys
-            database.recipe_category_keys.append(self.key)
-            # Add self to db.recipe_categories dict with key as self.key
-            database.recipe_categories[self.key] = self
-            # Add self's name and key in db's recipe_category_name_key_map
-            database.recipe_category_name_key_map[self.name] = self.key
+            with database.backend.atomic():
+                # index (user key, name) so a user's category can be found
+                # by name. Raises before anything is stored on a conflict
+                database.index_object(self)
+                user.recipe_categories.add(self.key)
+                # add self's key to set of db's recipe_category_keys
+                database.recipe_category_keys.add(self.key)
+                database.key_sequences.observe(RecipeCategory, self.key)
+                # Add self to db.recipe_categories dict with key as self.key
+                database.recipe_categories[self.key] = self
+                database.notify_saved(self)
 
 
 class Recipe:
     """
     Each recipe are owned by a user and has a category
     """
+    __slots__ = ('key', 'name', 'description', 'category', 'recipe_steps')
+    children_attribute = 'recipe_steps'
+    indexes = (Indexed('name', fields=('category', 'name')),
+               Indexed('prefix', fields=('category', 'name'), kind=SORTED, fold=True))
+
     def __init__(self, key, name, description, category):
         if check_type(key, int):
             self.key = key
@@ -400,61 +1219,76 @@ class Recipe:
         # the category key.
         if check_type(category, int):
             self.category = category
-        self._recipe_steps = []
-        
-    @property
-    def recipe_steps(self):
-        self._recipe_steps = list(set(self._recipe_steps))
-        return self._recipe_steps
+        # the index of child recipe step keys in the order they were authored
+        self.recipe_steps = ChildIndex()
+
+    def to_record(self):
+        """Returns the fields needed to rebuild this recipe"""
+        return dict(key=self.key, name=self.name,
+                    description=self.description, category=self.category)
 
+    @exclusive
     def change_category(self, new_category, database):
-        """Changes the category of the recipe"""
-        # add self's key to new_category's recipe list
-        # remove self's key from old category's recipe list
-        pass
+        """
+        Moves the recipe and its steps to new_category, a RecipeCategory
+        of the same user or its key, see Database.move_recipes
+        """
+        if check_type(database, Database):
+            database.move_recipes([self], new_category)
 
+    @exclusive
     def delete(self, database):
-        """Deleted the recipe and all its steps"""
+        """
+        Deletes the recipe and all its steps and returns the report
+        of Database.delete_object
+        """
         if check_type(database, Database):
             try:
-                database.delete_object(self)
-                category = database.get_recipe_category(self.category)
-                if category:
-                    category.recipes.remove(self.key)
+                return database.delete_object(self)
             except KeyError:
                 raise KeyError('The recipe is non-existent in database')
 
-    def create_step(self, database, recipe_step_data):
+    @exclusive
+    def create_step(self, database, recipe_step_data, position=None):
         """
         Creates a new recipe step and
-        adds it to database.recipe_steps
+        adds it to database.recipe_steps.
+        The step is appended unless a position is given
         """
         if check_type(database, Database):
             # get the last recipe_step key and add 1 
             key = database.get_next_key(RecipeStep)
             try:
-                # save recipe in database
-                self.save(database)
-                recipe_step = RecipeStep(**recipe_step_data, key=key, recipe=self.key)
-                recipe_step.save(database)
+                # save recipe in database, in one transaction with the new recipe step
+                with database.backend.atomic():
+                    self.save(database)
+                    recipe_step = RecipeStep(**recipe_step_data, key=key, recipe=self.key)
+                    recipe_step.save(database)
             except TypeError:
                 return None
+            if position is not None:
+                self.move_step(recipe_step.key, position, database)
             return recipe_step
 
+    @exclusive
+    def move_step(self, recipe_step_key, position, database):
+        """Moves one of this recipe's steps to a new position"""
+        if check_type(recipe_step_key, int) and check_type(position, int)\
+        and check_type(database, Database):
+            try:
+                self.recipe_steps.move(recipe_step_key, position)
+            except KeyError:
+                raise KeyError('The recipe step does not belong to this recipe')
+            database.notify_child_moved(self, recipe_step_key, position)
+
+    @shared
     def get_all_steps(self, database):
-        """returns a list of all steps that belong to self"""
+        """Returns a view of all steps that belong to self in their order"""
         if check_type(database, Database):
-            local_recipe_steps = []
-            for recipe_step in self.recipe_steps:
-                try:
-                    recipe_step_object = database.recipe_steps[recipe_step]
-                except KeyError:
-                    self.recipe_steps.remove(recipe_step)
-                else:
-                    local_recipe_steps.append(recipe_step_object)
-
-            return local_recipe_steps
+            return IndexView(self.recipe_steps, database.recipe_steps,
+                             database.lock)
 
+    @exclusive
     def set_name(self, name, database):
         """Edit the name of this recipe"""
         if check_type(name, str) and check_type(database, Database):
@@ -463,32 +1297,42 @@ class Recipe:
             self.name = name
             self.save(database)
 
+    @exclusive
     def set_description(self, description, database):
         """Edit the description of this recipe"""
         if check_type(description, str) and check_type(database, Database):
             self.description = description
             self.save(database)
 
+    @exclusive
     def save(self, database):
         """
         Saves the recipe to the db and to the category's set of recipes
         """
         if check_type(database, Database):
-            try:
-                category = database.recipe_categories[self.category]
-                category.recipes.append(self.key)
-            except KeyError:
+            category = database.fetch(RecipeCategory, self.category)
+            if category is None:
                 raise KeyError('Category should be saved in db first')
-            # add self's key to set of db's recipe_keys
-            database.recipe_keys.append(self.key)
-            # Add self to db.recipes dict with key as self.key
-            database.recipes[self.key] = self
-            # Add self's name and key in db's recipe_name_key_map
-            database.recipe_name_key_map[self.name] = self.key
+            with database.backend.atomic():
+                # index (category key, name) so a recipe can be found by name
+                database.index_object(self)
+                category.recipes.add(self.key)
+                # add self's key to set of db's recipe_keys
+                database.recipe_keys.add(self.key)
+                database.key_sequences.observe(Recipe, self.key)
+                # Add self to db.recipes dict with key as self.key
+                database.recipes[self.key] = self
+                database.notify_saved(self)
 
 
 class RecipeStep:
     """Every recipe contains individual steps"""
+    __slots__ = ('key', 'text_content', 'recipe')
+    indexes = ()
+    # how MemoryBackend(columnar=True) lays the steps out in columns
+    int_fields = ('key', 'recipe')
+    text_field = 'text_content'
+
     def __init__(self, key,  text_content, recipe):
         if check_type(key, int):
             self.key = key
@@ -503,17 +1347,24 @@ class RecipeStep:
         self.recipe = recipe
         self.text_content = text_content
 
+    def to_record(self):
+        """Returns the fields needed to rebuild this recipe step"""
+        return dict(key=self.key, text_content=self.text_content,
+                    recipe=self.recipe)
+
+    @exclusive
     def delete(self, database):
-        """Deleted the recipe step"""
+        """
+        Deletes the recipe step and returns the report of
+        Database.delete_object
+        """
         if check_type(database, Database):
             try:
-                database.delete_object(self)
-                recipe = database.get_recipe(self.recipe)
-                if recipe:
-                    recipe.recipe_steps.remove(self.key)
+                return database.delete_object(self)
             except KeyError:
                 raise KeyError('The recipe step is non-existent in database')
 
+    @exclusive
     def set_text_content(self, text_content, database):
         """Edit the text_content of this recipe step"""
         if check_type(text_content, str) and check_type(database, Database):
@@ -522,22 +1373,166 @@ class RecipeStep:
             self.text_content = text_content
             self.save(database)
 
+    @exclusive
     def save(self, database):
         """
         Save this object's key in parent recipe's set of recipe steps
         and in db
         """
         if check_type(database, Database):
-            try:
-                recipe = database.recipes[self.recipe]
-                recipe.recipe_steps.append(self.key)
-            except KeyError:
+            recipe = database.fetch(Recipe, self.recipe)
+            if recipe is None:
                 raise KeyError('Recipe should be saved in db first')
-            # add self's key to set of db's recipe_step_keys
-            database.recipe_step_keys.append(self.key)
-            # Add self to db.recipe_steps dict with key as self.key
-            database.recipe_steps[self.key] = self
+            with database.backend.atomic():
+                recipe.recipe_steps.add(self.key)
+                # add self's key to set of db's recipe_step_keys
+                database.recipe_step_keys.add(self.key)
+                database.key_sequences.observe(RecipeStep, self.key)
+                # Add self to db.recipe_steps dict with key as self.key
+                database.recipe_steps[self.key] = self
+                database.notify_saved(self)
+
+
+class Transaction:
+    """
+    Stages creates, updates and deletes and applies them in one pass.
+        with db.transaction() as transaction:
+            recipe = transaction.create(Recipe, name='Bread',
+                                        description='', category=1)
+            transaction.create(RecipeStep, text_content='Knead',
+                               recipe=recipe.key)
+    Everything staged is checked before anything is applied, then it
+    is applied under one exclusive lock without re-saving parents and
+    handed to the listeners as one batch, so readers and the write-ahead
+    log see all of it or none. Nothing is applied if the block raises
+    """
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+    def __init__(self, database):
+        if check_type(database, Database):
+            self.database = database
+        # (operation, object, fields) in the order they were staged
+        self.operations = []
+        self.committed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
+
+    def create(self, model, **fields):
+        """
+        Stages a new object of model and returns it. Its key is allocated
+        now so that children can be staged under it
+        """
+        if model not in MODEL_TYPES.values():
+            raise TypeError('%s type does not exist in database' % str(model))
+        obj = model(key=self.database.get_next_key(model), **fields)
+        self.operations.append((self.CREATE, obj, None))
+        return obj
+
+    def update(self, obj, **fields):
+        """Stages new values for some fields of obj"""
+        record = obj.to_record()
+        parent_field = PARENT_FIELDS.get(type(obj), (None,))[0]
+        for name in fields:
+            if name not in record or name in ('key', parent_field):
+                raise ValueError('%s cannot be updated' % str(name))
+        record.update(fields)
+        # the constructor validates the new values
+        type(obj)(**record)
+        self.operations.append((self.UPDATE, obj, fields))
+
+    def delete(self, obj):
+        """Stages the deletion of obj and everything under it"""
+        if type(obj) not in MODEL_TYPES.values():
+            raise TypeError('%s type does not exist in database' % str(type(obj)))
+        self.operations.append((self.DELETE, obj, None))
+
+    def _check(self):
+        """Raises if any staged operation would fail"""
+        database = self.database
+        staged = {}
+        deleted = set()
+        emails = set()
+        email_index = database.get_index(User, 'email')
+
+        def exists(model, key):
+            # the object and all its ancestors are there and not deleted
+            while True:
+                if (model, key) in deleted:
+                    return False
+                obj = staged.get((model, key)) or database.fetch(model, key)
+                if obj is None:
+                    return False
+                if model not in PARENT_FIELDS:
+                    return True
+                field, model = PARENT_FIELDS[model]
+                key = getattr(obj, field)
+
+        for operation, obj, fields in self.operations:
+            model = type(obj)
+            if operation == self.CREATE:
+                if model in PARENT_FIELDS:
+                    field, parent_model = PARENT_FIELDS[model]
+                    if not exists(parent_model, getattr(obj, field)):
+                        raise KeyError('%s should be saved in db first'
+                                       % parent_model.__name__)
+                if model == User:
+                    if email_index.first(obj.email) is not None \
+                    or obj.email in emails:
+                        raise ValueError('User already exists')
+                    emails.add(obj.email)
+                staged[(model, obj.key)] = obj
+            elif not exists(model, obj.key):
+                raise KeyError('%s does not exist' % str(model))
+            elif operation == self.UPDATE and 'email' in fields:
+                owner = email_index.first(fields['email'])
+                if fields['email'] in emails or owner not in (None, obj.key):
+                    raise ValueError('User already exists')
+                emails.add(fields['email'])
+            elif operation == self.DELETE:
+                deleted.add((model, obj.key))
+
+    def commit(self):
+        """Checks and applies the staged operations"""
+        if self.committed:
+            raise ValueError('The transaction has already been committed')
+        database = self.database
+        with database.lock.write():
+            self._check()
+            with database.backend.atomic(), database.batched_notifications():
+                for operation, obj, fields in self.operations:
+                    if operation == self.CREATE:
+                        obj.save(database)
+                    elif operation == self.UPDATE:
+                        for name, value in fields.items():
+                            setattr(obj, name, value)
+                        obj.save(database)
+                    else:
+                        database.delete_object(obj)
+        self.committed = True
+
 
+# The model types by name as used in persisted records
+MODEL_TYPES = {model.__name__: model
+               for model in (User, RecipeCategory, Recipe, RecipeStep)}
+# (table name, model) in the order stats() reports them
+TABLE_NAMES = (('users', User), ('recipe_categories', RecipeCategory),
+               ('recipes', Recipe), ('recipe_steps', RecipeStep))
+# model to (field holding the parent key, parent model)
+PARENT_FIELDS = {
+    RecipeCategory: ('user', User),
+    Recipe: ('category', RecipeCategory),
+    RecipeStep: ('recipe', Recipe),
+}
+# model to the model of its children
+CHILD_TYPES = {parent: model for model, (_, parent) in PARENT_FIELDS.items()}
 
 # A global db
 db = Database()
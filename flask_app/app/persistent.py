@@ -0,0 +1,425 @@
+"""
+This module holds an immutable map and an immutable sequence with
+structural sharing. Changing a PersistentMap returns a new map that
+shares every untouched node with the old one, so old versions stay
+valid and cheap to keep around. The treap behind PersistentSequence
+is changed the same way by ChildIndex, which hands out snapshots of
+its keys in O(1)
+"""
+from collections.abc import Sequence
+from random import random
+
+_BITS = 5
+_WIDTH = 1 << _BITS
+_MASK = _WIDTH - 1
+_EMPTY_NODE = (None,) * _WIDTH
+
+
+class _Leaf:
+    """One key and its value"""
+    __slots__ = ('hash', 'key', 'value')
+
+    def __init__(self, key_hash, key, value):
+        self.hash = key_hash
+        self.key = key
+        self.value = value
+
+
+class _Collision:
+    """Leaves whose keys have the same hash"""
+    __slots__ = ('hash', 'leaves')
+
+    def __init__(self, key_hash, leaves):
+        self.hash = key_hash
+        self.leaves = leaves
+
+
+def _pair(first, second, shift):
+    """Returns a node holding two entries with different hashes"""
+    node = list(_EMPTY_NODE)
+    first_index = (first.hash >> shift) & _MASK
+    second_index = (second.hash >> shift) & _MASK
+    if first_index == second_index:
+        node[first_index] = _pair(first, second, shift + _BITS)
+    else:
+        node[first_index] = first
+        node[second_index] = second
+    return tuple(node)
+
+
+def _combine(entry, leaf, shift):
+    """Returns what replaces entry once leaf is added next to it"""
+    if entry.hash == leaf.hash:
+        if isinstance(entry, _Collision):
+            leaves = tuple(old for old in entry.leaves if old.key != leaf.key)
+            return _Collision(leaf.hash, leaves + (leaf,))
+        return _Collision(leaf.hash, (entry, leaf))
+    return _pair(entry, leaf, shift + _BITS)
+
+
+def _set(node, shift, leaf):
+    """Returns (new node, whether a key was added)"""
+    index = (leaf.hash >> shift) & _MASK
+    entry = node[index]
+    added = False
+    if entry is None:
+        replacement = leaf
+        added = True
+    elif isinstance(entry, _Leaf):
+        if entry.key == leaf.key:
+            replacement = leaf
+        else:
+            replacement = _combine(entry, leaf, shift)
+            added = True
+    elif isinstance(entry, _Collision):
+        replacement = _combine(entry, leaf, shift)
+        if entry.hash == leaf.hash:
+            added = len(replacement.leaves) > len(entry.leaves)
+        else:
+            added = True
+    else:
+        replacement, added = _set(entry, shift + _BITS, leaf)
+    return node[:index] + (replacement,) + node[index + 1:], added
+
+
+def _remove(node, shift, key_hash, key):
+    """Returns the new node, or node itself if key is not in it"""
+    index = (key_hash >> shift) & _MASK
+    entry = node[index]
+    if entry is None:
+        return node
+    if isinstance(entry, _Leaf):
+        if entry.key != key:
+            return node
+        replacement = None
+    elif isinstance(entry, _Collision):
+        leaves = tuple(leaf for leaf in entry.leaves if leaf.key != key)
+        if len(leaves) == len(entry.leaves):
+            return node
+        replacement = leaves[0] if len(leaves) == 1 \
+            else _Collision(entry.hash, leaves)
+    else:
+        replacement = _remove(entry, shift + _BITS, key_hash, key)
+        if replacement is entry:
+            return node
+        if replacement == _EMPTY_NODE:
+            replacement = None
+    return node[:index] + (replacement,) + node[index + 1:]
+
+
+def _insert(node, shift, leaf):
+    """
+    Adds leaf to node in place. Used while building a map whose nodes
+    are still lists. Returns True if a key was added
+    """
+    index = (leaf.hash >> shift) & _MASK
+    entry = node[index]
+    if entry is None:
+        node[index] = leaf
+        return True
+    if isinstance(entry, list):
+        return _insert(entry, shift + _BITS, leaf)
+    if isinstance(entry, _Leaf) and entry.key == leaf.key:
+        node[index] = leaf
+        return False
+    if entry.hash == leaf.hash:
+        replacement = _combine(entry, leaf, shift)
+        node[index] = replacement
+        return not isinstance(entry, _Collision) \
+            or len(replacement.leaves) > len(entry.leaves)
+    child = [None] * _WIDTH
+    child[(entry.hash >> (shift + _BITS)) & _MASK] = entry
+    node[index] = child
+    return _insert(child, shift + _BITS, leaf)
+
+
+def _freeze(node):
+    """Turns a node built by _insert and its children into tuples"""
+    return tuple(_freeze(entry) if isinstance(entry, list) else entry
+                 for entry in node)
+
+
+def _leaves(node):
+    """Yields every leaf under node"""
+    stack = [node]
+    while stack:
+        for entry in stack.pop():
+            if entry is None:
+                continue
+            if isinstance(entry, _Leaf):
+                yield entry
+            elif isinstance(entry, _Collision):
+                for leaf in entry.leaves:
+                    yield leaf
+            else:
+                stack.append(entry)
+
+
+class PersistentMap:
+    """
+    An immutable hash array mapped trie.
+    get is O(log32 n) and set/remove copy only the O(log32 n)
+    nodes on the path to the key
+    """
+    __slots__ = ('_root', '_length')
+
+    def __init__(self, items=()):
+        # build with lists in place then freeze once, which is much
+        # cheaper than copying the path for every item
+        root = [None] * _WIDTH
+        length = 0
+        for key, value in (items.items() if isinstance(items, dict) else items):
+            length += _insert(root, 0, _Leaf(hash(key), key, value))
+        self._root = _freeze(root)
+        self._length = length
+
+    @classmethod
+    def _make(cls, root, length):
+        new_map = cls.__new__(cls)
+        new_map._root = root
+        new_map._length = length
+        return new_map
+
+    def set(self, key, value):
+        """Returns a new map where key holds value"""
+        root, added = _set(self._root, 0, _Leaf(hash(key), key, value))
+        return self._make(root, self._length + added)
+
+    def remove(self, key):
+        """Returns a new map without key. Missing keys are ignored"""
+        root = _remove(self._root, 0, hash(key), key)
+        if root is self._root:
+            return self
+        return self._make(root, self._length - 1)
+
+    def get(self, key, default=None):
+        """Returns the value of key or default"""
+        key_hash = hash(key)
+        node = self._root
+        shift = 0
+        while True:
+            entry = node[(key_hash >> shift) & _MASK]
+            if entry is None:
+                return default
+            if isinstance(entry, _Leaf):
+                return entry.value if entry.key == key else default
+            if isinstance(entry, _Collision):
+                for leaf in entry.leaves:
+                    if leaf.key == key:
+                        return leaf.value
+                return default
+            node = entry
+            shift += _BITS
+
+    def __getitem__(self, key):
+        missing = _Leaf
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _Leaf) is not _Leaf
+
+    def __iter__(self):
+        for leaf in _leaves(self._root):
+            yield leaf.key
+
+    def items(self):
+        """Yields (key, value) pairs"""
+        for leaf in _leaves(self._root):
+            yield leaf.key, leaf.value
+
+    def values(self):
+        """Yields the values"""
+        for leaf in _leaves(self._root):
+            yield leaf.value
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+
+class _Item:
+    """
+    A node of the treap behind PersistentSequence, ordered by label.
+    Nodes are never changed once they are in a tree that was shared
+    """
+    __slots__ = ('label', 'key', 'priority', 'size', 'left', 'right')
+
+    def __init__(self, label, key, priority, left=None, right=None):
+        self.label = label
+        self.key = key
+        self.priority = priority
+        self.left = left
+        self.right = right
+        self.size = 1 + _count(left) + _count(right)
+
+
+def _count(item):
+    """Returns the number of nodes in the subtree rooted at item"""
+    return item.size if item else 0
+
+
+def _copy(item, left, right):
+    """Returns a copy of item with other children"""
+    return _Item(item.label, item.key, item.priority, left, right)
+
+
+def _build(entries):
+    """
+    Returns a treap of (label, key) entries given in label order.
+    The nodes are new so they are linked in place in linear time
+    """
+    stack = []
+    for label, key in entries:
+        item = _Item(label, key, random())
+        # keep the right spine ordered by priority
+        last = None
+        while stack and stack[-1].priority < item.priority:
+            last = stack.pop()
+        item.left = last
+        if stack:
+            stack[-1].right = item
+        stack.append(item)
+    if not stack:
+        return None
+    root = stack[0]
+    # fix up the sizes children first
+    pending = [(root, False)]
+    while pending:
+        item, children_done = pending.pop()
+        if children_done:
+            item.size = 1 + _count(item.left) + _count(item.right)
+            continue
+        pending.append((item, True))
+        if item.left:
+            pending.append((item.left, False))
+        if item.right:
+            pending.append((item.right, False))
+    return root
+
+
+def _join(left, right):
+    """Returns a treap of left followed by right, whose labels are all larger"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        return _copy(left, left.left, _join(left.right, right))
+    return _copy(right, _join(left, right.left), right.right)
+
+
+def _split_at(item, label):
+    """Returns the treaps of the labels below label and of the rest"""
+    if item is None:
+        return None, None
+    if item.label < label:
+        left, right = _split_at(item.right, label)
+        return _copy(item, item.left, left), right
+    left, right = _split_at(item.left, label)
+    return left, _copy(item, right, item.right)
+
+
+def _insert_item(item, label, key, priority):
+    """Returns the treap with a new node, copying the path to it"""
+    if item is None or priority > item.priority:
+        left, right = _split_at(item, label)
+        return _Item(label, key, priority, left, right)
+    if label < item.label:
+        return _copy(item, _insert_item(item.left, label, key, priority), item.right)
+    return _copy(item, item.left, _insert_item(item.right, label, key, priority))
+
+
+def _delete_item(item, label):
+    """Returns the treap without the node of label, copying the path to it"""
+    if label == item.label:
+        return _join(item.left, item.right)
+    if label < item.label:
+        return _copy(item, _delete_item(item.left, label), item.right)
+    return _copy(item, item.left, _delete_item(item.right, label))
+
+
+def _rank(item, label):
+    """Returns the position of the node of label"""
+    position = 0
+    while True:
+        if label < item.label:
+            item = item.left
+        elif label > item.label:
+            position += _count(item.left) + 1
+            item = item.right
+        else:
+            return position + _count(item.left)
+
+
+def _at(item, position):
+    """Returns the node at position, which must be in range"""
+    while True:
+        left_size = _count(item.left)
+        if position < left_size:
+            item = item.left
+        elif position == left_size:
+            return item
+        else:
+            position -= left_size + 1
+            item = item.right
+
+
+def _walk(item):
+    """Yields the nodes in label order"""
+    stack = []
+    while stack or item:
+        while item:
+            stack.append(item)
+            item = item.left
+        item = stack.pop()
+        yield item
+        item = item.right
+
+
+class PersistentSequence(Sequence):
+    """
+    An immutable sequence of keys e.g. the child keys of a frozen
+    object. Indexing is O(log n) and a ChildIndex makes one of its
+    current keys in O(1) since they share the nodes of its treap
+    """
+    __slots__ = ('_root',)
+
+    def __init__(self, keys=()):
+        self._root = _build(enumerate(keys))
+
+    @classmethod
+    def _make(cls, root):
+        sequence = cls.__new__(cls)
+        sequence._root = root
+        return sequence
+
+    def __getitem__(self, position):
+        length = _count(self._root)
+        if position < 0:
+            position += length
+        if not 0 <= position < length:
+            raise IndexError('index out of range')
+        return _at(self._root, position).key
+
+    def __iter__(self):
+        for item in _walk(self._root):
+            yield item.key
+
+    def __len__(self):
+        return _count(self._root)
+
+    def __eq__(self, other):
+        if isinstance(other, (PersistentSequence, tuple, list)):
+            return len(self) == len(other) and tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, list(self))
@@ -0,0 +1,297 @@
+"""
+This module holds the full-text search over recipes.
+Each recipe is one document made of its name, its description and
+the text of its steps. A SearchIndex listens to the Database, keeps
+an inverted index of the documents up to date and ranks matches
+with BM25. Postings are grouped by term frequency and document
+length so a query stops reading once no unread posting could
+lift a document into the results
+"""
+import re
+import threading
+from collections import Counter
+from heapq import nlargest
+from math import log
+from operator import itemgetter
+
+# the BM25 parameters
+K1 = 1.2
+B = 0.75
+# a word of the name counts as this many words of the other fields
+NAME_WEIGHT = 3
+# documents whose lengths agree on this many top bits share a bucket
+LENGTH_BITS = 3
+STOP_WORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from',
+    'if', 'in', 'into', 'is', 'it', 'its', 'no', 'not', 'of', 'on', 'or',
+    'so', 'such', 'that', 'the', 'their', 'then', 'there', 'these', 'they',
+    'this', 'to', 'until', 'was', 'will', 'with'))
+_WORD = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Returns the lowercase words of text that are not stop words"""
+    return [word for word in _WORD.findall(text.lower())
+            if word not in STOP_WORDS]
+
+
+def _band(length):
+    """
+    Returns length rounded down to its top LENGTH_BITS bits, the
+    shortest document length of the band length falls in
+    """
+    shift = max(length.bit_length() - LENGTH_BITS, 0)
+    return length >> shift << shift
+
+
+class SearchIndex:
+    """
+    An inverted index of the recipes of a Database, registered as a
+    listener so it is updated inside the writer's exclusive lock.
+    A change to a recipe or one of its steps re-reads that recipe's
+    document, once per batch however many of its steps changed.
+    The index is built the first time it is searched, so enabling it
+    over a large snapshot does not hold up the boot
+    """
+    def __init__(self, database):
+        self.database = database
+        # readers may build the index while holding the shared lock
+        self._build_lock = threading.Lock()
+        self.rebuild()
+
+    def rebuild(self):
+        """Drops the index so it is built from scratch on first use e.g. after a load"""
+        with self.database.lock.read():
+            self.built = False
+            # recipe key to {term: frequency}
+            self._documents = {}
+            # recipe key to the length of its document
+            self._lengths = {}
+            # term to {(frequency, length band): set of recipe keys}
+            self._postings = {}
+            # term to the number of documents holding it
+            self._document_frequency = {}
+            self._total_length = 0
+            # recipe key to its category key and category key to a set
+            # of recipe keys, to find the documents under a deleted user
+            self._categories = {}
+            self._recipes_of = {}
+
+    def build(self):
+        """Indexes every recipe unless that has been done since rebuild()"""
+        if self.built:
+            return
+        with self.database.lock.read(), self._build_lock:
+            if self.built:
+                return
+            for recipe_key in list(self.database.recipes):
+                self._refresh(recipe_key)
+            # writes wait for the shared lock, so none were missed
+            self.built = True
+
+    def __len__(self):
+        self.build()
+        return len(self._documents)
+
+    def _read(self, recipe):
+        """Returns the {term: frequency} of recipe's document"""
+        words = tokenize(recipe.description)
+        steps = self.database.recipe_steps
+        for step_key in recipe.recipe_steps:
+            step = steps.get(step_key)
+            if step is not None:
+                words.extend(tokenize(step.text_content))
+        frequencies = Counter(words)
+        for term in tokenize(recipe.name):
+            frequencies[term] += NAME_WEIGHT
+        return frequencies
+
+    def _refresh(self, recipe_key):
+        """Brings the document of recipe_key in line with the live recipe"""
+        recipe = self.database.recipes.get(recipe_key)
+        self._file(recipe_key, recipe.category if recipe is not None else None)
+        old_frequencies = self._documents.get(recipe_key)
+        new_frequencies = self._read(recipe) if recipe is not None else None
+        if old_frequencies == new_frequencies:
+            return
+        if old_frequencies is not None:
+            self._unpost(recipe_key, old_frequencies)
+        if new_frequencies:
+            self._post(recipe_key, new_frequencies)
+
+    def _file(self, recipe_key, category_key):
+        """Records recipe_key under category_key, or nowhere if it is None"""
+        old_category_key = self._categories.get(recipe_key)
+        if old_category_key == category_key:
+            return
+        if old_category_key is not None:
+            del self._categories[recipe_key]
+            recipe_keys = self._recipes_of[old_category_key]
+            recipe_keys.discard(recipe_key)
+            if not recipe_keys:
+                del self._recipes_of[old_category_key]
+        if category_key is not None:
+            self._categories[recipe_key] = category_key
+            self._recipes_of.setdefault(category_key, set()).add(recipe_key)
+
+    def _post(self, recipe_key, frequencies):
+        length = sum(frequencies.values())
+        band = _band(length)
+        self._documents[recipe_key] = frequencies
+        self._lengths[recipe_key] = length
+        self._total_length += length
+        for term, frequency in frequencies.items():
+            buckets = self._postings.setdefault(term, {})
+            buckets.setdefault((frequency, band), set()).add(recipe_key)
+            self._document_frequency[term] = \
+                self._document_frequency.get(term, 0) + 1
+
+    def _unpost(self, recipe_key, frequencies):
+        length = self._lengths.pop(recipe_key)
+        band = _band(length)
+        del self._documents[recipe_key]
+        self._total_length -= length
+        for term, frequency in frequencies.items():
+            buckets = self._postings[term]
+            keys = buckets[(frequency, band)]
+            keys.discard(recipe_key)
+            if not keys:
+                del buckets[(frequency, band)]
+            if self._document_frequency[term] == 1:
+                del self._document_frequency[term]
+                del self._postings[term]
+            else:
+                self._document_frequency[term] -= 1
+
+    def _recipe_keys(self, event):
+        """Returns the keys of the recipes whose documents event touches"""
+        if event[0] == 'child_moved':
+            # the order of the steps does not change the ranking
+            return ()
+        obj = event[1]
+        type_name = type(obj).__name__
+        if type_name == 'Recipe':
+            return (obj.key,)
+        if type_name == 'RecipeStep':
+            return (obj.recipe,)
+        if event[0] == 'object_deleted':
+            if self.database.is_tombstone(obj):
+                # its recipes are dropped as they are compacted
+                return ()
+            if type_name == 'RecipeCategory':
+                # a deleted category still holds the keys of its recipes
+                return tuple(obj.recipes)
+            # a deleted user still holds the keys of its categories,
+            # which cannot be read from the tables any more
+            return [key for category_key in obj.recipe_categories
+                    for key in self._recipes_of.get(category_key, ())]
+        return ()
+
+    # Database listener interface
+    def object_saved(self, obj):
+        """Re-reads the recipe obj belongs to"""
+        self.batch_applied([('object_saved', obj)])
+
+    def object_deleted(self, obj):
+        """Drops or re-reads the recipes obj belonged to"""
+        self.batch_applied([('object_deleted', obj)])
+
+    def child_moved(self, parent, child_key, position):
+        """Does nothing since order does not affect ranking"""
+        pass
+
+    def objects_compacted(self, compacted):
+        """Drops the documents of the recipes compacted"""
+        if not self.built:
+            return
+        for type_name, keys in compacted:
+            if type_name == 'Recipe':
+                for recipe_key in keys:
+                    self._refresh(recipe_key)
+
+    def batch_applied(self, events):
+        """Re-reads every recipe touched by a batch once"""
+        if not self.built:
+            # the build will read the recipes as they are then
+            return
+        changed = set()
+        for event in events:
+            changed.update(self._recipe_keys(event))
+        for recipe_key in changed:
+            self._refresh(recipe_key)
+
+    def search(self, query, limit=10):
+        """
+        Returns up to limit (recipe key, score) pairs for the recipes
+        holding any word of query, best first
+        """
+        terms = set(tokenize(query))
+        self.build()
+        with self.database.lock.read():
+            return self._search(terms, limit)
+
+    def _search(self, terms, limit):
+        count = len(self._documents)
+        if not count or limit < 1:
+            return []
+        average_length = self._total_length / count
+        # K1 * (1 - B + B * length / average_length) is base + scale * length
+        base = K1 * (1 - B)
+        scale = K1 * B / average_length
+        # every bucket with the best score a document in it can get
+        buckets = []
+        for term in terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            frequency_of_term = self._document_frequency[term]
+            idf = log(1 + (count - frequency_of_term + 0.5) / (frequency_of_term + 0.5))
+            for (frequency, band), keys in postings.items():
+                numerator = idf * frequency * (K1 + 1)
+                denominator = frequency + base
+                bound = numerator / (denominator + scale * band)
+                buckets.append((bound, numerator, denominator, keys, term))
+        buckets.sort(key=itemgetter(0), reverse=True)
+        # remaining[i] is the most buckets i onwards can add to a score.
+        # A document is in one bucket per term, so each term adds the
+        # bound of its best unread bucket
+        remaining = [0.0] * (len(buckets) + 1)
+        best = {}
+        for position in range(len(buckets) - 1, -1, -1):
+            bound, term = buckets[position][0], buckets[position][4]
+            remaining[position] = remaining[position + 1] + bound - best.get(term, 0.0)
+            best[term] = bound
+
+        lengths = self._lengths
+        scores = {}
+        # the limit-th best score so far, a lower bound of the final one
+        threshold = 0.0
+        read = checked = 0
+        stopped_at = len(buckets)
+        for position, (bound, numerator, denominator, keys, _) in enumerate(buckets):
+            if len(scores) >= limit:
+                if threshold < remaining[position] \
+                and len(keys) + read - checked >= len(scores):
+                    # only worth it when it costs less than the reading it may save
+                    threshold = nlargest(limit, scores.values())[-1]
+                    checked = read
+                if threshold >= remaining[position]:
+                    # documents not seen yet cannot make the results
+                    stopped_at = position
+                    break
+            get_score = scores.get
+            for key in keys:
+                scores[key] = get_score(key, 0.0) \
+                    + numerator / (denominator + scale * lengths[key])
+            read += len(keys)
+        if stopped_at == len(buckets):
+            return nlargest(limit, scores.items(), key=itemgetter(1))
+
+        # finish the scores of the documents that can still make it from
+        # the unread buckets, which hold the rest of their terms
+        floor = threshold - remaining[stopped_at]
+        candidates = {key: score for key, score in scores.items() if score >= floor}
+        for _, numerator, denominator, keys, _ in buckets[stopped_at:]:
+            for key in candidates.keys() & keys:
+                candidates[key] += numerator / (denominator + scale * lengths[key])
+        return nlargest(limit, candidates.items(), key=itemgetter(1))
@@ -0,0 +1,96 @@
+"""
+This module holds the key sequences used by the Database
+to allocate primary keys for each type of model object
+"""
+from app.utilities import check_type
+
+
+class KeySequence:
+    """
+    A monotonic counter of keys for one type of object.
+    Keys are never handed out twice, even after the objects
+    holding them are deleted
+    """
+    def __init__(self, last_key=0):
+        self.restore(last_key)
+
+    @property
+    def last_key(self):
+        """The largest key that has been allocated or observed so far"""
+        return self._last_key
+
+    def next_key(self):
+        """Allocates and returns the next key in O(1)"""
+        self._last_key += 1
+        return self._last_key
+
+    def next_keys(self, count):
+        """Allocates a block of count consecutive keys and returns them as a range"""
+        if check_type(count, int) and count < 0:
+            raise ValueError('count should not be negative')
+        first_key = self._last_key + 1
+        self._last_key += count
+        return range(first_key, self._last_key + 1)
+
+    def observe(self, key):
+        """
+        Moves the counter forward if key was assigned outside
+        of this sequence e.g. when an object is saved with an explicit key
+        """
+        if check_type(key, int):
+            if key > self._last_key:
+                self._last_key = key
+
+    def restore(self, last_key):
+        """Resets the counter to a previously persisted value"""
+        if check_type(last_key, int):
+            if last_key < 0:
+                raise ValueError('last_key should not be negative')
+            self._last_key = last_key
+
+
+class KeySequences:
+    """
+    Holds one KeySequence per type of object so that
+    the whole set can be persisted and restored together
+    """
+    def __init__(self, *types_of_objects):
+        self._sequences = {}
+        for type_of_object in types_of_objects:
+            self.register(type_of_object)
+
+    def register(self, type_of_object, last_key=0):
+        """Adds a new sequence for type_of_object"""
+        if check_type(type_of_object, type):
+            self._sequences[type_of_object] = KeySequence(last_key)
+
+    def get(self, type_of_object):
+        """Returns the sequence for type_of_object or raises KeyError"""
+        if check_type(type_of_object, type):
+            try:
+                return self._sequences[type_of_object]
+            except KeyError:
+                raise KeyError('No key sequence for %s' % str(type_of_object))
+
+    def next_key(self, type_of_object):
+        """Allocates the next key for type_of_object"""
+        return self.get(type_of_object).next_key()
+
+    def next_keys(self, type_of_object, count):
+        """Allocates a block of count keys for type_of_object"""
+        return self.get(type_of_object).next_keys(count)
+
+    def observe(self, type_of_object, key):
+        """Records that key is in use by an object of type_of_object"""
+        self.get(type_of_object).observe(key)
+
+    def state(self):
+        """Returns a dict of type name to last key, suitable for persisting"""
+        return {type_of_object.__name__: sequence.last_key
+                for type_of_object, sequence in self._sequences.items()}
+
+    def restore(self, state):
+        """Restores the counters from a dict returned by state()"""
+        if check_type(state, dict):
+            for type_of_object, sequence in self._sequences.items():
+                sequence.restore(state.get(type_of_object.__name__, 0))
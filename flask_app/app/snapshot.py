@@ -0,0 +1,359 @@
+"""
+This module reads and writes compact binary snapshots of the Database.
+
+A snapshot file is laid out as
+    magic
+    for each table:
+        records            (packed fields followed by the child keys)
+        sorted keys        (int64 array, 8 byte aligned)
+        record offsets     (uint64 array, one more than the keys)
+    for each secondary index:
+        keys               (int64 array, 8 byte aligned)
+        values             (a JSON array, one value per key)
+    a JSON header with the position of every section
+    the header's offset and length, then magic again.
+Loading memory-maps the file and reads only the header. Objects are
+decoded the first time they are accessed and each secondary index
+the first time it is used, all its values with one json.loads
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections.abc import MutableMapping
+from app.utilities import check_type
+from app.indexes import LazyIndex
+from app.stats import table_bytes
+
+# version 4 holds the values of each secondary index as one JSON array
+MAGIC = b'YUMSNAP4'
+_LENGTH = struct.Struct('<I')
+_INT = struct.Struct('<q')
+# offset and length of the header
+_TRAILER = struct.Struct('<QI')
+
+# the fields of each model in the order they are packed.
+# 'q' fields are ints, 's' fields are strings
+SCHEMAS = {
+    'User': (('key', 'q'), ('first_name', 's'), ('last_name', 's'),
+             ('email', 's'), ('password', 's')),
+    'RecipeCategory': (('key', 'q'), ('name', 's'), ('user', 'q'),
+                       ('description', 's')),
+    'Recipe': (('key', 'q'), ('name', 's'), ('description', 's'),
+               ('category', 'q')),
+    'RecipeStep': (('key', 'q'), ('text_content', 's'), ('recipe', 'q')),
+}
+
+
+def _pack_record(schema, fields, children):
+    """Packs fields and the list of child keys into bytes"""
+    parts = []
+    for name, kind in schema:
+        if kind == 'q':
+            parts.append(_INT.pack(fields[name]))
+        else:
+            encoded = fields[name].encode('utf-8')
+            parts.append(_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+    parts.append(_LENGTH.pack(len(children)))
+    parts.append(array('q', children).tobytes())
+    return b''.join(parts)
+
+
+def _unpack_record(schema, buffer, position):
+    """Returns the fields and child keys packed at position"""
+    fields = {}
+    for name, kind in schema:
+        if kind == 'q':
+            fields[name] = _INT.unpack_from(buffer, position)[0]
+            position += _INT.size
+        else:
+            length = _LENGTH.unpack_from(buffer, position)[0]
+            position += _LENGTH.size
+            fields[name] = str(buffer[position:position + length], 'utf-8')
+            position += length
+    count = _LENGTH.unpack_from(buffer, position)[0]
+    position += _LENGTH.size
+    children = array('q')
+    children.frombytes(buffer[position:position + count * _INT.size])
+    return fields, children
+
+
+def _pad(output):
+    """Pads output with zeros up to the next multiple of 8 bytes"""
+    output.write(b'\0' * (-output.tell() % 8))
+
+
+def write_snapshot(path, tables, indexes, sequences):
+    """
+    Writes a snapshot to path atomically, streaming one record at a time.
+    tables is a list of (type_name, dict of key to object, children
+    attribute or None), indexes is a dict of index name to an index
+    with items() yielding (value, key) and sequences is the state of
+    the key sequences
+    """
+    header = {'byteorder': sys.byteorder, 'sequences': sequences,
+              'tables': {}, 'indexes': {}}
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as output:
+        output.write(MAGIC)
+        for type_name, table, children_attribute in tables:
+            schema = SCHEMAS[type_name]
+            keys = array('q', sorted(table.keys()))
+            offsets = array('Q', [0])
+            records_offset = output.tell()
+            size = 0
+            # objects still undecoded in a loaded snapshot are copied as is
+            raw_record = getattr(table, 'raw_record', None)
+            for key in keys:
+                record = raw_record(key) if raw_record else None
+                if record is None:
+                    obj = table[key]
+                    children = list(getattr(obj, children_attribute)) \
+                        if children_attribute else []
+                    record = _pack_record(schema, obj.to_record(), children)
+                output.write(record)
+                size += len(record)
+                offsets.append(size)
+            _pad(output)
+            keys_offset = output.tell()
+            output.write(keys.tobytes())
+            offsets_offset = output.tell()
+            output.write(offsets.tobytes())
+            header['tables'][type_name] = {
+                'count': len(keys), 'keys': keys_offset,
+                'offsets': offsets_offset, 'records': records_offset}
+        for name, index in indexes.items():
+            # an index still unbuilt since a load is copied as is
+            raw_entries = getattr(index, 'raw_entries', None)
+            entries = raw_entries() if raw_entries else None
+            if entries is None:
+                values, keys = [], array('q')
+                for value, key in index.items():
+                    values.append(value)
+                    keys.append(key)
+                entries = (keys.tobytes(),
+                           json.dumps(values, separators=(',', ':')).encode('utf-8'))
+            encoded_keys, encoded_values = entries
+            _pad(output)
+            header['indexes'][name] = {'count': len(encoded_keys) // _INT.size,
+                                       'keys': output.tell(),
+                                       'values': output.tell() + len(encoded_keys),
+                                       'length': len(encoded_values)}
+            output.write(encoded_keys)
+            output.write(encoded_values)
+        # the header goes last, found through the fixed size trailer
+        header_offset = output.tell()
+        encoded_header = json.dumps(header).encode('utf-8')
+        output.write(encoded_header)
+        output.write(_TRAILER.pack(header_offset, len(encoded_header)))
+        output.write(MAGIC)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(temporary_path, path)
+
+
+class Snapshot:
+    """A memory-mapped snapshot file"""
+    def __init__(self, path):
+        if check_type(path, str):
+            with open(path, 'rb') as snapshot_file:
+                self._mmap = mmap.mmap(snapshot_file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+        self.path = path
+        self._buffer = memoryview(self._mmap)
+        trailer = len(self._buffer) - len(MAGIC) - _TRAILER.size
+        if bytes(self._buffer[:len(MAGIC)]) != MAGIC or trailer < 0 \
+        or bytes(self._buffer[-len(MAGIC):]) != MAGIC:
+            raise ValueError('%s is not a snapshot' % path)
+        start, length = _TRAILER.unpack_from(self._buffer, trailer)
+        self.header = json.loads(str(self._buffer[start:start + length],
+                                     'utf-8'))
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError('%s was written on a machine with a different '
+                             'byte order' % path)
+
+    @property
+    def sequences(self):
+        """The state of the key sequences when the snapshot was taken"""
+        return self.header['sequences']
+
+    def table(self, type_name, build):
+        """
+        Returns a SnapshotTable for type_name. build(fields, children)
+        is called to turn a decoded record into an object
+        """
+        section = self.header['tables'][type_name]
+        count = section['count']
+        keys = self._buffer[section['keys']:
+                            section['keys'] + count * 8].cast('q')
+        offsets = self._buffer[section['offsets']:
+                               section['offsets'] + (count + 1) * 8].cast('Q')
+        return SnapshotTable(self._buffer, keys, offsets, section['records'],
+                             SCHEMAS[type_name], build)
+
+    def keys(self, type_name):
+        """Returns the sorted keys of type_name without copying them"""
+        section = self.header['tables'][type_name]
+        return self._buffer[section['keys']:
+                            section['keys'] + section['count'] * 8].cast('q')
+
+    def index(self, name, declaration):
+        """
+        Returns a LazyIndex over the entries of the secondary index
+        called name, or an empty index if it was not in the snapshot
+        """
+        section = self.header['indexes'].get(name)
+        if section is None:
+            return declaration.new_index()
+        return LazyIndex(declaration, section['count'],
+                         lambda: self.index_entries(name),
+                         lambda: self._index_sections(section))
+
+    def _index_sections(self, section):
+        """Returns the keys and the values of an index section as bytes"""
+        keys = section['keys']
+        return (bytes(self._buffer[keys:keys + section['count'] * _INT.size]),
+                bytes(self._buffer[section['values']:
+                                   section['values'] + section['length']]))
+
+    def index_entries(self, name):
+        """
+        Decodes and returns the (value, key) pairs of the secondary
+        index called name, or None if it was not in the snapshot
+        """
+        section = self.header['indexes'].get(name)
+        if section is None:
+            return None
+        keys = self._buffer[section['keys']:
+                            section['keys'] + section['count'] * _INT.size].cast('q')
+        values = json.loads(str(self._buffer[section['values']:
+                                             section['values'] + section['length']],
+                                'utf-8'))
+        # tuples such as (owner key, name) come back as lists
+        return list(zip([tuple(value) if isinstance(value, list) else value
+                         for value in values], keys))
+
+
+class SnapshotTable(MutableMapping):
+    """
+    A dict-like table backed by one section of a snapshot.
+    Objects are decoded on first access and cached; objects saved
+    or deleted afterwards are tracked on top of the snapshot
+    """
+    def __init__(self, buffer, keys, offsets, records, schema, build):
+        self._buffer = buffer
+        self._keys = keys
+        self._offsets = offsets
+        self._records = records
+        self._schema = schema
+        self._build = build
+        # decoded or newly saved objects
+        self._objects = {}
+        # keys of objects saved after loading that are not in the snapshot
+        self._new_keys = set()
+        # keys in the snapshot whose objects have been deleted
+        self._deleted_keys = set()
+
+    def _find(self, key):
+        """Returns the position of key in the snapshot or -1"""
+        position = bisect_left(self._keys, key)
+        if position < len(self._keys) and self._keys[position] == key:
+            return position
+        return -1
+
+    def __getitem__(self, key):
+        try:
+            return self._objects[key]
+        except KeyError:
+            pass
+        if key in self._deleted_keys:
+            raise KeyError(key)
+        position = self._find(key)
+        if position < 0:
+            raise KeyError(key)
+        fields, children = _unpack_record(
+            self._schema, self._buffer,
+            self._records + self._offsets[position])
+        # two readers may decode the same record; keep the first object
+        return self._objects.setdefault(key, self._build(fields, children))
+
+    def __setitem__(self, key, obj):
+        self._objects[key] = obj
+        self._deleted_keys.discard(key)
+        if self._find(key) < 0:
+            self._new_keys.add(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._objects.pop(key, None)
+        if key in self._new_keys:
+            self._new_keys.remove(key)
+        else:
+            self._deleted_keys.add(key)
+
+    def __contains__(self, key):
+        if key in self._objects:
+            return True
+        return key not in self._deleted_keys and self._find(key) >= 0
+
+    def __iter__(self):
+        for key in self._keys:
+            if key not in self._deleted_keys:
+                yield key
+        # copy so that saving while iterating does not break the loop
+        for key in list(self._new_keys):
+            yield key
+
+    def __len__(self):
+        return len(self._keys) - len(self._deleted_keys) + len(self._new_keys)
+
+    def memory_size(self):
+        """
+        Returns the approximate bytes of the objects decoded or saved
+        since the load. The records are mapped from the file, whose
+        pages the kernel can drop, so they are not counted
+        """
+        return (table_bytes(self._objects) + sys.getsizeof(self._new_keys)
+                + sys.getsizeof(self._deleted_keys))
+
+    def scan(self):
+        """
+        Yields (key, object) pairs in key order, building objects that
+        are not cached without caching them, so a whole table can be
+        copied elsewhere without holding every object at once
+        """
+        for position, key in enumerate(self._keys):
+            if key in self._deleted_keys:
+                continue
+            obj = self._objects.get(key)
+            if obj is None:
+                fields, children = _unpack_record(
+                    self._schema, self._buffer,
+                    self._records + self._offsets[position])
+                obj = self._build(fields, children)
+            yield key, obj
+        for key in sorted(self._new_keys):
+            yield key, self._objects[key]
+
+    def raw_record(self, key):
+        """
+        Returns the packed record of key if it has not been decoded,
+        and thus cannot have changed, since the snapshot was loaded
+        """
+        if key in self._objects or key in self._deleted_keys:
+            return None
+        position = self._find(key)
+        if position < 0:
+            return None
+        start = self._records + self._offsets[position]
+        return bytes(self._buffer[start:self._records + self._offsets[position + 1]])
+
+    @property
+    def decoded(self):
+        """The number of snapshot objects decoded so far"""
+        return len(self._objects) - len(self._new_keys)
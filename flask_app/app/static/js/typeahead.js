@@ -0,0 +1,63 @@
+/*
+ * Suggests the user's category and recipe names as they are typed.
+ * Names starting with the input come first, then names it misspells.
+ */
+(function () {
+    var input = document.getElementById('typeahead-in');
+    var results = document.getElementById('typeahead-results');
+    if (!input || !results) {
+        return;
+    }
+    // wait for a pause in typing before asking the server
+    var DELAY = 150;
+    var timer = null;
+    var latest = 0;
+
+    function show(suggestions) {
+        results.innerHTML = '';
+        suggestions.forEach(function (suggestion) {
+            var link = document.createElement('a');
+            link.className = 'list-group-item list-group-item-action';
+            link.href = suggestion.url;
+            link.textContent = suggestion.name;
+            var kind = document.createElement('small');
+            kind.className = 'text-muted';
+            kind.textContent = ' ' + suggestion.kind;
+            link.appendChild(kind);
+            results.appendChild(link);
+        });
+    }
+
+    function fetchSuggestions() {
+        var query = input.value.trim();
+        if (!query) {
+            show([]);
+            return;
+        }
+        var request = new XMLHttpRequest();
+        var number = ++latest;
+        request.open('GET', input.dataset.suggestUrl + '?q=' + encodeURIComponent(query));
+        request.onload = function () {
+            // a slow answer to an older query must not replace a newer one
+            if (number !== latest || request.status !== 200) {
+                return;
+            }
+            var data = JSON.parse(request.responseText);
+            var seen = {};
+            var suggestions = [];
+            data.categories.concat(data.recipes, data.fuzzy).forEach(function (suggestion) {
+                if (!seen[suggestion.url]) {
+                    seen[suggestion.url] = true;
+                    suggestions.push(suggestion);
+                }
+            });
+            show(suggestions);
+        };
+        request.send();
+    }
+
+    input.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(fetchSuggestions, DELAY);
+    });
+}());
@@ -0,0 +1,388 @@
+"""
+This module measures how much the database holds and how much memory
+it takes, cheaply enough to be scraped every few seconds. Counts and
+index sizes are read from their lengths, bytes are estimated from a
+small random sample of each table and the largest users are ranked
+now and then from per-user counts a listener keeps up to date
+"""
+import heapq
+import random
+import sys
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+# objects measured per table to estimate its bytes
+SAMPLE_SIZE = 64
+# random keys tried per object sampled before falling back to the first keys
+PROBES_PER_SAMPLE = 4
+# the number of users reported by largest_users
+LARGEST_USERS = 5
+# how long the largest users are reused before they are ranked again
+USER_SCAN_SECONDS = 60
+# how far back the growth rate looks
+GROWTH_WINDOW_SECONDS = 300
+# the most calls kept for the growth rate, however often it is scraped
+HISTORY_LENGTH = 1024
+
+
+def deep_size(obj):
+    """
+    Returns the bytes of a model object and of the values in its
+    slots. Child indexes are measured with their memory_size(), the
+    keys they hold are small ints that cost nothing extra
+    """
+    size = sys.getsizeof(obj)
+    for slot in getattr(type(obj), '__slots__', ()):
+        value = getattr(obj, slot, None)
+        if value is None:
+            continue
+        memory_size = getattr(value, 'memory_size', None)
+        size += memory_size() if memory_size is not None else sys.getsizeof(value)
+    return size
+
+
+def sample(table, size=SAMPLE_SIZE, rng=random):
+    """
+    Returns up to size objects of a dict table picked by probing random
+    keys up to the last one inserted, topped up with the first keys of
+    the table when too many probes miss, e.g. after large deletes
+    """
+    found = {}
+    if not table:
+        return []
+    last_key = next(reversed(table))
+    for _ in range(min(size, len(table)) * PROBES_PER_SAMPLE):
+        if len(found) >= size:
+            break
+        key = rng.randint(1, last_key)
+        obj = table.get(key)
+        if obj is not None:
+            found[key] = obj
+    if len(found) < min(size, len(table)):
+        # the first size keys are copied at once since readers may add
+        # to a table as they decode it, e.g. the cache of a SnapshotTable
+        for key in list(islice(table, size)):
+            if len(found) >= size:
+                break
+            obj = table.get(key)
+            if obj is not None:
+                found.setdefault(key, obj)
+    return list(found.values())
+
+
+def table_bytes(table, rng=random):
+    """
+    Returns the approximate bytes of table: the exact bytes of a table
+    with a memory_size() such as a ColumnarTable, or the bytes of the
+    dict plus its length times the mean deep size of a sample. Tables
+    kept outside the memory of this process give None
+    """
+    memory_size = getattr(table, 'memory_size', None)
+    if memory_size is not None:
+        return memory_size()
+    if type(table) is not dict:
+        return None
+    objects = sample(table, rng=rng)
+    if not objects:
+        return sys.getsizeof(table)
+    mean = sum(deep_size(obj) for obj in objects) / len(objects)
+    return sys.getsizeof(table) + int(mean * len(table))
+
+
+def process_memory():
+    """Returns the resident and peak resident bytes of this process or None"""
+    rss = peak = None
+    try:
+        with open('/proc/self/statm') as statm:
+            rss = int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, AttributeError, IndexError, ValueError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        if sys.platform != 'darwin':
+            peak *= 1024
+    return {'rss_bytes': rss, 'peak_rss_bytes': peak}
+
+
+class UserCounts:
+    """
+    The number of objects under each user, registered as a listener so
+    it is updated inside the writer's exclusive lock. A recipe counts
+    for itself and its steps, read from the length of its child index,
+    so a change costs the same however large its user is. After a
+    load it is built the first time it is used, like the search index
+    """
+    def __init__(self, database):
+        self.database = database
+        # readers may build the counts while holding the shared lock
+        self._build_lock = threading.Lock()
+        self.rebuild()
+
+    def rebuild(self):
+        """Drops the counts so they are built from scratch on first use e.g. after a load"""
+        with self.database.lock.read():
+            # an empty database is counted from its first write on. Other
+            # processes write to a shared backend, so it is never counted
+            self.built = self.database.is_empty() and not self.database.backend.shared
+            # user key to the number of objects under it, itself included
+            self._counts = {}
+            # category key to its user key and user key to category keys
+            self._owners = {}
+            self._categories_of = {}
+            # recipe key to (category key, 1 + its number of steps) and
+            # category key to recipe keys
+            self._recipes = {}
+            self._recipes_of = {}
+
+    def build(self):
+        """Counts every object unless that has been done since rebuild()"""
+        if self.built:
+            return
+        database = self.database
+        with database.lock.read(), self._build_lock:
+            if self.built:
+                return
+            for key in list(database.users):
+                self._refresh_user(key)
+            for key in list(database.recipe_categories):
+                self._refresh_category(key)
+            for key in list(database.recipes):
+                self._refresh_recipe(key)
+            # writes wait for the shared lock, so none were missed
+            self.built = True
+
+    def items(self):
+        """Returns a list of the (user key, objects) of every user"""
+        self.build()
+        with self.database.lock.read():
+            return list(self._counts.items())
+
+    def _live(self, table, key):
+        """Returns the object of key in table unless it is gone or hidden"""
+        obj = table.get(key)
+        return obj if obj is not None and self.database.is_visible(obj) else None
+
+    def _add(self, user_key, objects):
+        if user_key in self._counts:
+            self._counts[user_key] += objects
+
+    def _refresh_user(self, user_key):
+        """Starts or stops counting user_key as it is in the tables"""
+        if self._live(self.database.users, user_key) is not None:
+            self._counts.setdefault(user_key, 1)
+            return
+        for category_key in list(self._categories_of.get(user_key, ())):
+            self._drop_category(category_key)
+        self._counts.pop(user_key, None)
+
+    def _refresh_category(self, category_key):
+        """Files category_key under its user as it is in the tables"""
+        category = self._live(self.database.recipe_categories, category_key)
+        user_key = category.user if category is not None else None
+        if self._owners.get(category_key) == user_key:
+            return
+        if user_key is None:
+            self._drop_category(category_key)
+            return
+        self._owners[category_key] = user_key
+        self._categories_of.setdefault(user_key, set()).add(category_key)
+        self._add(user_key, 1)
+
+    def _drop_category(self, category_key):
+        for recipe_key in list(self._recipes_of.get(category_key, ())):
+            self._file(recipe_key, None)
+        user_key = self._owners.pop(category_key, None)
+        if user_key is not None:
+            category_keys = self._categories_of[user_key]
+            category_keys.discard(category_key)
+            if not category_keys:
+                del self._categories_of[user_key]
+            self._add(user_key, -1)
+
+    def _refresh_recipe(self, recipe_key):
+        """Counts recipe_key and its steps as they are in the tables"""
+        recipe = self._live(self.database.recipes, recipe_key)
+        if recipe is None or recipe.category not in self._owners:
+            self._file(recipe_key, None)
+        else:
+            self._file(recipe_key, (recipe.category, 1 + len(recipe.recipe_steps)))
+
+    def _file(self, recipe_key, entry):
+        """Replaces the (category key, objects) of recipe_key with entry"""
+        old_entry = self._recipes.get(recipe_key)
+        if old_entry == entry:
+            return
+        if old_entry is not None:
+            category_key, objects = old_entry
+            del self._recipes[recipe_key]
+            recipe_keys = self._recipes_of[category_key]
+            recipe_keys.discard(recipe_key)
+            if not recipe_keys:
+                del self._recipes_of[category_key]
+            self._add(self._owners.get(category_key), -objects)
+        if entry is not None:
+            category_key, objects = entry
+            self._recipes[recipe_key] = entry
+            self._recipes_of.setdefault(category_key, set()).add(recipe_key)
+            self._add(self._owners[category_key], objects)
+
+    # Database listener interface
+    def object_saved(self, obj):
+        """Counts obj or the recipe it belongs to again"""
+        self.batch_applied([('object_saved', obj)])
+
+    def object_deleted(self, obj):
+        """Stops counting obj and everything under it"""
+        self.batch_applied([('object_deleted', obj)])
+
+    def child_moved(self, parent, child_key, position):
+        """Does nothing since order does not change the counts"""
+        pass
+
+    def objects_compacted(self, compacted):
+        """Does nothing since the roots compacted were dropped when deleted"""
+        pass
+
+    def batch_applied(self, events):
+        """Counts every object touched by a batch again, parents first"""
+        if not self.built:
+            # the build will count the objects as they are then
+            return
+        users, categories, recipes = set(), set(), set()
+        for event in events:
+            if event[0] == 'child_moved':
+                continue
+            obj = event[1]
+            type_name = type(obj).__name__
+            if type_name == 'User':
+                users.add(obj.key)
+            elif type_name == 'RecipeCategory':
+                categories.add(obj.key)
+            elif type_name == 'Recipe':
+                recipes.add(obj.key)
+            elif type_name == 'RecipeStep':
+                recipes.add(obj.recipe)
+        for user_key in users:
+            self._refresh_user(user_key)
+        for category_key in categories:
+            self._refresh_category(category_key)
+        for recipe_key in recipes:
+            self._refresh_recipe(recipe_key)
+
+
+class DatabaseStats:
+    """
+    Collects the stats of a database and keeps what is reused between
+    calls: the largest users and the recent totals for the growth
+    rate. The caller holds the database's shared lock, this lock only
+    guards the state kept here from concurrent readers
+    """
+    def __init__(self, database, tables, rng=None,
+                 user_scan_seconds=USER_SCAN_SECONDS,
+                 growth_window_seconds=GROWTH_WINDOW_SECONDS):
+        self.database = database
+        # (name, model) of every table in the order they are reported
+        self.tables = tables
+        self.rng = rng or random.Random()
+        self.user_scan_seconds = user_scan_seconds
+        self.growth_window_seconds = growth_window_seconds
+        # (monotonic time, objects) of recent calls, oldest first
+        self._history = deque(maxlen=HISTORY_LENGTH)
+        self._largest_users = None
+        self._users_counted_at = None
+        self._lock = threading.Lock()
+
+    def collect(self):
+        """Returns the stats as a JSON-ready dict"""
+        started = time.perf_counter()
+        database = self.database
+        tables = {}
+        objects, total_bytes = 0, 0
+        for name, model in self.tables:
+            table = database.get_table(model)
+            count = len(table)
+            size = table_bytes(table, self.rng)
+            tables[name] = {
+                'objects': count,
+                'bytes': size,
+                'bytes_per_object': round(size / count, 1) if size and count else None,
+                'indexes': {index_name: len(index) for index_name, index
+                            in database.indexes.get(model, {}).items()},
+            }
+            objects += count
+            if total_bytes is not None:
+                total_bytes = None if size is None else total_bytes + size
+        with self._lock:
+            growth = self._growth(objects, total_bytes)
+            largest_users = self._users()
+        return {
+            'tables': tables,
+            'objects': objects,
+            'bytes': total_bytes,
+            'tombstones': len(database.tombstones),
+            'search_terms': None if database.search_index is None
+                            else len(database.search_index),
+            'fuzzy_entries': None if database.fuzzy_index is None
+                             else len(database.fuzzy_index),
+            'largest_users': largest_users,
+            'growth': growth,
+            'process': process_memory(),
+            'seconds': round(time.perf_counter() - started, 6),
+        }
+
+    def _growth(self, objects, total_bytes):
+        """
+        Records the objects counted by this call and returns the objects
+        added per second over the window, or None until there are two
+        calls. Bytes grow at the current mean bytes per object, since
+        the sampled totals of two calls differ by more than a few
+        seconds of growth
+        """
+        now = time.monotonic()
+        history = self._history
+        history.append((now, objects))
+        while history[0][0] < now - self.growth_window_seconds:
+            history.popleft()
+        then, old_objects = history[0]
+        if now <= then:
+            return None
+        seconds = now - then
+        per_second = (objects - old_objects) / seconds
+        return {
+            'seconds': round(seconds, 3),
+            'objects_per_second': round(per_second, 3),
+            'bytes_per_second': None if total_bytes is None or not objects
+                                else round(per_second * total_bytes / objects, 1),
+        }
+
+    def _users(self):
+        """
+        Returns the key, email and number of objects of the users
+        holding the most objects, ranked from database.user_counts at
+        most every user_scan_seconds. Other processes write to a shared
+        backend without telling this one, so it gives None
+        """
+        database = self.database
+        if database.backend.shared:
+            return None
+        now = time.monotonic()
+        if self._users_counted_at is not None \
+        and now - self._users_counted_at < self.user_scan_seconds:
+            return self._largest_users
+        # the email index also holds the users evicted to the tiered store
+        emails = database.get_index(dict(self.tables)['users'], 'email')
+        self._largest_users = [
+            {'key': key, 'email': emails.value_of(key), 'objects': objects}
+            for key, objects in heapq.nlargest(LARGEST_USERS, database.user_counts.items(),
+                                               key=lambda item: item[1])]
+        self._users_counted_at = now
+        return self._largest_users
@@ -0,0 +1,339 @@
+"""
+This module keeps the trees of the least recently used users on disk
+so the memory the database takes stays within a budget. A user is
+evicted with everything under it and faulted back in whole the next
+time one of its objects is looked up. The secondary, search and fuzzy
+indexes keep their entries for evicted objects, so lookups through
+them still find the keys that bring the trees back
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from app.utilities import check_type
+from app.stats import table_bytes
+
+# the least time between two checks of the memory budget
+CHECK_SECONDS = 1.0
+
+
+def _children(encoded):
+    """Decodes the child keys of a row, which objects without children lack"""
+    return () if encoded is None else json.loads(encoded)
+
+
+class TieredStore:
+    """
+    The on-disk tier of a Database and the recency of its users.
+    Evicted objects are kept as JSON records in a scratch SQLite file,
+    which is emptied when the store is opened: whatever it held is
+    also in the write-ahead log or snapshot. Database.enable_tiering
+    makes one and registers it as a listener so new users are tracked
+    """
+    def __init__(self, database, path, memory_budget, check_seconds=CHECK_SECONDS):
+        if check_type(path, str) and check_type(memory_budget, int):
+            if memory_budget <= 0:
+                raise ValueError('memory_budget should be positive')
+            self.path = path
+            self.memory_budget = memory_budget
+        self.database = database
+        self.check_seconds = check_seconds
+        # lookups served from memory, lookups that faulted a tree in
+        # from disk and users evicted
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.objects_evicted = 0
+        self.objects_faulted_in = 0
+        # keys of the users in memory, least recently used first
+        self.recent_users = OrderedDict()
+        # keys of the users whose trees are on disk
+        self.evicted_users = set()
+        # background saves reading the file; while there are any the
+        # rows on disk must stay as they were when the save forked, so
+        # nothing is evicted and faulted in users leave their rows behind
+        self.holds = 0
+        # users faulted in during a hold whose rows are left to delete
+        self._stale_users = set()
+        self._checked_at = None
+        self._rng = random.Random()
+        # guards the above and the file
+        self._lock = threading.Lock()
+        self._pid = None
+        self._connection = None
+        self._connect().execute('DELETE FROM objects')
+        self.rebuild()
+
+    def _connect(self):
+        """
+        Returns the connection to the file, opening a new one in a
+        forked child since a SQLite connection cannot cross a fork
+        """
+        if self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, isolation_level=None,
+                                         check_same_thread=False)
+            # a scratch file, rebuilt from the log after a crash
+            connection.execute('PRAGMA journal_mode=MEMORY')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS objects (
+                    type TEXT NOT NULL,
+                    key INTEGER NOT NULL,
+                    user INTEGER NOT NULL,
+                    record TEXT NOT NULL,
+                    children TEXT,
+                    PRIMARY KEY (type, key));
+                CREATE INDEX IF NOT EXISTS objects_by_user ON objects (user);
+            ''')
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def rebuild(self):
+        """Starts tracking every user in memory, in table order"""
+        with self._lock:
+            self.recent_users = OrderedDict.fromkeys(self.database.users)
+
+    def hold(self):
+        """
+        Keeps the file as it is until release(), e.g. while a forked
+        child writes a snapshot from it. Called with the exclusive lock
+        of the database held, before the fork
+        """
+        with self._lock:
+            self.holds += 1
+
+    def release(self):
+        """Ends a hold, deleting the rows faulted in users left behind"""
+        with self._lock:
+            self.holds -= 1
+            if self.holds or not self._stale_users:
+                return
+            connection = self._connect()
+            connection.execute('BEGIN')
+            connection.executemany('DELETE FROM objects WHERE user = ?',
+                                   [(user_key,) for user_key in self._stale_users])
+            connection.execute('COMMIT')
+            self._stale_users.clear()
+
+    def touch(self, user_key):
+        """Counts a lookup served from memory and marks its user as used"""
+        with self._lock:
+            self.hits += 1
+            if user_key in self.recent_users:
+                self.recent_users.move_to_end(user_key)
+
+    def owner(self, type_name, key):
+        """Returns the key of the evicted user holding the object or None"""
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT user FROM objects WHERE type = ? AND key = ?',
+                (type_name, key)).fetchone()
+            # rows left behind during a hold belong to resident users
+            return row[0] if row and row[0] in self.evicted_users else None
+
+    def put(self, user_key, rows):
+        """
+        Writes the (type name, key, record, child keys or None) rows of
+        the user's tree to disk and marks the user as evicted
+        """
+        with self._lock:
+            if self.holds:
+                raise ValueError('Users cannot be evicted while the file is held')
+            connection = self._connect()
+            connection.execute('BEGIN')
+            connection.executemany(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)',
+                [(type_name, key, user_key, json.dumps(record),
+                  None if children is None else json.dumps(children))
+                 for type_name, key, record, children in rows])
+            connection.execute('COMMIT')
+            self.recent_users.pop(user_key, None)
+            self.evicted_users.add(user_key)
+            self.evictions += 1
+            self.objects_evicted += len(rows)
+
+    def take(self, user_key):
+        """
+        Returns the (type name, record, child keys) rows of the user's
+        tree and removes them from disk, or leaves them for release()
+        during a hold
+        """
+        with self._lock:
+            connection = self._connect()
+            rows = [(type_name, json.loads(record), _children(children))
+                    for type_name, record, children in connection.execute(
+                        'SELECT type, record, children FROM objects WHERE user = ?',
+                        (user_key,))]
+            if self.holds:
+                self._stale_users.add(user_key)
+            else:
+                connection.execute('DELETE FROM objects WHERE user = ?', (user_key,))
+            self.evicted_users.discard(user_key)
+            self.recent_users[user_key] = None
+            self.misses += 1
+            self.objects_faulted_in += len(rows)
+            return rows
+
+    def records(self, type_name):
+        """Yields the (key, record, child keys) of the evicted objects of a type"""
+        for key, user_key, record, children in self._connect().execute(
+                'SELECT key, user, record, children FROM objects WHERE type = ? '
+                'ORDER BY key', (type_name,)):
+            if user_key in self.evicted_users:
+                yield key, json.loads(record), _children(children)
+
+    def record(self, type_name, key):
+        """Returns the (record, child keys) of an evicted object or None"""
+        row = self._connect().execute(
+            'SELECT user, record, children FROM objects WHERE type = ? AND key = ?',
+            (type_name, key)).fetchone()
+        if row is None or row[0] not in self.evicted_users:
+            return None
+        return json.loads(row[1]), _children(row[2])
+
+    def resident_bytes(self):
+        """
+        Returns the approximate bytes of the tables in memory, measured
+        under the shared lock so no writer changes them meanwhile
+        """
+        with self.database.lock.read():
+            return sum(table_bytes(table, self._rng) or 0 for table in self._tables())
+
+    def _tables(self):
+        """Returns the tables of the database"""
+        database = self.database
+        return (database.users, database.recipe_categories,
+                database.recipes, database.recipe_steps)
+
+    def enforce(self):
+        """
+        Evicts the least recently used users until the tables fit in
+        the memory budget. Returns the number of users evicted, which
+        is none while the file is held. The tables are measured under
+        the shared lock, which is given up before evicting
+        """
+        if self.holds:
+            return 0
+        with self.database.lock.read():
+            objects = sum(len(table) for table in self._tables())
+            size = self.resident_bytes()
+        if size <= self.memory_budget or not objects:
+            return 0
+        # what fits at the current bytes per object
+        target = int(self.memory_budget * objects / size)
+        evicted = 0
+        while objects > target:
+            with self._lock:
+                if not self.recent_users:
+                    break
+                user_key = next(iter(self.recent_users))
+            try:
+                objects -= self.database.evict_user(user_key)
+            except KeyError:
+                # deleted meanwhile
+                with self._lock:
+                    self.recent_users.pop(user_key, None)
+                continue
+            except ValueError:
+                # held meanwhile
+                break
+            evicted += 1
+        return evicted
+
+    def maybe_enforce(self):
+        """Calls enforce() if check_seconds have gone by since the last call"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_seconds:
+            return 0
+        self._checked_at = now
+        return self.enforce()
+
+    def table_view(self, model, table, build):
+        """
+        Returns a read-only view of the table of model with the evicted
+        objects added, built from their records by build(fields, children)
+        """
+        return TieredTableView(self, model.__name__, table, build)
+
+    def object_saved(self, obj):
+        if type(obj).__name__ == 'User':
+            with self._lock:
+                self.recent_users[obj.key] = None
+                self.recent_users.move_to_end(obj.key)
+
+    def object_deleted(self, obj):
+        if type(obj).__name__ == 'User':
+            with self._lock:
+                self.recent_users.pop(obj.key, None)
+
+    def child_moved(self, parent, child_key, position):
+        pass
+
+    def batch_applied(self, events):
+        for event in events:
+            getattr(self, event[0])(*event[1:])
+
+    def status(self):
+        """Returns a dict of the counters and what is where"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'memory_budget': self.memory_budget,
+                'resident_users': len(self.recent_users),
+                'evicted_users': len(self.evicted_users),
+                'held': self.holds > 0,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'objects_evicted': self.objects_evicted,
+                'objects_faulted_in': self.objects_faulted_in,
+            }
+
+    def close(self):
+        """Closes the file"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class TieredTableView(Mapping):
+    """
+    A table with the evicted objects of its type added, read from
+    disk one at a time, so a snapshot holds every object without
+    faulting the trees back in. Rows left on disk by users faulted in
+    during a hold are skipped since their objects are in the table
+    """
+    def __init__(self, store, type_name, table, build):
+        self.store = store
+        self.type_name = type_name
+        self.table = table
+        self.build = build
+
+    def __getitem__(self, key):
+        obj = self.table.get(key)
+        if obj is not None:
+            return obj
+        found = self.store.record(self.type_name, key)
+        if found is None:
+            raise KeyError(key)
+        return self.build(*found)
+
+    def __iter__(self):
+        for key in self.table:
+            yield key
+        for key, _, _ in self.store.records(self.type_name):
+            if key not in self.table:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def raw_record(self, key):
+        """The packed record of a snapshot table, which evicted objects never have"""
+        raw_record = getattr(self.table, 'raw_record', None)
+        return raw_record(key) if raw_record is not None else None
@@ -55,7 +55,7 @@ def replace_value_in_dict(the_dict, key, new_value):
         dict_copy = the_dict
         # this causes function to raise KeyError if key does
         # not exist
-        old_value = dict_copy[key]
+        dict_copy[key]
         dict_copy[key] = new_value
         return dict_copy
     except KeyError:
@@ -0,0 +1,293 @@
+"""
+This module gives page renders consistent snapshots of the Database.
+A VersionStore listens to every mutation and publishes an immutable
+DatabaseVersion once the mutation is complete. Versions share
+structure through PersistentMap so publishing one copies only a few
+small nodes, and a reader holding a version never takes the lock
+"""
+from collections import namedtuple
+from app.persistent import PersistentMap, PersistentSequence
+
+
+def _to_record(frozen):
+    """Returns the fields of a frozen object without its child keys"""
+    return {name: value for name, value in zip(frozen._fields, frozen)
+            if not isinstance(value, PersistentSequence)}
+
+
+class FrozenUser(namedtuple('FrozenUser', 'key first_name last_name email '
+                                          'password recipe_categories')):
+    """An immutable User. recipe_categories is a PersistentSequence of keys"""
+    __slots__ = ()
+    to_record = _to_record
+
+    def get_all_recipe_categories(self, version):
+        """Returns the user's recipe categories in version"""
+        return version.children(self.recipe_categories,
+                                version.recipe_categories)
+
+
+class FrozenRecipeCategory(namedtuple('FrozenRecipeCategory',
+                                      'key name user description recipes')):
+    """An immutable RecipeCategory. recipes is a PersistentSequence of keys"""
+    __slots__ = ()
+    to_record = _to_record
+
+    def get_all_recipes(self, version):
+        """Returns the recipes under this category in version"""
+        return version.children(self.recipes, version.recipes)
+
+
+class FrozenRecipe(namedtuple('FrozenRecipe', 'key name description '
+                                              'category recipe_steps')):
+    """An immutable Recipe. recipe_steps is a PersistentSequence of keys in order"""
+    __slots__ = ()
+    to_record = _to_record
+
+    def get_all_steps(self, version):
+        """Returns the steps of this recipe in version in their order"""
+        return version.children(self.recipe_steps, version.recipe_steps)
+
+
+class FrozenRecipeStep(namedtuple('FrozenRecipeStep',
+                                  'key text_content recipe')):
+    """An immutable RecipeStep"""
+    __slots__ = ()
+    to_record = _to_record
+
+
+# type name to (frozen type, name of the table in Database and DatabaseVersion)
+FROZEN_TYPES = {
+    'User': (FrozenUser, 'users'),
+    'RecipeCategory': (FrozenRecipeCategory, 'recipe_categories'),
+    'Recipe': (FrozenRecipe, 'recipes'),
+    'RecipeStep': (FrozenRecipeStep, 'recipe_steps'),
+}
+# frozen type to the name of the model it copies
+MODEL_NAMES = {frozen_type: type_name
+               for type_name, (frozen_type, _) in FROZEN_TYPES.items()}
+# type name to (field holding the parent key, parent type name)
+PARENTS = {
+    'RecipeCategory': ('user', 'User'),
+    'Recipe': ('category', 'RecipeCategory'),
+    'RecipeStep': ('recipe', 'Recipe'),
+}
+# type name to (field holding the child keys, child type name)
+CHILDREN = {
+    'User': ('recipe_categories', 'RecipeCategory'),
+    'RecipeCategory': ('recipes', 'Recipe'),
+    'Recipe': ('recipe_steps', 'RecipeStep'),
+}
+
+
+def freeze(obj):
+    """
+    Returns the frozen copy of a model object. The child keys of a
+    ChildIndex are shared with it, not copied, so refreezing a parent
+    with many children costs the same as one with a few
+    """
+    type_name = type(obj).__name__
+    fields = obj.to_record()
+    if type_name in CHILDREN:
+        children = getattr(obj, CHILDREN[type_name][0])
+        snapshot = getattr(children, 'snapshot', None)
+        fields[CHILDREN[type_name][0]] = snapshot() if snapshot is not None \
+            else PersistentSequence(children)
+    return FROZEN_TYPES[type_name][0](**fields)
+
+
+class DatabaseVersion:
+    """
+    An immutable picture of the Database at one point in time.
+    It has the read methods of Database and returns frozen objects
+    whose get_all_* methods take the version instead of the Database
+    """
+    __slots__ = ('number', 'users', 'recipe_categories', 'recipes',
+                 'recipe_steps', 'orphans')
+
+    def __init__(self, number, users, recipe_categories, recipes,
+                 recipe_steps, orphans=False):
+        self.number = number
+        self.users = users
+        self.recipe_categories = recipe_categories
+        self.recipes = recipes
+        self.recipe_steps = recipe_steps
+        # whether objects whose ancestor was deleted with
+        # Database.delete_later may still be in the tables
+        self.orphans = orphans
+
+    def table(self, type_name):
+        """Returns the PersistentMap holding objects of type_name"""
+        return getattr(self, FROZEN_TYPES[type_name][1])
+
+    def replace(self, orphans=False, **tables):
+        """Returns the next version with some tables replaced"""
+        fields = {name: tables.get(name, getattr(self, name))
+                  for name in ('users', 'recipe_categories', 'recipes',
+                               'recipe_steps')}
+        return DatabaseVersion(self.number + 1, orphans=orphans, **fields)
+
+    def _visible(self, type_name, frozen):
+        """Returns frozen if all its ancestors are in this version, else None"""
+        if frozen is None or not self.orphans:
+            return frozen
+        obj = frozen
+        while type_name in PARENTS:
+            field, type_name = PARENTS[type_name]
+            obj = self.table(type_name).get(getattr(obj, field))
+            if obj is None:
+                return None
+        return frozen
+
+    @staticmethod
+    def children(keys, table):
+        """Returns the objects of keys in table, skipping missing ones"""
+        found = []
+        for key in keys:
+            obj = table.get(key)
+            if obj is not None:
+                found.append(obj)
+        return found
+
+    def get_user(self, user_key):
+        """Returns the FrozenUser of user_key or None"""
+        return self.users.get(user_key)
+
+    def get_recipe_category(self, recipe_category_key):
+        """Returns the FrozenRecipeCategory of recipe_category_key or None"""
+        return self._visible('RecipeCategory',
+                             self.recipe_categories.get(recipe_category_key))
+
+    def get_recipe(self, recipe_key):
+        """Returns the FrozenRecipe of recipe_key or None"""
+        return self._visible('Recipe', self.recipes.get(recipe_key))
+
+    def get_recipe_step(self, recipe_step_key):
+        """Returns the FrozenRecipeStep of recipe_step_key or None"""
+        return self._visible('RecipeStep', self.recipe_steps.get(recipe_step_key))
+
+
+class VersionStore:
+    """
+    Keeps the latest DatabaseVersion of a Database up to date.
+    It is registered as a Database listener so it runs inside the
+    writer's exclusive lock; each mutation, including a whole
+    cascading delete, is published as one new version
+    """
+    def __init__(self, database):
+        self.database = database
+        self.current = None
+        self.rebuild()
+
+    def rebuild(self):
+        """Builds the current version from scratch e.g. after a load"""
+        with self.database.lock.read():
+            tables = {}
+            for type_name, (_, table_name) in FROZEN_TYPES.items():
+                live_table = getattr(self.database, table_name)
+                tables[table_name] = PersistentMap(
+                    (key, freeze(obj)) for key, obj in live_table.items())
+            number = self.current.number + 1 if self.current else 0
+            self.current = DatabaseVersion(number, orphans=bool(self.database.tombstones),
+                                           **tables)
+
+    def _table(self, tables, type_name):
+        """Returns the working table of type_name for the next version"""
+        table_name = FROZEN_TYPES[type_name][1]
+        if table_name not in tables:
+            tables[table_name] = self.current.table(type_name)
+        return tables[table_name]
+
+    @staticmethod
+    def _parent_of(type_name, obj):
+        """Returns (parent type name, parent key) of obj or None"""
+        if type_name not in PARENTS:
+            return None
+        field, parent_type_name = PARENTS[type_name]
+        return parent_type_name, getattr(obj, field)
+
+    def _saved(self, tables, changed, obj):
+        type_name = type(obj).__name__
+        table = self._table(tables, type_name)
+        frozen = table.get(obj.key)
+        if frozen is None:
+            # only a new or moved child changes the keys held by parents
+            changed.add(self._parent_of(type_name, obj))
+            changed.add((type_name, obj.key))
+        elif self._parent_of(type_name, frozen) != self._parent_of(type_name, obj):
+            changed.add(self._parent_of(type_name, frozen))
+            changed.add(self._parent_of(type_name, obj))
+        tables[FROZEN_TYPES[type_name][1]] = table.set(obj.key, freeze(obj))
+
+    def _deleted(self, tables, changed, obj):
+        if self.database.is_tombstone(obj):
+            # the objects under it stay until they are compacted
+            type_name = type(obj).__name__
+            table = self._table(tables, type_name)
+            tables[FROZEN_TYPES[type_name][1]] = table.remove(obj.key)
+            changed.add(self._parent_of(type_name, obj))
+            return
+        pending = [(type(obj).__name__, obj.key)]
+        while pending:
+            type_name, key = pending.pop()
+            table = self._table(tables, type_name)
+            frozen = table.get(key)
+            if frozen is None:
+                continue
+            tables[FROZEN_TYPES[type_name][1]] = table.remove(key)
+            if type_name in CHILDREN:
+                attribute, child_type_name = CHILDREN[type_name]
+                pending.extend((child_type_name, child_key)
+                               for child_key in getattr(frozen, attribute))
+        changed.add(self._parent_of(type(obj).__name__, obj))
+
+    def _moved(self, tables, changed, parent, child_key, position):
+        changed.add((type(parent).__name__, parent.key))
+
+    # Database listener interface
+    def object_saved(self, obj):
+        """Publishes a version holding the saved obj"""
+        self.batch_applied([('object_saved', obj)])
+
+    def object_deleted(self, obj):
+        """Publishes a version without obj and everything under it"""
+        self.batch_applied([('object_deleted', obj)])
+
+    def child_moved(self, parent, child_key, position):
+        """Publishes a version with the new order of parent's children"""
+        self.batch_applied([('child_moved', parent, child_key, position)])
+
+    def batch_applied(self, events):
+        """Publishes one version holding all the events of a batch"""
+        handlers = {'object_saved': self._saved,
+                    'object_deleted': self._deleted,
+                    'child_moved': self._moved}
+        tables = {}
+        # new objects and parents whose child keys changed are refrozen
+        # once at the end from the live objects. New objects whose
+        # ancestor was deleted later in the batch are dropped
+        changed = set()
+        for event in events:
+            handlers[event[0]](tables, changed, *event[1:])
+        changed.discard(None)
+        for type_name, key in changed:
+            table_name = FROZEN_TYPES[type_name][1]
+            obj = getattr(self.database, table_name).get(key)
+            table = self._table(tables, type_name)
+            if obj is not None:
+                tables[table_name] = table.set(key, freeze(obj))
+            else:
+                tables[table_name] = table.remove(key)
+        self.current = self.current.replace(orphans=bool(self.database.tombstones),
+                                            **tables)
+
+    def objects_compacted(self, compacted):
+        """Publishes a version without the (type name, keys) compacted"""
+        tables = {}
+        for type_name, keys in compacted:
+            table = self._table(tables, type_name)
+            for key in keys:
+                table = table.remove(key)
+            tables[FROZEN_TYPES[type_name][1]] = table
+        self.current = self.current.replace(orphans=bool(self.database.tombstones),
+                                            **tables)
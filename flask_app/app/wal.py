@@ -0,0 +1,196 @@
+"""
+This module holds the append-only write-ahead log that lets
+the in-memory Database survive restarts
+"""
+import json
+import os
+import threading
+from app.utilities import check_type
+
+# fsync after every record
+FSYNC_ALWAYS = 'always'
+# fsync once per group of records
+FSYNC_GROUP = 'group'
+# fsync from a background thread every few seconds
+FSYNC_PERIODIC = 'periodic'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_GROUP, FSYNC_PERIODIC)
+
+# record operations
+PUT = 'p'
+DELETE = 'd'
+MOVE = 'm'
+BATCH = 'b'
+
+
+def encode_record(record):
+    """Returns the compact single-line form of record"""
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def event_record(event):
+    """
+    Returns the log record of a Database event, a tuple of the
+    listener method name followed by its arguments
+    """
+    name = event[0]
+    if name == 'object_saved':
+        obj = event[1]
+        return [PUT, type(obj).__name__, obj.to_record()]
+    if name == 'object_deleted':
+        obj = event[1]
+        return [DELETE, type(obj).__name__, obj.key]
+    if name == 'child_moved':
+        parent, child_key, position = event[1:]
+        return [MOVE, type(parent).__name__, parent.key, child_key, position]
+    raise ValueError('Unknown event %r' % (name,))
+
+
+class WriteAheadLog:
+    """
+    An append-only file of Database mutations.
+    Each line is a JSON list whose first item is the operation:
+        ["p", type_name, fields]            an object was saved
+        ["d", type_name, key]               an object was deleted
+        ["m", type_name, key, child, pos]   a child key was moved
+        ["b", [record, ...]]                records applied as one batch
+    It is attached to a Database as a listener so every mutation
+    is appended, and it is replayed on startup
+    """
+    def __init__(self, path, fsync_policy=FSYNC_ALWAYS, group_size=32,
+                 interval=1.0):
+        if check_type(path, str) and check_type(fsync_policy, str):
+            if fsync_policy not in FSYNC_POLICIES:
+                raise ValueError('fsync_policy should be one of %s'
+                                 % ', '.join(FSYNC_POLICIES))
+        if check_type(group_size, int) and group_size < 1:
+            raise ValueError('group_size should be at least 1')
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.group_size = group_size
+        self.interval = interval
+        self.records_written = 0
+        self.syncs = 0
+        self._unsynced = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._file = open(path, 'a', encoding='utf-8')
+        self._syncer = None
+        if fsync_policy == FSYNC_PERIODIC:
+            self._syncer = threading.Thread(target=self._sync_periodically,
+                                            name='wal-fsync', daemon=True)
+            self._syncer.start()
+
+    def replay(self):
+        """
+        Yields the records in the log in the order they were written.
+        A torn last line left by a crash is ignored
+        """
+        with open(self.path, encoding='utf-8') as log_file:
+            line = log_file.readline()
+            while line:
+                next_line = log_file.readline()
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if next_line or line.endswith('\n'):
+                        raise ValueError('The log at %s is corrupt' % self.path)
+                    # the process died while writing the last record
+                    break
+                yield record
+                line = next_line
+
+    def append(self, record):
+        """Appends record to the log honouring the fsync policy"""
+        with self._lock:
+            self._file.write(encode_record(record))
+            # always hand the record to the OS so only an OS crash
+            # can lose it under the relaxed policies
+            self._file.flush()
+            self.records_written += 1
+            self._unsynced += 1
+            if self.fsync_policy == FSYNC_ALWAYS or (
+                    self.fsync_policy == FSYNC_GROUP
+                    and self._unsynced >= self.group_size):
+                self._sync()
+
+    def sync(self):
+        """Forces every appended record to disk"""
+        with self._lock:
+            self._file.flush()
+            self._sync()
+
+    def _sync(self):
+        """fsyncs the log file. The lock should be held by the caller"""
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self.syncs += 1
+
+    def _sync_periodically(self):
+        """Body of the background thread used by FSYNC_PERIODIC"""
+        while not self._closed.wait(self.interval):
+            self.sync()
+
+    def position(self):
+        """Returns the size of the log once pending writes are flushed"""
+        with self._lock:
+            self._file.flush()
+            return self._file.tell()
+
+    def discard_before(self, offset):
+        """
+        Drops the records before offset, keeping the ones appended after it.
+        Used once a snapshot holding those records is safely on disk
+        """
+        with self._lock:
+            self._file.flush()
+            temporary_path = self.path + '.tmp'
+            with open(self.path, 'rb') as old_log, \
+                    open(temporary_path, 'wb') as new_log:
+                old_log.seek(offset)
+                new_log.write(old_log.read())
+                new_log.flush()
+                os.fsync(new_log.fileno())
+            self._file.close()
+            os.replace(temporary_path, self.path)
+            self._file = open(self.path, 'a', encoding='utf-8')
+            self._unsynced = 0
+
+    def truncate(self):
+        """Empties the log e.g. after its contents have been snapshotted"""
+        with self._lock:
+            self._file.truncate(0)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        """Syncs outstanding records and closes the log"""
+        self._closed.set()
+        if self._syncer:
+            self._syncer.join()
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+                self._sync()
+                self._file.close()
+
+    # Database listener interface
+    def object_saved(self, obj):
+        """Logs that obj was saved"""
+        self.append(event_record(('object_saved', obj)))
+
+    def object_deleted(self, obj):
+        """Logs that obj and everything under it was deleted"""
+        self.append(event_record(('object_deleted', obj)))
+
+    def child_moved(self, parent, child_key, position):
+        """Logs that child_key was moved to position under parent"""
+        self.append(event_record(('child_moved', parent, child_key, position)))
+
+    def batch_applied(self, events):
+        """
+        Logs the events of a batch as one line so that a crash
+        part way through writing it replays none of them
+        """
+        self.append([BATCH, [event_record(event) for event in events]])
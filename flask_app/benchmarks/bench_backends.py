@@ -0,0 +1,59 @@
+"""
+Throughput benchmark comparing MemoryBackend and SQLiteBackend
+for creating steps and reading recipes with their steps.
+
+Run from flask_app/ with:
+    python -m benchmarks.bench_backends [number_of_steps]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from app.models import Database
+from app.backends import MemoryBackend, SQLiteBackend
+
+STEPS = 5000
+STEPS_PER_RECIPE = 10
+
+
+def run(db, number_of_steps):
+    """Returns (creates per second, recipe reads per second)"""
+    user = db.create_user({'first_name': 'John', 'last_name': 'Doe',
+                           'email': 'johndoe@example.com',
+                           'password': 'password'})
+    category = user.create_recipe_category(db, {'name': 'cakes'})
+    recipe_keys = []
+    started = time.perf_counter()
+    for number in range(number_of_steps):
+        if number % STEPS_PER_RECIPE == 0:
+            recipe = category.create_recipe(
+                db, {'name': 'cake %d' % number, 'description': 'yummy'})
+            recipe_keys.append(recipe.key)
+        recipe.create_step(db, {'text_content': 'Step %d' % number})
+    creates = number_of_steps / (time.perf_counter() - started)
+    started = time.perf_counter()
+    for recipe_key in recipe_keys:
+        list(db.get_recipe(recipe_key).get_all_steps(db))
+    reads = len(recipe_keys) / (time.perf_counter() - started)
+    return creates, reads
+
+
+def main(number_of_steps=STEPS):
+    """Prints the throughput of each backend"""
+    directory = tempfile.mkdtemp()
+    try:
+        backends = (('memory', MemoryBackend()),
+                    ('sqlite', SQLiteBackend(os.path.join(directory,
+                                                          'yummy.sqlite3'))))
+        print('%8s %16s %20s' % ('backend', 'step creates/s', 'recipe reads/s'))
+        for name, backend in backends:
+            creates, reads = run(Database(backend), number_of_steps)
+            print('%8s %16.0f %20.0f' % (name, creates, reads))
+            backend.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
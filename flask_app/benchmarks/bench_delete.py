@@ -0,0 +1,93 @@
+"""
+Benchmark of deleting a large category. Fills a database with
+other categories so the indexes are not empty, then deletes a
+category of 5000 recipes and 100000 steps with the old recursive
+cascade, with Database.delete_object and with Database.delete_later
+followed by compaction in slices as the Compactor runs it.
+
+Run from flask_app/ with:
+    python -m benchmarks.bench_delete [recipes] [steps_per_recipe] [other_recipes]
+"""
+import sys
+import time
+from app.compaction import SLICE_SECONDS
+from app.models import Database, User, RecipeCategory, Recipe, RecipeStep
+
+RECIPES = 5000
+STEPS_PER_RECIPE = 20
+# recipes in the categories that are not deleted
+OTHER_RECIPES = 200000
+RECIPES_PER_OTHER_CATEGORY = 1000
+
+
+def legacy_delete(database, obj):
+    """The old Database._delete_object: one recursive call per object"""
+    if type(obj) == RecipeCategory:
+        table, keys = database.recipe_categories, database.recipe_category_keys
+        children = list(obj.get_all_recipes(database))
+    elif type(obj) == Recipe:
+        table, keys = database.recipes, database.recipe_keys
+        children = list(obj.get_all_steps(database))
+    else:
+        table, keys = database.recipe_steps, database.recipe_step_keys
+        children = []
+    del table[obj.key]
+    keys.remove(obj.key)
+    database.unindex_object(obj)
+    for child in children:
+        legacy_delete(database, child)
+
+
+def fill(recipes, steps_per_recipe, other_recipes):
+    """Returns a database and the category to delete"""
+    database = Database()
+    user = User(key=database.get_next_key(User), first_name='John',
+                last_name='Doe', email='johndoe@example.com', password='password')
+    database.insert_many([user])
+    number_of_others = -(-other_recipes // RECIPES_PER_OTHER_CATEGORY)
+    category_keys = database.get_next_keys(RecipeCategory, number_of_others + 1)
+    database.insert_many([RecipeCategory(key=key, name='category %d' % key,
+                                         description='', user=user.key)
+                          for key in category_keys])
+    recipe_keys = database.get_next_keys(Recipe, other_recipes + recipes)
+    database.insert_many([Recipe(key=key, name='recipe %d' % key, description='',
+                                 category=category_keys[1 + number // RECIPES_PER_OTHER_CATEGORY])
+                          for number, key in enumerate(recipe_keys[:other_recipes])])
+    doomed = recipe_keys[other_recipes:]
+    database.insert_many([Recipe(key=key, name='recipe %d' % key, description='',
+                                 category=category_keys[0]) for key in doomed])
+    step_keys = database.get_next_keys(RecipeStep, recipes * steps_per_recipe)
+    database.insert_many([RecipeStep(key=key, text_content='Step %d' % key,
+                                     recipe=doomed[number // steps_per_recipe])
+                          for number, key in enumerate(step_keys)])
+    return database, database.recipe_categories[category_keys[0]]
+
+
+def main(recipes=RECIPES, steps_per_recipe=STEPS_PER_RECIPE, other_recipes=OTHER_RECIPES):
+    """Prints the seconds each way of deleting takes"""
+    database, category = fill(recipes, steps_per_recipe, other_recipes)
+    started = time.perf_counter()
+    legacy_delete(database, category)
+    legacy_seconds = time.perf_counter() - started
+    database, category = fill(recipes, steps_per_recipe, other_recipes)
+    report = database.delete_object(category)
+    print('%22s %12d' % ('objects deleted', report['objects']))
+    print('%22s %12.3f' % ('legacy seconds', legacy_seconds))
+    print('%22s %12.3f' % ('batched seconds', report['seconds']))
+    database, category = fill(recipes, steps_per_recipe, other_recipes)
+    started = time.perf_counter()
+    database.delete_later(category)
+    hidden_seconds = time.perf_counter() - started
+    slices = []
+    while database.tombstones:
+        started = time.perf_counter()
+        database.compact(SLICE_SECONDS)
+        slices.append(time.perf_counter() - started)
+    print('%22s %12.3f' % ('delete_later ms', hidden_seconds * 1000))
+    print('%22s %12d' % ('compaction slices', len(slices)))
+    print('%22s %12.3f' % ('longest slice ms', max(slices) * 1000))
+    print('%22s %12.3f' % ('compaction seconds', sum(slices)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,51 @@
+"""
+Benchmark of the bulk importer. Writes an NDJSON catalog with the
+given number of steps, ten per recipe and a thousand recipes per
+category, then imports it and reports rows per second.
+
+Run from flask_app/ with:
+    python -m benchmarks.bench_import [number_of_steps]
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+from app.models import Database
+from app.bulk import import_file
+
+STEPS = 1000000
+STEPS_PER_RECIPE = 10
+RECIPES_PER_CATEGORY = 1000
+
+
+def write_catalog(path, number_of_steps):
+    """Writes an NDJSON catalog with number_of_steps rows"""
+    with open(path, 'w', encoding='utf-8') as catalog:
+        for number in range(number_of_steps):
+            recipe = number // STEPS_PER_RECIPE
+            catalog.write(json.dumps({
+                'email': 'user%d@example.com' % (recipe // RECIPES_PER_CATEGORY // 10),
+                'first_name': 'John', 'last_name': 'Doe', 'password': 'password',
+                'category': 'category %d' % (recipe // RECIPES_PER_CATEGORY),
+                'recipe': 'recipe %d' % recipe,
+                'step': 'Step %d of recipe %d' % (number % STEPS_PER_RECIPE, recipe),
+            }) + '\n')
+
+
+def main(number_of_steps=STEPS):
+    """Prints the import report"""
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'catalog.ndjson')
+        write_catalog(path, number_of_steps)
+        report = import_file(Database(), path)
+    finally:
+        shutil.rmtree(directory)
+    for name in ('rows', 'users', 'recipe_categories', 'recipes',
+                 'recipe_steps', 'seconds', 'rows_per_second'):
+        print('%18s %12s' % (name, report[name]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,63 @@
+"""
+Benchmark for key allocation.
+Compares the old sort-the-keys allocator with KeySequence
+and times create_step as the tables grow.
+
+Run from flask_app/ with:
+    python -m benchmarks.bench_key_allocation
+"""
+import sys
+import timeit
+from app.models import Database
+from app.sequences import KeySequence
+
+SIZES = (1000, 10000, 100000)
+SAMPLES = 200
+
+
+def legacy_next_key(keys):
+    """The allocator used before KeySequence: dedupe, sort, take max"""
+    keys = list(set(keys))
+    if len(keys) == 0:
+        return 1
+    keys.sort()
+    return keys[len(keys) - 1] + 1
+
+
+def time_allocation(size):
+    """Returns microseconds per key for both allocators at size"""
+    keys = list(range(1, size + 1))
+    legacy = timeit.timeit(lambda: legacy_next_key(keys), number=SAMPLES)
+    sequence = KeySequence(size)
+    new = timeit.timeit(sequence.next_key, number=SAMPLES)
+    return legacy / SAMPLES * 1e6, new / SAMPLES * 1e6
+
+
+def time_create_step(size):
+    """Returns microseconds per create_step once size steps exist"""
+    db = Database()
+    user = db.create_user({'first_name': 'John', 'last_name': 'Doe',
+                           'email': 'johndoe@example.com',
+                           'password': 'password'})
+    category = user.create_recipe_category(db, {'name': 'cakes'})
+    recipe = category.create_recipe(db, {'name': 'cake', 'description': ''})
+    step_data = {'text_content': 'Bake in oven'}
+    for _ in range(size):
+        recipe.create_step(db, step_data)
+    elapsed = timeit.timeit(lambda: recipe.create_step(db, step_data),
+                            number=SAMPLES)
+    return elapsed / SAMPLES * 1e6
+
+
+def main(sizes=SIZES):
+    """Prints a table of per-insert costs for each size"""
+    print('%10s %16s %16s %16s' % ('keys', 'legacy us/key',
+                                   'sequence us/key', 'create_step us'))
+    for size in sizes:
+        legacy, new = time_allocation(size)
+        print('%10d %16.2f %16.2f %16.2f' % (size, legacy, new,
+                                             time_create_step(size)))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
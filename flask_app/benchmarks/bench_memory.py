@@ -0,0 +1,91 @@
+"""
+Benchmark of the memory the in-memory database takes. Inserts the
+given number of steps, ten per recipe and a thousand recipes per
+category, and reports the bytes each recipe and each step adds,
+counting the object itself, its table entry and its indexes. Steps
+are measured both as objects in a dict and in columnar tables.
+
+Run from flask_app/ with:
+    python -m benchmarks.bench_memory [number_of_steps]
+"""
+import gc
+import sys
+import tracemalloc
+from app.backends import MemoryBackend
+from app.models import Database, User, RecipeCategory, Recipe, RecipeStep
+
+STEPS = 1000000
+STEPS_PER_RECIPE = 10
+RECIPES_PER_CATEGORY = 1000
+# objects inserted per insert_many call, so the batch itself stays small
+CHUNK = 10000
+
+
+def object_size(obj):
+    """Returns the bytes of obj and of its attribute dict if it has one"""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def allocated():
+    """Returns the bytes traced as allocated once garbage is collected"""
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def insert(database, make, keys):
+    """Inserts make(number, key) for every key in chunks"""
+    keys = list(keys)
+    for start in range(0, len(keys), CHUNK):
+        database.insert_many([make(number, key) for number, key in
+                              enumerate(keys[start:start + CHUNK], start)])
+
+
+def measure(number_of_steps, columnar):
+    """Returns the database filled and the bytes per recipe and per step"""
+    number_of_recipes = -(-number_of_steps // STEPS_PER_RECIPE)
+    number_of_categories = -(-number_of_recipes // RECIPES_PER_CATEGORY)
+    tracemalloc.start()
+    database = Database(MemoryBackend(columnar=columnar))
+    user = User(key=database.get_next_key(User), first_name='John',
+                last_name='Doe', email='johndoe@example.com', password='password')
+    database.insert_many([user])
+    category_keys = database.get_next_keys(RecipeCategory, number_of_categories)
+    insert(database, lambda number, key: RecipeCategory(
+        key=key, name='category %d' % key, description='', user=user.key), category_keys)
+    recipe_keys = database.get_next_keys(Recipe, number_of_recipes)
+    step_keys = database.get_next_keys(RecipeStep, number_of_steps)
+    before_recipes = allocated()
+    insert(database, lambda number, key: Recipe(
+        key=key, name='recipe %d' % key, description='',
+        category=category_keys[number // RECIPES_PER_CATEGORY]), recipe_keys)
+    before_steps = allocated()
+    insert(database, lambda number, key: RecipeStep(
+        key=key, text_content='Step %d' % key,
+        recipe=recipe_keys[number // STEPS_PER_RECIPE]), step_keys)
+    after_steps = allocated()
+    tracemalloc.stop()
+    return (database, (before_steps - before_recipes) / number_of_recipes,
+            (after_steps - before_steps) / number_of_steps)
+
+
+def main(number_of_steps=STEPS):
+    """Prints the bytes per recipe and per step with and without columns"""
+    database, per_recipe, per_step = measure(number_of_steps, False)
+    recipe_key, step_key = next(iter(database.recipes)), next(iter(database.recipe_steps))
+    print('%22s %12d' % ('steps', number_of_steps))
+    print('%22s %12.1f' % ('bytes per recipe', per_recipe))
+    print('%22s %12.1f' % ('bytes per step', per_step))
+    print('%22s %12d' % ('recipe object bytes', object_size(database.recipes[recipe_key])))
+    print('%22s %12d' % ('step object bytes', object_size(database.recipe_steps[step_key])))
+    del database
+    database, _, columnar_per_step = measure(number_of_steps, True)
+    print('%22s %12.1f' % ('columnar step bytes', columnar_per_step))
+    print('%22s %12.1f' % ('in the columns', database.recipe_steps.memory_size()
+                           / number_of_steps))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+"""
+Microbenchmark comparing the old list(set()) key properties
+with OrderedIndex for add, contains, remove and iteration.
+
+Run from flask_app/ with:
+    python -m benchmarks.bench_ordered_index
+"""
+import sys
+import timeit
+from app.indexes import OrderedIndex
+
+SIZES = (10000, 1000000)
+SAMPLES = 100
+
+
+class LegacyKeys:
+    """The old behaviour: a list deduplicated on every access"""
+    def __init__(self, keys):
+        self._keys = list(keys)
+
+    @property
+    def keys(self):
+        self._keys = list(set(self._keys))
+        return self._keys
+
+
+def per_op(statement, number=SAMPLES):
+    """Returns microseconds per call of statement"""
+    return timeit.timeit(statement, number=number) / number * 1e6
+
+
+def bench(size):
+    """Returns a dict of operation to (legacy, new) microseconds"""
+    legacy = LegacyKeys(range(size))
+    index = OrderedIndex(range(size))
+    middle = size // 2
+    results = {}
+    results['add'] = (per_op(lambda: legacy.keys.append(size)),
+                      per_op(lambda: index.add(size)))
+    results['contains'] = (per_op(lambda: middle in legacy.keys),
+                           per_op(lambda: middle in index))
+
+    def legacy_remove():
+        legacy.keys.remove(middle)
+        legacy.keys.append(middle)
+
+    def new_remove():
+        index.remove(middle)
+        index.add(middle)
+
+    results['remove'] = (per_op(legacy_remove), per_op(new_remove))
+    results['iterate'] = (per_op(lambda: sum(1 for _ in legacy.keys), 5),
+                          per_op(lambda: sum(1 for _ in index), 5))
+    return results
+
+
+def main(sizes=SIZES):
+    """Prints the comparison table"""
+    print('%10s %10s %16s %16s' % ('keys', 'operation', 'legacy us/op',
+                                   'OrderedIndex us/op'))
+    for size in sizes:
+        for operation, (legacy, new) in bench(size).items():
+            print('%10d %10s %16.2f %16.2f' % (size, operation, legacy, new))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
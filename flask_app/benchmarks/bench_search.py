@@ -0,0 +1,98 @@
+"""
+Benchmark of the full-text search. Fills a database with the given
+number of steps, ten per recipe, whose words follow a Zipf-like
+distribution, then reports how long the index takes to build and
+the query latency for common, rare and multi-word queries.
+The target is under 10 ms for every query at 1M steps.
+
+Run from flask_app/ with:
+    python -m benchmarks.bench_search [number_of_steps]
+"""
+import random
+import sys
+import time
+from bisect import bisect
+from app.models import Database, User, RecipeCategory, Recipe, RecipeStep
+
+STEPS = 1000000
+STEPS_PER_RECIPE = 10
+RECIPES_PER_CATEGORY = 1000
+VOCABULARY = 20000
+WORDS_PER_STEP = 8
+SAMPLES = 50
+TARGET_MS = 10.0
+
+
+def fill(database, number_of_steps, generator):
+    """Inserts number_of_steps steps and returns the vocabulary"""
+    words = ['word%d' % rank for rank in range(VOCABULARY)]
+    # the cumulative weights of ranks 1..VOCABULARY under Zipf's law
+    cumulative = []
+    total = 0.0
+    for rank in range(VOCABULARY):
+        total += 1.0 / (rank + 1)
+        cumulative.append(total)
+
+    def text(count):
+        return ' '.join(words[min(bisect(cumulative, generator.random() * total),
+                                  VOCABULARY - 1)] for _ in range(count))
+
+    number_of_recipes = -(-number_of_steps // STEPS_PER_RECIPE)
+    number_of_categories = -(-number_of_recipes // RECIPES_PER_CATEGORY)
+    user = User(key=database.get_next_key(User), first_name='John',
+                last_name='Doe', email='johndoe@example.com', password='password')
+    objects = [user]
+    category_keys = database.get_next_keys(RecipeCategory, number_of_categories)
+    objects.extend(RecipeCategory(key=key, name='category %d' % key, description='',
+                                  user=user.key) for key in category_keys)
+    recipe_keys = database.get_next_keys(Recipe, number_of_recipes)
+    objects.extend(Recipe(key=key, name=text(2), description=text(4),
+                          category=category_keys[number // RECIPES_PER_CATEGORY])
+                   for number, key in enumerate(recipe_keys))
+    step_keys = database.get_next_keys(RecipeStep, number_of_steps)
+    objects.extend(RecipeStep(key=key, text_content=text(WORDS_PER_STEP),
+                              recipe=recipe_keys[number // STEPS_PER_RECIPE])
+                   for number, key in enumerate(step_keys))
+    database.insert_many(objects)
+    return words
+
+
+def latency(database, queries):
+    """Returns the median and worst milliseconds per query"""
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        database.search(query)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], timings[-1]
+
+
+def main(number_of_steps=STEPS):
+    """Prints the build time and the query latencies"""
+    generator = random.Random(42)
+    database = Database()
+    words = fill(database, number_of_steps, generator)
+    start = time.perf_counter()
+    database.enable_search()
+    # the index is built by the first search otherwise
+    database.search_index.build()
+    print('%18s %12d' % ('steps', number_of_steps))
+    print('%18s %12d' % ('recipes', len(database.search_index)))
+    print('%18s %12.2f' % ('build seconds', time.perf_counter() - start))
+    queries = {
+        'common': [words[generator.randrange(10)] for _ in range(SAMPLES)],
+        'rare': [words[generator.randrange(1000, VOCABULARY)]
+                 for _ in range(SAMPLES)],
+        'multi-word': [' '.join(generator.sample(words[:2000], 3))
+                       for _ in range(SAMPLES)],
+    }
+    print('%18s %12s %12s' % ('query', 'median ms', 'worst ms'))
+    for name, batch in queries.items():
+        median, worst = latency(database, batch)
+        print('%18s %12.2f %12.2f%s' % (name, median, worst,
+                                        '' if worst < TARGET_MS else '  (over target)'))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,98 @@
+"""
+Benchmark for snapshots: time to write a snapshot, to load it
+cold and to reach the first recipe, compared with replaying a log.
+The data is spread over many users, categories and recipes like a
+real deployment, and the first index lookup, search and fuzzy
+search after the load are timed since they build their indexes.
+
+Run from flask_app/ with:
+    python -m benchmarks.bench_snapshot [number_of_steps]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from app.models import Database
+from app.wal import WriteAheadLog, FSYNC_PERIODIC
+
+STEPS = 200000
+CATEGORIES_PER_USER = 4
+RECIPES_PER_CATEGORY = 5
+STEPS_PER_RECIPE = 10
+STEPS_PER_USER = CATEGORIES_PER_USER * RECIPES_PER_CATEGORY * STEPS_PER_RECIPE
+
+
+def populate(db, number_of_steps):
+    """
+    Creates number_of_steps steps under as many users as it takes,
+    each with a few categories of a few recipes. Returns the last recipe
+    """
+    recipe = None
+    for user_number in range(max(1, number_of_steps // STEPS_PER_USER)):
+        user = db.create_user({'first_name': 'John', 'last_name': 'Doe',
+                               'email': 'john%d@example.com' % user_number,
+                               'password': 'password'})
+        for category_number in range(CATEGORIES_PER_USER):
+            category = user.create_recipe_category(
+                db, {'name': 'cakes %d' % category_number})
+            for recipe_number in range(RECIPES_PER_CATEGORY):
+                recipe = category.create_recipe(
+                    db, {'name': 'cake %d %d' % (user_number, recipe_number),
+                         'description': 'yummy'})
+                for number in range(STEPS_PER_RECIPE):
+                    recipe.create_step(db, {'text_content': 'Step %d: mix the flour '
+                                                            'and the sugar' % number})
+    return recipe
+
+
+def main(number_of_steps=STEPS):
+    """Prints the timings"""
+    directory = tempfile.mkdtemp()
+    try:
+        snapshot_path = os.path.join(directory, 'yummy.snapshot')
+        log_path = os.path.join(directory, 'yummy.wal')
+        db = Database()
+        log = WriteAheadLog(log_path, fsync_policy=FSYNC_PERIODIC)
+        db.open_log(log)
+        last_recipe = populate(db, number_of_steps)
+        log.close()
+
+        started = time.perf_counter()
+        db.snapshot(snapshot_path)
+        print('snapshot write   %8.3fs  %d bytes' % (
+            time.perf_counter() - started, os.path.getsize(snapshot_path)))
+
+        started = time.perf_counter()
+        loaded = Database()
+        loaded.load(snapshot_path)
+        loaded.enable_search()
+        loaded.enable_fuzzy_search()
+        print('snapshot load    %8.3fs' % (time.perf_counter() - started))
+        started = time.perf_counter()
+        recipe = loaded.get_recipe(last_recipe.key)
+        list(recipe.get_all_steps(loaded))
+        print('first recipe     %8.3fs' % (time.perf_counter() - started))
+        started = time.perf_counter()
+        loaded.get_user_by_email('john0@example.com')
+        print('first by email   %8.3fs' % (time.perf_counter() - started))
+        started = time.perf_counter()
+        loaded.search('flour sugar')
+        print('first search     %8.3fs' % (time.perf_counter() - started))
+        started = time.perf_counter()
+        loaded.fuzzy_find(loaded.get_recipe_category(recipe.category).user, 'cak')
+        print('first fuzzy      %8.3fs' % (time.perf_counter() - started))
+
+        started = time.perf_counter()
+        replayed = Database()
+        replay_log = WriteAheadLog(log_path)
+        replayed.open_log(replay_log)
+        print('log replay       %8.3fs  %d bytes' % (
+            time.perf_counter() - started, os.path.getsize(log_path)))
+        replay_log.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,78 @@
+"""
+Microbenchmark comparing the old randomised, copying binary_search
+and a single sorted list with SortedKeyIndex for finding names,
+range queries, listing names in order and adding names.
+
+Run from flask_app/ with:
+    python -m benchmarks.bench_sorted_keys [sizes]
+"""
+import random
+import sys
+import timeit
+from bisect import insort
+from app.indexes import SortedKeyIndex
+
+SIZES = (10000, 1000000)
+SAMPLES = 100
+
+
+def legacy_binary_search(character, list_of_characters, position=0):
+    """The old models.binary_search: a random pivot and a slice per level"""
+    length_of_list = len(list_of_characters)
+    if length_of_list <= 1:
+        if length_of_list == 0:
+            return None
+        if character != list_of_characters[0]:
+            return None
+        return position
+    random_int = random.randint(0, length_of_list - 1)
+    if character < list_of_characters[random_int]:
+        new_list = list_of_characters[:random_int]
+    else:
+        new_list = list_of_characters[random_int:]
+        position += random_int
+    return legacy_binary_search(character, new_list, position)
+
+
+def legacy_range(names, low, high):
+    """Names between low and high the old way, by scanning the list"""
+    return [name for name in names if low <= name < high]
+
+
+def per_op(statement, number=SAMPLES):
+    """Returns microseconds per call of statement"""
+    return timeit.timeit(statement, number=number) / number * 1e6
+
+
+def bench(size):
+    """Returns a dict of operation to (legacy, new) microseconds"""
+    names = sorted('name %08d' % number for number in range(size))
+    index = SortedKeyIndex(names)
+    targets = [names[random.randrange(size)] for _ in range(SAMPLES)]
+    low, high = names[size // 2], names[size // 2 + 50]
+    found = iter(targets * 2)
+    results = {}
+    results['find'] = (per_op(lambda: legacy_binary_search(next(found), names)),
+                       per_op(lambda: index.position(next(found))))
+    results['range 50'] = (per_op(lambda: legacy_range(names, low, high), 5),
+                           per_op(lambda: list(index.range(low, high))))
+    results['first 20'] = (per_op(lambda: sorted(names)[:20], 5),
+                           per_op(lambda: list(index.range(limit=20))))
+    # new names land all over the index, as names typed by users would
+    added = iter(['name %08d x' % random.randrange(size) for _ in range(SAMPLES * 2)])
+    results['add'] = (per_op(lambda: insort(names, next(added))),
+                      per_op(lambda: index.add(next(added))))
+    return results
+
+
+def main(sizes=SIZES):
+    """Prints the comparison table"""
+    print('%10s %10s %16s %20s' % ('names', 'operation', 'legacy us/op',
+                                   'SortedKeyIndex us/op'))
+    for size in sizes:
+        for operation, (legacy, new) in bench(size).items():
+            print('%10d %10s %16.2f %20.2f' % (size, operation, legacy, new))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
@@ -0,0 +1,84 @@
+"""
+Benchmark of tiered storage. Fills a database with users of a few
+categories of recipes with steps each, squeezes it into half of the
+memory it takes and then looks up recipes of random users, reporting
+the time of lookups served from memory and of those that fault a
+user's tree back in from disk.
+
+Run from flask_app/ with:
+    python -m benchmarks.bench_tiering [users] [recipes_per_user] [lookups]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from app.models import Database, User, RecipeCategory, Recipe, RecipeStep
+
+USERS = 2000
+RECIPES_PER_USER = 50
+STEPS_PER_RECIPE = 10
+CATEGORIES_PER_USER = 5
+LOOKUPS = 5000
+
+
+def fill(database, users, recipes_per_user):
+    """Inserts the users and their trees and returns the keys of each user's recipes"""
+    user_keys = database.get_next_keys(User, users)
+    database.insert_many([User(key=key, first_name='John', last_name='Doe',
+                               email='john%d@example.com' % key, password='password')
+                          for key in user_keys])
+    recipes = {}
+    for user_key in user_keys:
+        category_keys = database.get_next_keys(RecipeCategory, CATEGORIES_PER_USER)
+        recipe_keys = database.get_next_keys(Recipe, recipes_per_user)
+        step_keys = database.get_next_keys(RecipeStep, recipes_per_user * STEPS_PER_RECIPE)
+        database.insert_many(
+            [RecipeCategory(key=key, name='category %d' % key, description='',
+                            user=user_key) for key in category_keys]
+            + [Recipe(key=key, name='recipe %d' % key, description='',
+                      category=category_keys[number % CATEGORIES_PER_USER])
+               for number, key in enumerate(recipe_keys)]
+            + [RecipeStep(key=key, text_content='Step %d' % key,
+                          recipe=recipe_keys[number // STEPS_PER_RECIPE])
+               for number, key in enumerate(step_keys)])
+        recipes[user_key] = list(recipe_keys)
+    return recipes
+
+
+def main(users=USERS, recipes_per_user=RECIPES_PER_USER, lookups=LOOKUPS):
+    """Prints the lookup times and the tier counters"""
+    directory = tempfile.mkdtemp()
+    try:
+        database = Database()
+        database.enable_tiering(os.path.join(directory, 'tiers.sqlite3'), 1)
+        recipes = fill(database, users, recipes_per_user)
+        tiers = database.tiers
+        tiers.memory_budget = tiers.resident_bytes() // 2
+        started = time.perf_counter()
+        evicted = tiers.enforce()
+        enforce_seconds = time.perf_counter() - started
+        rng = random.Random(1)
+        hits, misses = [], []
+        for _ in range(lookups):
+            user_key = rng.choice(list(recipes))
+            faulted = user_key in tiers.evicted_users
+            started = time.perf_counter()
+            database.get_recipe(rng.choice(recipes[user_key]))
+            (misses if faulted else hits).append(time.perf_counter() - started)
+            tiers.enforce()
+        status = tiers.status()
+        print('%22s %12d' % ('users evicted at once', evicted))
+        print('%22s %12.3f' % ('enforce seconds', enforce_seconds))
+        print('%22s %12.1f' % ('hit microseconds', sum(hits) / max(len(hits), 1) * 1e6))
+        print('%22s %12.1f' % ('miss microseconds', sum(misses) / max(len(misses), 1) * 1e6))
+        for name in ('hits', 'misses', 'hit_ratio', 'evictions'):
+            print('%22s %12s' % (name, status[name]))
+        tiers.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
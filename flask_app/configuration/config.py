@@ -12,6 +12,42 @@ class Config(object):
     SECRET = os.getenv('SECRET')
     CSRF_ENABLED = True
     SECRET_KEY = os.getenv('SECRET_KEY')
+    # path of the write-ahead log. Data is kept in memory only if unset
+    WAL_PATH = os.getenv('WAL_PATH')
+    # one of 'always', 'group' or 'periodic'
+    WAL_FSYNC = os.getenv('WAL_FSYNC') or 'always'
+    # number of records per fsync when WAL_FSYNC is 'group'
+    WAL_GROUP_SIZE = int(os.getenv('WAL_GROUP_SIZE') or 32)
+    # seconds between fsyncs when WAL_FSYNC is 'periodic'
+    WAL_FSYNC_INTERVAL = float(os.getenv('WAL_FSYNC_INTERVAL') or 1.0)
+    # path of the binary snapshot loaded on startup before the log is replayed
+    SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH')
+    # path of a SQLite file to keep the data in instead of memory.
+    # The write-ahead log and snapshots only apply to in-memory data
+    SQLITE_PATH = os.getenv('SQLITE_PATH')
+    # token expected by the /admin routes. They are disabled if unset
+    ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+    # set VERSIONED_READS=on to render pages from immutable versions of
+    # the data that writers never block. Off by default since building
+    # them from every object holds up the boot over a large snapshot
+    VERSIONED_READS = (os.getenv('VERSIONED_READS') or 'off') == 'on'
+    # keep a full-text index of the recipes for /search.
+    # Set FULL_TEXT_SEARCH=off to save the memory it takes
+    FULL_TEXT_SEARCH = (os.getenv('FULL_TEXT_SEARCH') or 'on') != 'off'
+    # keep a trigram index of category and recipe names so suggestions
+    # tolerate typos. Set FUZZY_SEARCH=off to save the memory it takes
+    FUZZY_SEARCH = (os.getenv('FUZZY_SEARCH') or 'on') != 'off'
+    # keep recipe steps in packed columns instead of one object each,
+    # which takes a fraction of the memory. Only applies to in-memory data
+    COLUMNAR_STEPS = (os.getenv('COLUMNAR_STEPS') or 'off') != 'off'
+    # hide deleted categories and recipes at once and reclaim what was
+    # under them from a background thread. Only applies to in-memory data
+    DEFERRED_DELETES = (os.getenv('DEFERRED_DELETES') or 'on') != 'off'
+    # scratch file the trees of the least recently used users are moved
+    # to once the tables take more than TIERED_MEMORY_MB. Unset to keep
+    # everything in memory. Not with VERSIONED_READS=on. In-memory data only
+    TIERED_STORE_PATH = os.getenv('TIERED_STORE_PATH')
+    TIERED_MEMORY_MB = int(os.getenv('TIERED_MEMORY_MB') or 512)
 
 
 class DevelopmentConfig(Config):
@@ -31,6 +67,10 @@ class TestingConfig(Config):
     SECRET = "development secret"
     TESTING = True
     SECRET_KEY = "development key"
+    WAL_PATH = None
+    SNAPSHOT_PATH = None
+    SQLITE_PATH = None
+    ADMIN_TOKEN = "admin token"
 
 
 class StagingConfig(Config):
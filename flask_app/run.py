@@ -2,17 +2,91 @@
 This is the entry point for the app
 """
 
+import io
 import os
+import click
 from flask import request, redirect, url_for,\
-    render_template, flash
+    render_template, flash, jsonify, abort, Response, stream_with_context
 from app import create_app
-from app.models import db
-from app import controller
+from app.models import db, RecipeCategory
+from app import controller, bulk, export
+from app.wal import WriteAheadLog
+from app.bgsave import BackgroundSaver
+from app.compaction import Compactor
+from app.backends import SQLiteBackend, MemoryBackend
 
 config_name = os.getenv('APP_SETTINGS') or 'development'
 app = create_app(config_name)
+
+write_ahead_log = None
+if app.config.get('SQLITE_PATH'):
+    # all workers share the data in one SQLite file
+    db.set_backend(SQLiteBackend(app.config['SQLITE_PATH']))
+else:
+    if app.config.get('COLUMNAR_STEPS'):
+        db.set_backend(MemoryBackend(columnar=True))
+    if app.config.get('SNAPSHOT_PATH') and os.path.exists(app.config['SNAPSHOT_PATH']):
+        # objects are decoded from the memory-mapped file as they are used
+        db.load(app.config['SNAPSHOT_PATH'])
+    if app.config.get('WAL_PATH'):
+        # rebuild db from the log then keep logging every mutation
+        write_ahead_log = WriteAheadLog(app.config['WAL_PATH'],
+                                        fsync_policy=app.config['WAL_FSYNC'],
+                                        group_size=app.config['WAL_GROUP_SIZE'],
+                                        interval=app.config['WAL_FSYNC_INTERVAL'])
+        db.open_log(write_ahead_log)
+        if app.config.get('SNAPSHOT_PATH'):
+            # fold the replayed log into a new snapshot so the next boot is fast
+            db.snapshot(app.config['SNAPSHOT_PATH'], log=write_ahead_log)
+
+if app.config.get('VERSIONED_READS') and not db.backend.shared:
+    # pages render from immutable versions and never wait for writers
+    db.enable_versions()
+
+if app.config.get('FULL_TEXT_SEARCH') and not db.backend.shared:
+    db.enable_search()
+
+if app.config.get('FUZZY_SEARCH') and not db.backend.shared:
+    db.enable_fuzzy_search()
+
+if app.config.get('TIERED_STORE_PATH') and not db.backend.shared:
+    # cold users' trees go to disk and come back when they are looked up
+    db.enable_tiering(app.config['TIERED_STORE_PATH'],
+                      app.config['TIERED_MEMORY_MB'] * 1024 * 1024)
+
+# the number of results on the search page
+SEARCH_LIMIT = 20
+# the number of names of each kind suggested as the user types
+SUGGESTION_LIMIT = 8
+
+background_saver = None
+if app.config.get('SNAPSHOT_PATH') and not db.backend.shared:
+    background_saver = BackgroundSaver(db, app.config['SNAPSHOT_PATH'],
+                                       log=write_ahead_log)
+
+compactor = None
+if app.config.get('DEFERRED_DELETES') and not db.backend.shared:
+    # deletes return at once and the compactor reclaims the rest
+    compactor = Compactor(db)
+    compactor.start()
+
+
+def delete(obj):
+    """Deletes obj, leaving what is under it to the compactor if there is one"""
+    if compactor is not None:
+        db.delete_later(obj)
+    else:
+        obj.delete(db)
     
 
+@app.after_request
+def enforce_memory_budget(response):
+    """Evicts the least recently used users, at most once a second, if over budget"""
+    if db.tiers is not None:
+        db.tiers.maybe_enforce()
+    return response
+
+
 # routes
 @app.route('/')
 def index():
@@ -33,7 +107,7 @@ def signup():
     form_data = None
     try:
         required_keys = ('first_name', 'last_name', 'email', 'password')
-        form_data = controller.process_form_data(dict(request.form),
+        form_data = controller.process_form_data(request.form.to_dict(flat=False),
                                                  *required_keys)
     except (AttributeError, ValueError):
         error = 'invalid request'
@@ -87,7 +161,7 @@ def signin():
     # get request.form data
     try:
         required_keys = ('email', 'password')
-        form_data = controller.process_form_data(dict(request.form), *required_keys)
+        form_data = controller.process_form_data(request.form.to_dict(flat=False), *required_keys)
     except (AttributeError, ValueError):
         error = "Invalid form input"
     
@@ -132,7 +206,6 @@ def categories_list(user_key):
         if user:
             user_details = dict(first_name=user.first_name, email=user.email,
             last_name=user.last_name, key=user.key)
-            recipe_categories = user.get_all_recipe_categories(db)
             # try to get the logged in user
             logged_in_user_key = controller.get_logged_in_user_key()
             if logged_in_user_key == user.key:
@@ -146,15 +219,20 @@ def categories_list(user_key):
         form_data = None
         try:
             required_keys = ('name',)
-            form_data = controller.process_form_data(dict(request.form),
+            form_data = controller.process_form_data(request.form.to_dict(flat=False),
                                                      *required_keys)
         except (AttributeError, ValueError):
             error = "Invalid form input"
         else:
-            # Try to create a new recipe category and add it to recipe category list
-            new_category = user.create_recipe_category(db, form_data)
-            if new_category:
-                recipe_categories.append(new_category)
+            # Try to create a new recipe category
+            user.create_recipe_category(db, form_data)
+
+    if user:
+        # read after any POST so the new category shows up
+        view = db.read_view()
+        user_version = view.get_user(user.key)
+        if user_version:
+            recipe_categories = user_version.get_all_recipe_categories(view)
 
     return render_template('categories_list.html', active=active, error=error,
                             user_details=user_details, editable=editable,
@@ -174,7 +252,6 @@ def categories_detail(user_key, category_key):
     recipe_category_details = {}
     recipe_category = None
     recipes = []
-    user = None
     missing_required_field = False
     try:
         recipe_category = db.get_recipe_category(category_key)
@@ -190,7 +267,7 @@ def categories_detail(user_key, category_key):
         method = request.args.get('_method') or None
         if editable and method == 'delete' and recipe_category:
             # attempt to delete the recipe_category
-            recipe_category.delete(db)
+            delete(recipe_category)
             flash('Delete successful')
             return redirect(url_for('categories_list', user_key=user_key))
         
@@ -217,10 +294,17 @@ def categories_detail(user_key, category_key):
             return redirect(url_for('categories_list', user_key=user_key))            
         
         if not error:
-            recipe_category_details = dict(name=recipe_category.name,
-                            description=recipe_category.description, 
-                            key=recipe_category.key)
-            recipes = list(recipe_category.get_all_recipes(db))
+            # render from one version so a concurrent write is either
+            # fully visible or not at all
+            view = db.read_view()
+            recipe_category = view.get_recipe_category(category_key)
+            if recipe_category is None:
+                error = "Recipe Category does not exist"
+            else:
+                recipe_category_details = dict(name=recipe_category.name,
+                                description=recipe_category.description,
+                                key=recipe_category.key)
+                recipes = recipe_category.get_all_recipes(view)
         return render_template('categories_detail.html', 
                 recipe_category_details=recipe_category_details, user_key=user_key,
                  editable=editable, error=error, recipes=recipes, category_key=category_key)
@@ -230,7 +314,7 @@ def categories_detail(user_key, category_key):
         form_data = None
         try:
             required_keys = ('name',)
-            form_data = controller.process_form_data(dict(request.form),
+            form_data = controller.process_form_data(request.form.to_dict(flat=False),
                                                      *required_keys)
         except (AttributeError, ValueError):
             error = "Invalid form input"
@@ -252,6 +336,33 @@ def categories_detail(user_key, category_key):
                                 category_key=category_key))
 
 
+@app.route('/user/<int:user_key>/categories/<int:category_key>/move',
+           methods=['POST'])
+def categories_move(user_key, category_key):
+    """
+    Moves the recipes whose keys are given in the form field 'recipes'
+    from this category to the category given in the field 'category' (POST)
+    """
+    recipe_category = db.get_recipe_category(category_key)
+    if (recipe_category is None or user_key != recipe_category.user
+            or user_key != controller.get_logged_in_user_key()):
+        flash("Recipe Category does not exist")
+        return redirect(url_for('categories_list', user_key=user_key))
+    try:
+        target_key = int(request.form.get('category', ''))
+        recipes = [db.get_recipe(int(key)) for key in request.form.getlist('recipes')]
+        if any(recipe is None or recipe.category != category_key for recipe in recipes):
+            raise ValueError('Wrong recipes')
+        moved = db.move_recipes(recipes, target_key)
+    except (ValueError, KeyError):
+        flash("Invalid form input for move")
+        return redirect(url_for('categories_detail', user_key=user_key,
+                                category_key=category_key))
+    flash('%d recipe(s) moved' % moved)
+    return redirect(url_for('categories_detail', user_key=user_key,
+                            category_key=target_key))
+
+
 @app.route('/user/<int:user_key>/categories/<int:category_key>/recipes/<int:recipe_key>',
 methods=['POST', 'GET'])
 def recipe_detail(user_key, category_key, recipe_key):
@@ -266,7 +377,6 @@ def recipe_detail(user_key, category_key, recipe_key):
     recipe_details = {}
     recipe = None
     steps = []
-    user = None
     category = None
     missing_required_field = False
     try:
@@ -283,7 +393,7 @@ def recipe_detail(user_key, category_key, recipe_key):
         method = request.args.get('_method') or None
         if editable and method == 'delete' and recipe:
             # attempt to delete the recipe
-            recipe.delete(db)
+            delete(recipe)
             flash('Delete successful')
             return redirect(url_for('categories_detail',
                             user_key=user_key, category_key=category_key))
@@ -312,10 +422,18 @@ def recipe_detail(user_key, category_key, recipe_key):
                             category_key=category_key))            
         
         if not error:
-            recipe_details = dict(name=recipe.name,
-                            description=recipe.description, 
-                            key=recipe.key)
-            steps = list(recipe.get_all_steps(db))
+            # render from one version so a concurrent write is either
+            # fully visible or not at all
+            view = db.read_view()
+            recipe = view.get_recipe(recipe_key)
+            category = view.get_recipe_category(category_key)
+            if recipe is None or category is None:
+                error = "Recipe does not exist"
+            else:
+                recipe_details = dict(name=recipe.name,
+                                description=recipe.description,
+                                key=recipe.key)
+                steps = recipe.get_all_steps(view)
         return render_template('recipe_detail.html', 
                 recipe_details=recipe_details, user_key=user_key, category=category,
                  editable=editable, error=error, steps=steps)
@@ -325,7 +443,7 @@ def recipe_detail(user_key, category_key, recipe_key):
         form_data = None
         try:
             required_keys = ('text_content',)
-            form_data = controller.process_form_data(dict(request.form), *required_keys)
+            form_data = controller.process_form_data(request.form.to_dict(flat=False), *required_keys)
         except (AttributeError, ValueError):
             error = "Invalid form input"
             flash(error)
@@ -358,7 +476,6 @@ def step_detail(user_key, category_key, recipe_key, step_key):
     editable = False
     recipe_step = None
     recipe = None
-    user = None
     category = None
     missing_required_field = False
     try:
@@ -406,5 +523,180 @@ def step_detail(user_key, category_key, recipe_key, step_key):
                             category_key=category_key, recipe_key=recipe_key))           
     
 
+@app.route('/search', methods=['GET'])
+def search():
+    """
+    The page listing the recipes whose name, description or steps
+    match the q arg, best first
+    """
+    active = 'search'
+    error = None
+    query = (request.args.get('q') or '').strip()
+    results = []
+    if query:
+        try:
+            matches = db.search(query, limit=SEARCH_LIMIT)
+        except ValueError as e:
+            error = str(e)
+        else:
+            view = db.read_view()
+            for recipe, score in matches:
+                recipe = view.get_recipe(recipe.key)
+                category = recipe and view.get_recipe_category(recipe.category)
+                if category:
+                    results.append(dict(name=recipe.name, key=recipe.key,
+                                        description=recipe.description,
+                                        category_key=category.key,
+                                        category_name=category.name,
+                                        user_key=category.user))
+    return render_template('search.html', active=active, error=error,
+                           query=query, results=results)
+
+
+@app.route('/user/<int:user_key>/suggest', methods=['GET'])
+def suggest(user_key):
+    """
+    Returns as JSON the user's category and recipe names that start
+    with the q arg, ignoring case, for suggesting names as they are typed.
+    With fuzzy search on, names the q arg misspells are listed under fuzzy
+    """
+    if db.get_user(user_key) is None:
+        abort(404)
+    prefix = request.args.get('q') or ''
+    categories = db.suggest_recipe_categories(user_key, prefix, SUGGESTION_LIMIT)
+    recipes = db.suggest_recipes(user_key, prefix, SUGGESTION_LIMIT)
+    fuzzy = []
+    if db.fuzzy_index is not None:
+        fuzzy = db.fuzzy_find(user_key, prefix, SUGGESTION_LIMIT)
+    return jsonify(
+        categories=[suggestion(user_key, category) for category in categories],
+        recipes=[suggestion(user_key, recipe) for recipe in recipes],
+        fuzzy=[suggestion(user_key, obj) for obj in fuzzy])
+
+
+def suggestion(user_key, obj):
+    """Returns the JSON-ready name, key and page of a category or recipe"""
+    if isinstance(obj, RecipeCategory):
+        return dict(name=obj.name, key=obj.key, kind='category',
+                    url=url_for('categories_detail', user_key=user_key,
+                                category_key=obj.key))
+    return dict(name=obj.name, key=obj.key, kind='recipe', category_key=obj.category,
+                url=url_for('recipe_detail', user_key=user_key,
+                            category_key=obj.category, recipe_key=obj.key))
+
+
+@app.route('/user/<int:user_key>/export', methods=['GET'])
+def user_export(user_key):
+    """
+    Streams the user's categories, recipes and steps as NDJSON.
+    Only the user or an admin may export them
+    """
+    if user_key != controller.get_logged_in_user_key() \
+    and not controller.is_admin_request():
+        abort(404)
+    # one version for the whole export so it is consistent
+    view = db.read_view()
+    user = view.get_user(user_key)
+    if user is None:
+        abort(404)
+    lines = export.export_user(view, user)
+    response = Response(stream_with_context(export.chunks(lines)),
+                        mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=user-%d.ndjson' % user_key
+    return response
+
+
+@app.route('/admin/snapshot', methods=['GET', 'POST'])
+def admin_snapshot():
+    """
+    Reports the status of background snapshots (GET)
+    or starts one in a forked process (POST)
+    """
+    if not controller.is_admin_request():
+        abort(404)
+    if background_saver is None:
+        return jsonify(error='SNAPSHOT_PATH is not configured'), 400
+    if request.method == 'POST':
+        try:
+            background_saver.start()
+        except ValueError as e:
+            return jsonify(error=str(e), **background_saver.status()), 409
+        return jsonify(**background_saver.status()), 202
+    return jsonify(**background_saver.status())
+
+
+@app.route('/admin/stats', methods=['GET'])
+def admin_stats():
+    """
+    Reports the objects, memory and index sizes of every table, the
+    largest users and the growth rate. Cheap enough to scrape often
+    """
+    if not controller.is_admin_request():
+        abort(404)
+    stats = db.stats()
+    if compactor is not None:
+        stats['compactor'] = compactor.status()
+    if db.tiers is not None:
+        stats['tiers'] = db.tiers.status()
+    return jsonify(**stats)
+
+
+@app.route('/admin/import', methods=['POST'])
+def admin_import():
+    """
+    Imports the rows in the request body in bulk. The format is taken
+    from the format arg (csv, ndjson or json) and CSV and NDJSON
+    bodies are streamed rather than read whole
+    """
+    if not controller.is_admin_request():
+        abort(404)
+    file_format = request.args.get('format') or 'ndjson'
+    if file_format not in bulk.FORMATS:
+        return jsonify(error='format should be one of %s'
+                       % ', '.join(bulk.FORMATS)), 400
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    importer = bulk.BulkImporter(db)
+    try:
+        importer.run(bulk.read_rows(lines, file_format))
+    except ValueError as e:
+        return jsonify(error=str(e), **importer.report()), 400
+    return jsonify(**importer.report())
+
+
+@app.cli.command('import-recipes')
+@click.argument('path')
+@click.option('--format', 'file_format', type=click.Choice(bulk.FORMATS),
+              help='Defaults to the extension of the file')
+@click.option('--batch-size', default=bulk.BATCH_SIZE,
+              help='Rows validated and saved together')
+def import_recipes(path, file_format, batch_size):
+    """Imports recipes in bulk from a CSV, NDJSON or JSON file"""
+    if write_ahead_log is None and not app.config.get('SQLITE_PATH'):
+        click.echo('Warning: neither WAL_PATH nor SQLITE_PATH is set so '
+                   'the imported data is lost on exit', err=True)
+    report = bulk.import_file(db, path, file_format, batch_size)
+    if write_ahead_log is not None and app.config.get('SNAPSHOT_PATH'):
+        # keep the next boot fast by folding the import into the snapshot
+        db.snapshot(app.config['SNAPSHOT_PATH'], log=write_ahead_log)
+    click.echo('Imported %(rows)d rows in %(seconds).1fs (%(rows_per_second)d rows/s): '
+               '%(users)d users, %(recipe_categories)d categories, '
+               '%(recipes)d recipes, %(recipe_steps)d steps' % report)
+
+
+@app.cli.command('export-user')
+@click.argument('email')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-',
+              help='File to write to. Defaults to standard output')
+def export_user(email, output):
+    """Exports a user's recipe tree as NDJSON"""
+    user = db.get_user_by_email(email)
+    if user is None:
+        raise click.ClickException('No user has the email %s' % email)
+    view = db.read_view()
+    for chunk in export.chunks(export.export_user(view, view.get_user(user.key))):
+        output.write(chunk)
+
+
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
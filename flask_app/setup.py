@@ -9,6 +9,7 @@ setup(
     name='app',
     packages=['app'],
     include_package_data=True,
+    python_requires='>=3.8',
     install_requires=[
         'flask',
     ],
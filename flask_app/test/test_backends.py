@@ -0,0 +1,254 @@
+"""Module with the parity tests for the storage backends"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from app.models import Database, User, RecipeCategory, RecipeStep
+from app.backends import MemoryBackend, SQLiteBackend
+
+
+class BackendParityMixin:
+    """
+    Tests every backend has to pass. Objects are compared by their
+    records because the SQLite backend hands out fresh copies
+    """
+
+    def make_backend(self):
+        """Returns the backend under test"""
+        raise NotImplementedError
+
+    def setUp(self):
+        """Creates a database on the backend with one user"""
+        self.directory = tempfile.mkdtemp()
+        self.backend = self.make_backend()
+        self.db = Database(self.backend)
+        self.user = self.db.create_user({
+            'first_name': 'John',
+            'last_name': 'Doe',
+            'email': 'johndoe@example.com',
+            'password': 'password',
+            })
+
+    def tearDown(self):
+        """Closes the backend and removes the temporary directory"""
+        self.backend.close()
+        shutil.rmtree(self.directory)
+
+    def test_create_and_get(self):
+        """Objects created through the models can be read back"""
+        category = self.user.create_recipe_category(self.db, {'name': 'cakes'})
+        recipe = category.create_recipe(self.db, {'name': 'Banana cake',
+                                                  'description': 'yummy'})
+        step = recipe.create_step(self.db, {'text_content': 'Bake'})
+        self.assertEqual(self.db.get_user_by_email('johndoe@example.com')
+                         .to_record(), self.user.to_record())
+        self.assertEqual(self.db.get_recipe_category(category.key).to_record(),
+                         category.to_record())
+        self.assertEqual(self.db.get_recipe(recipe.key).to_record(),
+                         recipe.to_record())
+        self.assertEqual(self.db.get_recipe_step(step.key).to_record(),
+                         step.to_record())
+        self.assertIsNone(self.db.get_recipe(99))
+        self.assertEqual(self.db.get_recipe_by_name(recipe.category, 'Banana cake').key, recipe.key)
+        self.assertIn(recipe.key, self.db.recipe_keys)
+        self.assertListEqual(list(self.db.recipe_keys), [recipe.key])
+        self.assertEqual(len(self.db.recipe_steps), 1)
+
+    def test_children_keep_their_order(self):
+        """Children are returned in authored order and can be moved"""
+        category = self.user.create_recipe_category(self.db, {'name': 'cakes'})
+        recipe = category.create_recipe(self.db, {'name': 'Banana cake',
+                                                  'description': 'yummy'})
+        for text_content in ('one', 'three'):
+            recipe.create_step(self.db, {'text_content': text_content})
+        recipe.create_step(self.db, {'text_content': 'two'}, position=1)
+        recipe = self.db.get_recipe(recipe.key)
+        recipe.move_step(recipe.recipe_steps[2], 0, self.db)
+        steps = [step.text_content for step in recipe.get_all_steps(self.db)]
+        self.assertListEqual(steps, ['three', 'one', 'two'])
+        user = self.db.get_user(self.user.key)
+        self.assertListEqual([c.name for c in user.get_all_recipe_categories(self.db)],
+                             ['cakes'])
+
+    def test_updates(self):
+        """Setters are stored"""
+        category = self.user.create_recipe_category(self.db, {'name': 'cakes'})
+        category.set_description('all recipes cake!', self.db)
+        recipe = category.create_recipe(self.db, {'name': 'Banana cake',
+                                                  'description': 'yummy'})
+        recipe.set_name('Banana bread', self.db)
+        step = recipe.create_step(self.db, {'text_content': 'Bake'})
+        step.set_text_content('Bake for an hour', self.db)
+        self.assertEqual(self.db.get_recipe_category(category.key).description,
+                         'all recipes cake!')
+        self.assertEqual(self.db.get_recipe(recipe.key).name, 'Banana bread')
+        self.assertEqual(self.db.get_recipe_step(step.key).text_content,
+                         'Bake for an hour')
+
+    def test_cascading_delete(self):
+        """Deleting a category removes everything under it"""
+        category = self.user.create_recipe_category(self.db, {'name': 'cakes'})
+        recipe = category.create_recipe(self.db, {'name': 'Banana cake',
+                                                  'description': 'yummy'})
+        step = recipe.create_step(self.db, {'text_content': 'Bake'})
+        report = self.db.get_recipe_category(category.key).delete(self.db)
+        self.assertEqual((report['recipe_categories'], report['recipes'],
+                          report['recipe_steps'], report['objects']), (1, 1, 1, 3))
+        self.assertIsNone(self.db.get_recipe_category(category.key))
+        self.assertIsNone(self.db.get_recipe(recipe.key))
+        self.assertIsNone(self.db.get_recipe_step(step.key))
+        self.assertNotIn(step.key, self.db.recipe_step_keys)
+        self.assertIsNone(self.db.get_index(RecipeCategory, 'name').first((self.user.key, 'cakes')))
+        self.assertEqual(len(self.db.get_user(self.user.key).recipe_categories), 0)
+        self.assertRaises(KeyError, category.delete, self.db)
+        # keys are not reused
+        self.assertEqual(self.db.get_next_key(RecipeStep), step.key + 1)
+
+    def test_secondary_indexes(self):
+        """Declared indexes follow saves, renames and deletes"""
+        cakes = self.user.create_recipe_category(self.db, {'name': 'cakes'})
+        self.user.create_recipe_category(self.db, {'name': 'bread'})
+        pies = self.user.create_recipe_category(self.db, {'name': 'pies'})
+        other = self.db.create_user({'first_name': 'Jane', 'last_name': 'Doe',
+                                     'email': 'janedoe@example.com',
+                                     'password': 'password'})
+        other.create_recipe_category(self.db, {'name': 'apples'})
+        names = [category.name for category in self.db.find_range(
+            RecipeCategory, 'prefix', (self.user.key,), (self.user.key + 1,))]
+        self.assertListEqual(names, ['bread', 'cakes', 'pies'])
+        self.db.get_recipe_category(pies.key).set_name('apples', self.db)
+        self.assertIsNone(self.db.get_recipe_category_by_name(self.user.key, 'pies'))
+        self.assertEqual(self.db.get_recipe_category_by_name(
+            self.user.key, 'apples').key, pies.key)
+        self.db.get_recipe_category(cakes.key).delete(self.db)
+        self.assertListEqual(self.db.find(RecipeCategory, 'name',
+                                          (self.user.key, 'cakes')), [])
+        self.assertRaises(ValueError, self.db.find_range, User, 'email')
+        self.assertRaises(KeyError, self.db.find, User, 'name', 'John')
+        # emails are unique
+        jane = self.db.get_user(other.key)
+        jane.email = 'johndoe@example.com'
+        self.assertRaises(ValueError, jane.save, self.db)
+        self.assertEqual(self.db.get_user_by_email('johndoe@example.com').key,
+                         self.user.key)
+
+    def test_name_suggestions(self):
+        """Names starting with a prefix are suggested in name order"""
+        cakes = self.user.create_recipe_category(self.db, {'name': 'Cakes'})
+        self.user.create_recipe_category(self.db, {'name': 'casseroles'})
+        bread = self.user.create_recipe_category(self.db, {'name': 'bread'})
+        cakes.create_recipe(self.db, {'name': 'Carrot cake', 'description': ''})
+        cakes.create_recipe(self.db, {'name': 'banana cake', 'description': ''})
+        bread.create_recipe(self.db, {'name': 'Cornbread', 'description': ''})
+        bread.create_recipe(self.db, {'name': 'ciabatta', 'description': ''})
+        other = self.db.create_user({'first_name': 'Jane', 'last_name': 'Doe',
+                                     'email': 'janedoe@example.com',
+                                     'password': 'password'})
+        other.create_recipe_category(self.db, {'name': 'cookies'})
+
+        def names(objects):
+            """Returns the names of objects"""
+            return [obj.name for obj in objects]
+
+        self.assertListEqual(names(self.db.suggest_recipe_categories(
+            self.user.key, 'CA')), ['Cakes', 'casseroles'])
+        self.assertListEqual(names(self.db.suggest_recipes(self.user.key, 'c')),
+                             ['Carrot cake', 'ciabatta', 'Cornbread'])
+        self.assertListEqual(names(self.db.suggest_recipes(self.user.key, 'c', 2)),
+                             ['Carrot cake', 'ciabatta'])
+        self.assertListEqual(names(self.db.suggest_recipes(self.user.key, 'x')), [])
+        self.assertListEqual(self.db.suggest_recipes(other.key + 1, 'c'), [])
+        # renames move the suggestion
+        self.db.get_recipe_category(bread.key).set_name('Crusts', self.db)
+        self.assertListEqual(names(self.db.suggest_recipe_categories(
+            self.user.key, 'c', 2)), ['Cakes', 'casseroles'])
+        self.assertListEqual(names(self.db.suggest_recipe_categories(
+            self.user.key, 'cr')), ['Crusts'])
+        self.assertListEqual(names(self.db.suggest_recipe_categories(
+            self.user.key, 'b')), [])
+        self.assertRaises(TypeError, self.db.suggest_recipes, self.user.key, 2)
+
+
+class MemoryBackendTest(BackendParityMixin, unittest.TestCase):
+    """Runs the parity tests against MemoryBackend"""
+
+    def make_backend(self):
+        return MemoryBackend()
+
+
+class ColumnarMemoryBackendTest(BackendParityMixin, unittest.TestCase):
+    """Runs the parity tests against MemoryBackend with columnar steps"""
+
+    def make_backend(self):
+        return MemoryBackend(columnar=True)
+
+
+class SQLiteBackendTest(BackendParityMixin, unittest.TestCase):
+    """Runs the parity tests against SQLiteBackend"""
+
+    def make_backend(self):
+        return SQLiteBackend(os.path.join(self.directory, 'yummy.sqlite3'))
+
+    def test_data_is_shared(self):
+        """Two databases on the same file see each other's writes"""
+        other_backend = SQLiteBackend(self.backend.path)
+        other = Database(other_backend)
+        user = other.get_user_by_email('johndoe@example.com')
+        category = user.create_recipe_category(other, {'name': 'cakes'})
+        self.assertEqual(self.db.get_recipe_category(category.key).name, 'cakes')
+        # both allocate from the same sequence
+        keys = {self.db.get_next_key(RecipeStep), other.get_next_key(RecipeStep),
+                self.db.get_next_key(RecipeStep)}
+        self.assertEqual(len(keys), 3)
+        other_backend.close()
+
+    def test_unique_indexes_hold_across_processes(self):
+        """A user saved by another process after this one checked the email is refused"""
+        other_backend = SQLiteBackend(self.backend.path)
+        other = Database(other_backend)
+        # as if other had checked the email before self.user was committed
+        other.get_index(User, 'email').allows = lambda value, key: True
+        late = User(key=other.get_next_key(User), first_name='Jane', last_name='Doe',
+                    email='johndoe@example.com', password='password')
+        self.assertRaises(ValueError, late.save, other)
+        # nothing of late was stored
+        self.assertIsNone(other.get_user(late.key))
+        self.assertNotIn(late.key, other.user_keys)
+        self.assertListEqual([user.key for user in
+                              other.find(User, 'email', 'johndoe@example.com')],
+                             [self.user.key])
+        self.assertRaises(ValueError, other.create_user, {
+            'first_name': 'Jane', 'last_name': 'Doe',
+            'email': 'johndoe@example.com', 'password': 'password'})
+        # an object keeps its value when a change to it is refused
+        jane = other.create_user({'first_name': 'Jane', 'last_name': 'Doe',
+                                  'email': 'jane@example.com', 'password': 'password'})
+        jane.email = 'johndoe@example.com'
+        self.assertRaises(ValueError, jane.save, other)
+        self.assertEqual(self.db.get_user_by_email('jane@example.com').key, jane.key)
+        other_backend.close()
+
+    def test_new_indexes_are_filled(self):
+        """An index missing from an existing file is built from its table"""
+        self.user.create_recipe_category(self.db, {'name': 'cakes'})
+        self.backend.execute('DELETE FROM secondary_indexes')
+        other_backend = SQLiteBackend(self.backend.path)
+        other = Database(other_backend)
+        self.assertEqual(other.get_user_by_email('johndoe@example.com').key,
+                         self.user.key)
+        self.assertIsNotNone(other.get_recipe_category_by_name(self.user.key, 'cakes'))
+        other_backend.close()
+
+    def test_set_backend(self):
+        """The global database can be switched to SQLite while empty"""
+        db = Database()
+        db.set_backend(SQLiteBackend(os.path.join(self.directory, 'other.sqlite3')))
+        self.assertIsInstance(db.backend, SQLiteBackend)
+        self.assertRaises(ValueError, self.db.set_backend, MemoryBackend())
+        db.backend.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
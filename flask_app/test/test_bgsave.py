@@ -0,0 +1,105 @@
+"""Module with tests for background snapshots"""
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from app.models import Database
+from app.wal import WriteAheadLog
+from app import bgsave
+from app.bgsave import BackgroundSaver
+
+
+class LockCheckingSaver(BackgroundSaver):
+    """A BackgroundSaver whose child only checks the locks it may take are free"""
+
+    def _run_child(self):
+        free = all(lock.acquire(False) for lock in self._child_locks())
+        os._exit(0 if free else 1)
+
+
+class BackgroundSaverTest(unittest.TestCase):
+    """Tests for BackgroundSaver"""
+
+    def setUp(self):
+        """Creates a logged database and a temporary directory"""
+        self.directory = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.directory, 'yummy.snapshot')
+        self.log = WriteAheadLog(os.path.join(self.directory, 'yummy.wal'))
+        self.db = Database()
+        self.db.open_log(self.log)
+        self.user = self.db.create_user({
+            'first_name': 'John',
+            'last_name': 'Doe',
+            'email': 'johndoe@example.com',
+            'password': 'password',
+            })
+
+    def tearDown(self):
+        """Closes the log and removes the temporary directory"""
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def test_background_save(self):
+        """The child writes a snapshot while the parent keeps the log tail"""
+        saver = BackgroundSaver(self.db, self.snapshot_path, log=self.log)
+        self.assertEqual(saver.status()['state'], bgsave.IDLE)
+        saver.start()
+        # written by the parent after the fork so not in the snapshot
+        self.user.create_recipe_category(self.db, {'name': 'cakes'})
+        saver.wait()
+        status = saver.status()
+        self.assertEqual(status['state'], bgsave.SUCCEEDED)
+        self.assertEqual(status['saves'], 1)
+        self.assertIsNotNone(status['last_duration'])
+
+        loaded = Database()
+        loaded.load(self.snapshot_path)
+        self.assertEqual(len(loaded.recipe_categories), 0)
+        replay_log = WriteAheadLog(self.log.path)
+        loaded.open_log(replay_log)
+        replay_log.close()
+        self.assertEqual(len(loaded.users), 1)
+        self.assertEqual(len(loaded.recipe_categories), 1)
+
+    def test_failed_background_save(self):
+        """A child that cannot write the snapshot is reported as failed"""
+        saver = BackgroundSaver(self.db, os.path.join(
+            self.directory, 'missing', 'yummy.snapshot'))
+        saver.start()
+        saver.wait()
+        self.assertEqual(saver.status()['state'], bgsave.FAILED)
+        self.assertEqual(saver.status()['failures'], 1)
+
+    def test_locks_are_free_in_the_child(self):
+        """No lock the child takes is copied while another thread holds it"""
+        self.db.enable_search()
+        self.db.enable_fuzzy_search()
+        self.db.enable_tiering(os.path.join(self.directory, 'tiers.sqlite3'),
+                               1024 * 1024 * 1024)
+        held = threading.Event()
+
+        def sync():
+            # like the syncer thread, which holds the log lock to fsync
+            with self.log._lock:
+                held.set()
+                time.sleep(0.2)
+
+        syncer = threading.Thread(target=sync)
+        syncer.start()
+        held.wait()
+        try:
+            # without a log to trim, start() does not wait for the lock itself
+            saver = LockCheckingSaver(self.db, self.snapshot_path)
+            saver.start()
+            saver.wait()
+            self.assertEqual(saver.status()['state'], bgsave.SUCCEEDED)
+        finally:
+            syncer.join()
+            self.db.tiers.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""Module with tests for the bulk importer"""
+
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from app.models import Database, RecipeCategory, RecipeStep
+from app import bulk
+from app.bulk import BulkImporter
+
+
+class BulkImporterTest(unittest.TestCase):
+    """Tests for BulkImporter and the row readers"""
+
+    def setUp(self):
+        """Creates an empty database and some rows"""
+        self.db = Database()
+        self.user = {'email': 'jo@example.com', 'first_name': 'Jo',
+                     'last_name': 'Doe', 'password': 'secret'}
+        self.rows = []
+        for recipe in ('Banana cake', 'Carrot cake'):
+            for step in ('Mix', 'Bake', 'Eat'):
+                row = dict(self.user, category='cakes', recipe=recipe, step=step)
+                self.rows.append(row)
+        self.rows.append(dict(self.user, category='soups', recipe='', step=''))
+
+    def test_import_builds_the_tree(self):
+        """Rows become users, categories, recipes and ordered steps"""
+        report = BulkImporter(self.db, batch_size=4).run(self.rows)
+        self.assertEqual(report['rows'], 7)
+        self.assertEqual(report['users'], 1)
+        self.assertEqual(report['recipe_categories'], 2)
+        self.assertEqual(report['recipes'], 2)
+        self.assertEqual(report['recipe_steps'], 6)
+        user = self.db.get_user_by_email('jo@example.com')
+        categories = list(user.get_all_recipe_categories(self.db))
+        self.assertListEqual([category.name for category in categories],
+                             ['cakes', 'soups'])
+        recipes = list(categories[0].get_all_recipes(self.db))
+        self.assertListEqual([recipe.name for recipe in recipes],
+                             ['Banana cake', 'Carrot cake'])
+        self.assertListEqual([step.text_content for step in recipes[1].get_all_steps(self.db)],
+                             ['Mix', 'Bake', 'Eat'])
+
+    def test_existing_objects_are_reused(self):
+        """Importing into existing users, categories and recipes adds to them"""
+        user = self.db.create_user(dict(self.user))
+        cakes = user.create_recipe_category(self.db, {'name': 'cakes'})
+        banana = cakes.create_recipe(self.db, {'name': 'Banana cake',
+                                               'description': ''})
+        banana.create_step(self.db, {'text_content': 'Buy bananas'})
+        report = BulkImporter(self.db).run(self.rows)
+        self.assertEqual(report['users'], 0)
+        self.assertEqual(report['recipe_categories'], 1)
+        self.assertEqual(report['recipes'], 1)
+        self.assertListEqual([step.text_content for step in banana.get_all_steps(self.db)],
+                             ['Buy bananas', 'Mix', 'Bake', 'Eat'])
+        self.assertEqual(len(cakes.recipes), 2)
+
+    def test_invalid_rows_stop_the_import_at_their_batch(self):
+        """Batches before a bad row are kept and the error names the row"""
+        self.rows[5]['step'] = ' '
+        self.rows[5]['recipe'] = ''
+        self.rows[5]['email'] = 'not an email'
+        importer = BulkImporter(self.db, batch_size=3)
+        with self.assertRaises(ValueError) as context:
+            importer.run(self.rows)
+        self.assertIn('Row 6', str(context.exception))
+        self.assertEqual(importer.report()['rows'], 3)
+        self.assertEqual(len(self.db.recipe_steps), 3)
+
+    def test_new_users_need_their_details(self):
+        """A row introducing a user must carry the user's names and password"""
+        rows = [{'email': 'new@example.com', 'category': 'cakes'}]
+        self.assertRaises(ValueError, BulkImporter(self.db).run, rows)
+        self.assertTrue(self.db.is_empty())
+
+    def test_formats(self):
+        """CSV, NDJSON and JSON files give the same rows"""
+        csv_file = io.StringIO('email,category,recipe,step\n'
+                               'jo@example.com,cakes,Banana cake,Mix\n')
+        ndjson_file = io.StringIO(json.dumps(self.rows[0]) + '\n\n')
+        json_file = io.StringIO(json.dumps([self.rows[0]]))
+        expected = {'email': 'jo@example.com', 'category': 'cakes',
+                    'recipe': 'Banana cake', 'step': 'Mix'}
+        for source, file_format in ((csv_file, 'csv'), (ndjson_file, 'ndjson'),
+                                    (json_file, 'json')):
+            rows = list(bulk.read_rows(source, file_format))
+            self.assertEqual(len(rows), 1)
+            self.assertDictEqual({column: rows[0][column] for column in expected},
+                                 expected)
+        self.assertRaises(ValueError, list, bulk.read_rows([], 'xml'))
+        self.assertEqual(bulk.guess_format('catalog.jsonl'), 'ndjson')
+        self.assertRaises(ValueError, bulk.guess_format, 'catalog.txt')
+
+    def test_import_file(self):
+        """import_file reads the file at a path"""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'catalog.ndjson')
+            with open(path, 'w') as catalog:
+                for row in self.rows:
+                    catalog.write(json.dumps(row) + '\n')
+            report = bulk.import_file(self.db, path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(report['recipe_steps'], 6)
+        self.assertGreater(report['rows_per_second'], 0)
+
+
+class InsertManyTest(unittest.TestCase):
+    """Tests for Database.insert_many and block key allocation"""
+
+    def test_get_next_keys(self):
+        """Blocks of keys do not overlap with single keys"""
+        db = Database()
+        block = db.get_next_keys(RecipeStep, 3)
+        self.assertListEqual(list(block), [1, 2, 3])
+        self.assertEqual(db.get_next_key(RecipeStep), 4)
+        self.assertListEqual(list(db.get_next_keys(RecipeStep, 0)), [])
+
+    def test_missing_parents_are_refused(self):
+        """insert_many saves nothing when a parent is missing"""
+        db = Database()
+        orphan = RecipeCategory(key=1, name='cakes', user=1)
+        self.assertRaises(KeyError, db.insert_many, [orphan])
+        self.assertTrue(db.is_empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Module with tests for the columnar table of recipe steps"""
+
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from app.columnar import ColumnarTable
+from app.backends import MemoryBackend
+from app.models import Database, Recipe, RecipeStep
+
+
+class ColumnarTableTest(unittest.TestCase):
+    """Tests for ColumnarTable"""
+
+    def setUp(self):
+        """Creates an empty table of recipe steps"""
+        self.table = ColumnarTable(RecipeStep)
+
+    def test_set_get_and_delete(self):
+        """Objects are stored, replaced and deleted by key"""
+        self.table[3] = RecipeStep(key=3, text_content='Mix the flour', recipe=1)
+        self.table[4] = RecipeStep(key=4, text_content='Bake ♨ for an hour', recipe=1)
+        step = self.table[4]
+        self.assertIsInstance(step, RecipeStep)
+        self.assertEqual((step.key, step.text_content, step.recipe),
+                         (4, 'Bake ♨ for an hour', 1))
+        # every access builds a new object
+        self.assertIsNot(self.table[4], step)
+        self.table[3] = RecipeStep(key=3, text_content='Sift the flour', recipe=2)
+        self.assertEqual(self.table[3].text_content, 'Sift the flour')
+        self.assertEqual(self.table[3].recipe, 2)
+        del self.table[3]
+        self.assertNotIn(3, self.table)
+        self.assertRaises(KeyError, self.table.__getitem__, 3)
+        self.assertRaises(KeyError, self.table.__delitem__, 3)
+        self.assertIsNone(self.table.get(5))
+        self.assertListEqual(list(self.table), [4])
+        self.assertEqual(len(self.table), 1)
+        self.table[3] = RecipeStep(key=3, text_content='Grease the tin', recipe=1)
+        self.assertListEqual([(key, step.text_content) for key, step in self.table.items()],
+                             [(3, 'Grease the tin'), (4, 'Bake ♨ for an hour')])
+        self.table.clear()
+        self.assertEqual(len(self.table), 0)
+
+    def test_matches_a_dict(self):
+        """Random writes leave the table holding what a dict would"""
+        rng = random.Random(3)
+        expected = {}
+        for _ in range(2000):
+            key = rng.randint(1, 200)
+            if key in expected and rng.random() < 0.4:
+                del self.table[key]
+                del expected[key]
+            else:
+                text = 'step %d' % rng.randint(1, 10 ** rng.randint(1, 6))
+                recipe = rng.randint(1, 20)
+                self.table[key] = RecipeStep(key=key, text_content=text, recipe=recipe)
+                expected[key] = (text, recipe)
+        self.assertListEqual(list(self.table), sorted(expected))
+        self.assertDictEqual({key: (step.text_content, step.recipe)
+                              for key, step in self.table.items()}, expected)
+        self.assertEqual(len(self.table.values()), len(expected))
+
+    def test_dead_rows_are_compacted(self):
+        """Deleted rows and replaced text do not pile up"""
+        for key in range(1, 101):
+            self.table[key] = RecipeStep(key=key, text_content='step %d' % key, recipe=1)
+        for key in range(1, 81):
+            del self.table[key]
+        self.assertLessEqual(len(self.table._keys), 2 * len(self.table))
+        for _ in range(50):
+            self.table[100] = RecipeStep(key=100, text_content='x' * 40, recipe=1)
+        self.assertLessEqual(len(self.table._text), 2 * 20 * 40)
+        self.assertEqual(self.table[100].text_content, 'x' * 40)
+        self.assertListEqual(list(self.table), list(range(81, 101)))
+
+    def test_models_with_children_are_refused(self):
+        """Only models without children fit in columns"""
+        self.assertRaises(ValueError, ColumnarTable, Recipe)
+        self.assertIsInstance(MemoryBackend(columnar=True).table('recipes', Recipe), dict)
+        self.assertRaises(TypeError, MemoryBackend, 'yes')
+
+
+class ColumnarDatabaseTest(unittest.TestCase):
+    """Tests for a Database keeping its steps in columns"""
+
+    def setUp(self):
+        """Creates a database with columnar steps and a recipe"""
+        self.directory = tempfile.mkdtemp()
+        self.db = Database(MemoryBackend(columnar=True))
+        user = self.db.create_user({'first_name': 'John', 'last_name': 'Doe',
+                                    'email': 'johndoe@example.com',
+                                    'password': 'password'})
+        category = user.create_recipe_category(self.db, {'name': 'Cakes'})
+        self.recipe = category.create_recipe(self.db, {'name': 'Sponge',
+                                                       'description': ''})
+        for text in ('Whisk the eggs', 'Fold in the flour', 'Bake'):
+            self.recipe.create_step(self.db, {'text_content': text})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_steps_are_columnar(self):
+        """The steps table is a ColumnarTable and the rest are dicts"""
+        self.assertIsInstance(self.db.recipe_steps, ColumnarTable)
+        self.assertIsInstance(self.db.recipes, dict)
+        self.assertListEqual([step.text_content for step in self.db.recipe_steps.values()],
+                             ['Whisk the eggs', 'Fold in the flour', 'Bake'])
+
+    def test_loaded_steps_are_columnar(self):
+        """Steps loaded from a snapshot are moved into columns"""
+        path = os.path.join(self.directory, 'yummy.snapshot')
+        self.db.snapshot(path)
+        other = Database(MemoryBackend(columnar=True))
+        other.load(path)
+        self.assertIsInstance(other.recipe_steps, ColumnarTable)
+        self.assertListEqual([step.text_content for step in other.recipe_steps.values()],
+                             ['Whisk the eggs', 'Fold in the flour', 'Bake'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""Module with tests for deferred deletes and the compactor"""
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from app.backends import SQLiteBackend
+from app.compaction import Compactor
+from app.models import Database, Recipe, RecipeCategory
+from app.wal import WriteAheadLog
+
+
+class DeferredDeleteTest(unittest.TestCase):
+    """Tests for Database.delete_later and Database.compact"""
+
+    def setUp(self):
+        """Creates a user with a category of recipes with steps"""
+        self.directory = tempfile.mkdtemp()
+        self.log = WriteAheadLog(os.path.join(self.directory, 'yummy.wal'))
+        self.db = Database()
+        self.db.open_log(self.log)
+        self.db.enable_versions()
+        self.db.enable_search()
+        self.db.enable_fuzzy_search()
+        self.user = self.db.create_user({
+            'first_name': 'John', 'last_name': 'Doe',
+            'email': 'johndoe@example.com', 'password': 'password'})
+        self.cakes = self.user.create_recipe_category(self.db, {'name': 'Cakes'})
+        self.pies = self.user.create_recipe_category(self.db, {'name': 'Pies'})
+        self.recipes = []
+        for number in range(300):
+            recipe = self.cakes.create_recipe(
+                self.db, {'name': 'Sponge %d' % number, 'description': 'light'})
+            recipe.create_step(self.db, {'text_content': 'Whisk the eggs'})
+            self.recipes.append(recipe)
+        self.apple_pie = self.pies.create_recipe(
+            self.db, {'name': 'Apple pie', 'description': 'light'})
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def test_hidden_at_once(self):
+        """The category and everything under it disappear before compaction"""
+        recipe = self.recipes[0]
+        step_key = list(recipe.recipe_steps)[0]
+        self.db.delete_later(self.cakes)
+        self.assertTrue(self.db.tombstones)
+        self.assertIsNone(self.db.get_recipe_category(self.cakes.key))
+        self.assertIsNone(self.db.get_recipe(recipe.key))
+        self.assertIsNone(self.db.get_recipe_step(step_key))
+        self.assertIsNone(self.db.get_recipe_category_by_name(self.user.key, 'Cakes'))
+        self.assertIsNone(self.db.find_one(Recipe, 'name', (self.cakes.key, 'Sponge 0')))
+        self.assertListEqual(self.db.find(Recipe, 'name', (self.cakes.key, 'Sponge 0')), [])
+        self.assertListEqual([category.name for category in
+                              self.user.get_all_recipe_categories(self.db)], ['Pies'])
+        self.assertListEqual([found.name for found, _ in self.db.search('light')],
+                             ['Apple pie'])
+        self.assertListEqual(self.db.fuzzy_find(self.user.key, 'sponge 1'), [])
+        view = self.db.read_view()
+        self.assertIsNone(view.get_recipe_category(self.cakes.key))
+        self.assertIsNone(view.get_recipe(recipe.key))
+        self.assertIsNone(view.get_recipe_step(step_key))
+        self.assertEqual(view.get_recipe(self.apple_pie.key).name, 'Apple pie')
+        # nothing under it has been reclaimed yet
+        self.assertEqual(len(self.db.recipes), 301)
+        self.assertRaises(KeyError, self.db.delete_later, self.cakes)
+
+    def test_compaction_is_incremental(self):
+        """Slices reclaim a little at a time until nothing is left"""
+        self.db.delete_later(self.cakes)
+        slices = 0
+        while self.db.tombstones:
+            self.db.compact(0.0001)
+            slices += 1
+        self.assertGreater(slices, 1)
+        self.assertListEqual(list(self.db.recipes), [self.apple_pie.key])
+        self.assertEqual(len(self.db.recipe_steps), 0)
+        self.assertEqual(len(self.db.recipe_keys), 1)
+        self.assertEqual(len(self.db.get_index(Recipe, 'prefix')), 1)
+        self.assertEqual(len(self.db.get_index(RecipeCategory, 'name')), 1)
+        self.assertEqual(len(self.db.search_index), 1)
+        self.assertEqual(len(self.db.fuzzy_index), 2)
+        view = self.db.read_view()
+        self.assertEqual(len(view.recipes), 1)
+        self.assertEqual(len(view.recipe_steps), 0)
+        self.assertFalse(view.orphans)
+        self.assertEqual(self.db.compact(), 0)
+
+    def test_deleting_a_user_and_a_step(self):
+        """Users are compacted with the rest and childless objects go at once"""
+        step_key = self.apple_pie.create_step(self.db, {'text_content': 'Peel'}).key
+        self.db.delete_later(self.db.get_recipe_step(step_key))
+        self.assertFalse(self.db.tombstones)
+        self.assertNotIn(step_key, self.db.recipe_steps)
+        self.db.delete_later(self.user)
+        self.assertIsNone(self.db.get_user_by_email('johndoe@example.com'))
+        # the user went with delete_later, the 2 categories, 301 recipes
+        # and 300 steps under it go now
+        self.assertEqual(self.db.compact(), 603)
+        self.assertTrue(self.db.is_empty())
+
+    def test_snapshots_and_logs(self):
+        """Snapshots wait for compaction and the log replays the whole delete"""
+        path = os.path.join(self.directory, 'yummy.snapshot')
+        self.db.delete_later(self.cakes)
+        self.assertRaises(ValueError, self.db.snapshot, path)
+        replayed = Database()
+        replayed.open_log(WriteAheadLog(self.log.path))
+        self.assertListEqual(list(replayed.recipes), [self.apple_pie.key])
+        self.assertEqual(len(replayed.recipe_steps), 0)
+        self.db.compact()
+        self.db.snapshot(path)
+
+    def test_shared_backends_cannot_defer(self):
+        """Other processes would not know about the tombstones"""
+        backend = SQLiteBackend(os.path.join(self.directory, 'yummy.sqlite3'))
+        database = Database(backend)
+        user = database.create_user({'first_name': 'Jane', 'last_name': 'Doe',
+                                     'email': 'janedoe@example.com',
+                                     'password': 'password'})
+        self.assertRaises(ValueError, database.delete_later, user)
+        backend.close()
+
+
+class CompactorTest(unittest.TestCase):
+    """Tests for the Compactor thread"""
+
+    def test_reclaims_in_the_background(self):
+        """The thread compacts until no tombstones are left"""
+        database = Database()
+        user = database.create_user({'first_name': 'John', 'last_name': 'Doe',
+                                     'email': 'johndoe@example.com',
+                                     'password': 'password'})
+        category = user.create_recipe_category(database, {'name': 'Cakes'})
+        for number in range(200):
+            category.create_recipe(database, {'name': 'Sponge %d' % number,
+                                              'description': ''})
+        compactor = Compactor(database, slice_seconds=0.001, pause_seconds=0.001,
+                              idle_seconds=0.01)
+        compactor.start()
+        self.assertRaises(ValueError, compactor.start)
+        database.delete_later(category)
+        deadline = time.time() + 10
+        while database.tombstones and time.time() < deadline:
+            time.sleep(0.01)
+        compactor.stop()
+        status = compactor.status()
+        self.assertEqual(status['tombstones'], 0)
+        self.assertEqual(status['objects_reclaimed'], 200)
+        self.assertGreaterEqual(status['slices'], 1)
+        self.assertFalse(status['running'])
+        self.assertEqual(len(database.recipes), 0)
+        self.assertRaises(ValueError, Compactor, database, slice_seconds=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,16 +17,16 @@ class ControllerTest(unittest.TestCase):
         # form return ImmutableMultiDict objects
         raw_form_data = {'name': 'John Doe', 'password': 'password', 'email': ''}
         form_data = ImmutableMultiDict(raw_form_data)
-        self.assertNotEqual(dict(form_data), raw_form_data)
-        self.assertEqual(controller.process_form_data(dict(form_data)),
+        self.assertNotEqual(form_data.to_dict(flat=False), raw_form_data)
+        self.assertEqual(controller.process_form_data(form_data.to_dict(flat=False)),
                          raw_form_data)
         # if email is a mandatory field and thus not an empty string
         self.assertRaises(ValueError, controller.process_form_data,
-                          dict(form_data), 'email')
+                          form_data.to_dict(flat=False), 'email')
         # if many fields/keys are mandatory
         required_keys = ('first_name', 'last_name', 'password')
         self.assertRaises(ValueError, controller.process_form_data,
-                          dict(form_data), *required_keys)
+                          form_data.to_dict(flat=False), *required_keys)
 
     def test_process_args_data(self):
         """
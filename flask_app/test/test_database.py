@@ -46,15 +46,25 @@ class DatabaseTest(unittest.TestCase):
         self.assertEqual(self.db.get_next_key(Recipe), 1)
         self.assertEqual(self.db.get_next_key(RecipeCategory), 1)
         self.assertEqual(self.db.get_next_key(RecipeStep), 1)
-        self.db._user_keys += [1,2,3]
-        self.assertEqual(self.db.get_next_key(User), 4)
-        self.db._recipe_keys += [1,2,3,7]
-        self.assertEqual(self.db.get_next_key(Recipe), 8)
-        self.db._recipe_category_keys += [1,2,3, 4]
-        self.assertEqual(self.db.get_next_key(RecipeCategory), 5)
-        self.db._recipe_step_keys += [1,2,3,9]
-        self.assertEqual(self.db.get_next_key(RecipeStep), 10)
+        # keys are allocated, so asking again gives a new key
+        self.assertEqual(self.db.get_next_key(User), 2)
+        # saving objects with explicit keys moves the sequence forward
+        self.user.save(self.db)
+        User(**utilities.replace_value_in_dict(
+            dict(self.user_data), 'email', 'jane@example.com'), key=7).save(self.db)
+        self.assertEqual(self.db.get_next_key(User), 8)
         self.assertRaises(TypeError, self.db.get_next_key, 2)
+        self.assertRaises(KeyError, self.db.get_next_key, int)
+
+    def test_get_next_key_does_not_reuse_keys(self):
+        """Keys of deleted objects are not handed out again"""
+        self.user.save(self.db)
+        category = RecipeCategory(**self.category_data)
+        category.save(self.db)
+        recipe = Recipe(**self.recipe_data)
+        recipe.save(self.db)
+        self.db.delete_object(recipe)
+        self.assertEqual(self.db.get_next_key(Recipe), 2)
 
     def test_create_user(self):
         """A user can be created in 'Database'"""
@@ -62,8 +72,7 @@ class DatabaseTest(unittest.TestCase):
         self.assertIsInstance(user, User)
         self.assertIn(user.key, self.db.user_keys)
         self.assertEqual(user, self.db.users[user.key])
-        self.assertIn(user.email, self.db.user_email_key_map.keys())
-        self.assertEqual(user.key, self.db.user_email_key_map[user.email])
+        self.assertEqual(user.key, self.db.get_index(User, 'email').first(user.email))
 
     def test_get_user(self):
         """A user can be got by user_key"""
@@ -122,10 +131,10 @@ class DatabaseTest(unittest.TestCase):
         self.assertNotIn(category.key, self.db.recipe_category_keys)
         # assert that the recipe key is not in self.db.recipe_keys
         self.assertNotIn(recipe.key, self.db.recipe_keys)
-        # assert that the category name is not in self.db.recipe_categories_name_key_map
-        self.assertNotIn(category.name, self.db.recipe_category_name_key_map.keys())
-        # assert that the recipe name is not in self.db.recipe_name_key_map
-        self.assertNotIn(recipe.name, self.db.recipe_name_key_map.keys())
+        # assert that the category name is no longer indexed
+        self.assertIsNone(self.db.get_index(RecipeCategory, 'name').first((category.user, category.name)))
+        # assert that the recipe name is no longer indexed
+        self.assertIsNone(self.db.get_index(Recipe, 'name').first((recipe.category, recipe.name)))
         # try to delete a non existent object by deleting category again
         self.assertRaises(KeyError, self.db.delete_object, category)
         # try to delete an object of a type that does not exist in database
@@ -152,8 +161,8 @@ class DatabaseTest(unittest.TestCase):
         self.assertNotIn(recipe_step.key, self.db.recipe_step_keys)
         # assert that the recipe key is not in self.db.recipe_keys
         self.assertNotIn(recipe.key, self.db.recipe_keys)
-        # assert that the recipe name is not in self.db.recipe_name_key_map
-        self.assertNotIn(recipe.name, self.db.recipe_name_key_map.keys())
+        # assert that the recipe name is no longer indexed
+        self.assertIsNone(self.db.get_index(Recipe, 'name').first((recipe.category, recipe.name)))
         # try to delete a non existent object by deleting category again
         self.assertRaises(KeyError, self.db.delete_object, recipe)
 
@@ -191,8 +200,104 @@ class DatabaseTest(unittest.TestCase):
         # try using a non-int key
         self.assertRaises(TypeError, self.db.get_recipe_step, 'string instead of int')
 
+    def test_delete_object_reports_what_it_removed(self):
+        """Deleting a user cascades through every level in one batch"""
+        self.user.save(self.db)
+        for position in range(3):
+            category = self.user.create_recipe_category(self.db,
+                                                        {'name': 'cakes %d' % position})
+            for number in range(40):
+                recipe = category.create_recipe(self.db, {'name': 'cake %d' % number,
+                                                          'description': ''})
+                for text in ('Mix', 'Bake'):
+                    recipe.create_step(self.db, {'text_content': text})
+        other = self.user.create_recipe_category(self.db, {'name': 'pies'})
+        other_recipe = other.create_recipe(self.db, {'name': 'apple pie', 'description': ''})
+        report = other_recipe.delete(self.db)
+        self.assertEqual((report['recipes'], report['recipe_steps'], report['objects']),
+                         (1, 0, 1))
+        self.assertListEqual(list(other.recipes), [])
+        report = self.db.delete_object(self.user)
+        self.assertEqual(report['users'], 1)
+        self.assertEqual(report['recipe_categories'], 4)
+        self.assertEqual(report['recipes'], 120)
+        self.assertEqual(report['recipe_steps'], 240)
+        self.assertEqual(report['objects'], 365)
+        self.assertGreaterEqual(report['seconds'], 0)
+        self.assertTrue(self.db.is_empty())
+        for model in (User, RecipeCategory, Recipe, RecipeStep):
+            for index in self.db.indexes[model].values():
+                self.assertEqual(len(index), 0)
+        self.assertEqual(len(self.db.recipe_step_keys), 0)
+        self.assertRaises(KeyError, self.db.delete_object, self.user)
+
+    def test_models_have_no_instance_dict(self):
+        """Model objects keep their fields in slots to save memory"""
+        self.user.save(self.db)
+        category = RecipeCategory(**self.category_data)
+        recipe = Recipe(**self.recipe_data)
+        step = RecipeStep(**self.recipe_step_data)
+        for obj in (self.user, category, recipe, step):
+            self.assertFalse(hasattr(obj, '__dict__'))
+        self.assertRaises(AttributeError, setattr, step, 'colour', 'red')
+
+    def test_names_are_looked_up_per_owner(self):
+        """Two users can each have a category of the same name"""
+        self.user.save(self.db)
+        other_user = User(key=2, first_name='Jane', last_name='Doe',
+                          email='janedoe@example.com', password='password')
+        other_user.save(self.db)
+        category = RecipeCategory(**self.category_data)
+        category.save(self.db)
+        other_category = RecipeCategory(key=2, name='cakes', description='',
+                                        user=other_user.key)
+        other_category.save(self.db)
+        self.assertEqual(self.db.get_recipe_category_by_name(self.user.key, 'cakes'),
+                         category)
+        self.assertEqual(self.db.get_recipe_category_by_name(other_user.key, 'cakes'),
+                         other_category)
+        recipe = Recipe(**self.recipe_data)
+        recipe.save(self.db)
+        other_recipe = Recipe(key=2, name='breadcake', description='',
+                              category=other_category.key)
+        other_recipe.save(self.db)
+        self.assertEqual(self.db.get_recipe_by_name(category.key, 'breadcake'),
+                         recipe)
+        self.assertEqual(self.db.get_recipe_by_name(other_category.key, 'breadcake'),
+                         other_recipe)
+        # deleting one leaves the other's name in place
+        other_category.delete(self.db)
+        self.assertEqual(self.db.get_recipe_category_by_name(self.user.key, 'cakes'),
+                         category)
+        self.assertIsNone(self.db.get_recipe_category_by_name(other_user.key, 'cakes'))
+        self.assertIsNone(self.db.get_recipe_by_name(other_category.key, 'breadcake'))
+        self.assertRaises(TypeError, self.db.get_recipe_by_name, 'cakes', 'breadcake')
+
+    def test_rename_moves_name_entry(self):
+        """A renamed category or recipe is only found by its new name"""
+        self.user.save(self.db)
+        category = RecipeCategory(**self.category_data)
+        category.save(self.db)
+        recipe = Recipe(**self.recipe_data)
+        recipe.save(self.db)
+        category.set_name('pies', self.db)
+        recipe.set_name('applepie', self.db)
+        self.assertIsNone(self.db.get_recipe_category_by_name(self.user.key, 'cakes'))
+        self.assertEqual(self.db.get_recipe_category_by_name(self.user.key, 'pies'),
+                         category)
+        self.assertIsNone(self.db.get_recipe_by_name(category.key, 'breadcake'))
+        self.assertEqual(self.db.get_recipe_by_name(category.key, 'applepie'), recipe)
+        # objects sharing a name are found in key order
+        duplicate = Recipe(key=2, name='applepie', description='',
+                           category=category.key)
+        duplicate.save(self.db)
+        self.assertListEqual(self.db.find(Recipe, 'name', (category.key, 'applepie')),
+                             [recipe, duplicate])
+        self.assertEqual(self.db.get_recipe_by_name(category.key, 'applepie'), recipe)
+        recipe.delete(self.db)
+        self.assertEqual(self.db.get_recipe_by_name(category.key, 'applepie'),
+                         duplicate)
 
-        
 
 
 
@@ -0,0 +1,63 @@
+"""Module with tests for the NDJSON export"""
+
+
+import json
+import unittest
+from app.models import Database
+from app import export
+
+
+class ExportTest(unittest.TestCase):
+    """Tests for export_user and chunks"""
+
+    def setUp(self):
+        """Creates a user with a small tree"""
+        self.db = Database()
+        self.user = self.db.create_user({
+            'first_name': 'John', 'last_name': 'Doe',
+            'email': 'johndoe@example.com', 'password': 'password'})
+        cakes = self.user.create_recipe_category(self.db, {'name': 'cakes'})
+        self.user.create_recipe_category(self.db, {'name': 'soups'})
+        recipe = cakes.create_recipe(self.db, {'name': 'Banana cake',
+                                               'description': 'yummy'})
+        recipe.create_step(self.db, {'text_content': 'Bake'})
+        recipe.create_step(self.db, {'text_content': 'Mix'}, position=0)
+
+    def export(self):
+        """Returns the exported records of the user"""
+        view = self.db.read_view()
+        lines = export.export_user(view, view.get_user(self.user.key))
+        return [json.loads(line) for line in lines]
+
+    def test_tree_is_exported_depth_first(self):
+        """Parents come before their children and steps keep their order"""
+        records = self.export()
+        self.assertListEqual([record['type'] for record in records],
+                             ['User', 'RecipeCategory', 'Recipe', 'RecipeStep',
+                              'RecipeStep', 'RecipeCategory'])
+        self.assertListEqual([record.get('text_content') for record in records[3:5]],
+                             ['Mix', 'Bake'])
+        self.assertEqual(records[2]['category'], records[1]['key'])
+
+    def test_passwords_are_not_exported(self):
+        """The user record has no password"""
+        self.assertNotIn('password', self.export()[0])
+        self.assertEqual(self.export()[0]['email'], 'johndoe@example.com')
+
+    def test_versions_give_the_same_export(self):
+        """Exporting from a version matches exporting from the live data"""
+        live = self.export()
+        self.db.enable_versions()
+        self.assertListEqual(self.export(), live)
+
+    def test_chunks(self):
+        """Lines are joined into chunks of about the given size"""
+        lines = ['%d\n' % number for number in range(100)]
+        chunks = list(export.chunks(lines, size=50))
+        self.assertEqual(''.join(chunks), ''.join(lines))
+        self.assertTrue(all(len(chunk) >= 50 for chunk in chunks[:-1]))
+        self.assertListEqual(list(export.chunks([])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""Module with tests for the typo-tolerant name search"""
+
+
+import random
+import unittest
+from app.models import Database, Recipe, RecipeCategory
+from app.fuzzy import trigrams, edit_distance
+
+
+class FuzzyIndexTest(unittest.TestCase):
+    """Tests for Database.fuzzy_find and the FuzzyIndex behind it"""
+
+    def setUp(self):
+        """Creates a user with a few names and enables fuzzy search"""
+        self.db = Database()
+        self.user = self.db.create_user({
+            'first_name': 'John', 'last_name': 'Doe',
+            'email': 'johndoe@example.com', 'password': 'password'})
+        self.cakes = self.user.create_recipe_category(self.db, {'name': 'Cakes'})
+        self.chocolate = self.cakes.create_recipe(
+            self.db, {'name': 'Chocolate cake', 'description': ''})
+        self.cakes.create_recipe(self.db, {'name': 'Carrot cake', 'description': ''})
+        self.db.enable_fuzzy_search()
+
+    def names(self, query, user_key=None):
+        """Returns the names found for query"""
+        if user_key is None:
+            user_key = self.user.key
+        return [obj.name for obj in self.db.fuzzy_find(user_key, query)]
+
+    def test_trigrams_and_edit_distance(self):
+        """Words are padded and a prefix of the name can be matched"""
+        self.assertSetEqual(trigrams('Pie'), {'  p', ' pi', 'pie', 'ie '})
+        self.assertEqual(edit_distance('choclate', 'chocolate'), (1, 1))
+        self.assertEqual(edit_distance('choc', 'chocolate'), (5, 0))
+
+    def test_misspellings_are_found(self):
+        """Names a few edits away are found, closest first"""
+        self.assertListEqual(self.names('choclate cake'), ['Chocolate cake'])
+        self.assertListEqual(self.names('CAROT'), ['Carrot cake'])
+        self.assertListEqual(self.names('cakse'), ['Cakes'])
+        self.assertListEqual(self.names('pie'), [])
+        self.assertListEqual(self.names(''), [])
+        self.assertIsInstance(self.db.fuzzy_find(self.user.key, 'cakes')[0],
+                              RecipeCategory)
+
+    def test_names_are_kept_per_user(self):
+        """A user only finds their own names"""
+        other = self.db.create_user({'first_name': 'Jane', 'last_name': 'Doe',
+                                     'email': 'janedoe@example.com',
+                                     'password': 'password'})
+        other.create_recipe_category(self.db, {'name': 'Chocolates'})
+        self.assertListEqual(self.names('choclates', other.key), ['Chocolates'])
+        self.assertListEqual(self.names('choclate cake', other.key), [])
+        # deleting a user drops only that user's names
+        self.db.delete_object(other)
+        self.assertListEqual(self.names('choclates', other.key), [])
+        self.assertListEqual(self.names('choclate cake'), ['Chocolate cake'])
+        self.assertEqual(len(self.db.fuzzy_index), 3)
+
+    def test_updates_are_incremental(self):
+        """Saving, renaming and deleting re-index the names"""
+        self.chocolate.set_name('Chocolate fudge', self.db)
+        self.assertListEqual(self.names('choclate fudge'), ['Chocolate fudge'])
+        self.chocolate.delete(self.db)
+        self.assertListEqual(self.names('choclate'), [])
+        with self.db.transaction() as transaction:
+            transaction.create(Recipe, name='Lemon drizzle', description='',
+                               category=self.cakes.key)
+        self.assertListEqual(self.names('lemmon drizzle'), ['Lemon drizzle'])
+        self.cakes.delete(self.db)
+        self.assertListEqual(self.names('carrot'), [])
+        self.assertEqual(len(self.db.fuzzy_index), 0)
+
+    def test_fuzzy_search_must_be_enabled(self):
+        """fuzzy_find raises until it is enabled"""
+        self.assertRaises(ValueError, Database().fuzzy_find, 1, 'cake')
+        self.assertRaises(TypeError, self.db.fuzzy_find, self.user.key, 42)
+
+    def test_single_typos_are_always_found(self):
+        """A name with one letter changed is found among many others"""
+        rng = random.Random(5)
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        names = set()
+        while len(names) < 300:
+            names.add(' '.join(''.join(rng.choice(letters) for _ in range(rng.randint(4, 9)))
+                               for _ in range(rng.randint(1, 3))))
+        for name in names:
+            self.cakes.create_recipe(self.db, {'name': name, 'description': ''})
+        for name in rng.sample(sorted(names), 50):
+            position = rng.randrange(len(name))
+            if name[position] == ' ':
+                continue
+            typo = name[:position] + rng.choice(letters.replace(name[position], '')) \
+                + name[position + 1:]
+            self.assertIn(name, self.names(typo))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,355 @@
+"""Module with tests for the index structures"""
+
+
+import random
+import unittest
+from app import indexes
+from app.indexes import OrderedIndex, ChildIndex, IndexView, Indexed, \
+HashIndex, SortedIndex, SortedKeyIndex, SORTED, binary_search
+
+
+class OrderedIndexTest(unittest.TestCase):
+    """Tests for OrderedIndex"""
+
+    def setUp(self):
+        """Initiates an index to be used in most tests"""
+        self.index = OrderedIndex([3, 1, 2])
+
+    def test_iteration_follows_insertion_order(self):
+        """Keys come out in the order they went in"""
+        self.index.add(0)
+        self.assertListEqual(list(self.index), [3, 1, 2, 0])
+        self.assertListEqual(list(reversed(self.index)), [0, 2, 1, 3])
+
+    def test_add_is_idempotent(self):
+        """Adding an existing key does not change the size or order"""
+        self.index.add(3)
+        self.assertEqual(len(self.index), 3)
+        self.assertListEqual(list(self.index), [3, 1, 2])
+
+    def test_remove(self):
+        """Keys can be removed and missing keys raise KeyError"""
+        self.index.remove(1)
+        self.assertNotIn(1, self.index)
+        self.assertRaises(KeyError, self.index.remove, 1)
+        self.index.discard(1)
+        self.assertListEqual(list(self.index), [3, 2])
+
+
+class ChildIndexTest(unittest.TestCase):
+    """Tests for ChildIndex"""
+
+    def setUp(self):
+        """Initiates an index to be used in most tests"""
+        self.index = ChildIndex([10, 20, 30])
+
+    def test_add_appends_in_order(self):
+        """Keys are kept in the order they were added"""
+        self.index.add(5)
+        self.index.add(10)
+        self.assertListEqual(list(self.index), [10, 20, 30, 5])
+        self.assertEqual(len(self.index), 4)
+        self.assertIn(5, self.index)
+
+    def test_extend(self):
+        """extend appends new keys in order and skips known ones"""
+        self.index.extend([40, 20, 50, 40])
+        self.assertListEqual(list(self.index), [10, 20, 30, 40, 50])
+        self.assertEqual(self.index.index(50), 4)
+        self.assertEqual(self.index[3], 40)
+        self.index.extend([])
+        self.assertEqual(len(self.index), 5)
+
+    def test_insert_and_position(self):
+        """Keys can be inserted at a position and looked up by position"""
+        self.index.insert(1, 15)
+        self.index.insert(0, 1)
+        self.index.insert(100, 99)
+        self.assertListEqual(list(self.index), [1, 10, 15, 20, 30, 99])
+        self.assertEqual(self.index.index(15), 2)
+        self.assertEqual(self.index[2], 15)
+        self.assertEqual(self.index[-1], 99)
+        self.assertRaises(IndexError, self.index.__getitem__, 6)
+        self.assertRaises(ValueError, self.index.insert, 0, 15)
+
+    def test_move_and_remove(self):
+        """Keys can be moved and removed"""
+        self.index.move(30, 0)
+        self.assertListEqual(list(self.index), [30, 10, 20])
+        self.index.remove(10)
+        self.assertListEqual(list(self.index), [30, 20])
+        self.assertRaises(KeyError, self.index.remove, 10)
+        self.assertRaises(KeyError, self.index.index, 10)
+        self.index.discard(10)
+        self.index.clear()
+        self.assertEqual(len(self.index), 0)
+
+    def test_matches_list_behaviour(self):
+        """Random inserts, moves and removes agree with a plain list"""
+        expected = []
+        index = ChildIndex()
+        rng = random.Random(7)
+        for key in range(500):
+            position = rng.randint(0, len(expected))
+            expected.insert(position, key)
+            index.insert(position, key)
+            if key % 3 == 0:
+                moved = rng.choice(expected)
+                position = rng.randint(0, len(expected) - 1)
+                expected.remove(moved)
+                expected.insert(position, moved)
+                index.move(moved, position)
+            if key % 5 == 0:
+                removed = rng.choice(expected)
+                expected.remove(removed)
+                index.remove(removed)
+        self.assertListEqual(list(index), expected)
+        for position, key in enumerate(expected):
+            self.assertEqual(index.index(key), position)
+            self.assertEqual(index[position], key)
+
+    def test_snapshots_do_not_change(self):
+        """A snapshot keeps the keys the index had when it was taken"""
+        first = self.index.snapshot()
+        self.index.insert(1, 15)
+        self.index.remove(30)
+        second = self.index.snapshot()
+        self.index.clear()
+        self.assertTupleEqual(tuple(first), (10, 20, 30))
+        self.assertEqual(first[-1], 30)
+        self.assertEqual(second, [10, 15, 20])
+        self.assertEqual(len(self.index.snapshot()), 0)
+
+    def test_inserts_at_the_same_spot(self):
+        """Keys are labelled again once none fit between two neighbours"""
+        expected = [1, 2]
+        index = ChildIndex(expected)
+        for key in range(3, 200):
+            expected.insert(1, key)
+            index.insert(1, key)
+        self.assertListEqual(list(index), expected)
+        self.assertEqual(index.index(2), len(expected) - 1)
+
+
+class IndexViewTest(unittest.TestCase):
+    """Tests for IndexView"""
+
+    def test_view_is_live(self):
+        """The view reflects the index and table without copying"""
+        index = ChildIndex([1, 2])
+        table = {1: 'one', 2: 'two', 3: 'three'}
+        view = IndexView(index, table)
+        self.assertListEqual(list(view), ['one', 'two'])
+        index.insert(0, 3)
+        self.assertListEqual(list(view), ['three', 'one', 'two'])
+        self.assertEqual(view[0], 'three')
+        self.assertEqual(len(view), 3)
+        # keys missing from the table are skipped
+        del table[1]
+        self.assertListEqual(list(view), ['three', 'two'])
+        self.assertFalse(IndexView(ChildIndex(), table))
+
+
+class SortedKeyIndexTest(unittest.TestCase):
+    """Tests for SortedKeyIndex and binary_search"""
+
+    def setUp(self):
+        """Initiates an index to be used in most tests"""
+        self.index = SortedKeyIndex(['pies', 'bread', 'cakes', 'apples'])
+
+    def test_binary_search(self):
+        """Items are found at their first position every time"""
+        items = ['a', 'b', 'b', 'b', 'c']
+        for _ in range(10):
+            self.assertEqual(binary_search('b', items), 1)
+        self.assertEqual(binary_search('c', items), 4)
+        self.assertIsNone(binary_search('d', items))
+        self.assertIsNone(binary_search('a', []))
+
+    def test_iteration_follows_key_order(self):
+        """Keys come back sorted however they were added"""
+        self.index.add('cookies')
+        self.assertListEqual(list(self.index),
+                             ['apples', 'bread', 'cakes', 'cookies', 'pies'])
+        self.assertEqual(self.index.position('cakes'), 2)
+        self.assertIsNone(self.index.position('scones'))
+        self.assertIn('pies', self.index)
+
+    def test_remove(self):
+        """Removed keys are no longer found"""
+        self.index.remove('bread')
+        self.index.discard('bread')
+        self.assertNotIn('bread', self.index)
+        self.assertRaises(KeyError, self.index.remove, 'bread')
+        self.assertEqual(len(self.index), 3)
+
+    def test_remove_all(self):
+        """Keys removed together are gone in one pass"""
+        self.index.remove_all(['bread', 'pies', 'scones'])
+        self.assertListEqual(list(self.index), ['apples', 'cakes'])
+        self.index.remove_all([])
+        self.assertEqual(len(self.index), 2)
+
+    def test_range(self):
+        """Ranges include low, exclude high and follow key order"""
+        self.assertListEqual(list(self.index.range('a', 'c')), ['apples', 'bread'])
+        self.assertListEqual(list(self.index.range('c')), ['cakes', 'pies'])
+        self.assertListEqual(list(self.index.range(high='b')), ['apples'])
+        self.assertListEqual(list(self.index.range(limit=2)), ['apples', 'bread'])
+        self.assertListEqual(list(self.index.range('z', 'a')), [])
+
+    def test_matches_sorted_list(self):
+        """Random adds and removes keep the index sorted"""
+        rng = random.Random(3)
+        index = SortedKeyIndex()
+        expected = []
+        for _ in range(500):
+            key = rng.randint(0, 100)
+            if key in expected and rng.random() < 0.4:
+                index.remove(key)
+                expected.remove(key)
+            else:
+                index.add(key)
+                expected.append(key)
+            self.assertListEqual(list(index), sorted(expected))
+
+    def test_many_blocks(self):
+        """Blocks split and merge while every operation sees one sorted list"""
+        block_size = indexes.BLOCK_SIZE
+        indexes.BLOCK_SIZE = 4
+        try:
+            rng = random.Random(5)
+            expected = sorted(rng.randint(0, 60) for _ in range(50))
+            index = SortedKeyIndex(expected)
+            for _ in range(2000):
+                key = rng.randint(0, 60)
+                if key in expected and rng.random() < 0.5:
+                    index.remove(key)
+                    expected.remove(key)
+                else:
+                    index.add(key)
+                    expected.append(key)
+                    expected.sort()
+                self.assertTrue(all(len(block) <= 8 for block in index._blocks))
+            self.assertListEqual(list(index), expected)
+            self.assertEqual(len(index), len(expected))
+            self.assertGreater(len(index._blocks), 2)
+            for key in range(62):
+                if key in expected:
+                    self.assertEqual(index.position(key), expected.index(key))
+                else:
+                    self.assertIsNone(index.position(key))
+                self.assertEqual(index.bisect(key),
+                                 len([other for other in expected if other < key]))
+                self.assertListEqual(list(index.range(key, key + 9, 7)),
+                                     [other for other in expected
+                                      if key <= other < key + 9][:7])
+            self.assertListEqual([index[position] for position in range(len(index))],
+                                 expected)
+            self.assertEqual(index[-1], expected[-1])
+            self.assertRaises(IndexError, index.__getitem__, len(index))
+            index.remove_all(range(0, 60, 2))
+            self.assertListEqual(list(index), [key for key in expected if key % 2 or key == 60])
+        finally:
+            indexes.BLOCK_SIZE = block_size
+
+
+class Named:
+    """A stand-in for an indexed model object"""
+
+    def __init__(self, key, owner, name):
+        self.key = key
+        self.owner = owner
+        self.name = name
+
+
+class IndexedTest(unittest.TestCase):
+    """Tests for the Indexed declaration"""
+
+    def test_value_of(self):
+        """One field gives its value and several give a tuple"""
+        obj = Named(1, 5, 'cakes')
+        self.assertEqual(Indexed('name').value_of(obj), 'cakes')
+        self.assertEqual(Indexed('name', fields=('owner', 'name')).value_of(obj),
+                         (5, 'cakes'))
+        self.assertEqual(Indexed('name', fields=('owner', 'name'), fold=True)
+                         .value_of(Named(1, 5, 'Cakes')), (5, 'cakes'))
+        self.assertIsInstance(Indexed('name', kind=SORTED).new_index(), SortedIndex)
+        self.assertRaises(ValueError, Indexed, 'name', kind='btree')
+
+
+class HashIndexTest(unittest.TestCase):
+    """Tests for HashIndex, also run against SortedIndex"""
+    index_type = HashIndex
+
+    def setUp(self):
+        """Initiates an index to be used in most tests"""
+        self.index = self.index_type(entries=[('cakes', 1), ('pies', 2),
+                                              ('cakes', 3)])
+
+    def test_keys_of_a_value(self):
+        """Keys sharing a value come back in key order"""
+        self.assertListEqual(self.index.keys('cakes'), [1, 3])
+        self.assertEqual(self.index.first('cakes'), 1)
+        self.assertListEqual(self.index.keys('bread'), [])
+        self.assertIsNone(self.index.first('bread'))
+        self.assertEqual(len(self.index), 3)
+
+    def test_add_moves_a_key(self):
+        """Adding a key under a new value removes its old value"""
+        self.index.add('bread', 1)
+        self.assertListEqual(self.index.keys('cakes'), [3])
+        self.assertListEqual(self.index.keys('bread'), [1])
+        self.assertEqual(self.index.value_of(1), 'bread')
+        self.index.add('bread', 1)
+        self.assertEqual(len(self.index), 3)
+
+    def test_discard(self):
+        """Discarded keys are no longer found"""
+        self.index.discard(3)
+        self.index.discard(3)
+        self.assertListEqual(self.index.keys('cakes'), [1])
+        self.assertIsNone(self.index.value_of(3))
+        self.assertEqual(sorted(self.index.items()), [('cakes', 1), ('pies', 2)])
+
+    def test_discard_many(self):
+        """Keys discarded together are removed whether few or many"""
+        self.index.discard_many([3, 2, 42])
+        self.assertEqual(sorted(self.index.items()), [('cakes', 1)])
+        rng = random.Random(4)
+        for key in range(10, 510):
+            self.index.add(rng.choice(['cakes', 'pies', 'bread']), key)
+        doomed = rng.sample(range(1, 510), 300)
+        self.index.discard_many(doomed)
+        kept = [key for key in [1] + list(range(10, 510)) if key not in doomed]
+        self.assertListEqual(sorted(key for _, key in self.index.items()), kept)
+        self.assertEqual(len(self.index), len(kept))
+        for value in ('cakes', 'pies', 'bread'):
+            self.assertTrue(set(self.index.keys(value)) <= set(kept))
+
+    def test_unique(self):
+        """A unique index only allows one key per value"""
+        index = self.index_type(unique=True, entries=[('a@example.com', 1)])
+        self.assertTrue(index.allows('a@example.com', 1))
+        self.assertFalse(index.allows('a@example.com', 2))
+        self.assertTrue(self.index.allows('cakes', 4))
+
+
+class SortedIndexTest(HashIndexTest):
+    """Tests for SortedIndex"""
+    index_type = SortedIndex
+
+    def test_range(self):
+        """Ranges include low, exclude high and follow value order"""
+        index = SortedIndex(entries=[((2, 'b'), 1), ((1, 'z'), 2),
+                                     ((2, 'a'), 3), ((3, 'a'), 4)])
+        self.assertListEqual(index.range((2,), (3,)), [3, 1])
+        self.assertListEqual(index.range((2, 'b')), [1, 4])
+        self.assertListEqual(index.range(high=(2, 'b')), [2, 3])
+        self.assertListEqual(index.range((2,), limit=2), [3, 1])
+        self.assertListEqual(index.range((2,), (3,), limit=0), [])
+        self.assertListEqual([key for _, key in index.items()], [2, 3, 1, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+"""Module with tests for the reader/writer lock and thread safety"""
+
+
+import threading
+import unittest
+from app.locks import ReadWriteLock
+from app.models import Database
+
+
+class ReadWriteLockTest(unittest.TestCase):
+    """Tests for ReadWriteLock"""
+
+    def setUp(self):
+        """Initiates a lock to be used in most tests"""
+        self.lock = ReadWriteLock()
+
+    def test_locks_are_reentrant(self):
+        """Both locks can be taken again by the thread holding them"""
+        with self.lock.write():
+            with self.lock.write():
+                with self.lock.read():
+                    pass
+        with self.lock.read():
+            with self.lock.read():
+                pass
+
+    def test_read_lock_cannot_be_upgraded(self):
+        """Taking the write lock while reading raises RuntimeError"""
+        with self.lock.read():
+            self.assertRaises(RuntimeError, self.lock.acquire_write)
+        self.assertRaises(RuntimeError, self.lock.release_read)
+        self.assertRaises(RuntimeError, self.lock.release_write)
+
+    def test_upgraded_gives_up_the_read_lock(self):
+        """upgraded() waits for the other readers, not for itself"""
+        other_in = threading.Event()
+        release_other = threading.Event()
+
+        def other_reader():
+            with self.lock.read():
+                other_in.set()
+                release_other.wait()
+
+        thread = threading.Thread(target=other_reader)
+        thread.start()
+        other_in.wait()
+        with self.lock.read():
+            with self.lock.read():
+                threading.Timer(0.05, release_other.set).start()
+                with self.lock.upgraded():
+                    self.assertIsNotNone(self.lock._writer)
+                    self.assertDictEqual(self.lock._readers, {})
+                # the read lock is held again, twice
+                self.assertEqual(self.lock._readers[threading.get_ident()], 2)
+        thread.join()
+        self.assertDictEqual(self.lock._readers, {})
+        with self.lock.write():
+            with self.lock.upgraded():
+                pass
+
+    def test_readers_share_and_writers_exclude(self):
+        """Readers run together while a writer waits for them"""
+        events = []
+        reader_in = threading.Event()
+        release_reader = threading.Event()
+
+        def reader():
+            with self.lock.read():
+                reader_in.set()
+                release_reader.wait()
+                events.append('reader done')
+
+        def writer():
+            with self.lock.write():
+                events.append('writer')
+
+        reader_thread = threading.Thread(target=reader)
+        reader_thread.start()
+        reader_in.wait()
+        # a second reader gets in while the first holds the lock
+        with self.lock.read():
+            pass
+        writer_thread = threading.Thread(target=writer)
+        writer_thread.start()
+        writer_thread.join(0.1)
+        self.assertListEqual(events, [])
+        release_reader.set()
+        reader_thread.join()
+        writer_thread.join()
+        self.assertListEqual(events, ['reader done', 'writer'])
+
+
+class DatabaseStressTest(unittest.TestCase):
+    """Hammers one Database from many threads"""
+
+    THREADS = 8
+    ROUNDS = 30
+
+    def test_concurrent_writers_keep_invariants(self):
+        """Keys stay unique and every index agrees with the tables"""
+        db = Database()
+        errors = []
+
+        def work(number):
+            try:
+                user = db.create_user({
+                    'first_name': 'John', 'last_name': 'Doe',
+                    'email': 'john%d@example.com' % number,
+                    'password': 'password'})
+                for round_number in range(self.ROUNDS):
+                    category = user.create_recipe_category(
+                        db, {'name': 'cakes %d %d' % (number, round_number)})
+                    recipe = category.create_recipe(
+                        db, {'name': 'cake %d %d' % (number, round_number),
+                             'description': ''})
+                    for step_number in range(3):
+                        recipe.create_step(db, {'text_content': 'step %d' % step_number})
+                    list(recipe.get_all_steps(db))
+                    db.get_recipe(recipe.key)
+                    if round_number % 3 == 0:
+                        category.delete(db)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=work, args=(number,))
+                   for number in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertListEqual(errors, [])
+
+        self.assertEqual(len(db.users), self.THREADS)
+        kept = self.THREADS * (self.ROUNDS - len(range(0, self.ROUNDS, 3)))
+        self.assertEqual(len(db.recipe_categories), kept)
+        self.assertEqual(len(db.recipes), kept)
+        self.assertEqual(len(db.recipe_steps), kept * 3)
+        for table, keys in ((db.users, db.user_keys),
+                            (db.recipe_categories, db.recipe_category_keys),
+                            (db.recipes, db.recipe_keys),
+                            (db.recipe_steps, db.recipe_step_keys)):
+            self.assertSetEqual(set(table), set(keys))
+        for recipe in db.recipes.values():
+            self.assertEqual(len(recipe.recipe_steps), 3)
+            for step_key in recipe.recipe_steps:
+                self.assertEqual(db.recipe_steps[step_key].recipe, recipe.key)
+        for user in db.users.values():
+            self.assertEqual(len(user.recipe_categories), kept // self.THREADS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""Module with tests for the persistent map"""
+
+
+import random
+import unittest
+from app.persistent import PersistentMap, PersistentSequence
+
+
+class CollidingKey:
+    """A key whose hash is chosen by the test"""
+    def __init__(self, name, key_hash):
+        self.name = name
+        self.key_hash = key_hash
+
+    def __hash__(self):
+        return self.key_hash
+
+    def __eq__(self, other):
+        return isinstance(other, CollidingKey) and self.name == other.name
+
+
+class PersistentMapTest(unittest.TestCase):
+    """Tests for PersistentMap"""
+
+    def test_set_leaves_the_old_map_unchanged(self):
+        """set and remove return new maps and the old ones stay valid"""
+        first = PersistentMap({1: 'a', 2: 'b'})
+        second = first.set(3, 'c').set(1, 'z')
+        third = second.remove(2)
+        self.assertDictEqual(dict(first.items()), {1: 'a', 2: 'b'})
+        self.assertDictEqual(dict(second.items()), {1: 'z', 2: 'b', 3: 'c'})
+        self.assertDictEqual(dict(third.items()), {1: 'z', 3: 'c'})
+        self.assertEqual([len(first), len(second), len(third)], [2, 3, 2])
+        self.assertIs(third.remove(2), third)
+
+    def test_lookups(self):
+        """get, [] and in behave like a dict"""
+        mapping = PersistentMap([('a', 1)])
+        self.assertEqual(mapping['a'], 1)
+        self.assertIn('a', mapping)
+        self.assertNotIn('b', mapping)
+        self.assertIsNone(mapping.get('b'))
+        self.assertRaises(KeyError, lambda: mapping['b'])
+
+    def test_hash_collisions(self):
+        """Keys with equal hashes are kept apart"""
+        first, second = CollidingKey('first', 7), CollidingKey('second', 7)
+        mapping = PersistentMap().set(first, 1).set(second, 2).set(first, 3)
+        self.assertEqual(len(mapping), 2)
+        self.assertEqual(mapping[first], 3)
+        self.assertEqual(mapping[second], 2)
+        mapping = mapping.remove(first)
+        self.assertEqual(len(mapping), 1)
+        self.assertNotIn(first, mapping)
+        self.assertEqual(mapping[second], 2)
+        built = PersistentMap([(first, 1), (second, 2), (CollidingKey('x', -7), 3)])
+        self.assertEqual(len(built), 3)
+        self.assertEqual(built[second], 2)
+
+    def test_matches_a_dict(self):
+        """Random changes give the same results as a dict"""
+        rng = random.Random(9)
+        expected = {rng.randrange(-5000, 5000): rng.random() for _ in range(500)}
+        mapping = PersistentMap(expected)
+        for _ in range(3000):
+            key = rng.randrange(-5000, 5000)
+            if rng.random() < 0.6:
+                value = rng.random()
+                expected[key] = value
+                mapping = mapping.set(key, value)
+            else:
+                expected.pop(key, None)
+                mapping = mapping.remove(key)
+        self.assertEqual(len(mapping), len(expected))
+        self.assertDictEqual(dict(mapping.items()), expected)
+        self.assertSetEqual(set(mapping), set(expected))
+
+
+class PersistentSequenceTest(unittest.TestCase):
+    """Tests for PersistentSequence"""
+
+    def test_sequence(self):
+        """It indexes, iterates and compares like a tuple"""
+        sequence = PersistentSequence([3, 1, 2])
+        self.assertEqual(len(sequence), 3)
+        self.assertListEqual(list(sequence), [3, 1, 2])
+        self.assertEqual(sequence[0], 3)
+        self.assertEqual(sequence[-1], 2)
+        self.assertRaises(IndexError, sequence.__getitem__, 3)
+        self.assertIn(1, sequence)
+        self.assertEqual(sequence.index(2), 2)
+        self.assertEqual(sequence, (3, 1, 2))
+        self.assertEqual(sequence, PersistentSequence((3, 1, 2)))
+        self.assertNotEqual(sequence, (3, 1))
+        self.assertEqual(hash(sequence), hash((3, 1, 2)))
+        self.assertEqual(PersistentSequence(), ())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@ import unittest
 from app.models import Database, User, RecipeCategory,\
 Recipe, RecipeStep
 from app import utilities
+from app.indexes import IndexView
 
 
 class RecipeTest(unittest.TestCase):
@@ -68,9 +69,8 @@ class RecipeTest(unittest.TestCase):
         self.assertIn(self.recipe.key, self.db.recipe_keys)
         self.assertEqual(self.recipe, self.db.recipes[self.recipe.key])
         self.assertIn(self.recipe.key, self.category.recipes)
-        self.assertIn(self.recipe.name, self.db.recipe_name_key_map.keys())
         self.assertEqual(self.recipe.key,
-                         self.db.recipe_name_key_map[self.recipe.name])
+                         self.db.get_index(Recipe, 'name').first((self.recipe.category, self.recipe.name)))
         # the category should exist in database
         invalid_data = utilities.replace_value_in_dict(self.recipe_data, 'category', 78)
         new_recipe = Recipe(**invalid_data)
@@ -95,7 +95,7 @@ class RecipeTest(unittest.TestCase):
                           self.db.recipes, self.recipe.key)
         self.assertNotIn(self.recipe.key, self.db.recipe_keys)
         self.assertNotIn(self.recipe.key, self.category.recipes)
-        self.assertNotIn(self.recipe.name, self.db.recipe_name_key_map.keys())
+        self.assertIsNone(self.db.get_index(Recipe, 'name').first((self.recipe.category, self.recipe.name)))
         # database parameter should be of type Database
         self.assertRaises(TypeError, self.recipe.delete, 
                           'string instead of Database object')
@@ -112,8 +112,7 @@ class RecipeTest(unittest.TestCase):
         # the records in db should be updated also
         self.assertEqual(self.recipe, self.db.recipes[self.recipe.key])
         self.assertIn(self.recipe.key, self.db.recipe_keys)
-        self.assertIn(self.recipe.name, self.db.recipe_name_key_map.keys())
-        self.assertEqual(self.recipe.key, self.db.recipe_name_key_map[self.recipe.name])
+        self.assertEqual(self.recipe.key, self.db.get_index(Recipe, 'name').first((self.recipe.category, self.recipe.name)))
         # assert that the new name is set
         self.assertEqual(new_name, self.recipe.name)
         # try setting with a non string name
@@ -135,8 +134,7 @@ class RecipeTest(unittest.TestCase):
         self.recipe.set_description(new_description, self.db)
         self.assertEqual(self.recipe, self.db.recipes[self.recipe.key])
         self.assertIn(self.recipe.key, self.db.recipe_keys)
-        self.assertIn(self.recipe.name, self.db.recipe_name_key_map.keys())
-        self.assertEqual(self.recipe.key, self.db.recipe_name_key_map[self.recipe.name])
+        self.assertEqual(self.recipe.key, self.db.get_index(Recipe, 'name').first((self.recipe.category, self.recipe.name)))
         # assert that the new description is set
         self.assertEqual(new_description, self.recipe.description)
         # try setting with a non string description
@@ -178,12 +176,72 @@ class RecipeTest(unittest.TestCase):
             key += 1
 
         recipe_steps = self.recipe.get_all_steps(self.db)
-        self.assertIsInstance(recipe_steps, list)
+        self.assertIsInstance(recipe_steps, IndexView)
         self.assertEqual(len(self.recipe.recipe_steps), len(recipe_steps))
-        self.assertListEqual(created_recipe_steps, recipe_steps)
+        self.assertListEqual(created_recipe_steps, list(recipe_steps))
         self.assertRaises(TypeError, self.recipe.get_all_steps,
                           'expected Database object not string')
 
+    def test_steps_keep_authored_order(self):
+        """Steps can be inserted at a position and moved"""
+        self.recipe.save(self.db)
+        first = self.recipe.create_step(self.db, {'text_content': 'first'})
+        third = self.recipe.create_step(self.db, {'text_content': 'third'})
+        second = self.recipe.create_step(self.db, {'text_content': 'second'},
+                                         position=1)
+        self.assertListEqual(list(self.recipe.get_all_steps(self.db)),
+                             [first, second, third])
+        self.recipe.move_step(third.key, 0, self.db)
+        self.assertListEqual(list(self.recipe.get_all_steps(self.db)),
+                             [third, first, second])
+        self.assertRaises(KeyError, self.recipe.move_step, 99, 0, self.db)
+        self.assertRaises(TypeError, self.recipe.move_step, third.key, '0',
+                          self.db)
+        # deleting a step removes it from the recipe's index
+        second.delete(self.db)
+        self.assertListEqual(list(self.recipe.recipe_steps),
+                             [third.key, first.key])
+
+    def test_change_category(self):
+        """A recipe moves with its steps and can be found under its new category"""
+        self.recipe.save(self.db)
+        step = self.recipe.create_step(self.db, self.recipe_step_data)
+        pies = self.user.create_recipe_category(self.db, {'name': 'pies'})
+        self.recipe.change_category(pies, self.db)
+        self.assertEqual(self.recipe.category, pies.key)
+        self.assertListEqual(list(self.category.recipes), [])
+        self.assertListEqual(list(pies.recipes), [self.recipe.key])
+        self.assertIsNone(self.db.get_recipe_by_name(self.category.key, 'Banana cake'))
+        self.assertEqual(self.db.get_recipe_by_name(pies.key, 'Banana cake'), self.recipe)
+        self.assertListEqual(self.db.suggest_recipes(self.user.key, 'ban'), [self.recipe])
+        self.assertListEqual(list(self.recipe.get_all_steps(self.db)), [step])
+        # moving by key and to the same category
+        self.recipe.change_category(self.category.key, self.db)
+        self.assertListEqual(list(self.category.recipes), [self.recipe.key])
+        self.assertEqual(self.db.move_recipes([self.recipe], self.category), 0)
+        self.assertRaises(KeyError, self.recipe.change_category, 99, self.db)
+        other_user = self.db.create_user({'first_name': 'Jane', 'last_name': 'Doe',
+                                          'email': 'janedoe@example.com',
+                                          'password': 'password'})
+        other_category = other_user.create_recipe_category(self.db, {'name': 'cakes'})
+        self.assertRaises(ValueError, self.recipe.change_category,
+                          other_category, self.db)
+        self.assertRaises(TypeError, self.recipe.change_category, pies, 'db')
+
+    def test_move_many_recipes(self):
+        """move_recipes moves a batch and checks all of it first"""
+        recipes = [self.category.create_recipe(self.db, {'name': 'cake %d' % number,
+                                                         'description': ''})
+                   for number in range(10)]
+        pies = self.user.create_recipe_category(self.db, {'name': 'pies'})
+        self.assertEqual(self.db.move_recipes(recipes[:6], pies), 6)
+        self.assertListEqual(list(pies.recipes), [recipe.key for recipe in recipes[:6]])
+        self.assertListEqual(list(self.category.recipes),
+                             [recipe.key for recipe in recipes[6:]])
+        missing = Recipe(key=99, name='missing', description='', category=pies.key)
+        self.assertRaises(KeyError, self.db.move_recipes, [recipes[6], missing], pies)
+        self.assertEqual(len(pies.recipes), 6)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -4,6 +4,7 @@
 import unittest
 from app.models import Database, User, RecipeCategory, Recipe
 from app import utilities
+from app.indexes import IndexView
 
 
 class RecipeCategoryTest(unittest.TestCase):
@@ -60,9 +61,8 @@ class RecipeCategoryTest(unittest.TestCase):
         self.assertIn(self.category.key, self.db.recipe_category_keys)
         self.assertEqual(self.category, self.db.recipe_categories[self.category.key])
         self.assertIn(self.category.key, self.user.recipe_categories)
-        self.assertIn(self.category.name, self.db.recipe_category_name_key_map.keys())
         self.assertEqual(self.category.key,
-                         self.db.recipe_category_name_key_map[self.category.name])
+                         self.db.get_index(RecipeCategory, 'name').first((self.category.user, self.category.name)))
         # the user should exist in database
         invalid_data = utilities.replace_value_in_dict(self.category_data, 'user', 78)
         new_category = RecipeCategory(**invalid_data)
@@ -87,7 +87,7 @@ class RecipeCategoryTest(unittest.TestCase):
                           self.db.recipe_categories, self.category.key)
         self.assertNotIn(self.category.key, self.db.recipe_category_keys)
         self.assertNotIn(self.category.key, self.user.recipe_categories)
-        self.assertNotIn(self.category.name, self.db.recipe_category_name_key_map.keys())
+        self.assertIsNone(self.db.get_index(RecipeCategory, 'name').first((self.category.user, self.category.name)))
         # database parameter should be of type Database
         self.assertRaises(TypeError, self.category.delete, 
                           'string instead of Database object')
@@ -104,8 +104,7 @@ class RecipeCategoryTest(unittest.TestCase):
         # the records in db should be updated also
         self.assertEqual(self.category, self.db.recipe_categories[self.category.key])
         self.assertIn(self.category.key, self.db.recipe_category_keys)
-        self.assertIn(self.category.name, self.db.recipe_category_name_key_map.keys())
-        self.assertEqual(self.category.key, self.db.recipe_category_name_key_map[self.category.name])
+        self.assertEqual(self.category.key, self.db.get_index(RecipeCategory, 'name').first((self.category.user, self.category.name)))
         # assert that the new name is set
         self.assertEqual(new_name, self.category.name)
         # try setting with a non string name
@@ -127,8 +126,7 @@ class RecipeCategoryTest(unittest.TestCase):
         self.category.set_description(new_description, self.db)
         self.assertEqual(self.category, self.db.recipe_categories[self.category.key])
         self.assertIn(self.category.key, self.db.recipe_category_keys)
-        self.assertIn(self.category.name, self.db.recipe_category_name_key_map.keys())
-        self.assertEqual(self.category.key, self.db.recipe_category_name_key_map[self.category.name])
+        self.assertEqual(self.category.key, self.db.get_index(RecipeCategory, 'name').first((self.category.user, self.category.name)))
         # assert that the new description is set
         self.assertEqual(new_description, self.category.description)
         # try setting with a non string description
@@ -145,9 +143,8 @@ class RecipeCategoryTest(unittest.TestCase):
         self.assertIn(recipe.key, self.category.recipes)
         self.assertIn(recipe.key, self.db.recipe_keys)
         self.assertEqual(recipe, self.db.recipes[recipe.key])
-        self.assertIn(recipe.name, self.db.recipe_name_key_map.keys())
         self.assertEqual(recipe.key,
-                          self.db.recipe_name_key_map[recipe.name])
+                          self.db.get_index(Recipe, 'name').first((recipe.category, recipe.name)))
         self.assertRaises(TypeError, self.category.create_recipe, 
                           'database should be a Database object', self.recipe_data)
         del(self.recipe_data['name'])
@@ -171,9 +168,9 @@ class RecipeCategoryTest(unittest.TestCase):
             key += 1
 
         recipes = self.category.get_all_recipes(self.db)
-        self.assertIsInstance(recipes, list)
+        self.assertIsInstance(recipes, IndexView)
         self.assertEqual(len(self.category.recipes), len(recipes))
-        self.assertListEqual(created_recipes, recipes)
+        self.assertListEqual(created_recipes, list(recipes))
         self.assertRaises(TypeError, self.category.get_all_recipes,
                           'expected Database object not string')
 
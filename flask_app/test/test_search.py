@@ -0,0 +1,159 @@
+"""Module with tests for the full-text search"""
+
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from math import log
+from app.models import Database, Recipe, RecipeStep
+from app.backends import SQLiteBackend
+from app.search import tokenize, K1, B, NAME_WEIGHT
+
+
+class SearchIndexTest(unittest.TestCase):
+    """Tests for Database.search and the SearchIndex behind it"""
+
+    def setUp(self):
+        """Creates two recipes and enables search"""
+        self.db = Database()
+        self.user = self.db.create_user({
+            'first_name': 'John', 'last_name': 'Doe',
+            'email': 'johndoe@example.com', 'password': 'password'})
+        self.category = self.user.create_recipe_category(self.db, {'name': 'cakes'})
+        self.banana = self.category.create_recipe(
+            self.db, {'name': 'Banana cake', 'description': 'Moist and sweet'})
+        self.banana.create_step(self.db, {'text_content': 'Mash the bananas'})
+        self.carrot = self.category.create_recipe(
+            self.db, {'name': 'Carrot cake', 'description': 'With walnuts'})
+        self.step = self.carrot.create_step(self.db, {'text_content': 'Grate the carrots'})
+        self.db.enable_search()
+
+    def names(self, query):
+        """Returns the names of the recipes found for query"""
+        return [recipe.name for recipe, _ in self.db.search(query)]
+
+    def test_tokenize(self):
+        """Words are lowercased and stop words are dropped"""
+        self.assertListEqual(tokenize('Bake the Cake, then cool it.'),
+                             ['bake', 'cake', 'cool'])
+
+    def test_existing_recipes_are_indexed(self):
+        """Names, descriptions and steps are searchable"""
+        self.assertListEqual(self.names('banana'), ['Banana cake'])
+        self.assertListEqual(self.names('moist'), ['Banana cake'])
+        self.assertListEqual(self.names('GRATE'), ['Carrot cake'])
+        self.assertListEqual(sorted(self.names('cake')), ['Banana cake', 'Carrot cake'])
+        self.assertListEqual(self.names('the'), [])
+        self.assertListEqual(self.names('pie'), [])
+
+    def test_ranking(self):
+        """Documents with more and rarer matching words come first"""
+        self.assertListEqual(self.names('carrot cake'), ['Carrot cake', 'Banana cake'])
+        # a word of the name weighs more than a word of a step
+        self.banana.create_step(self.db, {'text_content': 'Add a carrot'})
+        self.assertListEqual(self.names('carrot'), ['Carrot cake', 'Banana cake'])
+        self.assertEqual(len(self.db.search('cake', limit=1)), 1)
+
+    def test_updates_are_incremental(self):
+        """Creating, editing and deleting re-index the recipe"""
+        step = self.banana.create_step(self.db, {'text_content': 'Fold in pecans'})
+        self.assertListEqual(self.names('pecans'), ['Banana cake'])
+        step.set_text_content('Fold in walnuts', self.db)
+        self.assertListEqual(self.names('pecans'), [])
+        self.assertListEqual(sorted(self.names('walnuts')), ['Banana cake', 'Carrot cake'])
+        step.delete(self.db)
+        self.assertListEqual(self.names('walnuts'), ['Carrot cake'])
+        self.carrot.set_name('Carrot loaf', self.db)
+        self.assertListEqual(self.names('loaf'), ['Carrot loaf'])
+        self.carrot.delete(self.db)
+        self.assertListEqual(self.names('grate'), [])
+        self.category.delete(self.db)
+        self.assertListEqual(self.names('banana'), [])
+        self.assertEqual(len(self.db.search_index), 0)
+
+    def test_batches(self):
+        """Transactions and insert_many are indexed once they apply"""
+        with self.db.transaction() as transaction:
+            recipe = transaction.create(Recipe, name='Bread', description='',
+                                        category=self.category.key)
+            transaction.create(RecipeStep, text_content='Knead the dough',
+                               recipe=recipe.key)
+            transaction.delete(self.carrot)
+        self.assertListEqual(self.names('dough'), ['Bread'])
+        self.assertListEqual(self.names('carrots'), [])
+        keys = self.db.get_next_keys(RecipeStep, 2)
+        self.db.insert_many([RecipeStep(key=key, text_content='Proof the dough',
+                                        recipe=recipe.key) for key in keys])
+        self.assertEqual(len(self.db.search_index), 2)
+        self.assertListEqual(self.names('proof'), ['Bread'])
+
+    def test_search_must_be_enabled(self):
+        """Search raises until it is enabled and never tracks SQLite"""
+        self.assertRaises(ValueError, Database().search, 'cake')
+        self.assertRaises(TypeError, self.db.search, 42)
+        directory = tempfile.mkdtemp()
+        backend = SQLiteBackend(os.path.join(directory, 'yummy.sqlite3'))
+        try:
+            self.assertRaises(ValueError, Database(backend).enable_search)
+        finally:
+            backend.close()
+            shutil.rmtree(directory)
+
+    def test_results_match_scoring_every_document(self):
+        """Stopping early gives the same results as scoring everything"""
+        generator = random.Random(7)
+        words = ['word%d' % number for number in range(60)]
+        # a skewed vocabulary so some words are in most recipes
+        pool = [word for rank, word in enumerate(words)
+                for _ in range(len(words) // (rank + 1))]
+        for number in range(300):
+            recipe = self.category.create_recipe(self.db, {
+                'name': ' '.join(generator.choice(pool) for _ in range(2)),
+                'description': ''})
+            for _ in range(generator.randint(0, 6)):
+                recipe.create_step(self.db, {'text_content': ' '.join(
+                    generator.choice(pool) for _ in range(generator.randint(1, 8)))})
+        for _ in range(40):
+            query = ' '.join(generator.sample(words, generator.randint(1, 3)))
+            expected = self.score_everything(query)
+            found = self.db.search(query, limit=10)
+            self.assertEqual(len(found), min(10, len(expected)))
+            for (_, score), expected_score in zip(found, expected):
+                self.assertAlmostEqual(score, expected_score)
+
+    def score_everything(self, query):
+        """Returns the 10 best BM25 scores for query, found the slow way"""
+        documents = {}
+        for recipe in self.db.recipes.values():
+            words = tokenize(recipe.description)
+            for step in recipe.get_all_steps(self.db):
+                words.extend(tokenize(step.text_content))
+            frequencies = {}
+            for word in words:
+                frequencies[word] = frequencies.get(word, 0) + 1
+            for word in tokenize(recipe.name):
+                frequencies[word] = frequencies.get(word, 0) + NAME_WEIGHT
+            documents[recipe.key] = frequencies
+        average_length = sum(sum(frequencies.values())
+                             for frequencies in documents.values()) / len(documents)
+        scores = []
+        for frequencies in documents.values():
+            length = sum(frequencies.values())
+            score = 0.0
+            for term in set(tokenize(query)):
+                if term not in frequencies:
+                    continue
+                holding = sum(1 for other in documents.values() if term in other)
+                idf = log(1 + (len(documents) - holding + 0.5) / (holding + 0.5))
+                frequency = frequencies[term]
+                score += idf * frequency * (K1 + 1) / (
+                    frequency + K1 * (1 - B + B * length / average_length))
+            if score:
+                scores.append(score)
+        return sorted(scores, reverse=True)[:10]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+"""Module with tests for the key sequences"""
+
+
+import unittest
+from app.sequences import KeySequence, KeySequences
+from app.models import User, Recipe
+
+
+class KeySequenceTest(unittest.TestCase):
+    """Tests for KeySequence and KeySequences"""
+
+    def test_next_key_is_monotonic(self):
+        """Each call to next_key returns a bigger key"""
+        sequence = KeySequence()
+        self.assertEqual(sequence.next_key(), 1)
+        self.assertEqual(sequence.next_key(), 2)
+        self.assertEqual(sequence.last_key, 2)
+
+    def test_observe(self):
+        """Observed keys move the counter forward but never backward"""
+        sequence = KeySequence()
+        sequence.observe(10)
+        self.assertEqual(sequence.next_key(), 11)
+        sequence.observe(3)
+        self.assertEqual(sequence.next_key(), 12)
+        self.assertRaises(TypeError, sequence.observe, 'string')
+
+    def test_restore(self):
+        """A sequence can be restored from persisted state"""
+        sequence = KeySequence(5)
+        self.assertEqual(sequence.next_key(), 6)
+        sequence.restore(100)
+        self.assertEqual(sequence.next_key(), 101)
+        self.assertRaises(ValueError, sequence.restore, -1)
+
+    def test_sequences_state_roundtrip(self):
+        """The state of all sequences can be saved and restored"""
+        sequences = KeySequences(User, Recipe)
+        sequences.next_key(User)
+        sequences.observe(Recipe, 40)
+        state = sequences.state()
+        self.assertEqual(state, {'User': 1, 'Recipe': 40})
+        restored = KeySequences(User, Recipe)
+        restored.restore(state)
+        self.assertEqual(restored.next_key(User), 2)
+        self.assertEqual(restored.next_key(Recipe), 41)
+        self.assertRaises(KeyError, restored.next_key, int)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""Module with tests for binary snapshots"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from app.models import Database, RecipeStep, User
+from app.wal import WriteAheadLog
+
+
+class SnapshotTest(unittest.TestCase):
+    """Tests for Database.snapshot and Database.load"""
+
+    def setUp(self):
+        """Creates a populated database and a temporary directory"""
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'yummy.snapshot')
+        self.db = Database()
+        self.user = self.db.create_user({
+            'first_name': 'John',
+            'last_name': 'Doe',
+            'email': 'johndoe@example.com',
+            'password': 'password',
+            })
+        self.category = self.user.create_recipe_category(
+            self.db, {'name': 'cakes', 'description': 'all recipes cake!'})
+        self.recipe = self.category.create_recipe(
+            self.db, {'name': 'Banana cake', 'description': 'yummy'})
+        for text_content in ('Mash bananas', 'Bake', 'Eat'):
+            self.recipe.create_step(self.db, {'text_content': text_content})
+        self.recipe.move_step(3, 0, self.db)
+
+    def tearDown(self):
+        """Removes the temporary directory"""
+        shutil.rmtree(self.directory)
+
+    def test_snapshot_roundtrip(self):
+        """A loaded snapshot has the same objects, order and indexes"""
+        self.db.snapshot(self.path)
+        loaded = Database()
+        loaded.load(self.path)
+        # nothing is decoded until it is used
+        self.assertEqual(loaded.recipe_steps.decoded, 0)
+        self.assertEqual(len(loaded.recipe_steps), 3)
+        user = loaded.get_user_by_email('johndoe@example.com')
+        self.assertEqual(user.to_record(), self.user.to_record())
+        category = list(user.get_all_recipe_categories(loaded))[0]
+        self.assertEqual(category.to_record(), self.category.to_record())
+        recipe = loaded.get_recipe_by_name(category.key, 'Banana cake')
+        steps = [step.text_content for step in recipe.get_all_steps(loaded)]
+        self.assertListEqual(steps, ['Eat', 'Mash bananas', 'Bake'])
+        self.assertIn(2, loaded.recipe_step_keys)
+        self.assertEqual(loaded.get_next_key(RecipeStep), 4)
+
+    def test_loaded_database_can_be_changed(self):
+        """Objects can be saved and deleted on top of a loaded snapshot"""
+        self.db.snapshot(self.path)
+        loaded = Database()
+        loaded.load(self.path)
+        recipe = loaded.get_recipe(self.recipe.key)
+        new_step = recipe.create_step(loaded, {'text_content': 'Share'})
+        loaded.get_recipe_step(1).delete(loaded)
+        self.assertIsNone(loaded.get_recipe_step(1))
+        self.assertNotIn(1, loaded.recipe_step_keys)
+        self.assertListEqual(sorted(loaded.recipe_steps), [2, 3, new_step.key])
+        self.assertEqual(len(loaded.recipe_steps), 3)
+        # and snapshotted again
+        second_path = os.path.join(self.directory, 'second.snapshot')
+        loaded.snapshot(second_path)
+        reloaded = Database()
+        reloaded.load(second_path)
+        steps = [step.text_content for step in
+                 reloaded.get_recipe(self.recipe.key).get_all_steps(reloaded)]
+        self.assertListEqual(steps, ['Eat', 'Bake', 'Share'])
+
+    def test_indexes_are_decoded_when_used(self):
+        """Loading leaves the indexes in the file until they are looked up"""
+        self.db.enable_search()
+        self.db.snapshot(self.path)
+        loaded = Database()
+        loaded.load(self.path)
+        loaded.enable_search()
+        emails = loaded.get_index(User, 'email')
+        self.assertFalse(emails.loaded)
+        self.assertEqual(len(emails), 1)
+        self.assertFalse(loaded.search_index.built)
+        # an index that was never decoded is copied to the next snapshot as is
+        second_path = os.path.join(self.directory, 'second.snapshot')
+        loaded.snapshot(second_path)
+        self.assertFalse(emails.loaded)
+        reloaded = Database()
+        reloaded.load(second_path)
+        self.assertEqual(reloaded.get_user_by_email('johndoe@example.com').key,
+                         self.user.key)
+        self.assertTrue(reloaded.get_index(User, 'email').loaded)
+        self.assertEqual(reloaded.get_recipe_by_name(self.category.key,
+                                                     'Banana cake').key,
+                         self.recipe.key)
+        self.assertEqual(len(loaded.search('banana')), 1)
+        self.assertTrue(loaded.search_index.built)
+
+    def test_snapshot_truncates_log(self):
+        """A snapshot plus the log written after it rebuilds the database"""
+        log_path = os.path.join(self.directory, 'yummy.wal')
+        log = WriteAheadLog(log_path)
+        self.db.add_listener(log)
+        self.db.snapshot(self.path, log=log)
+        self.assertListEqual(list(log.replay()), [])
+        self.recipe.set_name('Banana bread', self.db)
+        log.close()
+        loaded = Database()
+        loaded.load(self.path)
+        loaded.open_log(WriteAheadLog(log_path))
+        self.assertEqual(loaded.get_recipe(self.recipe.key).name,
+                         'Banana bread')
+
+    def test_load_needs_empty_database(self):
+        """Loading into a database with data is refused"""
+        self.db.snapshot(self.path)
+        self.assertRaises(ValueError, self.db.load, self.path)
+        bad_path = os.path.join(self.directory, 'bad.snapshot')
+        with open(bad_path, 'wb') as bad_file:
+            bad_file.write(b'not a snapshot at all')
+        self.assertRaises(ValueError, Database().load, bad_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
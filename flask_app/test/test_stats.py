@@ -0,0 +1,191 @@
+"""Module with tests for the database stats"""
+
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from app.backends import MemoryBackend, SQLiteBackend
+from app.models import Database, Recipe, RecipeCategory, User, TABLE_NAMES
+from app.stats import DatabaseStats, deep_size, sample
+
+
+class StatsTest(unittest.TestCase):
+    """Tests for Database.stats and DatabaseStats"""
+
+    def fill(self, database, users=3):
+        """Gives user n n categories of 10 recipes with 2 steps each"""
+        for number in range(1, users + 1):
+            user = database.create_user({
+                'first_name': 'John', 'last_name': 'Doe',
+                'email': 'john%d@example.com' % number, 'password': 'password'})
+            for category_number in range(number):
+                category = user.create_recipe_category(
+                    database, {'name': 'Category %d' % category_number})
+                for recipe_number in range(10):
+                    recipe = category.create_recipe(
+                        database, {'name': 'Recipe %d' % recipe_number,
+                                   'description': ''})
+                    recipe.create_step(database, {'text_content': 'Mix'})
+                    recipe.create_step(database, {'text_content': 'Bake'})
+
+    def test_counts_and_indexes(self):
+        """Every table reports its objects, bytes and index sizes"""
+        database = Database()
+        database.enable_search()
+        self.fill(database)
+        stats = database.stats()
+        self.assertEqual(stats['tables']['users']['objects'], 3)
+        self.assertEqual(stats['tables']['recipe_categories']['objects'], 6)
+        self.assertEqual(stats['tables']['recipes']['objects'], 60)
+        self.assertEqual(stats['tables']['recipe_steps']['objects'], 120)
+        self.assertEqual(stats['objects'], 189)
+        self.assertDictEqual(stats['tables']['recipes']['indexes'],
+                             {'name': 60, 'prefix': 60})
+        self.assertEqual(stats['tables']['users']['indexes'], {'email': 3})
+        self.assertGreater(stats['search_terms'], 0)
+        self.assertIsNone(stats['fuzzy_entries'])
+        self.assertEqual(stats['tombstones'], 0)
+        for table in stats['tables'].values():
+            self.assertGreater(table['bytes'], 0)
+        self.assertEqual(stats['bytes'], sum(table['bytes'] for table
+                                             in stats['tables'].values()))
+
+    def test_bytes_are_sampled(self):
+        """Sampled bytes are close to measuring every object"""
+        database = Database()
+        self.fill(database, users=6)
+        stats = DatabaseStats(database, TABLE_NAMES, rng=random.Random(4)).collect()
+        for name, model in TABLE_NAMES:
+            table = database.get_table(model)
+            exact = sys.getsizeof(table) + sum(deep_size(obj) for obj in table.values())
+            self.assertLess(abs(stats['tables'][name]['bytes'] - exact), exact * 0.25)
+
+    def test_sample_after_deletes(self):
+        """Missing keys are skipped and the first keys fill the sample"""
+        rng = random.Random(2)
+        table = {key: key for key in range(1, 1001)}
+        self.assertEqual(len(sample(table, size=64, rng=rng)), 64)
+        # only the last 10 keys are left
+        table = {key: key for key in range(100001, 100011)}
+        self.assertListEqual(sorted(sample(table, size=64, rng=rng)),
+                             list(range(100001, 100011)))
+        self.assertListEqual(sample({}, rng=rng), [])
+
+    def test_columnar_tables(self):
+        """Columnar tables report the bytes of their columns"""
+        database = Database(MemoryBackend(columnar=True))
+        self.fill(database)
+        stats = database.stats()
+        self.assertEqual(stats['tables']['recipe_steps']['bytes'],
+                         database.recipe_steps.memory_size())
+
+    def test_largest_users(self):
+        """Users are ranked by the objects under them and recounted now and then"""
+        database = Database()
+        self.fill(database, users=7)
+        stats = DatabaseStats(database, TABLE_NAMES, user_scan_seconds=3600)
+        largest = stats.collect()['largest_users']
+        self.assertListEqual([user['email'] for user in largest],
+                             ['john%d@example.com' % number for number in (7, 6, 5, 4, 3)])
+        # 7 categories of 10 recipes of 2 steps and the user
+        self.assertEqual(largest[0]['objects'], 1 + 7 + 70 + 140)
+        user = database.get_user_by_email('john1@example.com')
+        category = database.get_recipe_category(next(iter(user.recipe_categories)))
+        for number in range(300):
+            category.create_recipe(database, {'name': 'More %d' % number,
+                                              'description': ''})
+        # counted less than user_scan_seconds ago
+        self.assertIs(stats.collect()['largest_users'], largest)
+        stats.user_scan_seconds = 0
+        self.assertEqual(stats.collect()['largest_users'][0]['email'],
+                         'john1@example.com')
+
+    def test_user_counts_follow_changes(self):
+        """The counts kept by the listener match a count of the tables"""
+        database = Database()
+        self.fill(database, users=4)
+
+        def counted():
+            counts = {key: 1 for key in database.users}
+            for category in database.recipe_categories.values():
+                if database.is_visible(category):
+                    counts[category.user] += 1
+            for recipe in database.recipes.values():
+                if database.is_visible(recipe):
+                    category = database.recipe_categories[recipe.category]
+                    counts[category.user] += 1 + len(recipe.recipe_steps)
+            return counts
+
+        self.assertDictEqual(dict(database.user_counts.items()), counted())
+        user = database.get_user_by_email('john4@example.com')
+        first, second, third = [database.get_recipe_category(key)
+                                for key in list(user.recipe_categories)[:3]]
+        recipe = database.get_recipe(next(iter(first.recipes)))
+        recipe.create_step(database, {'text_content': 'Cool'})
+        database.get_recipe_step(next(iter(recipe.recipe_steps))).delete(database)
+        database.move_recipes([database.get_recipe(key) for key in list(first.recipes)[:3]],
+                              second)
+        with database.transaction() as transaction:
+            created = transaction.create(RecipeCategory, name='Pies', user=user.key)
+            transaction.create(Recipe, name='Apple', description='',
+                               category=created.key)
+        self.assertDictEqual(dict(database.user_counts.items()), counted())
+        database.delete_later(third)
+        self.assertDictEqual(dict(database.user_counts.items()), counted())
+        database.compact()
+        database.delete_object(database.get_user_by_email('john2@example.com'))
+        self.assertDictEqual(dict(database.user_counts.items()), counted())
+        self.assertEqual(len(database.user_counts.items()), 3)
+
+    def test_growth(self):
+        """The growth rate is measured between calls in the window"""
+        database = Database()
+        stats = DatabaseStats(database, TABLE_NAMES)
+        self.assertIsNone(stats.collect()['growth'])
+        time.sleep(0.01)
+        self.fill(database, users=1)
+        growth = stats.collect()['growth']
+        self.assertGreater(growth['objects_per_second'], 0)
+        self.assertGreater(growth['bytes_per_second'], 0)
+        stats.growth_window_seconds = 0
+        time.sleep(0.01)
+        # the earlier calls have left the window
+        self.assertIsNone(stats.collect()['growth'])
+
+    def test_shared_backend(self):
+        """Only counts are given for tables outside this process"""
+        directory = tempfile.mkdtemp()
+        backend = SQLiteBackend(os.path.join(directory, 'yummy.sqlite3'))
+        try:
+            database = Database(backend)
+            self.fill(database, users=1)
+            stats = database.stats()
+            self.assertEqual(stats['tables']['recipes']['objects'], 10)
+            self.assertIsNone(stats['tables']['recipes']['bytes'])
+            self.assertIsNone(stats['bytes'])
+            self.assertIsNone(stats['largest_users'])
+        finally:
+            backend.close()
+            shutil.rmtree(directory)
+
+    def test_cheap_on_a_large_table(self):
+        """A call reads a sample, not the whole table"""
+        database = Database()
+        database.insert_many([User(key=key, first_name='John', last_name='Doe',
+                                   email='john%d@example.com' % key,
+                                   password='password')
+                              for key in range(1, 50001)])
+        stats = DatabaseStats(database, TABLE_NAMES)
+        stats.collect()
+        started = time.perf_counter()
+        for _ in range(10):
+            stats.collect()
+        self.assertLess((time.perf_counter() - started) / 10, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
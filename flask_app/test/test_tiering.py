@@ -0,0 +1,293 @@
+"""Module with tests for evicting cold users to disk"""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from app.bgsave import BackgroundSaver, SUCCEEDED
+from app.models import Database, Recipe
+from app.wal import WriteAheadLog
+
+
+class GatedSaver(BackgroundSaver):
+    """A BackgroundSaver whose child waits for a byte on gate before saving"""
+    def __init__(self, database, path, log, gate):
+        super().__init__(database, path, log=log)
+        self.gate = gate
+
+    def _run_child(self):
+        try:
+            os.read(self.gate, 1)
+        except BaseException:
+            os._exit(1)
+        super()._run_child()
+
+
+class TieringTest(unittest.TestCase):
+    """Tests for Database.enable_tiering, evict_user and fetch"""
+
+    def setUp(self):
+        """Creates 3 users with a category of recipes with steps each"""
+        self.directory = tempfile.mkdtemp()
+        self.db = Database()
+        self.db.enable_search()
+        self.db.enable_fuzzy_search()
+        self.db.enable_tiering(os.path.join(self.directory, 'tiers.sqlite3'),
+                               1024 * 1024 * 1024)
+        self.users = []
+        for number in range(3):
+            user = self.db.create_user({
+                'first_name': 'John', 'last_name': 'Doe',
+                'email': 'john%d@example.com' % number, 'password': 'password'})
+            category = user.create_recipe_category(self.db, {'name': 'Cakes'})
+            for recipe_number in range(5):
+                recipe = category.create_recipe(
+                    self.db, {'name': 'Sponge %d' % recipe_number,
+                              'description': 'light'})
+                recipe.create_step(self.db, {'text_content': 'Whisk the eggs'})
+                recipe.create_step(self.db, {'text_content': 'Bake'})
+            self.users.append(user)
+
+    def tearDown(self):
+        self.db.tiers.close()
+        shutil.rmtree(self.directory)
+
+    def test_evict_and_fault_in(self):
+        """An evicted tree leaves the tables and comes back whole when looked up"""
+        user = self.users[0]
+        category_key = next(iter(user.recipe_categories))
+        category = self.db.recipe_categories[category_key]
+        recipe_keys = list(category.recipes)
+        step_keys = list(self.db.recipes[recipe_keys[0]].recipe_steps)
+        self.assertEqual(self.db.evict_user(user.key), 1 + 1 + 5 + 10)
+        self.assertNotIn(user.key, self.db.users)
+        self.assertNotIn(category_key, self.db.recipe_categories)
+        self.assertNotIn(recipe_keys[0], self.db.recipes)
+        self.assertNotIn(step_keys[0], self.db.recipe_steps)
+        self.assertEqual(len(self.db.recipes), 10)
+        # the indexes keep the evicted keys
+        self.assertIn(recipe_keys[0], self.db.recipe_keys)
+        self.assertEqual(self.db.tiers.status()['evicted_users'], 1)
+        recipe = self.db.get_recipe(recipe_keys[0])
+        self.assertEqual(recipe.name, 'Sponge 0')
+        self.assertListEqual(list(recipe.recipe_steps), step_keys)
+        self.assertListEqual([step.text_content for step in recipe.get_all_steps(self.db)],
+                             ['Whisk the eggs', 'Bake'])
+        self.assertListEqual(list(self.db.get_user(user.key).recipe_categories),
+                             [category_key])
+        self.assertListEqual(list(self.db.recipe_categories[category_key].recipes),
+                             recipe_keys)
+        self.assertEqual(len(self.db.recipes), 15)
+        status = self.db.tiers.status()
+        self.assertEqual(status['misses'], 1)
+        self.assertGreaterEqual(status['hits'], 1)
+        self.assertEqual(status['evictions'], 1)
+        self.assertEqual(status['objects_evicted'], 17)
+        self.assertEqual(status['objects_faulted_in'], 17)
+        self.assertEqual(status['evicted_users'], 0)
+        self.assertIsNone(self.db.get_recipe(10000))
+        self.assertRaises(KeyError, self.db.evict_user, 10000)
+
+    def test_lookups_through_indexes(self):
+        """Lookups by email, name, search and fuzzy search fault trees in"""
+        for user in self.users:
+            self.db.evict_user(user.key)
+        self.assertEqual(self.db.get_user_by_email('john1@example.com').key,
+                         self.users[1].key)
+        category = self.db.get_recipe_category_by_name(self.users[2].key, 'Cakes')
+        self.assertEqual(category.user, self.users[2].key)
+        self.db.evict_user(self.users[2].key)
+        self.assertEqual(len(self.db.search('light', limit=20)), 15)
+        self.db.evict_user(self.users[1].key)
+        self.assertEqual(self.db.fuzzy_find(self.users[1].key, 'spnge 1')[0].name,
+                         'Sponge 1')
+        self.assertEqual(len(self.db.suggest_recipes(self.users[0].key, 'spo')), 5)
+        self.assertEqual(self.db.tiers.status()['evicted_users'], 0)
+
+    def test_deleting_a_user_keeps_evicted_documents(self):
+        """Only the deleted user's recipes leave the search index"""
+        self.db.evict_user(self.users[0].key)
+        self.db.delete_object(self.users[1])
+        self.assertEqual(len(self.db.search_index), 10)
+        found = self.db.search('light', limit=20)
+        self.assertEqual(len(found), 10)
+        self.assertSetEqual({self.db.get_recipe_category(recipe.category).user
+                             for recipe, _ in found},
+                            {self.users[0].key, self.users[2].key})
+
+    def test_writes_to_evicted_trees(self):
+        """Saving under or deleting an evicted object faults its tree in first"""
+        user = self.users[0]
+        category = self.db.recipe_categories[next(iter(user.recipe_categories))]
+        recipe = self.db.recipes[next(iter(category.recipes))]
+        self.db.evict_user(user.key)
+        step = recipe.create_step(self.db, {'text_content': 'Cool'})
+        self.assertEqual(len(self.db.recipes[recipe.key].recipe_steps), 3)
+        self.assertEqual(self.db.get_recipe_step(step.key).text_content, 'Cool')
+        self.db.evict_user(user.key)
+        # a stale object saved while evicted is newer than its copy on disk
+        recipe.set_name('Chiffon', self.db)
+        self.assertEqual(self.db.get_recipe(recipe.key).name, 'Chiffon')
+        self.assertListEqual([found.key for found in
+                              self.db.find(Recipe, 'name', (category.key, 'Chiffon'))],
+                             [recipe.key])
+        self.db.evict_user(user.key)
+        report = self.db.delete_object(category)
+        self.assertEqual(report['objects'], 1 + 5 + 11)
+        self.assertIsNone(self.db.get_recipe(recipe.key))
+        self.assertListEqual(list(self.db.get_user(user.key).recipe_categories), [])
+        self.db.evict_user(user.key)
+        self.db.delete_later(self.db.get_user(user.key))
+        self.assertIsNone(self.db.get_user(user.key))
+
+    def test_budget_evicts_least_recently_used(self):
+        """enforce evicts the users used longest ago until the tables fit"""
+        self.db.get_user(self.users[0].key)
+        self.db.get_recipe(next(iter(self.db.recipes)))
+        self.db.tiers.memory_budget = self.db.tiers.resident_bytes() // 2
+        self.assertGreaterEqual(self.db.tiers.enforce(), 1)
+        # user 0 was used last
+        self.assertIn(self.users[0].key, self.db.users)
+        self.assertNotIn(self.users[1].key, self.db.users)
+        self.assertLessEqual(self.db.tiers.resident_bytes(),
+                             self.db.tiers.memory_budget * 1.5)
+        self.db.tiers.memory_budget = 1024 * 1024 * 1024
+        self.assertEqual(self.db.tiers.enforce(), 0)
+
+    def test_snapshots_hold_evicted_objects(self):
+        """Snapshots copy evicted objects from disk without faulting them in"""
+        path = os.path.join(self.directory, 'yummy.snapshot')
+        user = self.users[1]
+        category_key = next(iter(user.recipe_categories))
+        self.db.evict_user(user.key)
+        self.db.snapshot(path)
+        self.assertNotIn(user.key, self.db.users)
+        loaded = Database()
+        loaded.load(path)
+        self.assertEqual(len(loaded.users), 3)
+        self.assertEqual(len(loaded.recipe_steps), 30)
+        self.assertListEqual(list(loaded.users[user.key].recipe_categories),
+                             [category_key])
+        self.assertEqual(len(loaded.recipe_categories[category_key].recipes), 5)
+
+    def test_enforce_while_saving(self):
+        """Measuring the tables is safe while another thread writes to them"""
+        category = self.db.recipe_categories[next(iter(self.users[0].recipe_categories))]
+        recipes = [category.create_recipe(self.db, {'name': 'Scone %d' % number,
+                                                    'description': ''})
+                   for number in range(300)]
+        # few keys left below the last one, so sampling falls back to
+        # walking the table
+        for recipe in recipes[:-1]:
+            recipe.delete(self.db)
+        errors = []
+        done = threading.Event()
+
+        def write():
+            try:
+                while not done.is_set():
+                    recipe = category.create_recipe(self.db, {'name': 'Bun',
+                                                              'description': ''})
+                    recipe.create_step(self.db, {'text_content': 'Bake'})
+                    recipe.delete(self.db)
+            except Exception as error:
+                errors.append(error)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            for _ in range(3000):
+                self.assertEqual(self.db.tiers.enforce(), 0)
+        finally:
+            done.set()
+            writer.join()
+            sys.setswitchinterval(interval)
+        self.assertListEqual(errors, [])
+
+    def test_budget_after_a_load(self):
+        """Objects decoded from a snapshot count against the budget"""
+        path = os.path.join(self.directory, 'yummy.snapshot')
+        self.db.snapshot(path)
+        self.db.tiers.close()
+        self.db = Database()
+        self.db.load(path)
+        self.db.enable_tiering(os.path.join(self.directory, 'loaded.sqlite3'),
+                               1024 * 1024 * 1024)
+        before = self.db.tiers.resident_bytes()
+        for user in self.users:
+            category_key = next(iter(self.db.get_user(user.key).recipe_categories))
+            for recipe in self.db.get_recipe_category(category_key).get_all_recipes(self.db):
+                list(recipe.get_all_steps(self.db))
+        self.assertGreater(self.db.tiers.resident_bytes(), before)
+        self.db.tiers.memory_budget = self.db.tiers.resident_bytes() // 2
+        self.assertGreaterEqual(self.db.tiers.enforce(), 1)
+        self.assertEqual(len(self.db.user_counts.items()), 3)
+        self.assertEqual(sum(objects for _, objects in self.db.user_counts.items()),
+                         3 * (1 + 1 + 5 + 10))
+
+    def test_fault_in_during_background_save(self):
+        """A save forked while a user was evicted holds that user after a restart"""
+        self.db.tiers.close()
+        log = WriteAheadLog(os.path.join(self.directory, 'yummy.wal'))
+        self.db = Database()
+        self.db.open_log(log)
+        self.db.enable_tiering(os.path.join(self.directory, 'logged.sqlite3'),
+                               1024 * 1024 * 1024)
+        for number in range(3):
+            user = self.db.create_user({
+                'first_name': 'John', 'last_name': 'Doe',
+                'email': 'john%d@example.com' % number, 'password': 'password'})
+            category = user.create_recipe_category(self.db, {'name': 'Cakes'})
+            category.create_recipe(self.db, {'name': 'Sponge', 'description': ''})
+        first, second = self.db.users[1], self.db.users[2]
+        self.db.evict_user(first.key)
+        gate, opener = os.pipe()
+        path = os.path.join(self.directory, 'yummy.snapshot')
+        saver = GatedSaver(self.db, path, log, gate)
+        saver.start()
+        try:
+            self.assertTrue(self.db.tiers.status()['held'])
+            # faulted in after the fork, which the child must not notice
+            self.assertEqual(self.db.get_user(first.key).email, 'john0@example.com')
+            # and nothing is evicted until the child is done
+            self.assertRaises(ValueError, self.db.evict_user, second.key)
+            self.db.tiers.memory_budget = 1
+            self.assertEqual(self.db.tiers.enforce(), 0)
+        finally:
+            os.write(opener, b'x')
+            os.close(opener)
+            saver.wait()
+            os.close(gate)
+        self.assertEqual(saver.status()['state'], SUCCEEDED)
+        self.assertFalse(self.db.tiers.status()['held'])
+        # the rows left for the child are gone
+        self.assertIsNone(self.db.tiers.record('User', first.key))
+        self.assertEqual(self.db.tiers.enforce(), 3)
+        log.close()
+
+        restarted = Database()
+        restarted.load(path)
+        replay_log = WriteAheadLog(log.path)
+        restarted.open_log(replay_log)
+        replay_log.close()
+        self.assertEqual(len(restarted.users), 3)
+        self.assertEqual(len(restarted.recipe_categories), 3)
+        self.assertEqual(len(restarted.recipes), 3)
+        self.assertEqual(restarted.get_user(first.key).email, 'john0@example.com')
+
+    def test_cannot_be_combined_with_versions(self):
+        """Versions would keep every object in memory"""
+        self.assertRaises(ValueError, self.db.enable_versions)
+        database = Database()
+        database.enable_versions()
+        self.assertRaises(ValueError, database.enable_tiering,
+                          os.path.join(self.directory, 'other.sqlite3'), 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+"""Module with tests for Database.transaction"""
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from app.models import Database, User, RecipeCategory, Recipe, RecipeStep
+from app.backends import SQLiteBackend
+from app import wal
+from app.wal import WriteAheadLog
+
+
+class TransactionTest(unittest.TestCase):
+    """Tests for Transaction"""
+
+    def setUp(self):
+        """Creates a database with a user and a category"""
+        self.directory = tempfile.mkdtemp()
+        self.db = Database()
+        self.user = self.db.create_user({
+            'first_name': 'John', 'last_name': 'Doe',
+            'email': 'johndoe@example.com', 'password': 'password'})
+        self.category = self.user.create_recipe_category(self.db, {'name': 'cakes'})
+
+    def tearDown(self):
+        """Removes the temporary directory"""
+        shutil.rmtree(self.directory)
+
+    def create_recipe(self, transaction):
+        """Stages a recipe with twenty steps"""
+        recipe = transaction.create(Recipe, name='Banana cake', description='',
+                                    category=self.category.key)
+        for number in range(20):
+            transaction.create(RecipeStep, text_content='step %d' % number,
+                               recipe=recipe.key)
+        return recipe
+
+    def test_staged_objects_are_applied_on_exit(self):
+        """Nothing is visible until the with block ends"""
+        with self.db.transaction() as transaction:
+            recipe = self.create_recipe(transaction)
+            self.assertIsNone(self.db.get_recipe(recipe.key))
+        self.assertTrue(transaction.committed)
+        saved = self.db.get_recipe(recipe.key)
+        self.assertIs(saved, recipe)
+        self.assertListEqual([step.text_content for step in saved.get_all_steps(self.db)],
+                             ['step %d' % number for number in range(20)])
+        self.assertIn(recipe.key, self.category.recipes)
+
+    def test_updates_and_deletes(self):
+        """Staged updates and deletes are applied in order"""
+        recipe = self.category.create_recipe(self.db, {'name': 'Bread',
+                                                       'description': ''})
+        step = recipe.create_step(self.db, {'text_content': 'Knead'})
+        with self.db.transaction() as transaction:
+            transaction.update(recipe, name='Rye bread', description='dark')
+            transaction.delete(step)
+        self.assertEqual(recipe.name, 'Rye bread')
+        self.assertEqual(recipe.description, 'dark')
+        self.assertIsNone(self.db.get_recipe_step(step.key))
+        self.assertEqual(len(recipe.recipe_steps), 0)
+
+    def test_invalid_updates_are_refused_when_staged(self):
+        """Unknown, fixed or invalid fields raise before anything is staged"""
+        transaction = self.db.transaction()
+        self.assertRaises(ValueError, transaction.update, self.category, colour='red')
+        self.assertRaises(ValueError, transaction.update, self.category, key=5)
+        self.assertRaises(ValueError, transaction.update, self.category, user=5)
+        self.assertRaises(ValueError, transaction.update, self.category, name=' ')
+        self.assertRaises(TypeError, transaction.create, dict)
+        self.assertListEqual(transaction.operations, [])
+
+    def test_all_or_nothing(self):
+        """A failing operation stops every operation from being applied"""
+        stranger = RecipeCategory(key=99, name='ghost', user=self.user.key)
+        transaction = self.db.transaction()
+        recipe = self.create_recipe(transaction)
+        transaction.create(Recipe, name='Lost', description='', category=stranger.key)
+        self.assertRaises(KeyError, transaction.commit)
+        self.assertIsNone(self.db.get_recipe(recipe.key))
+        self.assertEqual(len(self.db.recipe_steps), 0)
+        self.assertEqual(len(self.category.recipes), 0)
+
+    def test_error_in_block_applies_nothing(self):
+        """An exception in the with block discards the transaction"""
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction() as transaction:
+                recipe = self.create_recipe(transaction)
+                raise RuntimeError('changed my mind')
+        self.assertFalse(transaction.committed)
+        self.assertIsNone(self.db.get_recipe(recipe.key))
+
+    def test_children_of_deleted_objects_are_refused(self):
+        """Objects cannot be staged under something deleted earlier"""
+        transaction = self.db.transaction()
+        recipe = self.create_recipe(transaction)
+        transaction.delete(self.category)
+        transaction.update(recipe, name='Gone')
+        self.assertRaises(KeyError, transaction.commit)
+        self.assertIsNotNone(self.db.get_recipe_category(self.category.key))
+
+    def test_duplicate_emails_are_refused(self):
+        """Users created together cannot share an email"""
+        transaction = self.db.transaction()
+        user_data = {'first_name': 'Jane', 'last_name': 'Doe',
+                     'email': 'jane@example.com', 'password': 'password'}
+        transaction.create(User, **user_data)
+        transaction.create(User, **user_data)
+        self.assertRaises(ValueError, transaction.commit)
+        self.assertIsNone(self.db.get_user_by_email('jane@example.com'))
+
+    def test_one_version_and_one_log_record(self):
+        """Readers and the log see the transaction as one change"""
+        path = os.path.join(self.directory, 'yummy.wal')
+        log = WriteAheadLog(path)
+        self.db.open_log(log)
+        self.db.enable_versions()
+        before = self.db.read_view()
+        with self.db.transaction() as transaction:
+            recipe = self.create_recipe(transaction)
+            transaction.delete(self.category)
+            transaction.create(RecipeCategory, name='bread', user=self.user.key)
+        after = self.db.read_view()
+        self.assertEqual(after.number, before.number + 1)
+        self.assertIsNone(after.get_recipe(recipe.key))
+        self.assertEqual(len(after.recipe_steps), 0)
+        self.assertListEqual([category.name for category in after.get_user(
+            self.user.key).get_all_recipe_categories(after)], ['bread'])
+        log.close()
+        with open(path) as log_file:
+            records = [json.loads(line) for line in log_file]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0][0], wal.BATCH)
+
+    def test_batches_replay(self):
+        """A logged transaction rebuilds the same data"""
+        path = os.path.join(self.directory, 'yummy.wal')
+        db = Database()
+        log = WriteAheadLog(path)
+        db.open_log(log)
+        user = db.create_user({'first_name': 'John', 'last_name': 'Doe',
+                               'email': 'johndoe@example.com', 'password': 'password'})
+        self.category = user.create_recipe_category(db, {'name': 'cakes'})
+        with db.transaction() as transaction:
+            recipe = self.create_recipe(transaction)
+        log.close()
+        restored = Database()
+        restored.open_log(WriteAheadLog(path))
+        self.assertListEqual(list(restored.get_recipe(recipe.key).recipe_steps),
+                             list(recipe.recipe_steps))
+        self.assertEqual(len(restored.recipe_steps), 20)
+
+    def test_sqlite_backend(self):
+        """Transactions are applied in one SQLite transaction"""
+        db = Database(SQLiteBackend(os.path.join(self.directory, 'yummy.db')))
+        user = db.create_user({'first_name': 'John', 'last_name': 'Doe',
+                               'email': 'johndoe@example.com', 'password': 'password'})
+        self.category = user.create_recipe_category(db, {'name': 'cakes'})
+        with db.transaction() as transaction:
+            recipe = self.create_recipe(transaction)
+        self.assertEqual(len(list(db.get_recipe(recipe.key).get_all_steps(db))), 20)
+        db.backend.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
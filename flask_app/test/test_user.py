@@ -3,6 +3,7 @@
 import unittest
 from app.models import User, Database, RecipeCategory
 from app import utilities
+from app.indexes import IndexView
 
 
 class UserTest(unittest.TestCase):
@@ -72,8 +73,7 @@ class UserTest(unittest.TestCase):
         length_of_user_keys = len(self.db.user_keys)
         self.assertIn(self.user.key, self.db.user_keys)
         self.assertEqual(self.user, self.db.users[self.user.key])
-        self.assertIn(self.user.email, self.db.user_email_key_map.keys())
-        self.assertEqual(self.user.key, self.db.user_email_key_map[self.user.email])
+        self.assertEqual(self.user.key, self.db.get_index(User, 'email').first(self.user.email))
         # calling save more than once does not increase size of self.db.user_keys
         self.user.save(self.db)
         self.assertEqual(len(self.db.user_keys), length_of_user_keys)
@@ -85,9 +85,8 @@ class UserTest(unittest.TestCase):
         self.assertIn(category.key, self.user.recipe_categories)
         self.assertIn(category.key, self.db.recipe_category_keys)
         self.assertEqual(category, self.db.recipe_categories[category.key])
-        self.assertIn(category.name, self.db.recipe_category_name_key_map.keys())
         self.assertEqual(category.key,
-                          self.db.recipe_category_name_key_map[category.name])
+                          self.db.get_index(RecipeCategory, 'name').first((category.user, category.name)))
         self.assertRaises(TypeError, self.user.create_recipe_category, 
                           'database should be a Database object', self.category_data)
         del(self.category_data['name'])
@@ -110,9 +109,9 @@ class UserTest(unittest.TestCase):
             key += 1
 
         categories = self.user.get_all_recipe_categories(self.db)
-        self.assertIsInstance(categories, list)
+        self.assertIsInstance(categories, IndexView)
         self.assertEqual(len(self.user.recipe_categories), len(categories))
-        self.assertListEqual(created_categories, categories)
+        self.assertListEqual(created_categories, list(categories))
         self.assertRaises(TypeError, self.user.get_all_recipe_categories,
                           'expected Database object not string')
 
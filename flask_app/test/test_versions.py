@@ -0,0 +1,102 @@
+"""Module with tests for the immutable database versions"""
+
+
+import unittest
+from app.models import Database
+from app.versions import DatabaseVersion, FrozenRecipe, freeze
+
+
+class VersionStoreTest(unittest.TestCase):
+    """Tests for Database.read_view and the VersionStore behind it"""
+
+    def setUp(self):
+        """Creates a small tree and enables versions"""
+        self.db = Database()
+        self.user = self.db.create_user({
+            'first_name': 'John', 'last_name': 'Doe',
+            'email': 'johndoe@example.com', 'password': 'password'})
+        self.category = self.user.create_recipe_category(
+            self.db, {'name': 'cakes', 'description': 'sweet'})
+        self.recipe = self.category.create_recipe(
+            self.db, {'name': 'Banana cake', 'description': 'yummy!'})
+        self.first_step = self.recipe.create_step(self.db, {'text_content': 'mix'})
+        self.db.enable_versions()
+
+    def test_read_view_without_versions_is_the_database(self):
+        """read_view falls back to the live database"""
+        database = Database()
+        self.assertIs(database.read_view(), database)
+
+    def test_versions_are_built_from_existing_data(self):
+        """Enabling versions copies what is already in the database"""
+        view = self.db.read_view()
+        self.assertIsInstance(view, DatabaseVersion)
+        recipe = view.get_recipe(self.recipe.key)
+        self.assertEqual(recipe, freeze(self.recipe))
+        self.assertIsInstance(recipe, FrozenRecipe)
+        self.assertListEqual([step.text_content for step in recipe.get_all_steps(view)],
+                             ['mix'])
+        self.assertEqual(view.get_user(self.user.key).email, 'johndoe@example.com')
+
+    def test_old_versions_do_not_change(self):
+        """A version taken before a write never sees that write"""
+        before = self.db.read_view()
+        self.recipe.create_step(self.db, {'text_content': 'bake'})
+        self.recipe.set_name('Banana bread', self.db)
+        after = self.db.read_view()
+        self.assertGreater(after.number, before.number)
+        old_recipe = before.get_recipe(self.recipe.key)
+        new_recipe = after.get_recipe(self.recipe.key)
+        self.assertEqual(old_recipe.name, 'Banana cake')
+        self.assertEqual(len(old_recipe.get_all_steps(before)), 1)
+        self.assertEqual(new_recipe.name, 'Banana bread')
+        self.assertListEqual([step.text_content for step in new_recipe.get_all_steps(after)],
+                             ['mix', 'bake'])
+
+    def test_moves_are_published(self):
+        """Reordering steps publishes the new order"""
+        second = self.recipe.create_step(self.db, {'text_content': 'bake'})
+        self.recipe.move_step(second.key, 0, self.db)
+        view = self.db.read_view()
+        self.assertTupleEqual(tuple(view.get_recipe(self.recipe.key).recipe_steps),
+                              (second.key, self.first_step.key))
+
+    def test_recipe_moves_are_published(self):
+        """Moving a recipe changes both categories in the next version only"""
+        bread = self.user.create_recipe_category(self.db, {'name': 'bread'})
+        before = self.db.read_view()
+        self.recipe.change_category(bread, self.db)
+        after = self.db.read_view()
+        self.assertTupleEqual(tuple(before.get_recipe_category(self.category.key).recipes),
+                              (self.recipe.key,))
+        self.assertTupleEqual(tuple(before.get_recipe_category(bread.key).recipes), ())
+        self.assertTupleEqual(tuple(after.get_recipe_category(self.category.key).recipes), ())
+        self.assertTupleEqual(tuple(after.get_recipe_category(bread.key).recipes),
+                              (self.recipe.key,))
+        self.assertEqual(after.get_recipe(self.recipe.key).category, bread.key)
+
+    def test_cascading_delete_is_one_version(self):
+        """A deleted category disappears with its whole subtree at once"""
+        before = self.db.read_view()
+        self.category.delete(self.db)
+        after = self.db.read_view()
+        self.assertEqual(after.number, before.number + 1)
+        self.assertIsNone(after.get_recipe_category(self.category.key))
+        self.assertIsNone(after.get_recipe(self.recipe.key))
+        self.assertIsNone(after.get_recipe_step(self.first_step.key))
+        self.assertListEqual(after.get_user(self.user.key)
+                             .get_all_recipe_categories(after), [])
+        self.assertIsNotNone(before.get_recipe_step(self.first_step.key))
+
+    def test_versions_share_structure(self):
+        """Tables untouched by a write are shared with the last version"""
+        before = self.db.read_view()
+        self.first_step.set_text_content('stir', self.db)
+        after = self.db.read_view()
+        self.assertIs(after.users, before.users)
+        self.assertIs(after.recipes, before.recipes)
+        self.assertIsNot(after.recipe_steps, before.recipe_steps)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+"""Module with tests for the write-ahead log"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from app.models import Database, RecipeStep
+from app import wal
+from app.wal import WriteAheadLog
+
+
+class WriteAheadLogTest(unittest.TestCase):
+    """Tests for WriteAheadLog and Database.open_log"""
+
+    def setUp(self):
+        """Creates a temporary directory for the log"""
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'yummy.wal')
+        self.user_data = {
+            'first_name': 'John',
+            'last_name': 'Doe',
+            'email': 'johndoe@example.com',
+            'password': 'password',
+            }
+
+    def tearDown(self):
+        """Removes the temporary directory"""
+        shutil.rmtree(self.directory)
+
+    def populate(self, db):
+        """Runs every kind of mutation against db"""
+        user = db.create_user(self.user_data)
+        cakes = user.create_recipe_category(db, {'name': 'cakes'})
+        bread = user.create_recipe_category(db, {'name': 'bread'})
+        recipe = cakes.create_recipe(db, {'name': 'Banana cake',
+                                          'description': 'yummy'})
+        first = recipe.create_step(db, {'text_content': 'Mash bananas'})
+        second = recipe.create_step(db, {'text_content': 'Bake'})
+        recipe.create_step(db, {'text_content': 'Eat'}, position=0)
+        first.set_text_content('Mash ripe bananas', db)
+        second.delete(db)
+        recipe.set_name('Banana bread', db)
+        cakes.set_description('all recipes cake!', db)
+        bread.delete(db)
+        return user
+
+    def test_log_is_replayed(self):
+        """A database rebuilt from the log matches the original"""
+        log = WriteAheadLog(self.path)
+        db = Database()
+        db.open_log(log)
+        user = self.populate(db)
+        log.close()
+
+        restored = Database()
+        restored_log = WriteAheadLog(self.path)
+        restored.open_log(restored_log)
+        restored_user = restored.get_user_by_email(user.email)
+        self.assertEqual(restored_user.to_record(), user.to_record())
+        categories = list(restored_user.get_all_recipe_categories(restored))
+        self.assertListEqual([category.name for category in categories],
+                             ['cakes'])
+        self.assertEqual(categories[0].description, 'all recipes cake!')
+        recipes = list(categories[0].get_all_recipes(restored))
+        self.assertEqual(recipes[0].name, 'Banana bread')
+        steps = [step.text_content for step in recipes[0].get_all_steps(restored)]
+        self.assertListEqual(steps, ['Eat', 'Mash ripe bananas'])
+        self.assertListEqual(list(restored.recipe_step_keys),
+                             list(db.recipe_step_keys))
+        # deleted keys are not reused after a restart
+        self.assertEqual(restored.get_next_key(RecipeStep), 4)
+        restored_log.close()
+
+    def test_moves_are_replayed(self):
+        """A recipe moved between categories is only under the new one after replay"""
+        log = WriteAheadLog(self.path)
+        db = Database()
+        db.open_log(log)
+        user = db.create_user(self.user_data)
+        cakes = user.create_recipe_category(db, {'name': 'cakes'})
+        bread = user.create_recipe_category(db, {'name': 'bread'})
+        recipe = cakes.create_recipe(db, {'name': 'Banana bread',
+                                          'description': 'yummy'})
+        recipe.create_step(db, {'text_content': 'Bake'})
+        recipe.change_category(bread, db)
+        log.close()
+
+        restored = Database()
+        restored_log = WriteAheadLog(self.path)
+        restored.open_log(restored_log)
+        self.assertListEqual(list(restored.get_recipe_category(cakes.key).recipes), [])
+        self.assertListEqual(list(restored.get_recipe_category(bread.key).recipes),
+                             [recipe.key])
+        self.assertEqual(restored.get_recipe(recipe.key).category, bread.key)
+        self.assertEqual(len(restored.get_recipe(recipe.key).recipe_steps), 1)
+        restored_log.close()
+
+    def test_mutations_after_replay_are_logged(self):
+        """The log keeps growing after it has been replayed"""
+        log = WriteAheadLog(self.path)
+        db = Database()
+        db.open_log(log)
+        db.create_user(self.user_data)
+        log.close()
+        log = WriteAheadLog(self.path)
+        db = Database()
+        db.open_log(log)
+        user = db.get_user_by_email(self.user_data['email'])
+        user.create_recipe_category(db, {'name': 'cakes'})
+        log.close()
+        operations = [record[0] for record in WriteAheadLog(self.path).replay()]
+        self.assertListEqual(operations, [wal.PUT, wal.PUT, wal.PUT])
+
+    def test_torn_last_record_is_ignored(self):
+        """A partial record left by a crash does not stop the replay"""
+        log = WriteAheadLog(self.path)
+        db = Database()
+        db.open_log(log)
+        db.create_user(self.user_data)
+        log.close()
+        with open(self.path, 'a') as log_file:
+            log_file.write('["p","User",{"key":')
+        restored = Database()
+        restored.open_log(WriteAheadLog(self.path))
+        self.assertIsNotNone(restored.get_user_by_email(
+            self.user_data['email']))
+        # corruption in the middle of the log is an error
+        with open(self.path, 'a') as log_file:
+            log_file.write('\n["p","User",{}]\n')
+        self.assertRaises(ValueError, list, WriteAheadLog(self.path).replay())
+
+    def test_fsync_policies(self):
+        """Each policy syncs as often as it promises"""
+        log = WriteAheadLog(self.path, fsync_policy=wal.FSYNC_ALWAYS)
+        for _ in range(3):
+            log.append([wal.DELETE, 'User', 1])
+        self.assertEqual(log.syncs, 3)
+        log.close()
+        log = WriteAheadLog(self.path, fsync_policy=wal.FSYNC_GROUP,
+                            group_size=2)
+        for _ in range(5):
+            log.append([wal.DELETE, 'User', 1])
+        self.assertEqual(log.syncs, 2)
+        log.close()
+        self.assertEqual(log.syncs, 3)
+        log = WriteAheadLog(self.path, fsync_policy=wal.FSYNC_PERIODIC,
+                            interval=60)
+        log.append([wal.DELETE, 'User', 1])
+        self.assertEqual(log.syncs, 0)
+        log.close()
+        self.assertEqual(log.syncs, 1)
+        self.assertEqual(len(list(log.replay())), 9)
+        self.assertRaises(ValueError, WriteAheadLog, self.path, 'sometimes')
+
+    def test_truncate(self):
+        """The log can be emptied"""
+        log = WriteAheadLog(self.path)
+        log.append([wal.DELETE, 'User', 1])
+        log.truncate()
+        log.append([wal.DELETE, 'User', 2])
+        log.close()
+        self.assertListEqual(list(log.replay()), [[wal.DELETE, 'User', 2]])
+
+
+if __name__ == '__main__':
+    unittest.main()